@@ -0,0 +1,289 @@
+"""
+Benchmark for checkout throughput through the sales API.
+Each checkout creates a sale for a random basket with a partial payment, pays off the balance
+with add-payment and, for a share of the sales, processes a refund of one line. Baskets draw
+from a small set of hot SKUs with the given probability, so several workers fight over the
+same inventory rows. Requests go through the DRF test client in this process, or with
+--server through HTTP to a local daphne server started on the same database.
+Reports p50/p95/p99 latency, throughput and (in-process only) queries per request, and
+can write the results as JSON to compare runs across commits. Works on SQLite and
+PostgreSQL; SQLite allows one writer at a time, so it defaults to one worker and reports
+"database is locked" errors above that. The test data it creates is removed afterwards.
+
+Usage: python bench_checkout.py [--checkouts 500] [--workers 8] [--basket 5] [--skus 500]
+                                [--hot-skus 5] [--contention 0.2] [--return-rate 0.1]
+                                [--server] [--json results.json]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pos_project.settings')
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from pos_app.models import (
+    DocumentSequence, Inventory, LoyaltyTransaction, Payment, Product, Return, ReturnLine, Sale, SaleLine, Warehouse,
+)
+
+ENDPOINTS = ('create_sale', 'add_payment', 'process_return')
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class InProcessTransport:
+    """DRF test client per thread; also counts the queries of every request"""
+
+    def __init__(self, token):
+        self.token = token
+        self.local = threading.local()
+
+    def post(self, path, payload):
+        if not hasattr(self.local, 'client'):
+            self.local.client = APIClient(SERVER_NAME='localhost')
+            self.local.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.local.client.post(path, payload, format='json')
+        body = response.json() if response.content else {}
+        return response.status_code, body, len(queries)
+
+    def close(self):
+        pass
+
+
+class ServerTransport:
+    """HTTP session per thread against a daphne server started for the run"""
+
+    def __init__(self, token):
+        import requests
+
+        self.requests = requests
+        self.token = token
+        self.local = threading.local()
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(self.port), 'pos_project.asgi:application'],
+            cwd=BASE_DIR, env=os.environ.copy(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    self.close()
+                    raise RuntimeError('daphne did not start; is it installed?')
+                time.sleep(0.2)
+
+    def post(self, path, payload):
+        if not hasattr(self.local, 'session'):
+            self.local.session = self.requests.Session()
+            self.local.session.headers['Authorization'] = f'Bearer {self.token}'
+        response = self.local.session.post(f'http://127.0.0.1:{self.port}{path}', json=payload)
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        return response.status_code, body, None
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+
+def basket(rng, products, hot, size, contention):
+    picked = {}
+    for _ in range(size):
+        product = rng.choice(hot) if hot and rng.random() < contention else rng.choice(products)
+        picked[product.pk] = (product, picked.get(product.pk, (product, 0))[1] + 1)
+    return [
+        {'product_id': product.pk, 'quantity': quantity, 'unit_price': float(product.price)}
+        for product, quantity in picked.values()
+    ]
+
+
+def checkout(transport, context, seed, record):
+    rng = random.Random(seed)
+    items = basket(rng, context['products'], context['hot'], context['basket'], context['contention'])
+    subtotal = sum(Decimal(str(item['unit_price'])) * item['quantity'] for item in items)
+    deposit = (subtotal / 2).quantize(Decimal('0.01'))
+
+    def timed(endpoint, path, payload):
+        started = time.perf_counter()
+        try:
+            status, body, queries = transport.post(path, payload)
+        except Exception as e:
+            status, body, queries = None, {'error': repr(e)}, None
+        failure = None if status and 200 <= status < 300 else str(body.get('error', body) if isinstance(body, dict) else body)[:200]
+        record(endpoint, (time.perf_counter() - started) * 1000, status, queries, failure)
+        return status, body
+
+    status, sale = timed('create_sale', '/api/v1/sales/create/', {
+        'cashier_id': context['user'].pk, 'warehouse_id': context['warehouse'].pk, 'items': items,
+        'payments': [{'method': 'cash', 'amount': float(deposit)}],
+    })
+    if status != 201:
+        return
+    status, _ = timed('add_payment', f"/api/v1/sales/{sale['id']}/add-payment/", {
+        'method': 'card', 'amount': str(sale['balance_due']),
+    })
+    if status != 200 or rng.random() >= context['return_rate']:
+        return
+
+    # The return itself is set up outside the timing; only processing it is measured
+    line = SaleLine.objects.filter(sale_id=sale['id']).order_by('id').first()
+    return_obj = Return.objects.create(
+        original_sale_id=sale['id'], status='approved', reason='Benchmark', total_amount=line.unit_price,
+        refund_amount=line.unit_price,
+    )
+    ReturnLine.objects.create(
+        return_obj=return_obj, original_line=line, product_id=line.product_id, variant_id=line.variant_id,
+        quantity=1, unit_price=line.unit_price, total_price=line.unit_price,
+    )
+    timed('process_return', f'/api/v1/returns/{return_obj.pk}/process/', {
+        'action': 'refund', 'refund_method': 'cash', 'warehouse_id': context['warehouse'].pk,
+    })
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    # The views log every sale at error level and Django every 4xx; keep the report readable
+    for name in ('pos_app', 'django.request'):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+    suffix = uuid.uuid4().hex[:8].upper()
+    rng = random.Random(args.seed)
+    user = User.objects.create_user(username=f'bench-{suffix}', password=uuid.uuid4().hex)
+    warehouse = Warehouse.objects.create(name=f'Bench {suffix}', location='Bench')
+    products = Product.objects.bulk_create([
+        Product(name=f'Bench {suffix} {i}', sku=f'BENCH-{suffix}-{i}', price=Decimal(rng.randint(100, 2000)) / 100)
+        for i in range(args.skus)
+    ])
+    Inventory.objects.bulk_create([
+        Inventory(product=product, warehouse=warehouse, qty_on_hand=1_000_000) for product in products
+    ])
+    context = {
+        'user': user, 'warehouse': warehouse, 'products': products, 'hot': products[:args.hot_skus],
+        'basket': args.basket, 'contention': args.contention, 'return_rate': args.return_rate,
+    }
+    token = str(RefreshToken.for_user(user).access_token)
+    transport = None
+    try:
+        transport = ServerTransport(token) if args.server else InProcessTransport(token)
+        lock = threading.Lock()
+        samples = {endpoint: [] for endpoint in ENDPOINTS}
+
+        def record(endpoint, elapsed, status, queries, failure):
+            with lock:
+                samples[endpoint].append((elapsed, queries, failure))
+
+        for i in range(args.warmup):
+            checkout(transport, context, -args.seed * 1_000_003 - i - 1, lambda *_: None)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for future in [
+                pool.submit(checkout, transport, context, args.seed * 1_000_003 + i, record) for i in range(args.checkouts)
+            ]:
+                future.result()
+        wall = time.perf_counter() - started
+
+        results = {
+            'commit': current_commit(), 'database': connection.vendor,
+            'transport': 'server' if args.server else 'in-process', 'settings': vars(args),
+            'wall_seconds': round(wall, 3), 'endpoints': {},
+        }
+        completed = sum(1 for _, _, failure in samples['add_payment'] if failure is None)
+        results['checkouts_per_second'] = round(completed / wall, 1)
+        results['requests_per_second'] = round(sum(len(rows) for rows in samples.values()) / wall, 1)
+
+        print(f"Checkout benchmark: {args.checkouts} checkouts, {args.workers} workers, basket {args.basket}, "
+              f"{args.hot_skus} hot SKUs at {args.contention:.0%}, {results['transport']} on {connection.vendor}")
+        for endpoint, rows in samples.items():
+            timings = sorted(elapsed for elapsed, _, _ in rows)
+            queries = [count for _, count, _ in rows if count is not None]
+            failures = [failure for _, _, failure in rows if failure is not None]
+            stats = {
+                'requests': len(rows), 'errors': len(failures), 'error_samples': sorted(set(failures))[:3],
+                'p50_ms': percentile(timings, 0.50), 'p95_ms': percentile(timings, 0.95),
+                'p99_ms': percentile(timings, 0.99), 'per_second': round(len(rows) / wall, 1),
+                'queries_per_request': round(sum(queries) / len(queries), 1) if queries else None,
+            }
+            results['endpoints'][endpoint] = {
+                key: round(value, 2) if isinstance(value, float) else value for key, value in stats.items()
+            }
+            if rows:
+                print(f"  {endpoint:<15} {len(rows):>6} requests, {stats['errors']} errors, "
+                      f"p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms"
+                      + (f", {stats['queries_per_request']} queries" if queries else ""))
+                for failure in stats['error_samples']:
+                    print(f"    error: {failure}")
+        print(f"  throughput {results['checkouts_per_second']} checkouts/s, "
+              f"{results['requests_per_second']} requests/s over {wall:.2f} s")
+
+        if args.json:
+            with open(args.json, 'w') as output:
+                json.dump(results, output, indent=2)
+            print(f"  results written to {args.json}")
+        return completed == args.checkouts
+    finally:
+        if transport:
+            transport.close()
+        sales = Sale.objects.filter(warehouse=warehouse)
+        Return.objects.filter(original_sale__in=sales).delete()
+        LoyaltyTransaction.objects.filter(sale__in=sales).delete()
+        Payment.objects.filter(sale__in=sales).delete()
+        SaleLine.objects.filter(sale__in=sales).delete()
+        sales.delete()
+        Inventory.objects.filter(warehouse=warehouse).delete()
+        DocumentSequence.objects.filter(warehouse=warehouse).delete()
+        Product.objects.filter(pk__in=[product.pk for product in products]).delete()
+        warehouse.delete()
+        user.delete()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--checkouts', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=None, help='Concurrent checkouts (default: 8, 1 on SQLite)')
+    parser.add_argument('--basket', type=int, default=5, help='Lines drawn per basket')
+    parser.add_argument('--skus', type=int, default=500)
+    parser.add_argument('--hot-skus', type=int, default=5, help='Size of the contended SKU set')
+    parser.add_argument('--contention', type=float, default=0.2, help='Chance that a line is a hot SKU')
+    parser.add_argument('--return-rate', type=float, default=0.1, help='Share of checkouts that get a refund')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--server', action='store_true', help='Go through HTTP to a local daphne server')
+    parser.add_argument('--json', metavar='PATH', help='Write the results to this file')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    args.workers = args.workers or (1 if connection.vendor == 'sqlite' else 8)
+    sys.exit(0 if run(args) else 1)
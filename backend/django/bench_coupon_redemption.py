@@ -0,0 +1,103 @@
+"""
+Load test for concurrent coupon redemption.
+Fires concurrent redemptions at one coupon from a thread pool released through a barrier,
+then checks that the coupon was never oversubscribed: successful redemptions, the coupon's
+used_count and the stored redemption rows must all agree and stay within max_usage_count.
+With --per-customer the coupon is limited to one use per customer and the attempts are
+spread over a smaller set of customers. Run it against the production database engine;
+the test data it creates is removed afterwards.
+
+Usage: python bench_coupon_redemption.py [--attempts 500] [--limit 100] [--per-customer 50]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pos_project.settings')
+django.setup()
+
+from django.core.exceptions import ValidationError
+from django.db import OperationalError, connection
+from django.utils import timezone
+
+from pos_app.models import Coupon, CouponRedemption, Customer
+from pos_app.services import CouponRedemptionService
+
+
+def redeem(code, customer, barrier):
+    barrier.wait()
+    started = time.perf_counter()
+    try:
+        CouponRedemptionService.redeem(code, customer=customer)
+        outcome = 'redeemed'
+    except ValidationError:
+        outcome = 'rejected'
+    except OperationalError:
+        # e.g. SQLite giving up on its database lock; never counts as a redemption
+        outcome = 'error'
+    finally:
+        connection.close()
+    return outcome, (time.perf_counter() - started) * 1000
+
+
+def run(attempts, limit, customers, workers):
+    suffix = uuid.uuid4().hex[:8].upper()
+    now = timezone.now()
+    coupon = Coupon.objects.create(
+        code=f'LOAD-{suffix}', coupon_type='fixed_amount', discount_value=Decimal('1.00'),
+        start_date=now - timedelta(minutes=1), end_date=now + timedelta(hours=1),
+        max_usage_count=limit, is_limited_to_customer=bool(customers),
+    )
+    people = [
+        Customer.objects.create(first_name='Load', last_name=f'Test {i}', email=f'load-{suffix}-{i}@example.com')
+        for i in range(customers)
+    ]
+    try:
+        barrier = threading.Barrier(min(workers, attempts))
+        with ThreadPoolExecutor(max_workers=min(workers, attempts)) as pool:
+            futures = [
+                pool.submit(redeem, coupon.code, people[i % customers] if customers else None, barrier)
+                for i in range(attempts)
+            ]
+            results = [future.result() for future in futures]
+
+        coupon.refresh_from_db()
+        outcomes = [outcome for outcome, _ in results]
+        timings = sorted(timing for _, timing in results)
+        redeemed = outcomes.count('redeemed')
+        rows = CouponRedemption.objects.filter(coupon=coupon, status='committed').count()
+        expected_max = min(limit, customers) if customers else limit
+        duplicates = (
+            rows - CouponRedemption.objects.filter(coupon=coupon, status='committed').values('customer').distinct().count()
+            if customers else 0
+        )
+
+        print(f"Coupon redemption: {attempts} concurrent attempts, limit {limit}"
+              + (f", one use per customer over {customers} customers" if customers else ""))
+        print(f"  redeemed {redeemed}, rejected {outcomes.count('rejected')}, errors {outcomes.count('error')}")
+        print(f"  used_count {coupon.used_count}, committed rows {rows}, duplicate customers {duplicates}")
+        print(f"  latency p50 {timings[len(timings) // 2]:.1f} ms, max {timings[-1]:.1f} ms")
+        ok = redeemed == coupon.used_count == rows and redeemed <= expected_max and duplicates == 0
+        print(f"  oversubscription: {'none' if ok else 'DETECTED'}")
+        return ok
+    finally:
+        coupon.delete()
+        Customer.objects.filter(pk__in=[person.pk for person in people]).delete()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--attempts', type=int, default=500)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--per-customer', type=int, default=0, metavar='CUSTOMERS')
+    parser.add_argument('--workers', type=int, default=500)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.attempts, args.limit, args.per_customer, args.workers) else 1)
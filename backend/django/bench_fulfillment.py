@@ -0,0 +1,63 @@
+"""
+Benchmark for the multi-warehouse fulfillment planner.
+Plans 100-line orders over 200 warehouses with randomised (seeded) stock and locations
+and reports planning latency. Only the in-memory planning step is timed; loading
+availability is a single grouped query regardless of order size.
+
+Usage: python bench_fulfillment.py [--lines 100] [--warehouses 200] [--runs 200]
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pos_project.settings')
+django.setup()
+
+from pos_app.services import FulfillmentPlanner
+
+
+def build_dataset(lines, warehouses, seed):
+    rng = random.Random(seed)
+    demand = {(product_id, None): rng.randint(1, 5) for product_id in range(1, lines + 1)}
+    availability = {}
+    coordinates = {}
+    for warehouse_id in range(1, warehouses + 1):
+        coordinates[warehouse_id] = (rng.uniform(3.0, 15.0), rng.uniform(33.0, 48.0))
+        # Each warehouse stocks a random ~30% of the catalog
+        availability[warehouse_id] = {
+            key: rng.randint(0, 8) for key in demand if rng.random() < 0.3
+        }
+    origin = (rng.uniform(3.0, 15.0), rng.uniform(33.0, 48.0))
+    return demand, availability, coordinates, origin
+
+
+def run(lines, warehouses, runs, seed):
+    timings = []
+    shipments = []
+    for run_index in range(runs):
+        demand, availability, coordinates, origin = build_dataset(lines, warehouses, seed + run_index)
+        started = time.perf_counter()
+        plan = FulfillmentPlanner.plan_from_availability(demand, availability, coordinates, origin)
+        timings.append((time.perf_counter() - started) * 1000)
+        shipments.append(plan['warehouse_count'])
+
+    timings.sort()
+    print(f"Fulfillment planner: {lines} lines x {warehouses} warehouses, {runs} runs")
+    print(f"  p50 {statistics.median(timings):.2f} ms")
+    print(f"  p95 {timings[int(len(timings) * 0.95) - 1]:.2f} ms")
+    print(f"  max {timings[-1]:.2f} ms")
+    print(f"  shipments per order: mean {statistics.mean(shipments):.1f}, max {max(shipments)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=100)
+    parser.add_argument('--warehouses', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    run(args.lines, args.warehouses, args.runs, args.seed)
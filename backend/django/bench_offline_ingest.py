@@ -0,0 +1,104 @@
+"""
+Benchmark for replaying an offline terminal backlog through batch sale ingestion.
+Builds a backlog of client-stamped sales over a small catalog, ingests it in batches the way
+the service worker sends it, then replays the whole backlog again to time the duplicate path.
+Every sale must be created exactly once and the stock posted must equal the units sold.
+Run it against the production database engine; the test data it creates is removed afterwards.
+
+Usage: python bench_offline_ingest.py [--sales 2000] [--batch 500] [--lines 3] [--products 200]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pos_project.settings')
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db.models import Sum
+
+from pos_app.models import Inventory, LoyaltyTransaction, Payment, Product, Sale, SaleLine, Warehouse
+from pos_app.services import OfflineSaleIngestService
+
+
+def build_backlog(sales, lines, products, warehouse, terminal, seed):
+    rng = random.Random(seed)
+    backlog = []
+    for sequence in range(1, sales + 1):
+        items = [
+            {'product_id': product.pk, 'quantity': rng.randint(1, 3), 'unit_price': str(product.price)}
+            for product in rng.sample(products, lines)
+        ]
+        total = sum(Decimal(item['unit_price']) * item['quantity'] for item in items) * Decimal('1.10')
+        backlog.append({
+            'client_uuid': str(uuid.uuid4()), 'terminal_id': terminal, 'terminal_sequence': sequence,
+            'warehouse_id': warehouse.pk, 'items': items,
+            'payments': [{'method': 'cash', 'amount': str(total.quantize(Decimal('0.01')))}],
+        })
+    return backlog
+
+
+def replay(backlog, batch, user):
+    started = time.perf_counter()
+    outcomes = {}
+    for start in range(0, len(backlog), batch):
+        for result in OfflineSaleIngestService.ingest(backlog[start:start + batch], user=user):
+            outcomes[result['status']] = outcomes.get(result['status'], 0) + 1
+    return time.perf_counter() - started, outcomes
+
+
+def run(sales, batch, lines, product_count, seed):
+    suffix = uuid.uuid4().hex[:8].upper()
+    user = User.objects.create_user(username=f'bench-{suffix}', password=uuid.uuid4().hex)
+    warehouse = Warehouse.objects.create(name=f'Bench {suffix}', location='Bench')
+    products = Product.objects.bulk_create([
+        Product(name=f'Bench {suffix} {i}', sku=f'BENCH-{suffix}-{i}', price=Decimal(random.Random(i).randint(100, 2000)) / 100)
+        for i in range(product_count)
+    ])
+    Inventory.objects.bulk_create([
+        Inventory(product=product, warehouse=warehouse, qty_on_hand=1_000_000) for product in products
+    ])
+    try:
+        backlog = build_backlog(sales, lines, products, warehouse, f'BENCH-{suffix}', seed)
+        first, created = replay(backlog, batch, user)
+        second, repeated = replay(backlog, batch, user)
+
+        stored = Sale.objects.filter(warehouse=warehouse).count()
+        sold = sum(item['quantity'] for sale in backlog for item in sale['items'])
+        posted = 1_000_000 * product_count - Inventory.objects.filter(warehouse=warehouse).aggregate(
+            total=Sum('qty_on_hand'))['total']
+
+        print(f"Offline sale ingestion: {sales} sales x {lines} lines in batches of {batch}")
+        print(f"  first replay  {first:.2f} s ({sales / first:.0f} sales/s) {created}")
+        print(f"  second replay {second:.2f} s ({sales / second:.0f} sales/s) {repeated}")
+        print(f"  stored sales {stored}, units sold {sold}, units posted {posted}")
+        ok = stored == sales == created.get('created', 0) == repeated.get('duplicate', 0) and sold == posted
+        print(f"  consistency: {'ok' if ok else 'MISMATCH'}")
+        return ok
+    finally:
+        sales_qs = Sale.objects.filter(warehouse=warehouse)
+        LoyaltyTransaction.objects.filter(sale__in=sales_qs).delete()
+        Payment.objects.filter(sale__in=sales_qs).delete()
+        SaleLine.objects.filter(sale__in=sales_qs).delete()
+        sales_qs.delete()
+        Inventory.objects.filter(warehouse=warehouse).delete()
+        Product.objects.filter(pk__in=[product.pk for product in products]).delete()
+        warehouse.delete()
+        user.delete()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sales', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=OfflineSaleIngestService.MAX_BATCH_SIZE)
+    parser.add_argument('--lines', type=int, default=3)
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.sales, args.batch, args.lines, args.products, args.seed) else 1)
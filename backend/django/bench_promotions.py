@@ -0,0 +1,109 @@
+"""
+Benchmark for the basket promotion solver.
+Prices 50-line baskets against 200 active promotions (line discounts, buy X get Y and
+bundles) built in memory with a seeded generator, and reports solver latency against a
+budget. Only the in-memory allocation is timed; loading the promotion index and the
+basket's products are a fixed number of queries regardless of basket size.
+
+Usage: python bench_promotions.py [--lines 50] [--promotions 200] [--bundles 8] [--runs 500] [--budget-ms 5]
+"""
+import argparse
+import gc
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pos_project.settings')
+django.setup()
+
+from django.utils import timezone
+
+from pos_app.services import BasketPromotionSolver, IndexedPromotion, PromotionIndex
+
+CATALOG_SIZE = 500
+CATEGORY_COUNT = 20
+
+
+def build_index(promotions, seed):
+    rng = random.Random(seed)
+    built = []
+    for promotion_id in range(1, promotions + 1):
+        kind = rng.choices(['percentage', 'fixed_amount', 'buy_x_get_y', 'bundle'], weights=[4, 2, 2, 2])[0]
+        row = {
+            'id': promotion_id, 'name': f'Promotion {promotion_id}', 'promotion_type': kind,
+            'discount_value': Decimal(rng.randint(1, 30)), 'buy_quantity': rng.randint(1, 3),
+            'get_quantity': 1, 'min_order_value': Decimal(rng.choice([0, 0, 0, 50])),
+        }
+        relations = {}
+        if kind == 'bundle':
+            relations['required_products'] = rng.sample(range(1, CATALOG_SIZE + 1), rng.randint(2, 3))
+            if rng.random() < 0.5:
+                relations['bonus_products'] = [rng.randint(1, CATALOG_SIZE)]
+        elif rng.random() < 0.7:
+            relations['products'] = rng.sample(range(1, CATALOG_SIZE + 1), rng.randint(1, 25))
+        elif rng.random() < 0.8:
+            relations['categories'] = [rng.randint(1, CATEGORY_COUNT)]
+        built.append(IndexedPromotion(row, **relations))
+    index = PromotionIndex(built, timezone.now() + timedelta(hours=1))
+    index.bundles = [promotion for promotion in built if promotion.promotion_type == 'bundle']
+    return index
+
+
+def build_basket(lines, index, rng, bundles):
+    # Complete a few bundles in every basket so the solver has real conflicts to resolve
+    products = set()
+    for promotion in rng.sample(index.bundles, min(len(index.bundles), bundles)):
+        products |= promotion.required_products | promotion.bonus_products
+    while len(products) < lines:
+        products.add(rng.randint(1, CATALOG_SIZE))
+    return [
+        {
+            'product_id': product_id, 'category_id': product_id % CATEGORY_COUNT + 1,
+            'quantity': rng.randint(1, 6), 'unit_price': Decimal(rng.randint(100, 5000)) / 100,
+        }
+        for product_id in products
+    ]
+
+
+def run(lines, promotions, runs, budget_ms, seed, bundles):
+    index = build_index(promotions, seed)
+    rng = random.Random(seed)
+    # Keep full collections of the Django heap loaded at setup out of the timings
+    gc.collect()
+    gc.freeze()
+    timings = []
+    exact = 0
+    for _ in range(runs):
+        basket = build_basket(lines, index, rng, bundles)
+        started = time.perf_counter()
+        solution = BasketPromotionSolver(basket, index).solve()
+        timings.append((time.perf_counter() - started) * 1000)
+        exact += solution['exact']
+
+    timings.sort()
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"Basket promotion solver: {lines} lines x {promotions} promotions, {bundles} complete bundles, {runs} runs")
+    print(f"  p50 {statistics.median(timings):.2f} ms")
+    print(f"  p95 {p95:.2f} ms")
+    print(f"  max {timings[-1]:.2f} ms")
+    print(f"  solved exactly: {exact}/{runs}")
+    print(f"  budget {budget_ms:.2f} ms at p95: {'ok' if p95 <= budget_ms else 'EXCEEDED'}")
+    return p95 <= budget_ms
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=50)
+    parser.add_argument('--promotions', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=500)
+    parser.add_argument('--budget-ms', type=float, default=5.0)
+    parser.add_argument('--bundles', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.lines, args.promotions, args.runs, args.budget_ms, args.seed, args.bundles) else 1)
@@ -14,6 +14,7 @@ from .models import (
     Location,
     Bin,
     Inventory,
+    DemandForecast,
     Customer,
     
     # Sales & Orders
@@ -32,6 +33,12 @@ from .models import (
     # Promotions
     Promotion,
     Coupon,
+    CouponCampaign,
+    CouponRedemption,
+    LoyaltyTransaction,
+    IdempotencyKey,
+    DocumentSequence,
+    StockSummary,
     
     # Purchasing
     PurchaseOrder,
@@ -128,6 +135,27 @@ class InventoryAdmin(admin.ModelAdmin):
     available_stock.short_description = 'Available Stock'
 
 
+@admin.register(StockSummary)
+class StockSummaryAdmin(admin.ModelAdmin):
+    # Maintained by database triggers on the inventory table
+    list_display = ['product', 'variant', 'warehouse', 'on_hand', 'reserved', 'available']
+    list_filter = ['warehouse']
+    search_fields = ['product__name', 'product__sku', 'warehouse__name']
+    readonly_fields = ['product', 'variant', 'warehouse', 'on_hand', 'reserved', 'available']
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(DemandForecast)
+class DemandForecastAdmin(admin.ModelAdmin):
+    list_display = ['product', 'warehouse', 'smoothed_daily', 'days_of_cover', 'suggested_min_level', 'computed_through']
+    list_filter = ['warehouse', 'computed_through']
+    search_fields = ['product__name', 'product__sku', 'warehouse__name']
+    raw_id_fields = ['product', 'variant', 'warehouse']
+    readonly_fields = ['updated_at']
+
+
 @admin.register(Customer)
 class CustomerAdmin(admin.ModelAdmin):
     list_display = ['first_name', 'last_name', 'email', 'phone', 'loyalty_points', 'store_credit', 'is_active']
@@ -211,6 +239,47 @@ class CouponAdmin(admin.ModelAdmin):
     raw_id_fields = ['promotion']
 
 
+@admin.register(CouponCampaign)
+class CouponCampaignAdmin(admin.ModelAdmin):
+    list_display = ['name', 'prefix', 'quantity', 'coupon_type', 'discount_value', 'start_date', 'end_date', 'created_at']
+    list_filter = ['coupon_type', 'is_limited_to_customer', 'created_at']
+    search_fields = ['name', 'prefix']
+    raw_id_fields = ['promotion', 'created_by']
+
+
+@admin.register(CouponRedemption)
+class CouponRedemptionAdmin(admin.ModelAdmin):
+    list_display = ['coupon', 'customer', 'sale', 'status', 'created_at', 'expires_at']
+    list_filter = ['status', 'once_per_customer']
+    search_fields = ['coupon__code', 'customer__first_name', 'customer__last_name', 'customer__email']
+    raw_id_fields = ['coupon', 'customer', 'sale']
+
+
+@admin.register(LoyaltyTransaction)
+class LoyaltyTransactionAdmin(admin.ModelAdmin):
+    list_display = ['customer', 'transaction_type', 'points', 'sale', 'created_at', 'expires_at']
+    list_filter = ['transaction_type']
+    search_fields = ['customer__first_name', 'customer__last_name', 'customer__email', 'reason']
+    raw_id_fields = ['customer', 'sale', 'created_by']
+
+
+@admin.register(IdempotencyKey)
+class IdempotencyKeyAdmin(admin.ModelAdmin):
+    list_display = ['key', 'user', 'status_code', 'created_at', 'expires_at']
+    list_filter = ['status_code']
+    search_fields = ['key', 'user__username']
+    raw_id_fields = ['user']
+    exclude = ['response_body']
+
+
+@admin.register(DocumentSequence)
+class DocumentSequenceAdmin(admin.ModelAdmin):
+    list_display = ['warehouse', 'document_type', 'next_number']
+    list_filter = ['document_type']
+    search_fields = ['warehouse__name']
+    raw_id_fields = ['warehouse']
+
+
 # Inline for Purchase Order Lines
 class PurchaseOrderLineInline(admin.TabularInline):
     model = PurchaseOrderLine
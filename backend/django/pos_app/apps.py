@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class PosAppConfig(AppConfig):
@@ -6,4 +7,20 @@ class PosAppConfig(AppConfig):
     name = 'pos_app'
 
     def ready(self):
-        import pos_app.signals  # noqa
\ No newline at end of file
+        import pos_app.signals  # noqa
+        from django.db.models.signals import post_migrate
+
+        # Warehouse stock totals are kept by database triggers; (re)create them after migrations
+        post_migrate.connect(install_stock_summary_triggers, sender=self)
+
+        # Optional in-process reservation expiry sweeper (seconds between sweeps).
+        # Deployments with a scheduler should run `manage.py expire_reservations` instead.
+        interval = getattr(settings, 'RESERVATION_SWEEP_INTERVAL', None)
+        if interval:
+            from pos_app.services import ReservationExpiryService
+            ReservationExpiryService.start_periodic(interval)
+
+
+def install_stock_summary_triggers(using='default', **kwargs):
+    from pos_app.services import StockSummaryService
+    StockSummaryService.install_triggers(using=using)
@@ -3,6 +3,7 @@ import json
 from django.core.management.base import BaseCommand, CommandError
 from django.core.files.base import ContentFile
 from pos_app.models import Product, Category
+from pos_app.services import ProductExportService, ProductImportService
 import requests
 from io import StringIO
 from datetime import datetime
@@ -13,7 +14,12 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('action', type=str, help='Action: import or export')
         parser.add_argument('--file', type=str, help='Path to the CSV file for import/export')
-        parser.add_argument('--format', type=str, default='csv', help='File format: csv or json')
+        parser.add_argument('--format', type=str, default='csv', help='File format: csv or json (jsonl and xlsx are also accepted for export, jsonl for --dry-run)')
+        parser.add_argument('--dry-run', action='store_true', help='Validate the import file and preview changes without writing anything')
+        parser.add_argument('--columns', type=str, help='Comma-separated list of columns to export')
+        parser.add_argument('--category', type=str, help='Only export products in this category')
+        parser.add_argument('--active-only', action='store_true', help='Only export active products')
+        parser.add_argument('--gzip', action='store_true', help='Gzip the export on the fly (csv, json and jsonl only)')
 
     def handle(self, *args, **options):
         action = options['action']
@@ -23,11 +29,18 @@ class Command(BaseCommand):
         if action == 'import':
             if not file_path:
                 raise CommandError('File path is required for import')
-            self.import_products(file_path, file_format)
+            if options['dry_run']:
+                self.validate_products(file_path, file_format)
+            else:
+                self.import_products(file_path, file_format)
         elif action == 'export':
             if not file_path:
                 raise CommandError('File path is required for export')
-            self.export_products(file_path, file_format)
+            filters = {
+                'category': options['category'],
+                'is_active': True if options['active_only'] else None,
+            }
+            self.export_products(file_path, file_format, options['columns'], filters, options['gzip'])
         else:
             raise CommandError("Action must be 'import' or 'export'")
 
@@ -40,16 +53,59 @@ class Command(BaseCommand):
         else:
             raise CommandError(f"Unsupported format: {file_format}")
 
-    def export_products(self, file_path, file_format):
-        """Export products to a CSV/JSON file"""
-        products = Product.objects.all()
-        
-        if file_format.lower() == 'csv':
-            self.export_csv(products, file_path)
-        elif file_format.lower() == 'json':
-            self.export_json(products, file_path)
+    def validate_products(self, file_path, file_format):
+        """Validate a CSV/JSON file and print a diff preview without writing to the database"""
+        try:
+            with open(file_path, 'r', encoding='utf-8', newline='') as file:
+                report = ProductImportService.dry_run(
+                    ProductImportService.iter_rows(file, file_format)
+                )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            f"Validated {report['total_rows']} rows in {report['duration_ms']} ms: "
+            f"{report['created']} to create, {report['updated']} to update, "
+            f"{report['unchanged']} unchanged, {report['invalid_rows']} invalid"
+        )
+        for field, count in sorted(report['field_change_counts'].items()):
+            self.stdout.write(f'  {field}: {count} changes')
+        for change in report['changes']:
+            fields = ', '.join(
+                f"{field} {values['old']!r} -> {values['new']!r}"
+                for field, values in change['changes'].items()
+            )
+            self.stdout.write(f"  Row {change['row']} (SKU: {change['sku']}): {fields}")
+        for error in report['errors']:
+            self.stdout.write(
+                self.style.ERROR(f"Error on row {error['row']}: {'; '.join(error['errors'])}")
+            )
+
+        if report['invalid_rows']:
+            self.stdout.write(self.style.WARNING('Dry run finished with errors; nothing was written'))
         else:
-            raise CommandError(f"Unsupported format: {file_format}")
+            self.stdout.write(self.style.SUCCESS('Dry run finished; nothing was written'))
+
+    def export_products(self, file_path, file_format, columns=None, filters=None, compress=False):
+        """Stream products to a CSV/JSON/JSONL/XLSX file in constant memory"""
+        file_format = file_format.lower()
+        try:
+            if file_format == 'xlsx':
+                if compress:
+                    raise CommandError('--gzip is not supported for xlsx exports')
+                with open(file_path, 'wb') as file:
+                    count = ProductExportService.write_xlsx(file, columns, filters)
+            else:
+                with open(file_path, 'wb') as file:
+                    for chunk in ProductExportService.stream(file_format, columns, filters, compress):
+                        file.write(chunk)
+                count = ProductExportService.get_queryset(filters).count()
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Successfully exported {count} products to {file_path}')
+        )
 
     def import_csv(self, file_path):
         """Import products from a CSV file"""
@@ -85,7 +141,7 @@ class Command(BaseCommand):
                             'cost_price': row.get('cost_price') or None,
                             'min_wholesale_qty': row.get('min_wholesale_qty') or 1,
                             'tags': tags,
-                            'is_active': row.get('is_active', 'true').lower() == 'true'
+                            'is_active': ProductImportService.parse_is_active(row.get('is_active'))
                         }
                     )
                     
@@ -100,7 +156,7 @@ class Command(BaseCommand):
                         product.cost_price = row.get('cost_price') or None
                         product.min_wholesale_qty = row.get('min_wholesale_qty') or 1
                         product.tags = tags
-                        product.is_active = row.get('is_active', 'true').lower() == 'true'
+                        product.is_active = ProductImportService.parse_is_active(row.get('is_active'))
                         product.save()
                     
                     self.stdout.write(
@@ -143,7 +199,7 @@ class Command(BaseCommand):
                             'cost_price': item.get('cost_price') or None,
                             'min_wholesale_qty': item.get('min_wholesale_qty') or 1,
                             'tags': item.get('tags', ''),
-                            'is_active': item.get('is_active', True)
+                            'is_active': ProductImportService.parse_is_active(item.get('is_active'))
                         }
                     )
                     
@@ -158,7 +214,7 @@ class Command(BaseCommand):
                         product.cost_price = item.get('cost_price') or None
                         product.min_wholesale_qty = item.get('min_wholesale_qty') or 1
                         product.tags = item.get('tags', '')
-                        product.is_active = item.get('is_active', True)
+                        product.is_active = ProductImportService.parse_is_active(item.get('is_active'))
                         product.save()
                     
                     self.stdout.write(
@@ -169,63 +225,3 @@ class Command(BaseCommand):
                     self.stdout.write(
                         self.style.ERROR(f'Error importing product {item.get("name", "Unknown")}: {str(e)}')
                     )
-
-    def export_csv(self, products, file_path):
-        """Export products to a CSV file"""
-        with open(file_path, 'w', newline='', encoding='utf-8') as file:
-            fieldnames = [
-                'name', 'sku', 'barcode', 'description', 'category', 
-                'price', 'wholesale_price', 'cost_price', 'min_wholesale_qty',
-                'effective_date', 'tags', 'is_active'
-            ]
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            
-            for product in products:
-                writer.writerow({
-                    'name': product.name,
-                    'sku': product.sku,
-                    'barcode': product.barcode or '',
-                    'description': product.description,
-                    'category': product.category.name if product.category else '',
-                    'price': product.price,
-                    'wholesale_price': product.wholesale_price or '',
-                    'cost_price': product.cost_price or '',
-                    'min_wholesale_qty': product.min_wholesale_qty,
-                    'effective_date': product.effective_date,
-                    'tags': product.tags,
-                    'is_active': product.is_active
-                })
-        
-        self.stdout.write(
-            self.style.SUCCESS(f'Successfully exported {products.count()} products to {file_path}')
-        )
-
-    def export_json(self, products, file_path):
-        """Export products to a JSON file"""
-        products_data = []
-        for product in products:
-            products_data.append({
-                'name': product.name,
-                'sku': product.sku,
-                'barcode': product.barcode,
-                'description': product.description,
-                'category': product.category.name if product.category else None,
-                'price': float(product.price),
-                'wholesale_price': float(product.wholesale_price) if product.wholesale_price else None,
-                'cost_price': float(product.cost_price) if product.cost_price else None,
-                'min_wholesale_qty': product.min_wholesale_qty,
-                'effective_date': product.effective_date.isoformat(),
-                'image': str(product.image) if product.image else None,
-                'tags': product.tags,
-                'is_active': product.is_active,
-                'created_at': product.created_at.isoformat(),
-                'updated_at': product.updated_at.isoformat()
-            })
-        
-        with open(file_path, 'w', encoding='utf-8') as file:
-            json.dump(products_data, file, indent=2, ensure_ascii=False)
-        
-        self.stdout.write(
-            self.style.SUCCESS(f'Successfully exported {len(products_data)} products to {file_path}')
-        )
\ No newline at end of file
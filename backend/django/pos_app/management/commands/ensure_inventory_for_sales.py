@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
-from pos_app.models import Product, Warehouse, Inventory, ProductVariant
-from django.db import transaction
+
+from pos_app.services import InventoryBootstrapService
 
 
 class Command(BaseCommand):
@@ -13,61 +13,56 @@ class Command(BaseCommand):
             default=100,
             help='Quantity to set for newly created inventory records (default: 100)'
         )
+        parser.add_argument(
+            '--min-stock',
+            type=int,
+            default=10,
+            help='Minimum stock level for newly created inventory records (default: 10)'
+        )
+        parser.add_argument(
+            '--warehouse',
+            type=int,
+            action='append',
+            dest='warehouses',
+            help='Only create records in this warehouse id (can be repeated)'
+        )
+        parser.add_argument(
+            '--category',
+            type=int,
+            action='append',
+            dest='categories',
+            help='Only create records for products in this category id (can be repeated)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=InventoryBootstrapService.BATCH_SIZE,
+            help=f'Records inserted per statement (default: {InventoryBootstrapService.BATCH_SIZE})'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count the records that would be created'
+        )
 
     def handle(self, *args, **options):
-        qty = options['qty']
-        products = Product.objects.all()
-        warehouses = Warehouse.objects.all()
+        filters = {'warehouse_ids': options['warehouses'], 'category_ids': options['categories']}
 
-        created_count = 0
-        
-        for product in products:
-            for warehouse in warehouses:
-                # Check for all variants of the product
-                variants = ProductVariant.objects.filter(product=product)
-                
-                # Create inventory for base product (no variant)
-                # Use get_or_create with additional constraints to avoid conflicts
-                inventory, created = Inventory.objects.get_or_create(
-                    product=product,
-                    warehouse=warehouse,
-                    variant=None,
-                    location=None,
-                    bin=None,
-                    defaults={
-                        'qty_on_hand': qty,
-                        'qty_reserved': 0,
-                        'min_stock_level': 10
-                    }
-                )
-                if created:
-                    created_count += 1
-                    self.stdout.write(
-                        f'Created inventory: Product {product.id} in Warehouse {warehouse.id} (no variant)'
-                    )
-                
-                # Create inventory for each variant of the product
-                for variant in variants:
-                    variant_inventory, variant_created = Inventory.objects.get_or_create(
-                        product=product,
-                        warehouse=warehouse,
-                        variant=variant,
-                        location=None,
-                        bin=None,
-                        defaults={
-                            'qty_on_hand': qty,
-                            'qty_reserved': 0,
-                            'min_stock_level': 10
-                        }
-                    )
-                    if variant_created:
-                        created_count += 1
-                        self.stdout.write(
-                            f'Created inventory: Product {product.id} Variant {variant.id} in Warehouse {warehouse.id}'
-                        )
+        if options['dry_run']:
+            missing = InventoryBootstrapService.count_missing(**filters)
+            for warehouse_id, count in missing.items():
+                self.stdout.write(f'Warehouse {warehouse_id}: {count} inventory records missing')
+            self.stdout.write(
+                self.style.WARNING(f'Dry run: would create {sum(missing.values())} new inventory records.')
+            )
+            return
 
+        created_count = InventoryBootstrapService.ensure(
+            qty_on_hand=options['qty'], min_stock_level=options['min_stock'],
+            batch_size=options['batch_size'], **filters,
+        )
         self.stdout.write(
             self.style.SUCCESS(
                 f'Successfully ensured inventory records. Created {created_count} new inventory records.'
             )
-        )
\ No newline at end of file
+        )
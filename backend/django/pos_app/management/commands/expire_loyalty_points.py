@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from pos_app.services import LoyaltyService
+
+
+class Command(BaseCommand):
+    help = 'Expire lapsed loyalty points for all customers in set-based batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--as-of', type=str, help='Expire points lapsed by this ISO datetime (default: now)')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would expire without writing')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        if options['as_of']:
+            now = parse_datetime(options['as_of'])
+            if now is None:
+                raise CommandError('--as-of must be an ISO datetime')
+            if timezone.is_naive(now):
+                now = timezone.make_aware(now)
+
+        summary = LoyaltyService.expire(now=now, dry_run=options['dry_run'])
+        verb = 'Would expire' if options['dry_run'] else 'Expired'
+        self.stdout.write(
+            self.style.SUCCESS(f"{verb} {summary['points']} loyalty points for {summary['customers']} customers")
+        )
@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from pos_app.services import CouponRedemptionService, IdempotencyStore, ReservationExpiryService
+
+
+class Command(BaseCommand):
+    help = 'Cancel expired active reservations, releasing the stock and coupon uses they were holding, and purge expired idempotency keys'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=ReservationExpiryService.BATCH_SIZE,
+            help=f'Number of reservations expired per transaction (default: {ReservationExpiryService.BATCH_SIZE})'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be expired without changing anything'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=0,
+            help='Keep running and sweep every N seconds (default: run once)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        interval = options['interval']
+
+        while True:
+            summary = ReservationExpiryService.sweep(batch_size=batch_size, dry_run=dry_run)
+            prefix = 'Would expire' if dry_run else 'Expired'
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{prefix} {summary['expired_reservations']} reservations, "
+                    f"releasing {summary['released_units']} reserved units"
+                    + ('' if dry_run else f" across {summary['inventory_rows']} inventory rows")
+                )
+            )
+            if not dry_run:
+                released = CouponRedemptionService.release_expired()
+                if released:
+                    self.stdout.write(self.style.SUCCESS(f"Released {released} abandoned coupon reservations"))
+                purged = IdempotencyStore.purge_expired()
+                if purged:
+                    self.stdout.write(self.style.SUCCESS(f"Purged {purged} expired idempotency keys"))
+            if not interval:
+                break
+            time.sleep(interval)
@@ -0,0 +1,512 @@
+"""
+Generate a seeded, reproducible synthetic dataset at benchmark scale.
+
+Builds warehouses with location/bin trees, a catalog with variants and skewed (Zipf) demand,
+customers, cashiers, stock and transfers, then sales with lines, payments, returns and audit
+rows spread over a date range with weekly and yearly seasonality.
+
+Every day of sales is drawn from its own random stream seeded by (--seed, day), so the same
+seed always produces the same dataset and days can be generated in any order. The row counts
+of each day are known before anything is written, which lets the command hand out primary keys
+up front and write date shards from parallel processes. Rows are written straight to their
+tables (COPY on PostgreSQL, batched INSERTs elsewhere), bypassing save() and signals.
+"""
+import math
+import multiprocessing
+import os
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, connections, models, transaction
+from django.utils import timezone
+
+from pos_app.models import (
+    AuditLog, Bin, Category, Customer, Inventory, Location, Payment, Product, ProductVariant, Return,
+    ReturnLine, Sale, SaleLine, Transfer, TransferLine, UserProfile, Warehouse,
+)
+
+CATEGORIES = [
+    "Electronics", "Clothing", "Food & Beverages", "Home & Garden", "Beauty",
+    "Sports", "Books", "Toys", "Automotive", "Health",
+]
+VARIANT_OPTIONS = (('S', 'M', 'L', 'XL'), ('Black', 'White', 'Red', 'Blue'))
+WEEKDAY_FACTORS = (0.85, 0.9, 0.95, 1.0, 1.15, 1.35, 1.1)
+# Sales per hour of the day: quiet nights, a lunch peak and a larger evening peak
+HOUR_WEIGHTS = (1, 1, 1, 1, 1, 2, 4, 8, 12, 14, 16, 22, 26, 20, 16, 15, 18, 24, 28, 24, 16, 8, 4, 2)
+PAYMENT_METHODS = ('cash', 'card', 'mobile')
+PAYMENT_WEIGHTS = (0.45, 0.35, 0.2)
+RETURN_REASONS = ('Damaged', 'Wrong size', 'Changed mind', 'Not as described')
+TAX_RATE = Decimal('0.10')
+CENT = Decimal('0.01')
+MAX_LINES = 8
+RETURN_RATE = 0.02
+SPLIT_PAYMENT_RATE = 0.08
+CUSTOMER_SHARE = 0.4
+DISCOUNT_RATE = 0.05
+SHARDS_PER_WORKER = 4
+
+# Catalog the sales of a process are drawn from; set before generate_shard() runs
+_catalog = None
+
+
+def insert_rows(model, rows, using='default'):
+    """
+    Write row dicts keyed by field attname straight to the model's table.
+    Unset fields take their default, unset auto_now/auto_now_add fields the current time.
+    """
+    if not rows:
+        return
+    db = connections[using]
+    now = timezone.now()
+    fields = model._meta.concrete_fields
+    defaults = [
+        now if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False) else field.get_default()
+        for field in fields
+    ]
+    prepare = [isinstance(field, (models.DateTimeField, models.JSONField)) for field in fields]
+    values = []
+    for row in rows:
+        record = []
+        for field, default, prepared in zip(fields, defaults, prepare):
+            value = row.get(field.attname, default)
+            record.append(field.get_db_prep_save(value, db) if prepared and value is not None else value)
+        values.append(record)
+
+    table = db.ops.quote_name(model._meta.db_table)
+    columns = ', '.join(db.ops.quote_name(field.column) for field in fields)
+    with db.cursor() as cursor:
+        if db.vendor == 'postgresql':
+            with cursor.cursor.copy(f"COPY {table} ({columns}) FROM STDIN") as copy:
+                for record in values:
+                    copy.write_row(record)
+        else:
+            placeholders = ', '.join(['%s'] * len(fields))
+            cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", values)
+
+
+def next_id(model):
+    return (model.objects.aggregate(top=models.Max('pk'))['top'] or 0) + 1
+
+
+def cumulative(weights):
+    import numpy as np
+    return np.cumsum(np.asarray(weights, dtype=float))
+
+
+def draw(rng, cumulative_weights, size):
+    """
+    Draw `size` indexes with probabilities proportional to the weights behind `cumulative_weights`
+    """
+    import numpy as np
+    return np.searchsorted(cumulative_weights, rng.random(size) * cumulative_weights[-1], side='right')
+
+
+def daily_sales(seed, days, total):
+    """
+    Split `total` sales over the days by weekday, a December peak and some day-to-day noise
+    """
+    import numpy as np
+
+    rng = np.random.default_rng([seed, 0])
+    weights = np.array([
+        WEEKDAY_FACTORS[day.weekday()] * (1 + 0.25 * math.cos(2 * math.pi * (day.timetuple().tm_yday - 355) / 365.25))
+        for day in days
+    ]) * rng.lognormal(0, 0.1, len(days))
+    # Rounding the running total keeps the sum exact
+    running = np.rint(np.cumsum(weights) / weights.sum() * total).astype(int)
+    return np.diff(running, prepend=0).tolist()
+
+
+def sale_shapes(seed, day, count):
+    """
+    Per sale of a day: the number of lines, the number of payments and whether it gets a return.
+    Drawn from their own stream, so row counts can be planned without generating the rows.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng([seed, day.toordinal(), 0])
+    lines = np.minimum(rng.geometric(0.45, count), MAX_LINES)
+    payments = 1 + (rng.random(count) < SPLIT_PAYMENT_RATE)
+    returned = rng.random(count) < RETURN_RATE
+    return lines, payments, returned
+
+
+def build_day(catalog, day, count, ids):
+    """
+    Generate the rows of one day of sales, numbered from the first ids in `ids`
+    """
+    import numpy as np
+
+    seed, prefix = catalog['seed'], catalog['prefix']
+    lines_per_sale, payments_per_sale, returned = (shape.tolist() for shape in sale_shapes(seed, day, count))
+    rng = np.random.default_rng([seed, day.toordinal(), 1])
+    line_count = sum(lines_per_sale)
+    products = draw(rng, catalog['popularity'], line_count).tolist()
+    variant_picks = rng.integers(0, 1 << 30, line_count).tolist()
+    quantities = (1 + rng.poisson(0.35, line_count)).tolist()
+    discounted = (rng.random(line_count) < DISCOUNT_RATE).tolist()
+    warehouses = draw(rng, catalog['warehouse_weights'], count).tolist()
+    cashier_picks = rng.integers(0, 1 << 30, count).tolist()
+    with_customer = (rng.random(count) < CUSTOMER_SHARE).tolist()
+    customer_picks = rng.integers(0, max(1, len(catalog['customer_ids'])), count).tolist()
+    # Sorted so sale ids follow the time of day
+    seconds = np.sort(draw(rng, cumulative(HOUR_WEIGHTS), count) * 3600 + rng.integers(0, 3600, count)).tolist()
+    methods = draw(rng, cumulative(PAYMENT_WEIGHTS), sum(payments_per_sale)).tolist()
+    split_shares = rng.uniform(0.2, 0.8, count).tolist()
+    return_delays = rng.integers(1, 15, count).tolist()
+    return_picks = rng.integers(0, 1 << 30, count).tolist()
+
+    midnight = timezone.make_aware(datetime(day.year, day.month, day.day))
+    sales, lines, payments, returns, return_lines, audit = [], [], [], [], [], []
+    line_index = payment_index = 0
+    for index in range(count):
+        sale_id = ids['sale'] + index
+        at = midnight + timedelta(seconds=seconds[index])
+        warehouse = warehouses[index]
+        cashiers = catalog['cashiers'][warehouse]
+        cashier_id = cashiers[cashier_picks[index] % len(cashiers)]
+        customer_id = catalog['customer_ids'][customer_picks[index]] if with_customer[index] and catalog['customer_ids'] else None
+
+        subtotal = discount = Decimal('0')
+        sale_lines = []
+        for position in range(line_index, line_index + lines_per_sale[index]):
+            product = products[position]
+            variants = catalog['variants'][product]
+            variant_id, extra = variants[variant_picks[position] % len(variants)] if variants else (None, Decimal('0'))
+            unit_price = catalog['prices'][product] + extra
+            gross = unit_price * quantities[position]
+            percent = Decimal('10') if discounted[position] else Decimal('0')
+            cut = (gross * percent / 100).quantize(CENT)
+            subtotal += gross - cut
+            discount += cut
+            sale_lines.append({
+                'id': ids['line'] + position, 'sale_id': sale_id, 'product_id': catalog['product_ids'][product],
+                'variant_id': variant_id, 'quantity': quantities[position], 'unit_price': unit_price,
+                'total_price': gross - cut, 'discount_percent': percent, 'cost_price': catalog['costs'][product],
+            })
+        line_index += lines_per_sale[index]
+        lines.extend(sale_lines)
+
+        tax = (subtotal * TAX_RATE).quantize(CENT)
+        total = subtotal + tax
+        amounts = [total]
+        if payments_per_sale[index] == 2:
+            first = (total * Decimal(str(round(split_shares[index], 2)))).quantize(CENT)
+            amounts = [first, total - first]
+        for amount in amounts:
+            payments.append({
+                'id': ids['payment'] + payment_index, 'sale_id': sale_id,
+                'payment_method': PAYMENT_METHODS[methods[payment_index]], 'amount': amount, 'paid_at': at,
+            })
+            payment_index += 1
+
+        refunded = Decimal('0')
+        if returned[index]:
+            line = sale_lines[return_picks[index] % len(sale_lines)]
+            refunded = (line['total_price'] / line['quantity'] * (1 + TAX_RATE)).quantize(CENT)
+            return_id = ids['return'] + len(returns)
+            returned_at = at + timedelta(days=return_delays[index])
+            returns.append({
+                'id': return_id, 'return_number': f'{prefix}-RET-{return_id}', 'original_sale_id': sale_id,
+                'customer_id': customer_id, 'status': 'processed', 'reason': RETURN_REASONS[return_picks[index] % len(RETURN_REASONS)],
+                'total_amount': refunded, 'refund_amount': refunded, 'refunded_at': returned_at,
+                'processed_by_id': cashier_id, 'processed_at': returned_at, 'created_at': returned_at,
+                'updated_at': returned_at, 'is_locked': True, 'locked_at': returned_at, 'original_total': refunded,
+            })
+            return_lines.append({
+                'id': ids['return_line'] + len(return_lines), 'return_obj_id': return_id, 'original_line_id': line['id'],
+                'product_id': line['product_id'], 'variant_id': line['variant_id'], 'quantity': 1,
+                'unit_price': line['unit_price'], 'total_price': refunded, 'is_returned': True,
+            })
+
+        receipt = f'{prefix}-RCT-{sale_id}'
+        sales.append({
+            'id': sale_id, 'receipt_number': receipt, 'cashier_id': cashier_id, 'customer_id': customer_id,
+            'warehouse_id': catalog['warehouse_ids'][warehouse], 'total_amount': total, 'tax_amount': tax,
+            'discount_amount': discount, 'payment_status': 'completed', 'sale_date': at, 'completed_at': at,
+            'is_locked': True, 'locked_at': at, 'original_total': total, 'amount_paid': total,
+            'amount_refunded': refunded, 'balance_due': Decimal('0'),
+        })
+        audit.append({
+            'id': ids['audit'] + len(audit), 'user_id': cashier_id, 'action': 'create', 'object_type': 'Sale',
+            'object_id': sale_id, 'object_repr': receipt, 'new_values': {'total_amount': str(total)}, 'timestamp': at,
+        })
+
+    for row in returns:
+        audit.append({
+            'id': ids['audit'] + len(audit), 'user_id': row['processed_by_id'], 'action': 'return', 'object_type': 'Return',
+            'object_id': row['id'], 'object_repr': row['return_number'],
+            'new_values': {'refund_amount': str(row['refund_amount'])}, 'timestamp': row['created_at'],
+        })
+    return [(Sale, sales), (SaleLine, lines), (Payment, payments), (Return, returns), (ReturnLine, return_lines), (AuditLog, audit)]
+
+
+def start_worker(catalog):
+    global _catalog
+    _catalog = catalog
+
+
+def generate_shard(days):
+    """
+    Write the sales of a list of (day, count, ids) entries, one transaction per day.
+    Returns the number of sales written.
+    """
+    for day, count, ids in days:
+        tables = build_day(_catalog, day, count, ids)
+        with transaction.atomic():
+            for model, rows in tables:
+                insert_rows(model, rows)
+    return sum(count for _, count, _ in days)
+
+
+class Command(BaseCommand):
+    help = 'Generate a seeded synthetic dataset (catalog, stock, sales, returns, transfers) for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--warehouses', type=int, default=10, help='Number of warehouses (default: 10)')
+        parser.add_argument('--locations', type=int, default=4, help='Locations per warehouse (default: 4)')
+        parser.add_argument('--bins', type=int, default=5, help='Bins per location (default: 5)')
+        parser.add_argument('--cashiers', type=int, default=3, help='Cashiers per warehouse (default: 3)')
+        parser.add_argument('--products', type=int, default=2000, help='Number of products (default: 2000)')
+        parser.add_argument('--variant-share', type=float, default=0.2,
+                            help='Share of products that come in variants (default: 0.2)')
+        parser.add_argument('--customers', type=int, default=5000, help='Number of customers (default: 5000)')
+        parser.add_argument('--sales', type=int, default=100000, help='Number of sales over the whole range (default: 100000)')
+        parser.add_argument('--start', type=date.fromisoformat, help='First sales day, YYYY-MM-DD (default: a year before --end)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last sales day, YYYY-MM-DD (default: yesterday)')
+        parser.add_argument('--transfers-per-week', type=int, default=None,
+                            help='Completed transfers per week (default: half the number of warehouses)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes writing sales (default: CPU count on PostgreSQL, 1 elsewhere)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+        parser.add_argument('--prefix', default='SYN', help='Prefix of generated names, SKUs and document numbers (default: SYN)')
+
+    def handle(self, *args, **options):
+        import numpy as np
+
+        end = options['end'] or timezone.localdate() - timedelta(days=1)
+        start = options['start'] or end - timedelta(days=364)
+        if start > end:
+            raise CommandError('--start must not be after --end')
+        if min(options['warehouses'], options['locations'], options['bins'], options['cashiers'], options['products']) < 1:
+            raise CommandError('--warehouses, --locations, --bins, --cashiers and --products must be at least 1')
+        prefix = options['prefix']
+        if Product.objects.filter(sku__startswith=f'{prefix}-').exists():
+            raise CommandError(f'A dataset with prefix {prefix} already exists; choose another --prefix')
+        workers = options['workers'] or (os.cpu_count() if connection.vendor == 'postgresql' else 1)
+        if workers > 1 and connection.vendor != 'postgresql':
+            self.stdout.write(self.style.WARNING(f'{connection.vendor} allows one writer at a time; using 1 worker'))
+            workers = 1
+
+        started = time.perf_counter()
+        rng = np.random.default_rng([options['seed'], 1])
+        catalog = {'seed': options['seed'], 'prefix': prefix}
+        with transaction.atomic():
+            self.create_sites(rng, catalog, options)
+            self.create_catalog(rng, catalog, options)
+            self.create_stock(rng, catalog)
+            transfers = self.create_transfers(rng, catalog, start, end, options)
+        self.stdout.write(
+            f"Created {options['warehouses']} warehouses, {len(catalog['product_ids'])} products, "
+            f"{len(catalog['customer_ids'])} customers and {transfers} transfers "
+            f"in {time.perf_counter() - started:.1f} s"
+        )
+
+        started = time.perf_counter()
+        written = self.create_sales(catalog, start, end, options['sales'], workers)
+        elapsed = time.perf_counter() - started
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [
+                Inventory, Transfer, TransferLine, Sale, SaleLine, Payment, Return, ReturnLine, AuditLog,
+            ]):
+                cursor.execute(sql)
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {written} sales from {start} to {end} with {workers} workers "
+            f"in {elapsed:.1f} s ({written / max(elapsed, 1e-9):.0f} sales/s)"
+        ))
+
+    def create_sites(self, rng, catalog, options):
+        from django.contrib.auth.models import User
+
+        prefix = catalog['prefix']
+        warehouses = Warehouse.objects.bulk_create([
+            Warehouse(
+                name=f'{prefix} Site {number:03d}', location=f'Synthetic site {number}',
+                warehouse_type='distribution_center' if number % 10 == 0 else 'store',
+                capacity=int(rng.integers(5000, 50000)),
+                latitude=Decimal(str(round(rng.uniform(3.0, 15.0), 6))),
+                longitude=Decimal(str(round(rng.uniform(33.0, 48.0), 6))),
+            )
+            for number in range(1, options['warehouses'] + 1)
+        ])
+        locations = Location.objects.bulk_create([
+            Location(name=f'Aisle {aisle}', code=f'A{aisle:02d}', warehouse=warehouse)
+            for warehouse in warehouses for aisle in range(1, options['locations'] + 1)
+        ])
+        bins = Bin.objects.bulk_create([
+            Bin(name=f'Shelf {shelf}', code=f'{location.code}-{shelf:02d}', location=location)
+            for location in locations for shelf in range(1, options['bins'] + 1)
+        ])
+        users = User.objects.bulk_create([
+            User(username=f'{prefix.lower()}-cashier-{warehouse.pk}-{number}', password='!', first_name='Cashier')
+            for warehouse in warehouses for number in range(1, options['cashiers'] + 1)
+        ])
+        UserProfile.objects.bulk_create([UserProfile(user=user, role='cashier') for user in users])
+        customers = Customer.objects.bulk_create([
+            Customer(first_name='Customer', last_name=str(number), email=f'{prefix.lower()}.{number}@example.com')
+            for number in range(1, options['customers'] + 1)
+        ], batch_size=2000)
+
+        catalog['warehouse_ids'] = [warehouse.pk for warehouse in warehouses]
+        # Busier and quieter stores; distribution centres sell little
+        catalog['warehouse_weights'] = cumulative([
+            rng.lognormal(0, 0.5) * (0.1 if warehouse.warehouse_type == 'distribution_center' else 1)
+            for warehouse in warehouses
+        ])
+        catalog['cashiers'] = [
+            [user.pk for user in users[index * options['cashiers']:(index + 1) * options['cashiers']]]
+            for index in range(len(warehouses))
+        ]
+        catalog['bins'] = {}
+        for bin in bins:
+            catalog['bins'].setdefault(bin.location.warehouse_id, []).append((bin.location_id, bin.pk))
+        catalog['customer_ids'] = [customer.pk for customer in customers]
+
+    def create_catalog(self, rng, catalog, options):
+        prefix = catalog['prefix']
+        categories = [Category.objects.get_or_create(name=name)[0] for name in CATEGORIES]
+        prices = [max(Decimal('0.50'), Decimal(str(round(rng.lognormal(2.7, 0.8), 2)))) for _ in range(options['products'])]
+        costs = [(price * Decimal(str(round(rng.uniform(0.55, 0.8), 2)))).quantize(CENT) for price in prices]
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'{prefix} Product {number:06d}', sku=f'{prefix}-{number:06d}',
+                category=categories[int(rng.integers(0, len(categories)))], price=price, cost_price=cost,
+            )
+            for number, price, cost in zip(range(1, options['products'] + 1), prices, costs)
+        ], batch_size=2000)
+
+        variants = []
+        for product in products:
+            if rng.random() < options['variant_share']:
+                values = VARIANT_OPTIONS[int(rng.integers(0, len(VARIANT_OPTIONS)))]
+                variants.extend(
+                    ProductVariant(product=product, name=value, sku=f'{product.sku}-{value.upper()}',
+                                   additional_price=Decimal(position) * Decimal('0.50'))
+                    for position, value in enumerate(values)
+                )
+        variants = ProductVariant.objects.bulk_create(variants, batch_size=2000)
+        by_product = {}
+        for variant in variants:
+            by_product.setdefault(variant.product_id, []).append((variant.pk, variant.additional_price))
+
+        # Zipf demand over a shuffled ranking, so bestsellers are spread over the categories
+        ranks = rng.permutation(len(products)) + 1
+        catalog['popularity'] = cumulative(1 / ranks.astype(float) ** 1.1)
+        catalog['product_ids'] = [product.pk for product in products]
+        catalog['prices'] = prices
+        catalog['costs'] = costs
+        catalog['variants'] = [by_product.get(product.pk, []) for product in products]
+
+    def create_stock(self, rng, catalog):
+        rows = []
+        inventory_id = next_id(Inventory)
+        for warehouse_id in catalog['warehouse_ids']:
+            slots = catalog['bins'][warehouse_id]
+            for product_id, variants in zip(catalog['product_ids'], catalog['variants']):
+                for variant_id, _ in variants or [(None, None)]:
+                    location_id, bin_id = slots[int(rng.integers(0, len(slots)))]
+                    rows.append({
+                        'id': inventory_id, 'product_id': product_id, 'variant_id': variant_id,
+                        'warehouse_id': warehouse_id, 'location_id': location_id, 'bin_id': bin_id,
+                        'qty_on_hand': int(rng.lognormal(3.5, 1.0)), 'min_stock_level': 10,
+                    })
+                    inventory_id += 1
+        insert_rows(Inventory, rows)
+
+    def create_transfers(self, rng, catalog, start, end, options):
+        warehouse_ids = catalog['warehouse_ids']
+        if len(warehouse_ids) < 2:
+            return 0
+        per_week = options['transfers_per_week']
+        if per_week is None:
+            per_week = max(1, len(warehouse_ids) // 2)
+        count = per_week * ((end - start).days + 1) // 7
+        transfers, lines = [], []
+        transfer_id, line_id = next_id(Transfer), next_id(TransferLine)
+        for offset in sorted(rng.integers(0, (end - start).days + 1, count).tolist()):
+            requested = timezone.make_aware(datetime.combine(start + timedelta(days=offset), datetime.min.time())) + timedelta(
+                seconds=int(rng.integers(8 * 3600, 18 * 3600))
+            )
+            received = requested + timedelta(days=int(rng.integers(1, 5)))
+            source, destination = rng.choice(len(warehouse_ids), 2, replace=False).tolist()
+            transfers.append({
+                'id': transfer_id, 'transfer_number': f"{catalog['prefix']}-TRF-{transfer_id}",
+                'from_warehouse_id': warehouse_ids[source], 'to_warehouse_id': warehouse_ids[destination],
+                'requested_by_id': catalog['cashiers'][source][0], 'approved_by_id': catalog['cashiers'][destination][0],
+                'status': 'received', 'requested_at': requested, 'approved_at': requested, 'received_at': received,
+                'completed_at': received,
+            })
+            for product in draw(rng, catalog['popularity'], int(rng.integers(1, 5))).tolist():
+                variants = catalog['variants'][product]
+                quantity = int(rng.integers(5, 50))
+                lines.append({
+                    'id': line_id, 'transfer_id': transfer_id, 'product_id': catalog['product_ids'][product],
+                    'variant_id': variants[int(rng.integers(0, len(variants)))][0] if variants else None,
+                    'requested_qty': quantity, 'transferred_qty': quantity, 'received_qty': quantity,
+                })
+                line_id += 1
+            transfer_id += 1
+        insert_rows(Transfer, transfers)
+        insert_rows(TransferLine, lines)
+        return len(transfers)
+
+    def create_sales(self, catalog, start, end, total, workers):
+        days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+        ids = {
+            'sale': next_id(Sale), 'line': next_id(SaleLine), 'payment': next_id(Payment),
+            'return': next_id(Return), 'return_line': next_id(ReturnLine), 'audit': next_id(AuditLog),
+        }
+        planned = []
+        for day, count in zip(days, daily_sales(catalog['seed'], days, total)):
+            if not count:
+                continue
+            planned.append((day, count, dict(ids)))
+            lines, payments, returned = sale_shapes(catalog['seed'], day, count)
+            returns = int(returned.sum())
+            ids['sale'] += count
+            ids['line'] += int(lines.sum())
+            ids['payment'] += int(payments.sum())
+            ids['return'] += returns
+            ids['return_line'] += returns
+            ids['audit'] += count + returns
+
+        # Contiguous date shards of about the same number of sales
+        shard_size = max(1, math.ceil(total / (workers * SHARDS_PER_WORKER)))
+        shards, current, size = [], [], 0
+        for entry in planned:
+            current.append(entry)
+            size += entry[1]
+            if size >= shard_size:
+                shards.append(current)
+                current, size = [], 0
+        if current:
+            shards.append(current)
+
+        written = 0
+        if workers == 1:
+            start_worker(catalog)
+            for shard in shards:
+                written += generate_shard(shard)
+                self.stdout.write(f'  {written}/{total} sales')
+            return written
+
+        # Forked workers must not share the parent's connection
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers, initializer=start_worker, initargs=(catalog,)) as pool:
+            for count in pool.imap_unordered(generate_shard, shards):
+                written += count
+                self.stdout.write(f'  {written}/{total} sales')
+        return written
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from pos_app.services import LoyaltyService
+
+
+class Command(BaseCommand):
+    help = 'Check that customer loyalty balances equal the sum of their ledger entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Reset drifted balances to their ledger sums')
+
+    def handle(self, *args, **options):
+        drifted = LoyaltyService.reconcile(fix=options['fix'])
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('All loyalty balances match the ledger'))
+            return
+
+        for customer_id, balance, ledger_total in drifted:
+            self.stdout.write(f"Customer {customer_id}: balance {balance}, ledger {ledger_total}")
+        if options['fix']:
+            self.stdout.write(self.style.SUCCESS(f"Reset {len(drifted)} balances to their ledger sums"))
+        else:
+            self.stdout.write(self.style.WARNING(f"{len(drifted)} balances differ from the ledger; rerun with --fix"))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from pos_app.services import ReservedStockReconciler
+
+
+class Command(BaseCommand):
+    help = 'Check that reserved inventory equals the stock held by open sales, reservations and transfers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Reset drifted reservations to what the open documents hold')
+        parser.add_argument('--warehouse', type=int, action='append', dest='warehouses',
+                            help='Only check this warehouse id (can be repeated)')
+        parser.add_argument('--limit', type=int, default=50, help='Number of discrepancies to list (default: 50)')
+
+    def handle(self, *args, **options):
+        drifted = ReservedStockReconciler.reconcile(fix=options['fix'], warehouse_ids=options['warehouses'])
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('All reserved quantities match the open documents'))
+            return
+
+        over = under = unbacked = 0
+        for warehouse_id, product_id, variant_id, expected, reserved, on_hand in drifted:
+            over += max(0, reserved - expected)
+            under += max(0, expected - reserved)
+            unbacked += max(0, expected - on_hand)
+        for warehouse_id, product_id, variant_id, expected, reserved, on_hand in drifted[:options['limit']]:
+            self.stdout.write(
+                f"Warehouse {warehouse_id}, product {product_id}, variant {variant_id or '-'}: "
+                f"reserved {reserved}, open documents {expected}, on hand {on_hand}"
+            )
+        if len(drifted) > options['limit']:
+            self.stdout.write(f"... and {len(drifted) - options['limit']} more")
+
+        self.stdout.write(
+            f"{over} units reserved without an open document, {under} units missing from reservations, "
+            f"{unbacked} units held by documents but not on hand"
+        )
+        if options['fix']:
+            self.stdout.write(self.style.SUCCESS(f"Reset reservations of {len(drifted)} products"))
+        else:
+            self.stdout.write(self.style.WARNING(f"{len(drifted)} reserved quantities differ from the open documents; rerun with --fix"))
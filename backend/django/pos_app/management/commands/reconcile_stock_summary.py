@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from pos_app.services import StockSummaryService
+
+
+class Command(BaseCommand):
+    help = 'Check that warehouse stock summaries equal the totals of their bin-level inventory rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Reset drifted summaries to their bin-level totals')
+
+    def handle(self, *args, **options):
+        if StockSummaryService.install_triggers():
+            self.stdout.write(self.style.WARNING('Stock summary triggers were missing; recreated them and rebuilt the summary'))
+        drifted = StockSummaryService.reconcile(fix=options['fix'])
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('All stock summaries match the inventory rows'))
+            return
+
+        for warehouse_id, product_id, variant_id, on_hand, reserved, summary_on_hand, summary_reserved in drifted:
+            self.stdout.write(
+                f"Warehouse {warehouse_id}, product {product_id}, variant {variant_id or '-'}: "
+                f"bins {on_hand} on hand / {reserved} reserved, summary {summary_on_hand} / {summary_reserved}"
+            )
+        if options['fix']:
+            self.stdout.write(self.style.SUCCESS(f"Reset {len(drifted)} summaries to their bin-level totals"))
+        else:
+            self.stdout.write(self.style.WARNING(f"{len(drifted)} summaries differ from the inventory rows; rerun with --fix"))
@@ -0,0 +1,44 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pos_app.services import DemandForecastService
+
+
+class Command(BaseCommand):
+    help = 'Refresh per warehouse/SKU demand forecasts from completed sales (run nightly)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--as-of',
+            type=str,
+            help='Last day of sales to include, YYYY-MM-DD (default: yesterday)'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Rebuild the smoothed demand from the history window instead of continuing from stored state'
+        )
+        parser.add_argument(
+            '--warehouse',
+            type=int,
+            action='append',
+            help='Only refresh this warehouse id (repeatable)'
+        )
+
+    def handle(self, *args, **options):
+        as_of = None
+        if options['as_of']:
+            try:
+                as_of = date.fromisoformat(options['as_of'])
+            except ValueError:
+                raise CommandError('--as-of must be a date in YYYY-MM-DD format')
+
+        summary = DemandForecastService.refresh(as_of=as_of, full=options['full'], warehouse_ids=options['warehouse'])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Forecasts through {summary['as_of']}: {summary['pairs']} pairs "
+                f"({summary['created']} created, {summary['updated']} updated, {summary['pruned']} pruned) "
+                f"in {summary['duration_ms']} ms"
+            )
+        )
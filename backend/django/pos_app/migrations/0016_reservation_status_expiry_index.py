@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-19 08:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pos_app', '0015_reservation_reservationline'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['status', 'expires_at'], name='reservation_status_expiry_idx'),
+        ),
+    ]
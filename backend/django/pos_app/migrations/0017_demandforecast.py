@@ -0,0 +1,41 @@
+# Generated by Django 4.2 on 2026-10-19 08:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pos_app', '0016_reservation_status_expiry_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DemandForecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('avg_daily_7', models.FloatField(default=0, help_text='Moving average over the last 7 days')),
+                ('avg_daily_28', models.FloatField(default=0, help_text='Moving average over the last 28 days')),
+                ('smoothed_daily', models.FloatField(default=0, help_text='Exponentially smoothed daily demand (carried between runs)')),
+                ('std_daily', models.FloatField(default=0, help_text='Standard deviation of daily demand over the history window')),
+                ('weekday_factors', models.JSONField(blank=True, default=list, help_text='Demand multipliers for Monday..Sunday')),
+                ('available_stock', models.IntegerField(default=0)),
+                ('days_of_cover', models.FloatField(blank=True, help_text='Available stock divided by forecast demand', null=True)),
+                ('suggested_min_level', models.PositiveIntegerField(default=0)),
+                ('computed_through', models.DateField(help_text='Last day of sales included in this forecast')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='demand_forecasts', to='pos_app.product')),
+                ('variant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='demand_forecasts', to='pos_app.productvariant')),
+                ('warehouse', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='demand_forecasts', to='pos_app.warehouse')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='demandforecast',
+            index=models.Index(fields=['warehouse', 'days_of_cover'], name='forecast_wh_cover_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='demandforecast',
+            unique_together={('warehouse', 'product', 'variant')},
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-19 08:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pos_app', '0017_demandforecast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('reserved', 'Reserved'), ('committed', 'Committed'), ('released', 'Released')], default='reserved', max_length=20)),
+                ('once_per_customer', models.BooleanField(default=False)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemptions', to='pos_app.coupon')),
+                ('customer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='coupon_redemptions', to='pos_app.customer')),
+                ('sale', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='coupon_redemptions', to='pos_app.sale')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='couponredemption',
+            index=models.Index(fields=['status', 'expires_at'], name='coupon_redemption_expiry_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='couponredemption',
+            constraint=models.UniqueConstraint(condition=models.Q(('once_per_customer', True), ('status__in', ['reserved', 'committed'])), fields=('coupon', 'customer'), name='coupon_redemption_once_per_customer'),
+        ),
+    ]
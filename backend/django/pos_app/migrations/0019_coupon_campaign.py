@@ -0,0 +1,40 @@
+# Generated by Django 4.2 on 2026-10-19 08:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pos_app', '0018_coupon_redemption'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponCampaign',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('prefix', models.CharField(blank=True, max_length=10)),
+                ('code_length', models.PositiveIntegerField(default=10, help_text='Random characters after the prefix')),
+                ('quantity', models.PositiveIntegerField()),
+                ('coupon_type', models.CharField(choices=[('percentage', 'Percentage Discount'), ('fixed_amount', 'Fixed Amount Discount')], max_length=20)),
+                ('discount_value', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('start_date', models.DateTimeField()),
+                ('end_date', models.DateTimeField()),
+                ('max_uses_per_code', models.PositiveIntegerField(blank=True, default=1, null=True)),
+                ('is_limited_to_customer', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('promotion', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='pos_app.promotion')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='campaign',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='coupons', to='pos_app.couponcampaign'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.2 on 2026-10-19 08:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def open_ledger(apps, schema_editor):
+    """
+    Record each existing balance as an opening adjustment so balances equal ledger sums
+    """
+    Customer = apps.get_model('pos_app', 'Customer')
+    LoyaltyTransaction = apps.get_model('pos_app', 'LoyaltyTransaction')
+    LoyaltyTransaction.objects.bulk_create(
+        [
+            LoyaltyTransaction(customer_id=pk, transaction_type='adjust', points=points, reason='Opening balance')
+            for pk, points in Customer.objects.exclude(loyalty_points=0).values_list('pk', 'loyalty_points').iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pos_app', '0019_coupon_campaign'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoyaltyTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_type', models.CharField(choices=[('earn', 'Earned'), ('redeem', 'Redeemed'), ('expire', 'Expired'), ('adjust', 'Adjustment')], max_length=10)),
+                ('points', models.IntegerField(help_text='Signed change to the balance')),
+                ('expires_at', models.DateTimeField(blank=True, help_text='When earned points lapse if unused', null=True)),
+                ('reason', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='loyalty_transactions', to='pos_app.customer')),
+                ('sale', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='loyalty_transactions', to='pos_app.sale')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='loyaltytransaction',
+            index=models.Index(fields=['customer', 'created_at'], name='loyalty_customer_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loyaltytransaction',
+            index=models.Index(fields=['transaction_type', 'expires_at'], name='loyalty_type_expiry_idx'),
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
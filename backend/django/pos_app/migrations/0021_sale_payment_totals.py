@@ -0,0 +1,54 @@
+# Generated by Django 4.2 on 2026-10-19 08:59
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_payment_totals(apps, schema_editor):
+    """
+    Store each sale's payment totals: positive payments are paid, negative ones refunded
+    """
+    Sale = apps.get_model('pos_app', 'Sale')
+    Payment = apps.get_model('pos_app', 'Payment')
+
+    def total(**filters):
+        sums = Payment.objects.filter(sale=OuterRef('pk'), **filters).values('sale').annotate(
+            total=Sum('amount')
+        ).values('total')
+        return Coalesce(Subquery(sums, output_field=DecimalField()), Value(Decimal('0')))
+
+    Sale.objects.update(amount_paid=total(amount__gt=0), amount_refunded=-total(amount__lt=0))
+    Sale.objects.update(balance_due=F('total_amount') - F('amount_paid'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pos_app', '0020_loyaltytransaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='amount_paid',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='amount_refunded',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='balance_due',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(backfill_payment_totals, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(condition=models.Q(('balance_due__gt', 0)), fields=['balance_due'], name='sale_outstanding_balance_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2 on 2026-10-19 09:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pos_app', '0021_sale_payment_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='client_uuid',
+            field=models.UUIDField(blank=True, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='terminal_id',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='terminal_sequence',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='sale',
+            constraint=models.UniqueConstraint(condition=models.Q(('terminal_sequence__isnull', False)), fields=('terminal_id', 'terminal_sequence'), name='sale_terminal_sequence_unique'),
+        ),
+    ]
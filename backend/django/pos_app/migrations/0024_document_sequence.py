@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-19 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pos_app', '0023_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('document_type', models.CharField(choices=[('sale', 'Sale receipt'), ('exchange', 'Exchange receipt'), ('return', 'Return'), ('transfer', 'Transfer'), ('purchase_order', 'Purchase order'), ('grn', 'Goods received note'), ('reservation', 'Reservation')], max_length=20)),
+                ('next_number', models.PositiveBigIntegerField(default=1)),
+                ('warehouse', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='document_sequences', to='pos_app.warehouse')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='documentsequence',
+            constraint=models.UniqueConstraint(fields=('warehouse', 'document_type'), name='document_sequence_per_warehouse'),
+        ),
+    ]
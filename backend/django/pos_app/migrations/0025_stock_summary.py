@@ -0,0 +1,46 @@
+# Generated by Django 4.2 on 2026-10-19 09:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.functions.comparison
+
+TRIGGER_NAMES = ('pos_app_stock_summary_insert', 'pos_app_stock_summary_update', 'pos_app_stock_summary_delete')
+
+
+def drop_triggers(apps, schema_editor):
+    # The triggers themselves are (re)created after migrate by StockSummaryService.install_triggers
+    for name in TRIGGER_NAMES:
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {name} ON pos_app_inventory")
+        else:
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pos_app', '0024_document_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('on_hand', models.IntegerField(default=0)),
+                ('reserved', models.IntegerField(default=0)),
+                ('available', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_summaries', to='pos_app.product')),
+                ('variant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stock_summaries', to='pos_app.productvariant')),
+                ('warehouse', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_summaries', to='pos_app.warehouse')),
+            ],
+            options={
+                'verbose_name_plural': 'Stock summaries',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='stocksummary',
+            constraint=models.UniqueConstraint(models.F('product'), django.db.models.functions.comparison.Coalesce('variant', models.Value(0)), models.F('warehouse'), name='stock_summary_unique'),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, drop_triggers),
+    ]
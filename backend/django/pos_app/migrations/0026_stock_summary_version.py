@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-19 09:23
+
+from django.db import migrations, models
+
+TRIGGER_NAMES = ('pos_app_stock_summary_insert', 'pos_app_stock_summary_update', 'pos_app_stock_summary_delete')
+
+
+def drop_triggers(apps, schema_editor):
+    # Recreated with the version bump by StockSummaryService.install_triggers after migrate
+    for name in TRIGGER_NAMES:
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {name} ON pos_app_inventory")
+        else:
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pos_app', '0025_stock_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stocksummary',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(drop_triggers, drop_triggers),
+    ]
@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Coalesce, Round
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
@@ -512,6 +514,38 @@ class Inventory(models.Model):
         return queryset
 
 
+class StockSummary(models.Model):
+    """
+    Stock of one product (and variant) in one warehouse, summed over all its locations and bins.
+
+    Rows are maintained by database triggers on the inventory table, in the same transaction as
+    every bin-level change (see StockSummaryService), so "how much can be sold here" is a single
+    indexed lookup. Never write to this table directly.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_summaries')
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, null=True, blank=True,
+                                related_name='stock_summaries')
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.CASCADE, related_name='stock_summaries')
+    on_hand = models.IntegerField(default=0)
+    reserved = models.IntegerField(default=0)
+    # on_hand - reserved; negative only if bin rows already hold more reserved than on hand
+    available = models.IntegerField(default=0)
+    # Bumped by every change, so clients can tell whether stock they looked at has moved
+    version = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Coalesced so that rows without a variant are unique too
+            models.UniqueConstraint(
+                'product', Coalesce('variant', Value(0)), 'warehouse', name='stock_summary_unique',
+            ),
+        ]
+        verbose_name_plural = "Stock summaries"
+
+    def __str__(self):
+        return f"{self.product_id}/{self.variant_id or '-'} @ {self.warehouse_id}: {self.available} available"
+
+
 class Customer(models.Model):
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
@@ -536,30 +570,29 @@ class Customer(models.Model):
         self.clean()
         super().save(*args, **kwargs)
     
-    def earn_loyalty_points(self, points):
+    def earn_loyalty_points(self, points, **kwargs):
         """
-        Add loyalty points to the customer's account
+        Add loyalty points to the customer's account through the loyalty ledger
         """
-        if points > 0:
-            self.loyalty_points += points
-            self.save()
-            return self.loyalty_points
-        else:
-            raise ValidationError("Points to earn must be greater than zero.")
+        from .services import LoyaltyService
+        self.loyalty_points = LoyaltyService.earn(self, points, **kwargs)
+        return self.loyalty_points
     
-    def redeem_loyalty_points(self, points):
+    def redeem_loyalty_points(self, points, **kwargs):
         """
-        Redeem loyalty points from the customer's account
+        Redeem loyalty points from the customer's account through the loyalty ledger
         """
-        if points > 0:
-            if points <= self.loyalty_points:
-                self.loyalty_points -= points
-                self.save()
-                return self.loyalty_points
-            else:
-                raise ValidationError(f"Insufficient loyalty points. Customer has {self.loyalty_points} points, but tried to redeem {points} points.")
-        else:
-            raise ValidationError("Points to redeem must be greater than zero.")
+        from .services import LoyaltyService
+        self.loyalty_points = LoyaltyService.redeem(self, points, **kwargs)
+        return self.loyalty_points
+    
+    def adjust_loyalty_points(self, points, **kwargs):
+        """
+        Correct the customer's balance by a signed amount through the loyalty ledger
+        """
+        from .services import LoyaltyService
+        self.loyalty_points = LoyaltyService.adjust(self, points, **kwargs)
+        return self.loyalty_points
     
     def calculate_loyalty_points_from_purchase(self, purchase_amount):
         """
@@ -601,43 +634,38 @@ class Sale(models.Model):
     locked_at = models.DateTimeField(null=True, blank=True, help_text="When the record was locked for immutability")
     original_total = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True, help_text="Original total amount before any changes (for audit purposes)")
 
+    # Payment totals, maintained by SalePaymentService with F() updates alongside each payment or refund
+    amount_paid = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    amount_refunded = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    balance_due = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    # Stamped by terminals that queue sales offline; the uuid makes replaying a queue idempotent
+    client_uuid = models.UUIDField(null=True, blank=True, unique=True)
+    terminal_id = models.CharField(max_length=64, blank=True)
+    terminal_sequence = models.PositiveBigIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Only unpaid sales are indexed, so "what is still owed" stays cheap as sales pile up
+            models.Index(fields=['balance_due'], name='sale_outstanding_balance_idx', condition=models.Q(balance_due__gt=0)),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['terminal_id', 'terminal_sequence'],
+                condition=models.Q(terminal_sequence__isnull=False),
+                name='sale_terminal_sequence_unique',
+            ),
+        ]
+
     def __str__(self):
         return f"Sale {self.receipt_number}"
     
-    def amount_paid(self):
-        return sum(payment.amount for payment in self.payments.all())
-    
-    def balance_due(self):
-        return self.total_amount - self.amount_paid()
-    
     def update_payment_status(self):
         """
-        Update the payment status based on the amount paid vs total amount
+        Recompute the stored payment totals and status from the sale's payment records
         """
-        amount_paid = self.amount_paid()
-        
-        if amount_paid <= 0:
-            # No payment made yet
-            self.payment_status = 'pending'
-        elif amount_paid >= self.total_amount:
-            # Full payment received
-            self.payment_status = 'completed'
-        elif 0 < amount_paid < self.total_amount:
-            # Partial payment
-            self.payment_status = 'partially_paid'
-        else:
-            # Overpaid scenario (shouldn't happen with proper validation)
-            self.payment_status = 'completed'
-        
-        # Lock the sale record if it's a terminal status to ensure immutability
-        if self.payment_status in ['completed', 'cancelled', 'refunded'] and not self.is_locked:
-            self.is_locked = True
-            self.locked_at = timezone.now()
-            # Store the original total to ensure audit trail
-            if not self.original_total:
-                self.original_total = self.total_amount
-        
-        self.save()
+        from .services import SalePaymentService
+        SalePaymentService.sync(self)
     
     def process_payments(self, payment_data_list):
         """
@@ -647,29 +675,17 @@ class Sale(models.Model):
             payment_data_list: List of payment dictionaries with 'method', 'amount', and optional 'reference'
         """
         from django.db import transaction
+        from .services import SalePaymentService
         
         with transaction.atomic():
-            # Calculate the total amount to be paid
-            total_payment_amount = sum(p['amount'] for p in payment_data_list)
-            
-            # Validate that total payment doesn't exceed the sale total
-            if total_payment_amount > self.total_amount:
-                raise ValidationError(
-                    f"Total payment amount (${total_payment_amount}) exceeds sale total (${self.total_amount})"
-                )
-            
-            # Create payment records
+            # Each payment is checked against the stored balance in the same UPDATE that applies it
             for payment_data in payment_data_list:
-                Payment.objects.create(
-                    sale=self,
-                    payment_method=payment_data['method'],
-                    amount=payment_data['amount'],
+                SalePaymentService.record(
+                    self,
+                    payment_data['amount'],
+                    payment_data['method'],
                     reference=payment_data.get('reference', ''),
-                    # Note: paid_at will default to current time
                 )
-            
-            # Update payment status
-            self.update_payment_status()
     
     def clean(self):
         if self.total_amount <= 0:
@@ -722,6 +738,10 @@ class Sale(models.Model):
         if self.pk:  # If this is an existing object
             old_sale = Sale.objects.get(pk=self.pk)
             old_status = old_sale.payment_status
+            # Payment totals only change through SalePaymentService; never write back stale copies
+            self.amount_paid = old_sale.amount_paid
+            self.amount_refunded = old_sale.amount_refunded
+        self.balance_due = self.total_amount - self.amount_paid
         
         is_new = self.pk is None
         will_reserve_stock = getattr(settings, 'AUTO_RESERVE_SALE_STOCK', True)
@@ -739,125 +759,59 @@ class Sale(models.Model):
         
         # Handle stock reservation based on payment status changes
         if old_status and old_status != self.payment_status:
-            # If status changed to cancelled from pending, release reserved stock
-            if old_status == 'pending' and self.payment_status == 'cancelled':
+            # If an open sale was cancelled, release its reserved stock
+            if old_status in ('pending', 'partially_paid') and self.payment_status == 'cancelled':
                 self.release_reserved_stock()
-            # If status changed to completed from pending, finalize the sale
-            elif old_status == 'pending' and self.payment_status == 'completed':
+            # If an open sale was paid off, finalize it
+            elif old_status in ('pending', 'partially_paid') and self.payment_status == 'completed':
                 self.finalize_sale()
     
+    def _stock_items(self):
+        return [(line.product_id, line.variant_id, line.quantity) for line in self.lines.all()]
+
     def reserve_stock_for_sale(self):
         """
         Reserve stock for all items in the sale
         """
-        from django.db import transaction
-        with transaction.atomic():
-            for line in self.lines.all():
-                # Find the inventory record for this product at the sale warehouse
-                inventory = Inventory.objects.filter(
-                    product=line.product,
-                    variant=line.variant,
-                    warehouse=self.warehouse
-                ).first()
-                
-                if inventory:
-                    # Check if sufficient stock is available
-                    available_stock = inventory.qty_on_hand - inventory.qty_reserved
-                    if available_stock >= line.quantity:
-                        # Reserve the stock by updating the reserved quantity
-                        inventory.qty_reserved += line.quantity
-                        inventory.save()
-                    else:
-                        raise ValidationError(
-                            f"Insufficient stock for product {line.product.name}. "
-                            f"Available: {available_stock}, Requested: {line.quantity}"
-                        )
-                else:
-                    # Create an inventory record if it doesn't exist, with 0 on hand but reserve the quantity
-                    # This is unusual but could happen if inventory tracking is not properly set up
-                    inventory = Inventory.objects.create(
-                        product=line.product,
-                        variant=line.variant,
-                        warehouse=self.warehouse,
-                        qty_on_hand=0,
-                        qty_reserved=line.quantity,
-                        min_stock_level=0
-                    )
+        from .services import StockSummaryService
+        lines = list(self.lines.select_related('product'))
+        StockSummaryService.reserve(
+            self.warehouse_id, [(line.product_id, line.variant_id, line.quantity) for line in lines],
+            names={line.product_id: line.product.name for line in lines},
+        )
     
     def release_reserved_stock(self):
         """
         Release previously reserved stock for this sale
         """
-        from django.db import transaction
-        with transaction.atomic():
-            for line in self.lines.all():
-                # Find and update the inventory record
-                inventory = Inventory.objects.filter(
-                    product=line.product,
-                    variant=line.variant,
-                    warehouse=self.warehouse
-                ).first()
-                
-                if inventory:
-                    # Release the reserved stock
-                    inventory.qty_reserved = max(0, inventory.qty_reserved - line.quantity)
-                    inventory.save()
+        from .services import StockSummaryService
+        StockSummaryService.release(self.warehouse_id, self._stock_items())
     
     def finalize_sale(self):
         """
         Finalize the sale by reducing inventory quantities
         """
-        from django.db import transaction
-        with transaction.atomic():
-            for line in self.lines.all():
-                # Find and update the inventory record
-                inventory = Inventory.objects.filter(
-                    product=line.product,
-                    variant=line.variant,
-                    warehouse=self.warehouse
-                ).first()
-                
-                if inventory:
-                    # Reduce both on-hand and reserved quantities
-                    inventory.qty_on_hand = max(0, inventory.qty_on_hand - line.quantity)
-                    inventory.qty_reserved = max(0, inventory.qty_reserved - line.quantity)
-                    inventory.save()
+        from .services import StockSummaryService
+        StockSummaryService.deduct(self.warehouse_id, self._stock_items(), reserved=True)
     
     @classmethod
-    def select_fulfillment_warehouse(cls, product, quantity, customer_location=None, preferred_warehouses=None):
+    def select_fulfillment_warehouse(cls, product, quantity, customer_location=None, preferred_warehouses=None, variant=None):
         """
-        Select the best warehouse for fulfilling an order based on availability and other factors
-        Supports round-robin or priority-based selection
+        Select the best warehouse for fulfilling a single product based on availability and
+        distance to the customer (nearest first, lowest id when no location is known)
         """
-        # Get all warehouses that have the product in stock
-        available_inventories = Inventory.objects.filter(
-            product=product,
-            qty_on_hand__gte=quantity
-        ).select_related('warehouse')
-        
-        if preferred_warehouses:
-            # Filter by preferred warehouses if specified
-            available_inventories = available_inventories.filter(
-                warehouse__in=preferred_warehouses
-            )
+        from .services import FulfillmentPlanner
         
-        if customer_location:
-            # If customer location is provided, prioritize warehouses based on proximity
-            # For now, we'll sort by some criteria - in a real system, you might calculate distance
-            available_inventories = available_inventories.order_by('warehouse__id')  # Basic priority
-        else:
-            # Default: Sort by warehouse ID to create a round-robin effect
-            available_inventories = available_inventories.order_by('warehouse__id')
+        plan = FulfillmentPlanner.plan(
+            [{'product': product, 'variant': variant, 'quantity': quantity}],
+            customer_location, preferred_warehouses
+        )
         
-        # Get the first available warehouse (this implements basic round-robin)
-        for inventory in available_inventories:
-            # Check if there's sufficient available stock (not reserved)
-            available_stock = inventory.qty_on_hand - inventory.qty_reserved
-            if available_stock >= quantity:
-                return inventory.warehouse
+        # A single product is only "fulfillable" here if one warehouse can ship all of it
+        if not plan['fully_fulfilled'] or plan['is_split']:
+            return None
         
-        # If no warehouse has sufficient stock, return None
-        return None
+        return Warehouse.objects.get(pk=plan['shipments'][0]['warehouse_id'])
     
     @classmethod
     def create_with_reservation(cls, receipt_number, cashier, warehouse, total_amount, 
@@ -909,86 +863,158 @@ class Sale(models.Model):
     def create_online_order(cls, receipt_number, customer, total_amount,
                            tax_amount=0, discount_amount=0, 
                            sale_type='sale', notes='', lines_data=None,
-                           customer_location=None, preferred_warehouses=None):
+                           customer_location=None, preferred_warehouses=None, cashier=None):
         """
-        Create an online order with warehouse selection based on availability
-        Implements round-robin or priority-based warehouse fulfillment
+        Create an online order fulfilled from a single warehouse.
+        The warehouse is chosen by FulfillmentPlanner (nearest warehouse that can ship every line).
+        Orders that can only be fulfilled by splitting across warehouses are rejected; use
+        create_split_online_order for those.
         """
         from django.db import transaction
-        import uuid
+        from .services import FulfillmentPlanner
         
         if lines_data is None:
             lines_data = []
         
         with transaction.atomic():
-            # Select warehouse for fulfillment based on availability and other factors
-            selected_warehouse = None
-            all_available = True
-            
-            for line_data in lines_data:
-                product = line_data['product']
-                quantity = line_data['quantity']
-                
-                # Find the best warehouse for this product
-                product_warehouse = cls.select_fulfillment_warehouse(
-                    product, quantity, customer_location, preferred_warehouses
-                )
-                
-                if not product_warehouse:
-                    raise ValidationError(f"Insufficient stock available for product {product.name}")
-                
-                # For mixed fulfillment orders, we might want to handle each item separately
-                # For now, let's use the first item's warehouse as the main warehouse
-                if selected_warehouse is None:
-                    selected_warehouse = product_warehouse
-                elif selected_warehouse != product_warehouse:
-                    # If different items need to come from different warehouses,
-                    # we might want to create separate orders or handle this differently
-                    # For now, let's use round-robin and pick the first available warehouse
-                    pass
+            plan = FulfillmentPlanner.plan(lines_data, customer_location, preferred_warehouses)
+            cls._validate_fulfillment_plan(plan, lines_data)
             
-            # If all items can be fulfilled from the same warehouse or we just need any warehouse
-            if not selected_warehouse and lines_data:
-                # If we couldn't determine a warehouse, just use the first product's available warehouse
-                first_line = lines_data[0]
-                selected_warehouse = cls.select_fulfillment_warehouse(
-                    first_line['product'], first_line['quantity'], customer_location, preferred_warehouses
+            if plan['is_split']:
+                raise ValidationError(
+                    f"Order requires {plan['warehouse_count']} warehouses to fulfil; "
+                    f"use create_split_online_order to split it into shipments"
                 )
-                
-                if not selected_warehouse:
-                    raise ValidationError(f"No warehouse available for the requested products")
             
-            # Create the online order sale
-            sale = cls.objects.create(
-                receipt_number=receipt_number,
-                cashier=customer.user if hasattr(customer, 'user') else None,  # Use customer user if available
-                customer=customer,
-                warehouse=selected_warehouse,
-                sale_type=sale_type,
-                total_amount=total_amount,
-                tax_amount=tax_amount,
-                discount_amount=discount_amount,
-                payment_status='pending',
-                notes=notes
+            warehouse = Warehouse.objects.get(pk=plan['shipments'][0]['warehouse_id'])
+            sale = cls._create_online_sale(
+                receipt_number, customer, cashier, warehouse, total_amount, tax_amount,
+                discount_amount, sale_type, notes, lines_data
             )
+            sale.fulfillment_plan = plan
+            return sale
+    
+    @classmethod
+    def create_split_online_order(cls, receipt_number, customer, total_amount,
+                                  tax_amount=0, discount_amount=0,
+                                  sale_type='sale', notes='', lines_data=None,
+                                  customer_location=None, preferred_warehouses=None, cashier=None):
+        """
+        Create an online order that may be split across warehouses.
+        One pending sale is created per shipment in the plan (receipt numbers get a -1, -2, ...
+        suffix when split) and the order totals are apportioned by line value.
+        Returns the list of created sales, largest shipment first.
+        """
+        from decimal import Decimal
+        from django.db import transaction
+        from .services import FulfillmentPlanner
+        
+        if lines_data is None:
+            lines_data = []
+        
+        with transaction.atomic():
+            plan = FulfillmentPlanner.plan(lines_data, customer_location, preferred_warehouses)
+            cls._validate_fulfillment_plan(plan, lines_data)
             
-            # Create the sale lines
+            def line_value(line):
+                discount_factor = (100 - Decimal(str(line.get('discount_percent', 0)))) / 100
+                return line['quantity'] * Decimal(str(line['unit_price'])) * discount_factor
+            
+            # Hand out each line's planned quantities shipment by shipment
+            pending = {}
             for line_data in lines_data:
-                SaleLine.objects.create(
-                    sale=sale,
-                    product=line_data['product'],
-                    variant=line_data.get('variant'),
-                    quantity=line_data['quantity'],
-                    unit_price=line_data['unit_price'],
-                    total_price=line_data.get('total_price'),
-                    discount_percent=line_data.get('discount_percent', 0),
-                    cost_price=line_data.get('cost_price')
-                )
+                key = (getattr(line_data['product'], 'pk', line_data['product']),
+                       getattr(line_data.get('variant'), 'pk', line_data.get('variant')))
+                pending.setdefault(key, []).append(dict(line_data))
             
-            # Reserve stock for the sale
-            sale.reserve_stock_for_sale()
+            shipments = []
+            for shipment in plan['shipments']:
+                shipment_lines = []
+                for planned in shipment['lines']:
+                    quantity = planned['quantity']
+                    for line_data in pending[(planned['product_id'], planned['variant_id'])]:
+                        if not quantity:
+                            break
+                        take = min(quantity, line_data['quantity'])
+                        if not take:
+                            continue
+                        part = dict(line_data, quantity=take)
+                        part['total_price'] = line_value(part).quantize(Decimal('0.01'))
+                        shipment_lines.append(part)
+                        line_data['quantity'] -= take
+                        quantity -= take
+                shipments.append((shipment['warehouse_id'], shipment_lines))
             
-            return sale
+            order_value = sum(line_value(line) for _, shipment_lines in shipments for line in shipment_lines)
+            amounts = [Decimal(str(total_amount)), Decimal(str(tax_amount)), Decimal(str(discount_amount))]
+            allocated = [Decimal('0')] * 3
+            warehouses = Warehouse.objects.in_bulk([warehouse_id for warehouse_id, _ in shipments])
+            
+            sales = []
+            for index, (warehouse_id, shipment_lines) in enumerate(shipments, start=1):
+                if index == len(shipments):
+                    # The last shipment takes the rounding remainder so totals add up exactly
+                    shares = [amount - done for amount, done in zip(amounts, allocated)]
+                else:
+                    ratio = sum(line_value(line) for line in shipment_lines) / order_value if order_value else 0
+                    shares = [(amount * ratio).quantize(Decimal('0.01')) for amount in amounts]
+                allocated = [done + share for done, share in zip(allocated, shares)]
+                
+                sale = cls._create_online_sale(
+                    f"{receipt_number}-{index}" if len(shipments) > 1 else receipt_number,
+                    customer, cashier, warehouses[warehouse_id], shares[0], shares[1], shares[2],
+                    sale_type, notes, shipment_lines
+                )
+                sale.fulfillment_plan = plan
+                sales.append(sale)
+            
+            return sales
+    
+    @staticmethod
+    def _validate_fulfillment_plan(plan, lines_data):
+        if plan['fully_fulfilled']:
+            return
+        names = {
+            getattr(line['product'], 'pk', line['product']): getattr(line['product'], 'name', line['product'])
+            for line in lines_data
+        }
+        missing = ', '.join(str(names.get(item['product_id'], item['product_id'])) for item in plan['unfulfilled'])
+        raise ValidationError(f"Insufficient stock available for product {missing}")
+    
+    @classmethod
+    def _create_online_sale(cls, receipt_number, customer, cashier, warehouse, total_amount, tax_amount,
+                            discount_amount, sale_type, notes, lines_data):
+        # Create the online order sale
+        sale = cls.objects.create(
+            receipt_number=receipt_number,
+            cashier=cashier or (customer.user if hasattr(customer, 'user') else None),  # Use customer user if available
+            customer=customer,
+            warehouse=warehouse,
+            sale_type=sale_type,
+            total_amount=total_amount,
+            tax_amount=tax_amount,
+            discount_amount=discount_amount,
+            payment_status='pending',
+            notes=notes
+        )
+        
+        # Create the sale lines
+        for line_data in lines_data:
+            SaleLine.objects.create(
+                sale=sale,
+                product=line_data['product'],
+                variant=line_data.get('variant'),
+                quantity=line_data['quantity'],
+                unit_price=line_data['unit_price'],
+                total_price=line_data.get('total_price'),
+                discount_percent=line_data.get('discount_percent', 0),
+                cost_price=line_data.get('cost_price')
+            )
+        
+        # Reserve stock for the sale
+        sale.reserve_stock_for_sale()
+        
+        return sale
 
 
 class SaleLine(models.Model):
@@ -1128,6 +1154,9 @@ class Transfer(models.Model):
         will_reserve_stock = getattr(settings, 'AUTO_RESERVE_TRANSFER_STOCK', True)
         
         self.clean()
+        if not self.transfer_number:
+            from .services import DocumentNumberService
+            self.transfer_number = DocumentNumberService.next('transfer', self.from_warehouse_id)
         super().save(*args, **kwargs)
         
         # Reserve stock automatically if configured to do so and this is a new transfer
@@ -1188,51 +1217,24 @@ class Transfer(models.Model):
                 inventory.qty_reserved = max(0, inventory.qty_reserved - line.requested_qty)
                 inventory.save()
     
-    def receive_transfer(self):
+    def receive_transfer(self, received_quantities=None):
         """
-        Process the transfer receipt, moving inventory from source to destination
+        Process the transfer receipt, moving inventory from source to destination.
+
+        `received_quantities` maps transfer line ids to the quantity that actually arrived;
+        lines that are not listed are received in full. The requested quantity always leaves
+        the source, so any shortfall is recorded on the line as a discrepancy.
         """
         from django.db import transaction
+        from .services import TransferStockService, broadcast_inventory_rows
+
         with transaction.atomic():
-            for line in self.lines.all():
-                # Find and update source inventory
-                source_inventory = Inventory.objects.filter(
-                    product=line.product,
-                    variant=line.variant,
-                    warehouse=self.from_warehouse,
-                    location=self.from_location,
-                    bin=self.from_bin
-                ).first()
-                
-                if source_inventory:
-                    # Reduce on-hand and reserved quantities in source
-                    source_inventory.qty_on_hand = max(0, source_inventory.qty_on_hand - line.requested_qty)
-                    source_inventory.qty_reserved = max(0, source_inventory.qty_reserved - line.requested_qty)
-                    source_inventory.save()
-                
-                # Find or create destination inventory
-                dest_inventory, created = Inventory.objects.get_or_create(
-                    product=line.product,
-                    variant=line.variant,
-                    warehouse=self.to_warehouse,
-                    location=self.to_location,
-                    bin=self.to_bin,
-                    defaults={
-                        'qty_on_hand': 0,
-                        'qty_reserved': 0,
-                        'min_stock_level': 0
-                    }
-                )
-                
-                # Increase on-hand quantity at destination
-                dest_inventory.qty_on_hand += line.requested_qty
-                dest_inventory.save()
-                
-                # Update the transfer line to mark as received
-                line.transferred_qty = line.requested_qty
-                line.received_qty = line.requested_qty
-                line.save()
-    
+            touched = TransferStockService.receive([self], received_quantities)
+            self.status = 'received'
+            self.received_at = timezone.now()
+            Transfer.objects.filter(pk=self.pk).update(status='received', received_at=self.received_at)
+            transaction.on_commit(lambda: broadcast_inventory_rows(touched, 'transfer_received'))
+
     def cancel_transfer(self):
         """
         Cancel the transfer and release any reserved stock
@@ -1390,8 +1392,8 @@ class Return(models.Model):
         
         self.clean()
         if not self.return_number:
-            import uuid
-            self.return_number = f"RET-{uuid.uuid4().hex[:8].upper()}"
+            from .services import DocumentNumberService
+            self.return_number = DocumentNumberService.next('return', self.original_sale.warehouse_id)
         super().save(*args, **kwargs)
         
         # Handle return processing based on status changes
@@ -1449,21 +1451,25 @@ class Return(models.Model):
             self.status = 'processed'
             self.save()
     
-    def issue_refund(self):
+    def issue_refund(self, refund_method='cash'):
         """
-        Issue a refund based on the refund method specified
+        Issue a refund through the given payment method
         """
         if self.refund_amount <= 0:
             return
             
-        # Find the original payment for this amount to determine the payment method
-        original_payments = self.original_sale.payments.all()
+        if self.refunded_at:
+            return
         
-        # For simplicity, we'll create a refund record
         # In a real system, you might need to process actual refunds through payment processors
         from django.db import transaction
+        from .services import SalePaymentService
         with transaction.atomic():
-            # For now, just mark the refund as processed
+            # Refunds are capped by what was paid on the original sale
+            SalePaymentService.refund(
+                self.original_sale, self.refund_amount, refund_method,
+                reference=f"Refund for return {self.return_number}"
+            )
             self.refunded_at = timezone.now()
             self.save()
     
@@ -1480,19 +1486,18 @@ class Return(models.Model):
             return
         
         from django.db import transaction
+        from .services import SalePaymentService
         with transaction.atomic():
+            # Record the credit against the original sale's payments
+            SalePaymentService.refund(
+                self.original_sale, credit_amount, 'credit',
+                reference=f"Store credit issued for return {self.return_number}"
+            )
+            
             # Add credit to customer's store credit balance
             self.customer.store_credit += credit_amount
             self.customer.save()
             
-            # Create a payment record indicating store credit was issued
-            Payment.objects.create(
-                sale=self.original_sale,
-                payment_method='credit',
-                amount=-credit_amount,  # Negative indicates credit
-                reference=f"Store credit issued for return {self.return_number}"
-            )
-            
             # Update return record
             self.refund_amount = 0  # Since we're using store credit instead
             self.refunded_at = timezone.now()
@@ -1540,9 +1545,9 @@ class Return(models.Model):
         from django.db import transaction
         with transaction.atomic():
             # Create a new sale for the exchanged items
-            import uuid
+            from .services import DocumentNumberService
             new_sale = Sale.objects.create(
-                receipt_number=f"EXC-{uuid.uuid4().hex[:8].upper()}",
+                receipt_number=DocumentNumberService.next('exchange', self.original_sale.warehouse_id),
                 cashier=self.original_sale.cashier,
                 customer=self.original_sale.customer,
                 warehouse=self.original_sale.warehouse,
@@ -1590,6 +1595,10 @@ class Return(models.Model):
                     payment_method='cash',  # Could be configurable
                     amount=exchange_payment_amount
                 )
+                Sale.objects.filter(pk=new_sale.pk).update(
+                    amount_paid=Round(models.F('amount_paid') + exchange_payment_amount, 2),
+                    balance_due=Round(models.F('balance_due') - exchange_payment_amount, 2),
+                )
             elif exchange_payment_amount < 0:
                 # Store owes customer (would require store credit system)
                 # For now, we just note it in our records
@@ -1706,7 +1715,7 @@ class Promotion(models.Model):
         """
         Calculate the discount amount for a specific product and quantity
         """
-        if not self.is_valid() or not self.is_eligible_for_customer(customer_user):
+        if not self.is_valid or not self.is_eligible_for_customer(customer_user):
             return 0
         
         # Check if product is eligible for promotion
@@ -1771,6 +1780,59 @@ class Promotion(models.Model):
         super().save(*args, **kwargs)
 
 
+class LoyaltyTransaction(models.Model):
+    """
+    Ledger entry for a change to a customer's loyalty points. Customer.loyalty_points is kept equal
+    to the sum of the customer's entries; see LoyaltyService.reconcile.
+    """
+    TRANSACTION_TYPE_CHOICES = [
+        ('earn', 'Earned'),
+        ('redeem', 'Redeemed'),
+        ('expire', 'Expired'),
+        ('adjust', 'Adjustment'),
+    ]
+
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='loyalty_transactions')
+    transaction_type = models.CharField(max_length=10, choices=TRANSACTION_TYPE_CHOICES)
+    points = models.IntegerField(help_text="Signed change to the balance")
+    sale = models.ForeignKey(Sale, on_delete=models.SET_NULL, null=True, blank=True, related_name='loyalty_transactions')
+    expires_at = models.DateTimeField(null=True, blank=True, help_text="When earned points lapse if unused")
+    reason = models.CharField(max_length=255, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['customer', 'created_at'], name='loyalty_customer_created_idx'),
+            models.Index(fields=['transaction_type', 'expires_at'], name='loyalty_type_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.customer} {self.points:+d} ({self.transaction_type})"
+
+
+class CouponCampaign(models.Model):
+    """
+    A batch of generated single-purpose coupon codes sharing the same terms
+    """
+    name = models.CharField(max_length=255)
+    prefix = models.CharField(max_length=10, blank=True)
+    code_length = models.PositiveIntegerField(default=10, help_text="Random characters after the prefix")
+    quantity = models.PositiveIntegerField()
+    promotion = models.ForeignKey(Promotion, on_delete=models.SET_NULL, null=True, blank=True)
+    coupon_type = models.CharField(max_length=20, choices=[('percentage', 'Percentage Discount'), ('fixed_amount', 'Fixed Amount Discount')])
+    discount_value = models.DecimalField(max_digits=10, decimal_places=2)
+    start_date = models.DateTimeField()
+    end_date = models.DateTimeField()
+    max_uses_per_code = models.PositiveIntegerField(null=True, blank=True, default=1)
+    is_limited_to_customer = models.BooleanField(default=False)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.quantity} codes)"
+
+
 class Coupon(models.Model):
     CODE_TYPE_CHOICES = [
         ('percentage', 'Percentage Discount'),
@@ -1779,6 +1841,7 @@ class Coupon(models.Model):
     
     code = models.CharField(max_length=50, unique=True)
     promotion = models.ForeignKey(Promotion, on_delete=models.CASCADE, null=True, blank=True)
+    campaign = models.ForeignKey(CouponCampaign, on_delete=models.CASCADE, null=True, blank=True, related_name='coupons')
     coupon_type = models.CharField(max_length=20, choices=CODE_TYPE_CHOICES)
     discount_value = models.DecimalField(max_digits=10, decimal_places=2)
     is_active = models.BooleanField(default=True)
@@ -1817,11 +1880,49 @@ class Coupon(models.Model):
     def save(self, *args, **kwargs):
         self.clean()
         if not self.code:
-            import uuid
-            self.code = f"COUP-{uuid.uuid4().hex[:8].upper()}"
+            import secrets
+            # Random rather than sequential, so codes cannot be guessed from one another
+            self.code = f"COUP-{secrets.token_hex(6).upper()}"
         super().save(*args, **kwargs)
 
 
+class CouponRedemption(models.Model):
+    """
+    One use of a coupon. A reserved redemption already counts towards Coupon.used_count and is
+    either committed with the sale or released, which gives the use back.
+    """
+    STATUS_CHOICES = [
+        ('reserved', 'Reserved'),
+        ('committed', 'Committed'),
+        ('released', 'Released'),
+    ]
+
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='redemptions')
+    customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True, related_name='coupon_redemptions')
+    sale = models.ForeignKey(Sale, on_delete=models.SET_NULL, null=True, blank=True, related_name='coupon_redemptions')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='reserved')
+    # Copied from the coupon so the database can enforce one live redemption per customer
+    once_per_customer = models.BooleanField(default=False)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['coupon', 'customer'],
+                condition=models.Q(once_per_customer=True, status__in=['reserved', 'committed']),
+                name='coupon_redemption_once_per_customer',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='coupon_redemption_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.coupon.code} ({self.status})"
+
+
 class PurchaseOrder(models.Model):
     STATUS_CHOICES = [
         ('draft', 'Draft'),
@@ -1870,12 +1971,11 @@ class PurchaseOrder(models.Model):
     
     def calculate_totals(self):
         """Calculate and update the totals for this purchase order"""
-        subtotal = 0
-        for line in self.lines.all():
-            subtotal += line.total_price
+        from django.db.models import Sum
+        subtotal = self.lines.aggregate(subtotal=Sum('total_price'))['subtotal'] or 0
         self.subtotal = subtotal
         self.total_amount = subtotal + self.tax_amount + self.shipping_cost
-        self.save()
+        self.save(update_fields=['subtotal', 'total_amount', 'updated_at'])
     
     def clean(self):
         if self.expected_delivery_date and self.order_date >= self.expected_delivery_date:
@@ -1892,8 +1992,8 @@ class PurchaseOrder(models.Model):
     def save(self, *args, **kwargs):
         self.clean()
         if not self.po_number:
-            import uuid
-            self.po_number = f"PO-{uuid.uuid4().hex[:8].upper()}"
+            from .services import DocumentNumberService
+            self.po_number = DocumentNumberService.next('purchase_order', self.warehouse_id)
         super().save(*args, **kwargs)
 
 
@@ -1980,8 +2080,8 @@ class GoodsReceivedNote(models.Model):
     
     def save(self, *args, **kwargs):
         if not self.grn_number:
-            import uuid
-            self.grn_number = f"GRN-{uuid.uuid4().hex[:8].upper()}"
+            from .services import DocumentNumberService
+            self.grn_number = DocumentNumberService.next('grn', self.purchase_order.warehouse_id)
         super().save(*args, **kwargs)
 
 
@@ -2017,13 +2117,20 @@ class Reservation(models.Model):
     def __str__(self):
         return f"Reservation {self.reservation_number}"
 
+    class Meta:
+        indexes = [
+            # Used by the expiry sweeper to find stale active reservations
+            models.Index(fields=['status', 'expires_at'], name='reservation_status_expiry_idx'),
+        ]
+
     def clean(self):
         if self.expires_at <= timezone.now():
             raise ValidationError("Expiration date must be in the future.")
 
     def save(self, *args, **kwargs):
         if not self.reservation_number:
-            self.reservation_number = f"RES-{uuid.uuid4().hex[:8].upper()}"
+            from .services import DocumentNumberService
+            self.reservation_number = DocumentNumberService.next('reservation', self.warehouse_id)
         self.clean()
         super().save(*args, **kwargs)
 
@@ -2045,6 +2152,42 @@ class ReservationLine(models.Model):
         self.clean()
         super().save(*args, **kwargs)
 
+class DemandForecast(models.Model):
+    """Nightly demand forecast for one product/variant at one warehouse"""
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.CASCADE, related_name='demand_forecasts')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='demand_forecasts')
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, null=True, blank=True, related_name='demand_forecasts')
+
+    # Daily unit demand
+    avg_daily_7 = models.FloatField(default=0, help_text="Moving average over the last 7 days")
+    avg_daily_28 = models.FloatField(default=0, help_text="Moving average over the last 28 days")
+    smoothed_daily = models.FloatField(default=0, help_text="Exponentially smoothed daily demand (carried between runs)")
+    std_daily = models.FloatField(default=0, help_text="Standard deviation of daily demand over the history window")
+    weekday_factors = models.JSONField(default=list, blank=True, help_text="Demand multipliers for Monday..Sunday")
+
+    # Planning outputs
+    available_stock = models.IntegerField(default=0)
+    days_of_cover = models.FloatField(null=True, blank=True, help_text="Available stock divided by forecast demand")
+    suggested_min_level = models.PositiveIntegerField(default=0)
+
+    computed_through = models.DateField(help_text="Last day of sales included in this forecast")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [['warehouse', 'product', 'variant']]
+        indexes = [
+            models.Index(fields=['warehouse', 'days_of_cover'], name='forecast_wh_cover_idx'),
+        ]
+
+    def __str__(self):
+        variant_str = f" - {self.variant.name}" if self.variant else ""
+        return f"Forecast {self.product.name}{variant_str} @ {self.warehouse.name}"
+
+    def forecast_for(self, day):
+        """Expected demand on a given date, applying the weekday factor"""
+        factor = self.weekday_factors[day.weekday()] if len(self.weekday_factors) == 7 else 1.0
+        return self.smoothed_daily * factor
+
 class BlacklistedToken(models.Model):
     """Model to store blacklisted JWT tokens"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
@@ -2061,6 +2204,62 @@ class BlacklistedToken(models.Model):
         ordering = ['-blacklisted_at']
 
 
+class IdempotencyKey(models.Model):
+    """
+    The stored outcome of a mutating request sent with an Idempotency-Key header, so a retry
+    with the same key replays the response instead of running the request again.
+    A row without a status code is a request still in progress.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=128)
+    # sha256 of method, path and body; a key reused for a different request is refused
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.BinaryField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotency_key_per_user'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at'], name='idempotency_key_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} ({self.status_code or 'in progress'})"
+
+
+class DocumentSequence(models.Model):
+    """
+    Counter behind the numbers of one document type in one warehouse, e.g. RCT-003-000124.
+    Workers reserve blocks of numbers from it with a single UPDATE (see DocumentNumberService);
+    next_number is the first number no worker has reserved yet.
+    """
+    DOCUMENT_TYPE_CHOICES = [
+        ('sale', 'Sale receipt'),
+        ('exchange', 'Exchange receipt'),
+        ('return', 'Return'),
+        ('transfer', 'Transfer'),
+        ('purchase_order', 'Purchase order'),
+        ('grn', 'Goods received note'),
+        ('reservation', 'Reservation'),
+    ]
+
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.CASCADE, related_name='document_sequences')
+    document_type = models.CharField(max_length=20, choices=DOCUMENT_TYPE_CHOICES)
+    next_number = models.PositiveBigIntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['warehouse', 'document_type'], name='document_sequence_per_warehouse'),
+        ]
+
+    def __str__(self):
+        return f"{self.warehouse_id} {self.document_type}: next {self.next_number}"
+
+
 class Webhook(models.Model):
     """
     Model to store webhook configurations
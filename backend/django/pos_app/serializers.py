@@ -4,7 +4,7 @@ from django.db import transaction
 from .models import (
     UserProfile, Category, Product, ProductVariant, Warehouse, Location, Bin,
     Inventory, Customer, Sale, SaleLine, Payment, Webhook, WebhookLog, PaymentToken, PaymentGatewayConfig, EcommercePlatform, EcommerceSyncLog, 
-    Transfer, TransferLine, Return, ReturnLine, Promotion, Coupon, 
+    Transfer, TransferLine, Return, ReturnLine, Promotion, Coupon, CouponCampaign, CouponRedemption, LoyaltyTransaction,
     PurchaseOrder, PurchaseOrderLine, GoodsReceivedNote, GoodsReceivedNoteLine, AuditLog, Reservation, ReservationLine
 )
 
@@ -309,6 +309,8 @@ class CustomerSerializer(serializers.ModelSerializer):
     class Meta:
         model = Customer
         fields = '__all__'
+        # Balances only move through the loyalty ledger (earn/redeem/adjust-points endpoints)
+        read_only_fields = ['loyalty_points']
     
     def validate_email(self, value):
         if value and Customer.objects.filter(email=value).exclude(id=self.instance.id if self.instance else None).exists():
@@ -356,6 +358,7 @@ class SaleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Sale
         fields = '__all__'
+        read_only_fields = ('amount_paid', 'amount_refunded', 'balance_due')
     
     def validate(self, attrs):
         lines_data = attrs.get('lines', [])
@@ -651,6 +654,7 @@ class GoodsReceivedNoteLineSerializer(serializers.ModelSerializer):
     class Meta:
         model = GoodsReceivedNoteLine
         fields = '__all__'
+        read_only_fields = ('grn',)
         
     def validate_received_qty(self, value):
         if value <= 0:
@@ -687,15 +691,19 @@ class GoodsReceivedNoteSerializer(serializers.ModelSerializer):
             raise CustomValidationError({"lines": "GRN must have at least one line item."})
         return attrs
     
-    @transaction.atomic
     def create(self, validated_data):
-        lines_data = validated_data.pop('lines')
-        grn = GoodsReceivedNote.objects.create(**validated_data)
+        from django.core.exceptions import ValidationError as DjangoValidationError
+        from .services import GoodsReceivingService
         
-        for line_data in lines_data:
-            GoodsReceivedNoteLine.objects.create(grn=grn, **line_data)
+        lines_data = validated_data.pop('lines')
+        purchase_order = validated_data.pop('purchase_order')
+        received_by = validated_data.pop('received_by')
         
-        return grn
+        # Posting the GRN moves the received stock into inventory and updates the purchase order
+        try:
+            return GoodsReceivingService.post(purchase_order, lines_data, received_by, **validated_data)
+        except DjangoValidationError as e:
+            raise CustomValidationError(e.messages)
 
 
 class ReservationLineSerializer(serializers.ModelSerializer):
@@ -767,6 +775,38 @@ class CouponSerializer(serializers.ModelSerializer):
         return attrs
 
 
+class CouponCampaignSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CouponCampaign
+        fields = '__all__'
+        read_only_fields = ('created_by', 'created_at')
+
+    def validate(self, attrs):
+        if attrs['start_date'] >= attrs['end_date']:
+            raise CustomValidationError({"end_date": "End date must be after start date."})
+        if attrs['discount_value'] <= 0:
+            raise CustomValidationError({"discount_value": "Discount value must be greater than zero."})
+        return attrs
+
+
+class CouponRedemptionSerializer(serializers.ModelSerializer):
+    code = serializers.CharField(source='coupon.code', read_only=True)
+
+    class Meta:
+        model = CouponRedemption
+        fields = '__all__'
+        read_only_fields = ('status', 'once_per_customer', 'expires_at', 'created_at', 'updated_at')
+
+
+class LoyaltyTransactionSerializer(serializers.ModelSerializer):
+    receipt_number = serializers.CharField(source='sale.receipt_number', read_only=True, default=None)
+
+    class Meta:
+        model = LoyaltyTransaction
+        fields = '__all__'
+        read_only_fields = ('created_at',)
+
+
 class ReturnSerializer(serializers.ModelSerializer):
     lines = ReturnLineSerializer(many=True)
     original_sale_receipt = serializers.CharField(source='original_sale.receipt_number', read_only=True)
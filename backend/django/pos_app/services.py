@@ -2,7 +2,9 @@ import requests
 import json
 import hashlib
 import hmac
+import threading
 from datetime import datetime
+from decimal import Decimal
 from django.utils import timezone
 from .models import Webhook, WebhookLog
 
@@ -865,6 +867,7 @@ class EcommerceSyncService:
                     warehouse=warehouse,
                     total_amount=order_data.get('total_price', 0),
                     payment_status='completed',  # Assuming completed orders from e-commerce
+                    amount_paid=order_data.get('total_price', 0),
                     sale_date=order_data.get('created_at', timezone.now()),
                     notes=f"Order from {platform.platform}: {order_data.get('order_number', 'N/A')}"
                 )
@@ -895,4 +898,4569 @@ class EcommerceSyncService:
                 return True
                 
         except Exception:
-            return False
\ No newline at end of file
+            return False
+
+class ProductImportService:
+    """
+    Service class to validate bulk product imports and preview the resulting changes
+    """
+
+    REQUIRED_FIELDS = ('sku', 'name', 'price')
+    COMPARED_FIELDS = (
+        'name', 'barcode', 'description', 'category', 'price', 'wholesale_price',
+        'cost_price', 'min_wholesale_qty', 'tags', 'is_active'
+    )
+    CHUNK_SIZE = 2000
+    SAMPLE_SIZE = 20
+
+    @staticmethod
+    def iter_rows(file_obj, file_format):
+        """
+        Yield (row_number, row_dict) pairs from a text file object without loading it all into memory.
+        CSV and JSON Lines are streamed line by line; plain JSON arrays are parsed in one go.
+        """
+        file_format = file_format.lower()
+        if file_format == 'csv':
+            import csv
+            # Start from 2 to account for the header row
+            for row_num, row in enumerate(csv.DictReader(file_obj), start=2):
+                yield row_num, row
+        elif file_format == 'jsonl':
+            for row_num, line in enumerate(file_obj, start=1):
+                if line.strip():
+                    yield row_num, json.loads(line)
+        elif file_format == 'json':
+            data = json.load(file_obj) if hasattr(file_obj, 'read') else json.loads(''.join(file_obj))
+            for row_num, item in enumerate(data, start=1):
+                yield row_num, item
+        else:
+            raise ValueError(f"Unsupported format: {file_format}")
+
+    @staticmethod
+    def _normalize_row(row):
+        """
+        Normalize a raw import row into comparable values, returning (values, errors)
+        """
+        from decimal import Decimal, InvalidOperation
+
+        def text(value):
+            return str(value).strip() if value is not None else ''
+
+        def decimal_or_none(field):
+            value = text(row.get(field))
+            if not value:
+                return None
+            try:
+                number = Decimal(value)
+            except InvalidOperation:
+                number = None
+            # NaN and Infinity parse, but cannot be compared or stored
+            if number is None or not number.is_finite():
+                errors.append(f"Invalid {field}: {value}")
+                return None
+            return number
+
+        errors = []
+        values = {
+            'sku': text(row.get('sku')),
+            'name': text(row.get('name')),
+            'barcode': text(row.get('barcode')) or None,
+            'description': text(row.get('description')),
+            'category': text(row.get('category')) or None,
+            'tags': text(row.get('tags')),
+        }
+
+        for field in ProductImportService.REQUIRED_FIELDS:
+            if not text(row.get(field)):
+                errors.append(f"Missing required field: {field}")
+
+        values['price'] = decimal_or_none('price')
+        if values['price'] is not None and values['price'] <= 0:
+            errors.append("Price must be greater than zero.")
+        values['wholesale_price'] = decimal_or_none('wholesale_price')
+        values['cost_price'] = decimal_or_none('cost_price')
+
+        min_qty = text(row.get('min_wholesale_qty'))
+        try:
+            values['min_wholesale_qty'] = int(min_qty) if min_qty else 1
+        except ValueError:
+            errors.append(f"Invalid min_wholesale_qty: {min_qty}")
+            values['min_wholesale_qty'] = 1
+
+        values['is_active'] = ProductImportService.parse_is_active(row.get('is_active'))
+
+        return values, errors
+
+    @staticmethod
+    def parse_is_active(value):
+        """
+        Read an import row's is_active value; a missing or blank value keeps the product active
+        """
+        if isinstance(value, bool):
+            return value
+        value = str(value).strip().lower() if value is not None else ''
+        return value in ('', 'true', '1', 'yes')
+
+    @staticmethod
+    def dry_run(rows, chunk_size=None, sample_size=None):
+        """
+        Validate an iterable of (row_number, row_dict) pairs against the database without writing anything.
+
+        Rows are checked in chunks: each chunk costs two queries (existing products by SKU and
+        barcode owners), and duplicates within the file are detected with in-memory sets.
+        Returns a compact report with created/updated/unchanged counts and sample field-level changes.
+        """
+        import time
+        from .models import Product
+
+        chunk_size = chunk_size or ProductImportService.CHUNK_SIZE
+        sample_size = sample_size if sample_size is not None else ProductImportService.SAMPLE_SIZE
+        started = time.monotonic()
+
+        report = {
+            'dry_run': True,
+            'total_rows': 0,
+            'valid_rows': 0,
+            'invalid_rows': 0,
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'field_change_counts': {},
+            'errors': [],
+            'changes': [],
+        }
+        seen_skus = set()
+        seen_barcodes = {}
+        chunk = []
+
+        def record_error(row_num, sku, errors):
+            report['invalid_rows'] += 1
+            if len(report['errors']) < sample_size:
+                report['errors'].append({'row': row_num, 'sku': sku, 'errors': errors})
+
+        def flush(chunk):
+            skus = [values['sku'] for _, values in chunk]
+            barcodes = [values['barcode'] for _, values in chunk if values['barcode']]
+
+            existing = {
+                item['sku']: item
+                for item in Product.objects.filter(sku__in=skus).values(
+                    'sku', 'name', 'barcode', 'description', 'category__name', 'price',
+                    'wholesale_price', 'cost_price', 'min_wholesale_qty', 'tags', 'is_active'
+                )
+            }
+            barcode_owners = dict(
+                Product.objects.filter(barcode__in=barcodes).values_list('barcode', 'sku')
+            ) if barcodes else {}
+
+            for row_num, values in chunk:
+                owner = barcode_owners.get(values['barcode'])
+                if owner and owner != values['sku']:
+                    record_error(row_num, values['sku'], [
+                        f"Barcode {values['barcode']} already belongs to product {owner}"
+                    ])
+                    continue
+
+                report['valid_rows'] += 1
+                current = existing.get(values['sku'])
+                if current is None:
+                    report['created'] += 1
+                    continue
+
+                current['category'] = current.pop('category__name')
+                changes = {}
+                for field in ProductImportService.COMPARED_FIELDS:
+                    if current[field] != values[field]:
+                        changes[field] = {
+                            'old': _json_safe(current[field]),
+                            'new': _json_safe(values[field]),
+                        }
+                        report['field_change_counts'][field] = report['field_change_counts'].get(field, 0) + 1
+
+                if changes:
+                    report['updated'] += 1
+                    if len(report['changes']) < sample_size:
+                        report['changes'].append({'row': row_num, 'sku': values['sku'], 'changes': changes})
+                else:
+                    report['unchanged'] += 1
+
+        for row_num, row in rows:
+            report['total_rows'] += 1
+            values, errors = ProductImportService._normalize_row(row)
+            sku = values['sku']
+
+            if sku:
+                if sku in seen_skus:
+                    errors.append(f"Duplicate SKU in file: {sku}")
+                else:
+                    seen_skus.add(sku)
+
+            barcode = values['barcode']
+            if barcode:
+                first_sku = seen_barcodes.setdefault(barcode, sku)
+                if first_sku != sku:
+                    errors.append(f"Duplicate barcode in file: {barcode} (also used by SKU {first_sku})")
+
+            if errors:
+                record_error(row_num, sku, errors)
+                continue
+
+            chunk.append((row_num, values))
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+
+        if chunk:
+            flush(chunk)
+
+        report['duration_ms'] = round((time.monotonic() - started) * 1000, 2)
+        return report
+
+
+def _json_safe(value):
+    """
+    Convert Decimal and datetime values into JSON-friendly representations
+    """
+    from decimal import Decimal
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class ProductExportService:
+    """
+    Service class to stream the product catalog in constant memory.
+    Rows are read with values_list() over a server-side cursor, so no model instances are built
+    and the category name is joined in SQL instead of being fetched per row.
+    """
+
+    # Export column -> ORM lookup
+    COLUMNS = {
+        'id': 'id',
+        'name': 'name',
+        'sku': 'sku',
+        'barcode': 'barcode',
+        'description': 'description',
+        'category': 'category__name',
+        'price': 'price',
+        'wholesale_price': 'wholesale_price',
+        'cost_price': 'cost_price',
+        'min_wholesale_qty': 'min_wholesale_qty',
+        'effective_date': 'effective_date',
+        'image': 'image',
+        'tags': 'tags',
+        'is_active': 'is_active',
+        'created_at': 'created_at',
+        'updated_at': 'updated_at',
+    }
+    DEFAULT_COLUMNS = [
+        'name', 'sku', 'barcode', 'description', 'category',
+        'price', 'wholesale_price', 'cost_price', 'min_wholesale_qty',
+        'effective_date', 'tags', 'is_active'
+    ]
+    JSON_DEFAULT_COLUMNS = DEFAULT_COLUMNS + ['image', 'created_at', 'updated_at']
+    # Filter name -> ORM lookup
+    FILTERS = {
+        'category': 'category__name',
+        'is_active': 'is_active',
+        'sku_prefix': 'sku__startswith',
+        'updated_since': 'updated_at__gte',
+    }
+    FORMATS = {
+        'csv': ('text/csv', 'csv'),
+        'json': ('application/json', 'json'),
+        'jsonl': ('application/x-ndjson', 'jsonl'),
+        'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    }
+    CHUNK_SIZE = 2000
+
+    @staticmethod
+    def resolve_columns(columns=None, file_format='csv'):
+        """
+        Validate requested columns (a list or comma-separated string) and return them in order
+        """
+        if not columns:
+            if file_format in ('json', 'jsonl'):
+                return list(ProductExportService.JSON_DEFAULT_COLUMNS)
+            return list(ProductExportService.DEFAULT_COLUMNS)
+        if isinstance(columns, str):
+            columns = [column.strip() for column in columns.split(',') if column.strip()]
+        unknown = [column for column in columns if column not in ProductExportService.COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown export columns: {', '.join(unknown)}")
+        return columns
+
+    @staticmethod
+    def get_queryset(filters=None):
+        """
+        Build the product queryset for the given export filters
+        """
+        from .models import Product
+
+        queryset = Product.objects.all()
+        for name, value in (filters or {}).items():
+            if value in (None, ''):
+                continue
+            if name not in ProductExportService.FILTERS:
+                raise ValueError(f"Unknown export filter: {name}")
+            if name == 'updated_since' and isinstance(value, str):
+                from django.utils.dateparse import parse_date, parse_datetime
+                parsed = parse_datetime(value) or parse_date(value)
+                if parsed is None:
+                    raise ValueError(f"Invalid updated_since value: {value}")
+                value = parsed
+            queryset = queryset.filter(**{ProductExportService.FILTERS[name]: value})
+        return queryset
+
+    @staticmethod
+    def iter_rows(columns, filters=None):
+        """
+        Yield one tuple per product with the values of the requested columns
+        """
+        queryset = ProductExportService.get_queryset(filters)
+        lookups = [ProductExportService.COLUMNS[column] for column in columns]
+        return queryset.order_by('pk').values_list(*lookups).iterator(
+            chunk_size=ProductExportService.CHUNK_SIZE
+        )
+
+    @staticmethod
+    def stream(file_format, columns=None, filters=None, compress=False):
+        """
+        Return a generator of encoded chunks for the csv, json or jsonl formats
+        """
+        columns = ProductExportService.resolve_columns(columns, file_format)
+        rows = ProductExportService.iter_rows(columns, filters)
+
+        if file_format == 'csv':
+            chunks = ProductExportService._iter_csv(columns, rows)
+        elif file_format == 'jsonl':
+            chunks = ProductExportService._iter_json(columns, rows, lines=True)
+        elif file_format == 'json':
+            chunks = ProductExportService._iter_json(columns, rows, lines=False)
+        else:
+            raise ValueError(f"Unsupported format: {file_format}")
+
+        encoded = (chunk.encode('utf-8') for chunk in chunks)
+        return ProductExportService._gzip(encoded) if compress else encoded
+
+    @staticmethod
+    def write_xlsx(file_obj, columns=None, filters=None):
+        """
+        Write the export to a binary file object using openpyxl's write-only mode.
+        Returns the number of exported rows.
+        """
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise ValueError('Excel export not available. Install openpyxl: pip install openpyxl')
+
+        columns = ProductExportService.resolve_columns(columns)
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('Products')
+        sheet.append(columns)
+        count = 0
+        for row in ProductExportService.iter_rows(columns, filters):
+            sheet.append([
+                value.replace(tzinfo=None) if isinstance(value, datetime) else value
+                for value in row
+            ])
+            count += 1
+        workbook.save(file_obj)
+        return count
+
+    @staticmethod
+    def _iter_csv(columns, rows):
+        import csv
+        from io import StringIO
+
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(row)
+            # Hand the buffer over every few hundred rows to keep chunks reasonably sized
+            if count % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    @staticmethod
+    def _iter_json(columns, rows, lines):
+        if not lines:
+            yield '['
+        separator = '\n' if lines else ','
+        for index, row in enumerate(rows):
+            item = json.dumps(
+                {column: _json_export_value(value) for column, value in zip(columns, row)},
+                ensure_ascii=False
+            )
+            if lines:
+                yield item + separator
+            else:
+                yield (separator if index else '') + item
+        if not lines:
+            yield ']'
+
+    @staticmethod
+    def _gzip(chunks):
+        import zlib
+
+        compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def _json_export_value(value):
+    """
+    Convert a database value into the representation used by the JSON product export
+    """
+    from decimal import Decimal
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class FulfillmentPlanner:
+    """
+    Plan which warehouses should fulfil an order.
+
+    Availability for every line is loaded in a single grouped query. The planner then prefers the
+    nearest warehouse that can ship the whole order, otherwise it greedily picks the warehouses that
+    cover the most remaining lines (ties broken by distance to the customer), and finally splits any
+    line that no single warehouse can cover across the warehouses already in the plan.
+    """
+
+    EARTH_RADIUS_KM = 6371.0
+
+    @staticmethod
+    def plan(lines_data, customer_location=None, preferred_warehouses=None):
+        """
+        Build a fulfillment plan for lines given as dicts with 'product', optional 'variant' and 'quantity'
+        (model instances or ids). Returns a dict describing one shipment per warehouse.
+        """
+        demand = FulfillmentPlanner._aggregate_demand(lines_data)
+        availability, coordinates = FulfillmentPlanner.load_availability(demand.keys(), preferred_warehouses)
+        return FulfillmentPlanner.plan_from_availability(
+            demand, availability, coordinates, FulfillmentPlanner.coerce_location(customer_location)
+        )
+
+    @staticmethod
+    def load_availability(keys, preferred_warehouses=None):
+        """
+        Return ({warehouse_id: {(product_id, variant_id): available}}, {warehouse_id: (lat, lng)})
+        for the requested product/variant keys, using one query summed over locations and bins.
+        """
+        from django.db.models import F, Sum
+        from .models import Inventory
+
+        keys = set(keys)
+        queryset = Inventory.objects.filter(
+            product_id__in={product_id for product_id, _ in keys},
+            warehouse__is_active=True,
+        )
+        if preferred_warehouses:
+            queryset = queryset.filter(warehouse__in=preferred_warehouses)
+
+        rows = queryset.order_by().values(
+            'warehouse_id', 'product_id', 'variant_id', 'warehouse__latitude', 'warehouse__longitude'
+        ).annotate(available=Sum(F('qty_on_hand') - F('qty_reserved')))
+
+        availability = {}
+        coordinates = {}
+        for row in rows:
+            key = (row['product_id'], row['variant_id'])
+            if key not in keys or row['available'] <= 0:
+                continue
+            warehouse_id = row['warehouse_id']
+            availability.setdefault(warehouse_id, {})[key] = row['available']
+            if row['warehouse__latitude'] is not None and row['warehouse__longitude'] is not None:
+                coordinates[warehouse_id] = (float(row['warehouse__latitude']), float(row['warehouse__longitude']))
+        return availability, coordinates
+
+    @staticmethod
+    def plan_from_availability(demand, availability, coordinates=None, origin=None):
+        """
+        Pure planning step over pre-loaded availability; see plan() for the strategy
+        """
+        coordinates = coordinates or {}
+        stock = {warehouse_id: dict(items) for warehouse_id, items in availability.items()}
+        distances = {
+            warehouse_id: FulfillmentPlanner.distance_km(origin, coordinates.get(warehouse_id))
+            for warehouse_id in stock
+        }
+
+        def rank(warehouse_id):
+            # Unknown distances sort after known ones; the id keeps the order deterministic
+            distance = distances[warehouse_id]
+            return (distance is None, distance or 0, warehouse_id)
+
+        remaining = dict(demand)
+        allocations = {}
+
+        def allocate(warehouse_id, key, quantity):
+            stock[warehouse_id][key] -= quantity
+            remaining[key] -= quantity
+            if not remaining[key]:
+                del remaining[key]
+            shipment = allocations.setdefault(warehouse_id, {})
+            shipment[key] = shipment.get(key, 0) + quantity
+
+        # 1. Nearest warehouse that can ship the whole order
+        complete = [
+            warehouse_id for warehouse_id, items in stock.items()
+            if all(items.get(key, 0) >= quantity for key, quantity in remaining.items())
+        ]
+        if remaining and complete:
+            warehouse_id = min(complete, key=rank)
+            for key, quantity in list(remaining.items()):
+                allocate(warehouse_id, key, quantity)
+
+        # 2. Greedy cover: each round adds the warehouse that fully covers the most remaining lines
+        while remaining:
+            best = None
+            for warehouse_id, items in stock.items():
+                covered = [key for key, quantity in remaining.items() if items.get(key, 0) >= quantity]
+                if not covered:
+                    continue
+                # Prefer warehouses already shipping something, then coverage, then distance
+                score = (warehouse_id not in allocations, -len(covered), rank(warehouse_id))
+                if best is None or score < best[0]:
+                    best = (score, warehouse_id, covered)
+            if best is None:
+                break
+            _, warehouse_id, covered = best
+            for key in covered:
+                allocate(warehouse_id, key, remaining[key])
+
+        # 3. Split lines no single warehouse can cover, drawing from planned warehouses first
+        for key in list(remaining):
+            sources = sorted(
+                (warehouse_id for warehouse_id, items in stock.items() if items.get(key, 0) > 0),
+                key=lambda warehouse_id: (warehouse_id not in allocations, rank(warehouse_id))
+            )
+            for warehouse_id in sources:
+                if key not in remaining:
+                    break
+                allocate(warehouse_id, key, min(stock[warehouse_id][key], remaining[key]))
+
+        shipments = [
+            {
+                'warehouse_id': warehouse_id,
+                'distance_km': distances[warehouse_id],
+                'lines': [
+                    {'product_id': product_id, 'variant_id': variant_id, 'quantity': quantity}
+                    for (product_id, variant_id), quantity in items.items()
+                ],
+            }
+            for warehouse_id, items in sorted(
+                allocations.items(),
+                key=lambda item: (-sum(item[1].values()), rank(item[0]))
+            )
+        ]
+        known_distances = [shipment['distance_km'] for shipment in shipments if shipment['distance_km'] is not None]
+
+        return {
+            'shipments': shipments,
+            'warehouse_count': len(shipments),
+            'is_split': len(shipments) > 1,
+            'fully_fulfilled': not remaining,
+            'unfulfilled': [
+                {'product_id': product_id, 'variant_id': variant_id, 'quantity': quantity}
+                for (product_id, variant_id), quantity in remaining.items()
+            ],
+            'total_distance_km': round(sum(known_distances), 3) if known_distances else None,
+        }
+
+    @staticmethod
+    def coerce_location(location):
+        """
+        Accept (lat, lng) tuples, 'lat,lng' strings, dicts or objects with latitude/longitude
+        """
+        if location is None:
+            return None
+        try:
+            if isinstance(location, str):
+                latitude, longitude = location.split(',')
+            elif isinstance(location, dict):
+                latitude = location.get('latitude', location.get('lat'))
+                longitude = location.get('longitude', location.get('lng'))
+            elif isinstance(location, (list, tuple)):
+                latitude, longitude = location
+            else:
+                latitude, longitude = location.latitude, location.longitude
+            if latitude is None or longitude is None:
+                return None
+            return float(latitude), float(longitude)
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def distance_km(origin, destination):
+        """
+        Great-circle (haversine) distance in kilometres, or None when either point is unknown
+        """
+        import math
+
+        if origin is None or destination is None:
+            return None
+        lat1, lng1 = map(math.radians, origin)
+        lat2, lng2 = map(math.radians, destination)
+        a = (math.sin((lat2 - lat1) / 2) ** 2 +
+             math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+        return 2 * FulfillmentPlanner.EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+    @staticmethod
+    def _aggregate_demand(lines_data):
+        demand = {}
+        for line in lines_data:
+            product = line['product']
+            variant = line.get('variant')
+            key = (getattr(product, 'pk', product), getattr(variant, 'pk', variant))
+            demand[key] = demand.get(key, 0) + line['quantity']
+        return demand
+
+
+class WarehouseSpatialIndex:
+    """
+    In-process k-d tree over the coordinates of active warehouses.
+
+    Points are stored as 3D unit vectors, so straight-line (chord) distance orders warehouses
+    exactly like great-circle distance and the tree never has to deal with longitude wrap-around.
+    The index is built lazily, dropped by the warehouse save/delete signals and refreshed
+    periodically so changes made by other processes are eventually picked up.
+    """
+
+    REFRESH_SECONDS = 300
+
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, warehouses):
+        """
+        Build the tree from an iterable of dicts with id, name, warehouse_type, location, latitude, longitude
+        """
+        import time
+
+        self.warehouses = {}
+        points = []
+        for warehouse in warehouses:
+            if warehouse['latitude'] is None or warehouse['longitude'] is None:
+                continue
+            coordinates = (float(warehouse['latitude']), float(warehouse['longitude']))
+            self.warehouses[warehouse['id']] = dict(warehouse, coordinates=coordinates)
+            points.append((WarehouseSpatialIndex._to_vector(coordinates), warehouse['id']))
+        self.root = WarehouseSpatialIndex._build(points, 0)
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def get(cls):
+        """
+        Return the shared index, (re)building it if it was invalidated or is stale
+        """
+        import time
+
+        with cls._lock:
+            instance = cls._instance
+            if instance is None or time.monotonic() - instance.built_at > cls.REFRESH_SECONDS:
+                from .models import Warehouse
+                instance = cls(
+                    Warehouse.objects.filter(
+                        is_active=True, latitude__isnull=False, longitude__isnull=False
+                    ).values('id', 'name', 'warehouse_type', 'location', 'latitude', 'longitude')
+                )
+                cls._instance = instance
+            return instance
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Drop the shared index; it is rebuilt on next use
+        """
+        cls._instance = None
+
+    def nearest(self, latitude, longitude, limit=5, candidates=None, max_distance_km=None):
+        """
+        Return up to `limit` (warehouse, distance_km) pairs nearest to the given point.
+        When `candidates` is given, only those warehouse ids are considered.
+        """
+        import heapq
+        import math
+
+        if limit <= 0 or self.root is None:
+            return []
+        target = WarehouseSpatialIndex._to_vector((latitude, longitude))
+        # Max-heap (by negated squared chord length) of the best matches found so far
+        best = []
+
+        def visit(node):
+            if node is None:
+                return
+            point, warehouse_id, axis, left, right = node
+            squared = sum((a - b) ** 2 for a, b in zip(point, target))
+            if candidates is None or warehouse_id in candidates:
+                if len(best) < limit:
+                    heapq.heappush(best, (-squared, warehouse_id))
+                elif squared < -best[0][0]:
+                    heapq.heapreplace(best, (-squared, warehouse_id))
+            delta = target[axis] - point[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            visit(near)
+            if len(best) < limit or delta ** 2 < -best[0][0]:
+                visit(far)
+
+        visit(self.root)
+
+        results = []
+        for negated, warehouse_id in sorted(best, reverse=True):
+            # Convert the chord length back into a great-circle distance
+            chord = math.sqrt(-negated)
+            distance = 2 * FulfillmentPlanner.EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+            if max_distance_km is not None and distance > max_distance_km:
+                break
+            results.append((self.warehouses[warehouse_id], distance))
+        return results
+
+    @staticmethod
+    def _to_vector(coordinates):
+        import math
+
+        latitude, longitude = map(math.radians, coordinates)
+        return (
+            math.cos(latitude) * math.cos(longitude),
+            math.cos(latitude) * math.sin(longitude),
+            math.sin(latitude),
+        )
+
+    @staticmethod
+    def _build(points, depth):
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda item: item[0][axis])
+        median = len(points) // 2
+        point, warehouse_id = points[median]
+        return (
+            point, warehouse_id, axis,
+            WarehouseSpatialIndex._build(points[:median], depth + 1),
+            WarehouseSpatialIndex._build(points[median + 1:], depth + 1),
+        )
+
+
+def find_nearest_stock(sku, latitude, longitude, limit=5, min_qty=1, max_distance_km=None):
+    """
+    Find the nearest active warehouses holding at least `min_qty` available units of a SKU.
+    The SKU may belong to a product or a product variant. Availability is read with a single
+    grouped query over that product's inventory rows and joined against the spatial index.
+    """
+    from django.db.models import F, Q, Sum
+    from .models import Inventory, Product, ProductVariant
+
+    variant = ProductVariant.objects.filter(sku=sku).values('id', 'product_id').first()
+    if variant:
+        stock_filter = Q(product_id=variant['product_id'], variant_id=variant['id'])
+    else:
+        product_id = Product.objects.filter(sku=sku).values_list('id', flat=True).first()
+        if product_id is None:
+            return None
+        stock_filter = Q(product_id=product_id)
+
+    available = dict(
+        Inventory.objects.filter(stock_filter, warehouse__is_active=True)
+        .order_by()
+        .values('warehouse_id')
+        .annotate(available=Sum(F('qty_on_hand') - F('qty_reserved')))
+        .filter(available__gte=min_qty)
+        .values_list('warehouse_id', 'available')
+    )
+    if not available:
+        return []
+
+    matches = WarehouseSpatialIndex.get().nearest(
+        latitude, longitude, limit, candidates=available, max_distance_km=max_distance_km
+    )
+    return [
+        {
+            'warehouse_id': warehouse['id'],
+            'warehouse_name': warehouse['name'],
+            'warehouse_type': warehouse['warehouse_type'],
+            'location': warehouse['location'],
+            'latitude': warehouse['coordinates'][0],
+            'longitude': warehouse['coordinates'][1],
+            'distance_km': round(distance, 3),
+            'available_stock': available[warehouse['id']],
+        }
+        for warehouse, distance in matches
+    ]
+
+
+def broadcast_inventory_rows(inventory_ids, action):
+    """
+    Send one websocket event carrying the current state of several inventory rows.
+    Bulk stock paths update rows with queryset updates, which skip the per-row
+    post_save broadcast, and use this instead.
+    """
+    import logging
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+    from .models import Inventory
+
+    try:
+        rows = [
+            dict(row, last_updated=row['last_updated'].isoformat())
+            for row in Inventory.objects.filter(id__in=inventory_ids).order_by('id').values(
+                'id', 'product_id', 'variant_id', 'warehouse_id',
+                'qty_on_hand', 'qty_reserved', 'min_stock_level', 'last_updated',
+            )
+        ]
+        async_to_sync(get_channel_layer().group_send)(
+            "inventory",
+            {"type": "inventory_update_message", "inventory": rows, "action": action}
+        )
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Error broadcasting inventory update: {e}")
+
+
+class ReservationExpiryService:
+    """
+    Sweeps expired active reservations and releases the stock they were holding.
+
+    Each batch is handled in one transaction: the expired reservations are locked, their line
+    quantities are summed per inventory row, every row is released with a single set-based
+    UPDATE and the reservations are marked canceled in bulk. One consolidated inventory event
+    is sent for the whole sweep instead of one per row.
+    """
+
+    BATCH_SIZE = 500
+
+    _thread = None
+
+    @staticmethod
+    def sweep(now=None, batch_size=None, dry_run=False):
+        """
+        Expire every active reservation whose expires_at has passed.
+        Returns a summary with the number of reservations expired and units released.
+        """
+        from django.db.models import Sum
+        from .models import Reservation, ReservationLine
+
+        now = now or timezone.now()
+        batch_size = batch_size or ReservationExpiryService.BATCH_SIZE
+        summary = {
+            'dry_run': dry_run,
+            'expired_reservations': 0,
+            'released_units': 0,
+            'inventory_rows': 0,
+        }
+        expired = Reservation.objects.filter(status='active', expires_at__lte=now)
+
+        if dry_run:
+            summary['expired_reservations'] = expired.count()
+            summary['released_units'] = ReservationLine.objects.filter(
+                reservation__in=expired
+            ).aggregate(total=Sum('quantity'))['total'] or 0
+            return summary
+
+        touched = set()
+        while True:
+            released, inventory_ids, count = ReservationExpiryService._expire_batch(expired, batch_size)
+            if not count:
+                break
+            summary['expired_reservations'] += count
+            summary['released_units'] += released
+            touched.update(inventory_ids)
+            if count < batch_size:
+                break
+
+        summary['inventory_rows'] = len(touched)
+        if touched:
+            broadcast_inventory_rows(touched, 'reservations_expired')
+        return summary
+
+    @staticmethod
+    def _expire_batch(expired, batch_size):
+        from django.db import transaction
+        from django.db.models import Case, F, IntegerField, Sum, Value, When
+        from django.db.models.functions import Greatest
+        from .models import Inventory, Reservation, ReservationLine
+
+        with transaction.atomic():
+            reservation_ids = list(
+                expired.select_for_update(skip_locked=True)
+                .order_by('expires_at', 'id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not reservation_ids:
+                return 0, [], 0
+
+            demand = {
+                (row['reservation__warehouse_id'], row['product_id'], row['variant_id']): row['quantity']
+                for row in ReservationLine.objects.filter(reservation_id__in=reservation_ids)
+                .order_by()
+                .values('reservation__warehouse_id', 'product_id', 'variant_id')
+                .annotate(quantity=Sum('quantity'))
+            }
+
+            # Reservations hold stock against one row per product/variant/warehouse; when a product
+            # is split across bins, release from the row carrying the most reserved stock.
+            release = {}
+            rows = Inventory.objects.filter(
+                warehouse_id__in={key[0] for key in demand},
+                product_id__in={key[1] for key in demand},
+            ).order_by('-qty_reserved', 'id').values_list('id', 'warehouse_id', 'product_id', 'variant_id')
+            for inventory_id, warehouse_id, product_id, variant_id in rows:
+                key = (warehouse_id, product_id, variant_id)
+                if key in demand:
+                    release[inventory_id] = demand.pop(key)
+
+            if release:
+                # Lock in primary key order so concurrent sweeps and sales cannot deadlock
+                list(Inventory.objects.select_for_update().filter(id__in=release).order_by('id').values_list('id'))
+                Inventory.objects.filter(id__in=release).update(
+                    qty_reserved=Greatest(
+                        F('qty_reserved') - Case(
+                            *[When(id=inventory_id, then=Value(quantity)) for inventory_id, quantity in release.items()],
+                            default=Value(0),
+                            output_field=IntegerField(),
+                        ),
+                        Value(0),
+                    ),
+                    last_updated=timezone.now(),
+                )
+
+            Reservation.objects.filter(id__in=reservation_ids).update(status='canceled')
+
+        return sum(release.values()), list(release), len(reservation_ids)
+
+    @classmethod
+    def start_periodic(cls, interval):
+        """
+        Run the sweeper every `interval` seconds on a daemon thread in the current process
+        """
+        import logging
+
+        if cls._thread is not None and cls._thread.is_alive():
+            return cls._thread
+
+        def run():
+            from django.db import close_old_connections
+
+            stop = threading.Event()
+            while not stop.wait(interval):
+                close_old_connections()
+                try:
+                    cls.sweep()
+                    CouponRedemptionService.release_expired()
+                    IdempotencyStore.purge_expired()
+                except Exception as e:
+                    logging.getLogger(__name__).error(f"Reservation expiry sweep failed: {e}")
+
+        cls._thread = threading.Thread(target=run, name='reservation-expiry-sweeper', daemon=True)
+        cls._thread.start()
+        return cls._thread
+
+
+class InventoryRowUpdater:
+    """
+    Set-based helpers for moving stock on many inventory rows at once.
+
+    Rows are addressed by (warehouse, location, bin, product, variant) keys. Quantities are applied
+    with one F() update per chunk of rows, and rows are always locked in id order so concurrent
+    movements cannot deadlock. Callers are expected to run inside a transaction.
+    """
+
+    UPDATE_CHUNK_SIZE = 500
+
+    @staticmethod
+    def rows(keys):
+        """
+        Map (warehouse, location, bin, product, variant) keys to inventory row ids with one query
+        """
+        from django.db.models import Q
+        from .models import Inventory
+
+        slots = {key[:3] for key in keys}
+        if not slots:
+            return {}
+        condition = Q()
+        for warehouse_id, location_id, bin_id in slots:
+            condition |= Q(warehouse_id=warehouse_id, location_id=location_id, bin_id=bin_id)
+        rows = {}
+        for row in Inventory.objects.filter(
+            condition, product_id__in={key[3] for key in keys}
+        ).order_by('id').values_list('id', 'warehouse_id', 'location_id', 'bin_id', 'product_id', 'variant_id'):
+            key = row[1:]
+            if key in keys:
+                rows.setdefault(key, row[0])
+        return rows
+
+    @staticmethod
+    def ensure_rows(keys):
+        """
+        Like rows(), but first creates any missing rows with zero stock in one statement.
+        A concurrent writer may create some of them first, so conflicts are ignored and
+        the rows are read back.
+        """
+        from .models import Inventory
+
+        rows = InventoryRowUpdater.rows(keys)
+        missing = [key for key in keys if key not in rows]
+        if missing:
+            Inventory.objects.bulk_create([
+                Inventory(
+                    warehouse_id=warehouse_id, location_id=location_id, bin_id=bin_id,
+                    product_id=product_id, variant_id=variant_id,
+                    qty_on_hand=0, qty_reserved=0, min_stock_level=0,
+                )
+                for warehouse_id, location_id, bin_id, product_id, variant_id in missing
+            ], ignore_conflicts=True)
+            rows = InventoryRowUpdater.rows(keys)
+        return rows
+
+    @staticmethod
+    def lock(inventory_ids):
+        """
+        Lock the given inventory rows for the rest of the transaction
+        """
+        from .models import Inventory
+
+        # One ordered statement, so concurrent movements always lock rows in the same order
+        list(Inventory.objects.select_for_update().filter(id__in=list(inventory_ids)).order_by('id').values_list('id'))
+
+    @staticmethod
+    def apply(rows, quantities, on_hand=0, reserved=0):
+        """
+        Add (sign=1) or subtract (sign=-1) the keyed quantities on their rows, clamping at zero
+        """
+        from .models import Inventory
+
+        increments = {}
+        for key, qty in quantities.items():
+            if key in rows and qty:
+                previous = increments.get(rows[key], (0, 0))
+                increments[rows[key]] = (previous[0] + qty * on_hand, previous[1] + qty * reserved)
+        bulk_increment(
+            Inventory, increments, ('qty_on_hand', 'qty_reserved'),
+            chunk_size=InventoryRowUpdater.UPDATE_CHUNK_SIZE, last_updated=timezone.now(),
+        )
+
+
+def bulk_increment(model, increments, fields, chunk_size=500, **values):
+    """
+    Add per-row integer deltas to `fields` with set-based UPDATEs, clamping results at zero.
+
+    `increments` maps primary keys to a tuple of deltas aligned with `fields`. Rows sharing the
+    same deltas are updated together with one `pk IN (...)` statement; the remaining rows are
+    updated in chunks with a CASE expression per field. Extra keyword values are set on every row.
+    """
+    from django.db.models import Case, F, IntegerField, Value, When
+    from django.db.models.functions import Greatest
+
+    def adjust(field, delta, clamp):
+        expression = F(field) + delta
+        return Greatest(expression, Value(0)) if clamp else expression
+
+    groups = {}
+    for pk, deltas in increments.items():
+        if any(deltas):
+            groups.setdefault(tuple(deltas), []).append(pk)
+
+    singles = []
+    for deltas, pks in groups.items():
+        if len(pks) == 1:
+            singles.append((pks[0], deltas))
+            continue
+        changes = {field: adjust(field, Value(delta), delta < 0) for field, delta in zip(fields, deltas) if delta}
+        for start in range(0, len(pks), chunk_size):
+            model.objects.filter(pk__in=pks[start:start + chunk_size]).update(**changes, **values)
+
+    for start in range(0, len(singles), chunk_size):
+        chunk = singles[start:start + chunk_size]
+        changes = {}
+        for position, field in enumerate(fields):
+            whens = [When(pk=pk, then=Value(deltas[position])) for pk, deltas in chunk if deltas[position]]
+            if whens:
+                clamp = any(deltas[position] < 0 for _, deltas in chunk)
+                changes[field] = adjust(field, Case(*whens, default=Value(0), output_field=IntegerField()), clamp)
+        model.objects.filter(pk__in=[pk for pk, _ in chunk]).update(**changes, **values)
+
+
+class TransferStockService:
+    """
+    Set-based stock movements for one or many transfers.
+
+    Quantities are summed per inventory row across every transfer in the call and moved through
+    InventoryRowUpdater, so the statement count does not depend on the number of transfers or lines.
+    Callers are expected to run inside a transaction.
+    """
+
+    @staticmethod
+    def receive(transfers, received_quantities=None):
+        """
+        Move the stock of the given transfers from source to destination and mark their lines.
+        `received_quantities` maps line ids to the quantity that arrived; unlisted lines arrive in full.
+        Returns the ids of the inventory rows that changed.
+        """
+        from django.core.exceptions import ValidationError
+        from .models import TransferLine
+
+        received_quantities = received_quantities or {}
+        transfers = {transfer.pk: transfer for transfer in transfers}
+        lines = list(TransferLine.objects.filter(transfer_id__in=transfers).order_by('id'))
+        shipped = {}
+        received = {}
+        for line in lines:
+            qty = received_quantities.get(line.id, line.requested_qty)
+            if qty < 0 or qty > line.requested_qty:
+                raise ValidationError(
+                    f"Received quantity for line {line.id} must be between 0 and {line.requested_qty}."
+                )
+            transfer = transfers[line.transfer_id]
+            source_key = TransferStockService._source_slot(transfer) + (line.product_id, line.variant_id)
+            destination_key = TransferStockService._destination_slot(transfer) + (line.product_id, line.variant_id)
+            shipped[source_key] = shipped.get(source_key, 0) + line.requested_qty
+            received[destination_key] = received.get(destination_key, 0) + qty
+            line.transferred_qty = line.requested_qty
+            line.received_qty = qty
+
+        destination = InventoryRowUpdater.ensure_rows(received)
+        source = InventoryRowUpdater.rows(shipped)
+
+        InventoryRowUpdater.lock(set(source.values()) | set(destination.values()))
+        InventoryRowUpdater.apply(source, shipped, on_hand=-1, reserved=-1)
+        InventoryRowUpdater.apply(destination, received, on_hand=1)
+
+        for line in lines:
+            transfer = transfers[line.transfer_id]
+            product_key = (line.product_id, line.variant_id)
+            line.from_inventory_id = source.get(
+                TransferStockService._source_slot(transfer) + product_key, line.from_inventory_id
+            )
+            line.to_inventory_id = destination[TransferStockService._destination_slot(transfer) + product_key]
+        TransferLine.objects.bulk_update(
+            lines, ['transferred_qty', 'received_qty', 'from_inventory', 'to_inventory'],
+            batch_size=InventoryRowUpdater.UPDATE_CHUNK_SIZE,
+        )
+        return sorted(set(source.values()) | set(destination.values()))
+
+    @staticmethod
+    def release(transfers):
+        """
+        Release the source stock reserved by the given transfers.
+        Returns the ids of the inventory rows that changed.
+        """
+        from django.db.models import Sum
+        from .models import TransferLine
+
+        transfers = {transfer.pk: transfer for transfer in transfers}
+        reserved = {}
+        for row in (
+            TransferLine.objects.filter(transfer_id__in=transfers).order_by()
+            .values('transfer_id', 'product_id', 'variant_id').annotate(quantity=Sum('requested_qty'))
+        ):
+            key = TransferStockService._source_slot(transfers[row['transfer_id']]) + (row['product_id'], row['variant_id'])
+            reserved[key] = reserved.get(key, 0) + row['quantity']
+
+        source = InventoryRowUpdater.rows(reserved)
+        InventoryRowUpdater.lock(source.values())
+        InventoryRowUpdater.apply(source, reserved, reserved=-1)
+        return sorted(set(source.values()))
+
+    @staticmethod
+    def _source_slot(transfer):
+        return (transfer.from_warehouse_id, transfer.from_location_id, transfer.from_bin_id)
+
+    @staticmethod
+    def _destination_slot(transfer):
+        return (transfer.to_warehouse_id, transfer.to_location_id, transfer.to_bin_id)
+
+
+class TransferBulkService:
+    """
+    Applies one status transition to many transfers in a single transaction.
+
+    Permissions are resolved once for the acting user, the transfers are locked in id order
+    and their stock effects are executed through TransferStockService, so a request touching
+    hundreds of transfers costs a fixed number of statements. Each transfer gets its own outcome.
+    """
+
+    MAX_TRANSFERS = 500
+
+    MANAGER_ROLES = ['store_manager', 'admin', 'super_admin', 'warehouse_manager']
+
+    # action -> (statuses it may be applied to, resulting status)
+    TRANSITIONS = {
+        'approve': (['draft', 'requested'], 'approved'),
+        'reject': (['draft', 'requested'], 'rejected'),
+        'in_transit': (['approved'], 'in_transit'),
+        'receive': (['approved', 'in_transit'], 'received'),
+        'cancel': (['draft', 'requested', 'approved'], 'cancelled'),
+    }
+
+    @staticmethod
+    def transition(user, action, transfer_ids):
+        """
+        Apply `action` to the given transfer ids and return a list of per-transfer outcomes
+        """
+        from django.db import transaction
+        from .models import Transfer
+
+        if action not in TransferBulkService.TRANSITIONS:
+            raise ValueError(
+                f"Unknown action '{action}'. Expected one of: {', '.join(TransferBulkService.TRANSITIONS)}"
+            )
+        transfer_ids = sorted(set(transfer_ids))
+        if len(transfer_ids) > TransferBulkService.MAX_TRANSFERS:
+            raise ValueError(f"At most {TransferBulkService.MAX_TRANSFERS} transfers can be processed per request")
+
+        profile = getattr(user, 'userprofile', None)
+        role = profile.role if profile else None
+        allowed_from, new_status = TransferBulkService.TRANSITIONS[action]
+
+        outcomes = {}
+        with transaction.atomic():
+            transfers = {
+                transfer.pk: transfer
+                for transfer in Transfer.objects.select_for_update().filter(pk__in=transfer_ids).order_by('pk')
+            }
+            eligible = []
+            for transfer_id in transfer_ids:
+                transfer = transfers.get(transfer_id)
+                if transfer is None:
+                    outcomes[transfer_id] = {'id': transfer_id, 'success': False, 'error': 'Transfer not found.'}
+                elif not TransferBulkService._permitted(user, role, action, transfer):
+                    outcomes[transfer_id] = {
+                        'id': transfer_id, 'success': False,
+                        'error': f'You do not have permission to {action} this transfer.',
+                    }
+                elif transfer.status not in allowed_from:
+                    outcomes[transfer_id] = {
+                        'id': transfer_id, 'success': False,
+                        'error': f'Cannot {action} a transfer with status: {transfer.status}.',
+                    }
+                else:
+                    eligible.append(transfer)
+
+            touched = []
+            if action == 'receive' and eligible:
+                touched = TransferStockService.receive(eligible)
+            elif action == 'cancel':
+                # Only requested and approved transfers hold reserved stock
+                holding = [transfer for transfer in eligible if transfer.status in ['requested', 'approved']]
+                if holding:
+                    touched = TransferStockService.release(holding)
+
+            if eligible:
+                now = timezone.now()
+                changes = {'status': new_status}
+                if action in ['approve', 'reject']:
+                    changes.update(approved_by=user, approved_at=now)
+                elif action == 'receive':
+                    changes['received_at'] = now
+                Transfer.objects.filter(pk__in=[transfer.pk for transfer in eligible]).update(**changes)
+                for transfer in eligible:
+                    outcomes[transfer.pk] = {
+                        'id': transfer.pk, 'success': True,
+                        'previous_status': transfer.status, 'status': new_status,
+                    }
+
+            if touched:
+                transaction.on_commit(lambda: broadcast_inventory_rows(touched, f'transfers_{new_status}'))
+
+        return [outcomes[transfer_id] for transfer_id in transfer_ids]
+
+    @staticmethod
+    def _permitted(user, role, action, transfer):
+        if action in ['approve', 'reject', 'receive']:
+            return role in TransferBulkService.MANAGER_ROLES
+        if action == 'cancel':
+            return transfer.requested_by_id == user.pk or role in ['admin', 'super_admin']
+        return transfer.requested_by_id == user.pk or role in ['admin', 'super_admin', 'warehouse_manager']
+
+
+class ReplenishmentPlanner:
+    """
+    Plan stock replenishment across warehouses.
+
+    Stock, recent sales and inbound quantities are each read with one grouped query. Every
+    warehouse/SKU gets a target level of max(min_stock_level, daily velocity x cover days);
+    anything below target (after counting open transfers and purchase orders, drafts included) is a
+    deficit, anything above it is surplus that other warehouses may draw on. Draft transfers reserve
+    nothing at their source, so their quantities are taken off the source's available stock here;
+    planning again after create_drafts therefore does not draft the same moves twice. Deficits are matched
+    greedily against the nearest surplus and the remainder is left for purchase orders.
+    """
+
+    LOOKBACK_DAYS = 28
+    COVER_DAYS = 14
+
+    OPEN_TRANSFER_STATUSES = ['draft', 'requested', 'approved', 'in_transit']
+    OPEN_PURCHASE_ORDER_STATUSES = ['draft', 'pending', 'approved', 'ordered', 'in_transit', 'partially_received']
+
+    @staticmethod
+    def plan(warehouse_ids=None, lookback_days=None, cover_days=None, allow_transfers=True):
+        """
+        Build a replenishment plan. `warehouse_ids` limits which warehouses are replenished;
+        every active warehouse can still act as a transfer source.
+        """
+        import math
+
+        lookback_days = lookback_days or ReplenishmentPlanner.LOOKBACK_DAYS
+        cover_days = cover_days or ReplenishmentPlanner.COVER_DAYS
+        stock, coordinates = ReplenishmentPlanner._load_stock()
+        velocity = ReplenishmentPlanner._load_velocity(lookback_days)
+        inbound, drafted_out = ReplenishmentPlanner._load_inbound()
+        targets = set(warehouse_ids) if warehouse_ids else None
+
+        # SKUs that sell in a warehouse without an inventory row there still need stock
+        for key in velocity:
+            if key not in stock and key[0] in coordinates:
+                stock[key] = (0, 0)
+
+        deficits = {}
+        surplus = {}
+        for key, (available, min_level) in stock.items():
+            warehouse_id, product_id, variant_id = key
+            available -= drafted_out.get(key, 0)
+            daily = velocity.get(key, 0) / lookback_days
+            target = max(min_level, math.ceil(daily * cover_days))
+            position = available + inbound.get(key, 0)
+            if position < target and (targets is None or warehouse_id in targets):
+                deficits.setdefault((product_id, variant_id), []).append([warehouse_id, target - position])
+            elif available > target:
+                surplus.setdefault((product_id, variant_id), {})[warehouse_id] = available - target
+
+        transfers = {}
+        purchases = {}
+        for sku, needs in deficits.items():
+            sources = surplus.get(sku, {}) if allow_transfers else {}
+            # Largest deficits first so scarce surplus goes where it is needed most
+            for warehouse_id, needed in sorted(needs, key=lambda need: (-need[1], need[0])):
+                if sources:
+                    for source_id in ReplenishmentPlanner._by_distance(warehouse_id, sources, coordinates):
+                        if needed <= 0:
+                            break
+                        qty = min(needed, sources[source_id])
+                        transfers.setdefault((source_id, warehouse_id), []).append(
+                            {'product_id': sku[0], 'variant_id': sku[1], 'quantity': qty}
+                        )
+                        needed -= qty
+                        sources[source_id] -= qty
+                        if not sources[source_id]:
+                            del sources[source_id]
+                if needed > 0:
+                    purchases.setdefault(warehouse_id, []).append(
+                        {'product_id': sku[0], 'variant_id': sku[1], 'quantity': needed}
+                    )
+
+        return {
+            'lookback_days': lookback_days,
+            'cover_days': cover_days,
+            'transfers': [
+                {'from_warehouse_id': source_id, 'to_warehouse_id': warehouse_id, 'lines': lines}
+                for (source_id, warehouse_id), lines in sorted(transfers.items())
+            ],
+            'purchase_orders': [
+                {'warehouse_id': warehouse_id, 'lines': lines}
+                for warehouse_id, lines in sorted(purchases.items())
+            ],
+            'transfer_units': sum(line['quantity'] for lines in transfers.values() for line in lines),
+            'purchase_units': sum(line['quantity'] for lines in purchases.values() for line in lines),
+        }
+
+    @staticmethod
+    def create_drafts(plan, user):
+        """
+        Persist a plan as draft transfers and purchase orders using bulk inserts.
+        Returns (transfers, purchase_orders).
+        """
+        from decimal import Decimal
+        from django.db import transaction
+        from .models import Product, PurchaseOrder, PurchaseOrderLine, Transfer, TransferLine
+
+        with transaction.atomic():
+            transfer_numbers = ReplenishmentPlanner._numbers(
+                'transfer', [draft['from_warehouse_id'] for draft in plan['transfers']]
+            )
+            transfers = Transfer.objects.bulk_create([
+                Transfer(
+                    transfer_number=number,
+                    from_warehouse_id=draft['from_warehouse_id'], to_warehouse_id=draft['to_warehouse_id'],
+                    requested_by=user, status='draft', notes='Generated by replenishment planner',
+                )
+                for draft, number in zip(plan['transfers'], transfer_numbers)
+            ])
+            TransferLine.objects.bulk_create([
+                TransferLine(
+                    transfer_id=transfer.pk, product_id=line['product_id'],
+                    variant_id=line['variant_id'], requested_qty=line['quantity'],
+                )
+                for transfer, draft in zip(transfers, plan['transfers'])
+                for line in draft['lines']
+            ])
+
+            product_ids = {line['product_id'] for draft in plan['purchase_orders'] for line in draft['lines']}
+            costs = {
+                product_id: cost_price or price
+                for product_id, cost_price, price in Product.objects.filter(pk__in=product_ids)
+                .values_list('pk', 'cost_price', 'price')
+            }
+            purchase_lines = []
+            orders = []
+            order_numbers = ReplenishmentPlanner._numbers(
+                'purchase_order', [draft['warehouse_id'] for draft in plan['purchase_orders']]
+            )
+            for draft, number in zip(plan['purchase_orders'], order_numbers):
+                lines = [
+                    PurchaseOrderLine(
+                        product_id=line['product_id'], variant_id=line['variant_id'],
+                        ordered_qty=line['quantity'], unit_cost=costs[line['product_id']],
+                        total_price=costs[line['product_id']] * line['quantity'],
+                    )
+                    for line in draft['lines']
+                ]
+                subtotal = sum((line.total_price for line in lines), Decimal('0'))
+                orders.append(PurchaseOrder(
+                    po_number=number,
+                    warehouse_id=draft['warehouse_id'],
+                    status='draft', subtotal=subtotal, total_amount=subtotal,
+                    notes='Generated by replenishment planner',
+                ))
+                purchase_lines.append(lines)
+            orders = PurchaseOrder.objects.bulk_create(orders)
+            for order, lines in zip(orders, purchase_lines):
+                for line in lines:
+                    line.purchase_order_id = order.pk
+            PurchaseOrderLine.objects.bulk_create([line for lines in purchase_lines for line in lines])
+
+        return transfers, orders
+
+    @staticmethod
+    def _load_stock():
+        """
+        Return ({(warehouse, product, variant): (available, min_level)}, {warehouse: (lat, lng) or None})
+        for active warehouses
+        """
+        from django.db.models import F, Sum
+        from .models import Inventory, Warehouse
+
+        stock = {
+            (warehouse_id, product_id, variant_id): (available or 0, min_level or 0)
+            for warehouse_id, product_id, variant_id, available, min_level in (
+                Inventory.objects.filter(warehouse__is_active=True, product__is_active=True)
+                .order_by()
+                .values('warehouse_id', 'product_id', 'variant_id')
+                .annotate(available=Sum(F('qty_on_hand') - F('qty_reserved')), min_level=Sum('min_stock_level'))
+                .values_list('warehouse_id', 'product_id', 'variant_id', 'available', 'min_level')
+                .iterator(chunk_size=5000)
+            )
+        }
+        coordinates = {
+            warehouse_id: (
+                (float(latitude), float(longitude)) if latitude is not None and longitude is not None else None
+            )
+            for warehouse_id, latitude, longitude in Warehouse.objects.filter(is_active=True)
+            .values_list('id', 'latitude', 'longitude')
+        }
+        return stock, coordinates
+
+    @staticmethod
+    def _load_velocity(lookback_days):
+        """
+        Units sold per (warehouse, product, variant) over the lookback window
+        """
+        from datetime import timedelta
+        from django.db.models import Sum
+        from .models import SaleLine
+
+        since = timezone.now() - timedelta(days=lookback_days)
+        return {
+            (warehouse_id, product_id, variant_id): sold
+            for warehouse_id, product_id, variant_id, sold in (
+                SaleLine.objects.filter(
+                    sale__sale_date__gte=since, sale__payment_status='completed', sale__sale_type='sale'
+                )
+                .order_by()
+                .values('sale__warehouse_id', 'product_id', 'variant_id')
+                .annotate(sold=Sum('quantity'))
+                .values_list('sale__warehouse_id', 'product_id', 'variant_id', 'sold')
+                .iterator(chunk_size=5000)
+            )
+        }
+
+    @staticmethod
+    def _numbers(document_type, warehouse_ids):
+        """
+        Document numbers for a batch, in order, taken as one block per warehouse
+        """
+        counts = {}
+        for warehouse_id in warehouse_ids:
+            counts[warehouse_id] = counts.get(warehouse_id, 0) + 1
+        numbers = {
+            warehouse_id: iter(DocumentNumberService.take(document_type, warehouse_id, count))
+            for warehouse_id, count in counts.items()
+        }
+        return [next(numbers[warehouse_id]) for warehouse_id in warehouse_ids]
+
+    @staticmethod
+    def _load_inbound():
+        """
+        Units already on their way per (warehouse, product, variant) from open transfers and purchase
+        orders, and units drafted to leave each warehouse by draft transfers, as (inbound, drafted_out)
+        """
+        from django.db.models import F, Sum
+        from .models import PurchaseOrderLine, TransferLine
+
+        inbound = {}
+        transfer_rows = TransferLine.objects.filter(
+            transfer__status__in=ReplenishmentPlanner.OPEN_TRANSFER_STATUSES
+        ).order_by().values('transfer__to_warehouse_id', 'product_id', 'variant_id').annotate(
+            qty=Sum(F('requested_qty') - F('received_qty'))
+        ).values_list('transfer__to_warehouse_id', 'product_id', 'variant_id', 'qty')
+        order_rows = PurchaseOrderLine.objects.filter(
+            purchase_order__status__in=ReplenishmentPlanner.OPEN_PURCHASE_ORDER_STATUSES
+        ).order_by().values('purchase_order__warehouse_id', 'product_id', 'variant_id').annotate(
+            qty=Sum(F('ordered_qty') - F('received_qty'))
+        ).values_list('purchase_order__warehouse_id', 'product_id', 'variant_id', 'qty')
+        for rows in (transfer_rows, order_rows):
+            for warehouse_id, product_id, variant_id, qty in rows:
+                key = (warehouse_id, product_id, variant_id)
+                inbound[key] = inbound.get(key, 0) + max(qty or 0, 0)
+        drafted_out = {
+            (warehouse_id, product_id, variant_id): qty or 0
+            for warehouse_id, product_id, variant_id, qty in TransferLine.objects.filter(transfer__status='draft')
+            .order_by().values('transfer__from_warehouse_id', 'product_id', 'variant_id')
+            .annotate(qty=Sum('requested_qty'))
+            .values_list('transfer__from_warehouse_id', 'product_id', 'variant_id', 'qty')
+        }
+        return inbound, drafted_out
+
+    @staticmethod
+    def _by_distance(warehouse_id, sources, coordinates):
+        origin = coordinates.get(warehouse_id)
+
+        def distance(source_id):
+            destination = coordinates.get(source_id)
+            if origin is None or destination is None:
+                return float('inf')
+            return FulfillmentPlanner.distance_km(origin, destination)
+
+        # Nearest first; without coordinates, prefer the largest surplus
+        return sorted(sources, key=lambda source_id: (distance(source_id), -sources[source_id], source_id))
+
+
+class DemandForecastService:
+    """
+    Builds the nightly DemandForecast table from completed sales.
+
+    Daily unit sales for every warehouse/SKU pair over the history window are loaded with one
+    grouped query into a NumPy matrix (pairs x days). Moving averages, the exponentially smoothed
+    level, weekday seasonality and the planning outputs are then computed column-wise for all
+    pairs at once. The smoothed level is carried over between runs, so a nightly refresh only
+    feeds in the days after each pair's `computed_through` date.
+    """
+
+    HISTORY_DAYS = 56
+    ALPHA = 0.3
+    LEAD_TIME_DAYS = 7
+    SERVICE_LEVEL_Z = 1.65
+    # Units of history needed before weekday factors are trusted fully
+    SEASONALITY_SHRINK_UNITS = 20
+    WRITE_BATCH_SIZE = 2000
+
+    @staticmethod
+    def refresh(as_of=None, full=False, warehouse_ids=None):
+        """
+        Recompute forecasts through `as_of` (default: yesterday). With `full`, the smoothed level is
+        rebuilt from the history window instead of continuing from the stored state.
+        Returns a summary of the run.
+        """
+        import math
+        import time
+        from datetime import timedelta
+        import numpy as np
+        from .models import DemandForecast
+
+        started = time.monotonic()
+        as_of = as_of or timezone.localdate() - timedelta(days=1)
+        history = DemandForecastService.HISTORY_DAYS
+        start = as_of - timedelta(days=history - 1)
+
+        existing_rows = DemandForecast.objects.all()
+        if warehouse_ids:
+            existing_rows = existing_rows.filter(warehouse_id__in=warehouse_ids)
+        state = {
+            (warehouse_id, product_id, variant_id): (pk, level, computed_through)
+            for pk, warehouse_id, product_id, variant_id, level, computed_through in existing_rows.values_list(
+                'pk', 'warehouse_id', 'product_id', 'variant_id', 'smoothed_daily', 'computed_through'
+            ).iterator(chunk_size=10000)
+        }
+
+        keys, rows, cols, quantities = DemandForecastService._load_daily_sales(start, as_of, warehouse_ids)
+        index = {key: i for i, key in enumerate(keys)}
+        for key in state:
+            if key not in index:
+                index[key] = len(keys)
+                keys.append(key)
+        if not keys:
+            return {'as_of': as_of.isoformat(), 'pairs': 0, 'created': 0, 'updated': 0, 'pruned': 0,
+                    'duration_ms': round((time.monotonic() - started) * 1000)}
+
+        sales = np.zeros((len(keys), history), dtype=np.float32)
+        sales[np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)] = quantities
+
+        # Exponential smoothing, continuing each pair's stored level where possible
+        level = sales.mean(axis=1, dtype=np.float64)
+        first_day = np.zeros(len(keys), dtype=np.int64)
+        if not full:
+            for key, (_, stored_level, computed_through) in state.items():
+                offset = (computed_through - start).days + 1
+                if offset > 0:
+                    i = index[key]
+                    level[i] = stored_level
+                    first_day[i] = offset
+        alpha = DemandForecastService.ALPHA
+        for day in range(int(first_day.min()), history):
+            active = first_day <= day
+            level[active] = alpha * sales[active, day] + (1 - alpha) * level[active]
+
+        avg_7 = sales[:, -7:].mean(axis=1)
+        avg_28 = sales[:, -28:].mean(axis=1)
+        std = sales.std(axis=1)
+        totals = sales.sum(axis=1)
+        mean = totals / history
+
+        # Weekday multipliers, shrunk towards 1 for pairs with little history
+        weekdays = np.array([(start + timedelta(days=day)).weekday() for day in range(history)])
+        factors = np.ones((len(keys), 7))
+        for weekday in range(7):
+            columns = weekdays == weekday
+            weekday_mean = sales[:, columns].mean(axis=1)
+            factors[:, weekday] = np.divide(weekday_mean, mean, out=np.ones(len(keys)), where=mean > 0)
+        weight = totals / (totals + DemandForecastService.SEASONALITY_SHRINK_UNITS)
+        factors = 1 + (factors - 1) * weight[:, None]
+
+        available = DemandForecastService._load_available(keys)
+        lead = DemandForecastService.LEAD_TIME_DAYS
+        suggested = np.ceil(level * lead + DemandForecastService.SERVICE_LEVEL_Z * std * math.sqrt(lead))
+        cover = np.divide(available, level, out=np.full(len(keys), np.nan), where=level > 1e-6)
+
+        to_create = []
+        to_update = []
+        pruned = []
+        for i, key in enumerate(keys):
+            existing = state.get(key)
+            if totals[i] == 0:
+                # Nothing sold in the whole window: drop the pair to keep the table compact
+                if existing:
+                    pruned.append(existing[0])
+                continue
+            forecast = DemandForecast(
+                warehouse_id=key[0], product_id=key[1], variant_id=key[2],
+                avg_daily_7=round(float(avg_7[i]), 4), avg_daily_28=round(float(avg_28[i]), 4),
+                smoothed_daily=float(level[i]), std_daily=round(float(std[i]), 4),
+                weekday_factors=[round(float(factor), 3) for factor in factors[i]],
+                available_stock=int(available[i]),
+                days_of_cover=None if np.isnan(cover[i]) else round(float(cover[i]), 2),
+                suggested_min_level=int(suggested[i]),
+                computed_through=as_of,
+            )
+            if existing:
+                forecast.pk = existing[0]
+                to_update.append(forecast)
+            else:
+                to_create.append(forecast)
+
+        from django.db import transaction
+        with transaction.atomic():
+            batch = DemandForecastService.WRITE_BATCH_SIZE
+            DemandForecast.objects.bulk_create(to_create, batch_size=batch)
+            DemandForecast.objects.bulk_update(to_update, [
+                'avg_daily_7', 'avg_daily_28', 'smoothed_daily', 'std_daily', 'weekday_factors',
+                'available_stock', 'days_of_cover', 'suggested_min_level', 'computed_through',
+            ], batch_size=batch)
+            for offset in range(0, len(pruned), batch):
+                DemandForecast.objects.filter(pk__in=pruned[offset:offset + batch]).delete()
+
+        return {
+            'as_of': as_of.isoformat(),
+            'pairs': len(to_create) + len(to_update),
+            'created': len(to_create),
+            'updated': len(to_update),
+            'pruned': len(pruned),
+            'duration_ms': round((time.monotonic() - started) * 1000),
+        }
+
+    @staticmethod
+    def _load_daily_sales(start, end, warehouse_ids=None):
+        """
+        Return (keys, row indexes, day offsets, quantities) for units sold per pair and day
+        """
+        from datetime import datetime, time, timedelta
+        from django.db.models import Sum
+        from django.db.models.functions import TruncDate
+        from .models import SaleLine
+
+        tz = timezone.get_current_timezone()
+        queryset = SaleLine.objects.filter(
+            sale__payment_status='completed', sale__sale_type='sale',
+            sale__sale_date__gte=timezone.make_aware(datetime.combine(start, time.min), tz),
+            sale__sale_date__lt=timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min), tz),
+        )
+        if warehouse_ids:
+            queryset = queryset.filter(sale__warehouse_id__in=warehouse_ids)
+
+        keys = []
+        index = {}
+        rows, cols, quantities = [], [], []
+        for warehouse_id, product_id, variant_id, day, sold in (
+            queryset.order_by()
+            .annotate(day=TruncDate('sale__sale_date', tzinfo=tz))
+            .values('sale__warehouse_id', 'product_id', 'variant_id', 'day')
+            .annotate(sold=Sum('quantity'))
+            .values_list('sale__warehouse_id', 'product_id', 'variant_id', 'day', 'sold')
+            .iterator(chunk_size=10000)
+        ):
+            key = (warehouse_id, product_id, variant_id)
+            i = index.get(key)
+            if i is None:
+                i = index[key] = len(keys)
+                keys.append(key)
+            rows.append(i)
+            cols.append((day - start).days)
+            quantities.append(sold)
+        return keys, rows, cols, quantities
+
+    @staticmethod
+    def _load_available(keys):
+        import numpy as np
+        from django.db.models import F, Sum
+        from .models import Inventory
+
+        available = {
+            (warehouse_id, product_id, variant_id): qty or 0
+            for warehouse_id, product_id, variant_id, qty in Inventory.objects.filter(
+                warehouse_id__in={key[0] for key in keys}
+            ).order_by().values('warehouse_id', 'product_id', 'variant_id').annotate(
+                available=Sum(F('qty_on_hand') - F('qty_reserved'))
+            ).values_list('warehouse_id', 'product_id', 'variant_id', 'available').iterator(chunk_size=10000)
+        }
+        return np.array([max(available.get(key, 0), 0) for key in keys], dtype=np.float64)
+
+
+class GoodsReceivingService:
+    """
+    Posts goods received notes against purchase orders.
+
+    The purchase order and its lines are locked, the GRN lines are inserted with one bulk_create,
+    the accepted quantities are added to inventory through InventoryRowUpdater and the purchase
+    order lines are updated with one bulk_update, all in a single transaction.
+    Lines whose condition is not stockable (e.g. Damaged, Missing) count as received but are not
+    put into stock, so they remain visible as received_qty - processed_qty.
+    """
+
+    RECEIVABLE_STATUSES = ['approved', 'ordered', 'in_transit', 'partially_received']
+    STOCKABLE_CONDITIONS = ['good']
+
+    @staticmethod
+    def post(purchase_order, lines_data, received_by, **grn_fields):
+        """
+        Create and post a GRN. `lines_data` holds dicts with purchase_order_line (instance or id),
+        received_qty and optional condition, notes, destination_location and destination_bin.
+        Returns the GRN.
+        """
+        from django.core.exceptions import ValidationError
+        from django.db import transaction
+        from django.db.models import F
+        from .models import GoodsReceivedNote, GoodsReceivedNoteLine, PurchaseOrder, PurchaseOrderLine
+
+        if not lines_data:
+            raise ValidationError("GRN must have at least one line item.")
+
+        with transaction.atomic():
+            order = PurchaseOrder.objects.select_for_update().get(pk=getattr(purchase_order, 'pk', purchase_order))
+            if order.status not in GoodsReceivingService.RECEIVABLE_STATUSES:
+                raise ValidationError(f"Cannot receive goods against a purchase order with status: {order.status}.")
+            order_lines = {
+                line.pk: line
+                for line in PurchaseOrderLine.objects.select_for_update().filter(purchase_order=order).order_by('pk')
+            }
+
+            grn = GoodsReceivedNote.objects.create(purchase_order=order, received_by=received_by, **grn_fields)
+            grn_lines = []
+            stocked = {}
+            line_increments = {}
+            for data in lines_data:
+                line_id = getattr(data['purchase_order_line'], 'pk', data['purchase_order_line'])
+                order_line = order_lines.get(line_id)
+                if order_line is None:
+                    raise ValidationError(f"Line {line_id} does not belong to purchase order {order.po_number}.")
+                qty = data['received_qty']
+                if qty <= 0:
+                    raise ValidationError("Received quantity must be greater than zero.")
+                if qty > order_line.ordered_qty - order_line.received_qty:
+                    raise ValidationError(
+                        f"Cannot receive {qty} of {order_line.product_id}: only "
+                        f"{order_line.ordered_qty - order_line.received_qty} outstanding on line {line_id}."
+                    )
+
+                grn_line = GoodsReceivedNoteLine(
+                    grn=grn, purchase_order_line=order_line, received_qty=qty,
+                    condition=data.get('condition') or 'Good', notes=data.get('notes', ''),
+                    destination_location=data.get('destination_location'),
+                    destination_bin=data.get('destination_bin'),
+                )
+                grn_lines.append(grn_line)
+                order_line.received_qty += qty
+
+                if grn_line.condition.lower() in GoodsReceivingService.STOCKABLE_CONDITIONS:
+                    # The most specific destination wins: GRN line, then PO line, then PO
+                    if grn_line.destination_location_id or grn_line.destination_bin_id:
+                        slot = (grn_line.destination_location_id, grn_line.destination_bin_id)
+                    elif order_line.destination_location_id or order_line.destination_bin_id:
+                        slot = (order_line.destination_location_id, order_line.destination_bin_id)
+                    else:
+                        slot = (order.destination_location_id, order.destination_bin_id)
+                    key = (order.warehouse_id,) + slot + (order_line.product_id, order_line.variant_id)
+                    stocked[key] = stocked.get(key, 0) + qty
+                    processed_qty = qty
+                else:
+                    processed_qty = 0
+                received, processed = line_increments.get(line_id, (0, 0))
+                line_increments[line_id] = (received + qty, processed + processed_qty)
+
+            GoodsReceivedNoteLine.objects.bulk_create(grn_lines, batch_size=InventoryRowUpdater.UPDATE_CHUNK_SIZE)
+
+            rows = InventoryRowUpdater.ensure_rows(stocked)
+            InventoryRowUpdater.lock(rows.values())
+            InventoryRowUpdater.apply(rows, stocked, on_hand=1)
+
+            bulk_increment(PurchaseOrderLine, line_increments, ('received_qty', 'processed_qty'))
+
+            outstanding = PurchaseOrderLine.objects.filter(
+                purchase_order=order, received_qty__lt=F('ordered_qty')
+            ).exists()
+            order.status = 'partially_received' if outstanding else 'received'
+            changes = {'status': order.status, 'updated_at': timezone.now()}
+            if not outstanding:
+                order.received_date = changes['received_date'] = timezone.now()
+            PurchaseOrder.objects.filter(pk=order.pk).update(**changes)
+
+            touched = sorted(set(rows.values()))
+            if touched:
+                transaction.on_commit(lambda: broadcast_inventory_rows(touched, 'goods_received'))
+
+        return grn
+
+
+class IndexedPromotion:
+    """
+    Read-only snapshot of a Promotion and its M2M restrictions, as held by PromotionIndex
+    """
+
+    def __init__(self, row, products=(), categories=(), groups=(), required_products=(), bonus_products=()):
+        self.id = row['id']
+        self.name = row['name']
+        self.promotion_type = row['promotion_type']
+        self.discount_value = Decimal(row['discount_value'])
+        self.buy_quantity = row['buy_quantity'] or 0
+        self.get_quantity = row['get_quantity'] or 0
+        self.min_order_value = Decimal(row['min_order_value'] or 0)
+        self.products = frozenset(products)
+        self.categories = frozenset(categories)
+        self.groups = frozenset(groups)
+        self.required_products = frozenset(required_products)
+        self.bonus_products = frozenset(bonus_products)
+
+    def applies_to(self, product_id, category_id):
+        """
+        Product and category restrictions must both pass, as in Promotion.calculate_discount: an empty
+        restriction allows everything, and a category restriction does not exclude uncategorized products
+        """
+        return ((not self.products or product_id in self.products) and
+                (not self.categories or category_id is None or category_id in self.categories))
+
+    def is_eligible(self, group_ids, subtotal):
+        return ((not self.groups or not self.groups.isdisjoint(group_ids)) and
+                subtotal >= self.min_order_value)
+
+    def line_discount(self, quantity, unit_price):
+        """
+        Discount for a single line, mirroring Promotion.calculate_discount
+        """
+        if self.promotion_type == 'percentage':
+            return unit_price * quantity * self.discount_value / 100
+        if self.promotion_type == 'fixed_amount':
+            return min(self.discount_value, unit_price * quantity)
+        if self.promotion_type == 'buy_x_get_y' and self.buy_quantity and self.get_quantity:
+            return (quantity // (self.buy_quantity + self.get_quantity)) * self.get_quantity * unit_price
+        return Decimal('0')
+
+
+class PromotionIndex:
+    """
+    In-process index of the promotions that are currently valid, keyed by product and category.
+
+    All promotions and their M2M restrictions are loaded with a fixed number of queries. The index
+    is valid until the next promotion starts or ends, or REFRESH_SECONDS pass, whichever is first.
+    It is also dropped by the promotion save/delete and M2M signals, so edits in this process are
+    visible immediately and edits made elsewhere after at most REFRESH_SECONDS.
+    """
+
+    REFRESH_SECONDS = 60
+
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, promotions, valid_until):
+        self.promotions = {promotion.id: promotion for promotion in promotions}
+        self.valid_until = valid_until
+        self.by_product = {}
+        self.by_category = {}
+        self.category_restricted = []
+        self.unrestricted = []
+        self.bundles_by_product = {}
+        self._candidates = {}
+        self._line_options = {}
+        for promotion in promotions:
+            if promotion.promotion_type == 'bundle':
+                # Bundles are matched on their required products by BasketPromotionSolver
+                for product_id in promotion.required_products:
+                    self.bundles_by_product.setdefault(product_id, []).append(promotion)
+            # Product restrictions are the most selective, so index under those first
+            elif promotion.products:
+                for product_id in promotion.products:
+                    self.by_product.setdefault(product_id, []).append(promotion)
+            elif promotion.categories:
+                self.category_restricted.append(promotion)
+                for category_id in promotion.categories:
+                    self.by_category.setdefault(category_id, []).append(promotion)
+            else:
+                self.unrestricted.append(promotion)
+
+    @classmethod
+    def get(cls, now=None):
+        """
+        Return the shared index, rebuilding it if it was invalidated or its window has passed
+        """
+        now = now or timezone.now()
+        with cls._lock:
+            instance = cls._instance
+            if instance is None or now >= instance.valid_until:
+                instance = cls.load(now)
+                cls._instance = instance
+            return instance
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Drop the shared index; it is rebuilt on next use
+        """
+        cls._instance = None
+
+    @classmethod
+    def load(cls, now):
+        from datetime import timedelta
+        from django.db.models import F, Q
+        from .models import Promotion
+
+        valid_until = now + timedelta(seconds=cls.REFRESH_SECONDS)
+        rows = []
+        for row in Promotion.objects.filter(is_active=True, end_date__gte=now).filter(
+            Q(max_usage_count__isnull=True) | Q(used_count__lt=F('max_usage_count'))
+        ).values(
+            'id', 'name', 'promotion_type', 'discount_value', 'buy_quantity', 'get_quantity',
+            'min_order_value', 'start_date', 'end_date',
+        ):
+            if row['start_date'] > now:
+                valid_until = min(valid_until, row['start_date'])
+            else:
+                valid_until = min(valid_until, row['end_date'])
+                rows.append(row)
+
+        ids = [row['id'] for row in rows]
+        relations = {}
+        for name, through, column in (
+            ('products', Promotion.products.through, 'product_id'),
+            ('categories', Promotion.categories.through, 'category_id'),
+            ('groups', Promotion.customer_groups.through, 'group_id'),
+            ('required_products', Promotion.required_products.through, 'product_id'),
+            ('bonus_products', Promotion.bonus_products.through, 'product_id'),
+        ):
+            related = relations[name] = {}
+            if ids:
+                for promotion_id, related_id in through.objects.filter(
+                    promotion_id__in=ids
+                ).values_list('promotion_id', column):
+                    related.setdefault(promotion_id, []).append(related_id)
+
+        promotions = [
+            IndexedPromotion(row, **{name: related.get(row['id'], ()) for name, related in relations.items()})
+            for row in rows
+        ]
+        return cls(promotions, valid_until)
+
+    def candidates(self, product_id, category_id):
+        """
+        Line promotions that apply to a product, in id order
+        """
+        key = (product_id, category_id)
+        cached = self._candidates.get(key)
+        if cached is None:
+            cached = self._candidates[key] = self._collect(product_id, category_id)
+        return cached
+
+    def line_options(self, product_id, category_id):
+        """
+        Line promotions for a product grouped by kind, best first within each group. Within a group
+        a promotion can never beat the one ranked above it, so pricing only needs the first eligible
+        one: the largest percentage, the largest fixed amount, and one buy X get Y per (X, Y).
+        """
+        key = (product_id, category_id)
+        cached = self._line_options.get(key)
+        if cached is None:
+            groups = {}
+            for promotion in self.candidates(product_id, category_id):
+                if promotion.promotion_type == 'buy_x_get_y':
+                    group = (promotion.promotion_type, promotion.buy_quantity, promotion.get_quantity)
+                else:
+                    group = (promotion.promotion_type,)
+                groups.setdefault(group, []).append(promotion)
+            cached = self._line_options[key] = [
+                sorted(ranked, key=lambda promotion: (-promotion.discount_value, promotion.id))
+                for ranked in groups.values()
+            ]
+        return cached
+
+    def bundles_for(self, product_ids):
+        """
+        Bundle promotions whose required and bonus products are all among product_ids, in id order
+        """
+        product_ids = set(product_ids)
+        found = {}
+        for product_id in product_ids:
+            for promotion in self.bundles_by_product.get(product_id, ()):
+                found[promotion.id] = promotion
+        return [
+            found[key] for key in sorted(found)
+            if found[key].required_products <= product_ids and found[key].bonus_products <= product_ids
+        ]
+
+    def _collect(self, product_id, category_id):
+        found = {}
+        for promotion in self.by_product.get(product_id, ()):
+            found[promotion.id] = promotion
+        # Uncategorized products are not excluded by category restrictions
+        in_category = self.category_restricted if category_id is None else self.by_category.get(category_id, ())
+        for promotion in in_category:
+            found[promotion.id] = promotion
+        for promotion in self.unrestricted:
+            found[promotion.id] = promotion
+        return [found[key] for key in sorted(found) if found[key].applies_to(product_id, category_id)]
+
+
+class BasketPromotionSolver:
+    """
+    Allocates promotions across a whole basket so that the total discount is as large as possible.
+
+    Each unit in the basket can be claimed by at most one promotion. A bundle application claims
+    one unit of each of its required and bonus products; units left on a line then get the best
+    line promotion (percentage, fixed amount, or buy X get Y of the same product).
+
+    While the number of bundle application combinations is at most DP_STATE_LIMIT the allocation
+    is exact, found by a memoised search over how many times each bundle is applied. Beyond that a
+    greedy pass applies bundles in order of marginal gain while the gain stays positive; its
+    result is a feasible allocation and so a lower bound on the optimum.
+    """
+
+    DP_STATE_LIMIT = 4096
+
+    def __init__(self, lines, index, group_ids=(), subtotal=None):
+        self.zero = Decimal('0')
+        self.prices = [line['unit_price'] for line in lines]
+        self.quantities = [line['quantity'] for line in lines]
+        if subtotal is None:
+            subtotal = sum((price * quantity for price, quantity in zip(self.prices, self.quantities)), self.zero)
+        group_ids = frozenset(group_ids)
+
+        eligible = {}
+
+        def is_eligible(promotion):
+            if promotion.id not in eligible:
+                eligible[promotion.id] = promotion.is_eligible(group_ids, subtotal)
+            return eligible[promotion.id]
+
+        # Only the best eligible promotion of each kind can win a line, see PromotionIndex.line_options
+        chosen = {}
+        self.line_promotions = []
+        for line in lines:
+            key = (line['product_id'], line['category_id'])
+            if key not in chosen:
+                chosen[key] = [
+                    next((promotion for promotion in ranked if is_eligible(promotion)), None)
+                    for ranked in index.line_options(*key)
+                ]
+                chosen[key] = [promotion for promotion in chosen[key] if promotion is not None]
+            self.line_promotions.append(chosen[key])
+
+        # Lines of each product, cheapest first, so bundles give up as little line discount as possible
+        self.product_lines = {}
+        for position in sorted(range(len(lines)), key=self.prices.__getitem__):
+            self.product_lines.setdefault(lines[position]['product_id'], []).append(position)
+
+        self.bundles = []
+        for promotion in index.bundles_for(self.product_lines):
+            if not promotion.required_products or not is_eligible(promotion):
+                continue
+            needs = [(product_id, False) for product_id in sorted(promotion.required_products)]
+            needs += [(product_id, True) for product_id in sorted(promotion.bonus_products)]
+            per_product = {}
+            for product_id, _ in needs:
+                per_product[product_id] = per_product.get(product_id, 0) + 1
+            limit = min(
+                sum(self.quantities[position] for position in self.product_lines[product_id]) // count
+                for product_id, count in per_product.items()
+            )
+            if limit:
+                self.bundles.append((promotion, needs, limit))
+        self._line_best = {}
+
+    def solve(self):
+        """
+        Return {'allocations': [{IndexedPromotion: discount}, ...] per line, 'exact': bool}
+        """
+        counts = [0] * len(self.bundles)
+        exact = True
+        for bundles in self._components():
+            lines = sorted({
+                position for bundle in bundles for product_id, _ in self.bundles[bundle][1]
+                for position in self.product_lines[product_id]
+            })
+            states = 1
+            for bundle in bundles:
+                states *= self.bundles[bundle][2] + 1
+                if states > self.DP_STATE_LIMIT:
+                    break
+            if states <= self.DP_STATE_LIMIT:
+                chosen = self._search(bundles, lines, 0, self.quantities, {})[1]
+            else:
+                # Components share no lines, so each can start from the full quantities
+                chosen = self._greedy(bundles, list(self.quantities))
+                exact = False
+            for bundle, count in zip(bundles, chosen):
+                counts[bundle] = count
+        return {'allocations': self._allocate(counts), 'exact': exact}
+
+    def _components(self):
+        """
+        Group bundles that compete for the same products; separate groups are solved independently
+        """
+        owner = {}
+        parent = list(range(len(self.bundles)))
+
+        def find(bundle):
+            while parent[bundle] != bundle:
+                parent[bundle] = parent[parent[bundle]]
+                bundle = parent[bundle]
+            return bundle
+
+        for bundle, (_, needs, _) in enumerate(self.bundles):
+            for product_id, _ in needs:
+                if product_id in owner:
+                    parent[find(bundle)] = find(owner[product_id])
+                else:
+                    owner[product_id] = bundle
+        components = {}
+        for bundle in range(len(self.bundles)):
+            components.setdefault(find(bundle), []).append(bundle)
+        return list(components.values())
+
+    def line_best(self, position, quantity):
+        """
+        Best (discount, promotion) for the given number of units left on a line
+        """
+        key = (position, quantity)
+        best = self._line_best.get(key)
+        if best is None:
+            best = (self.zero, None)
+            if quantity:
+                price = self.prices[position]
+                for promotion in self.line_promotions[position]:
+                    discount = promotion.line_discount(quantity, price)
+                    if discount > best[0]:
+                        best = (discount, promotion)
+            self._line_best[key] = best
+        return best
+
+    def _take(self, needs, remaining):
+        """
+        Claim one application's units from the cheapest lines; returns None (claiming nothing) if short
+        """
+        taken = []
+        for product_id, bonus in needs:
+            for position in self.product_lines[product_id]:
+                if remaining[position]:
+                    remaining[position] -= 1
+                    taken.append((position, bonus))
+                    break
+            else:
+                self._release(taken, remaining)
+                return None
+        return taken
+
+    @staticmethod
+    def _release(taken, remaining):
+        for position, _ in taken:
+            remaining[position] += 1
+
+    def _shares(self, promotion, taken):
+        """
+        Split one bundle application's discount over the lines whose units it claimed.
+        Bundles with bonus products give those units away; others take discount_value off the set.
+        """
+        if promotion.bonus_products:
+            return [(position, self.prices[position]) for position, bonus in taken if bonus]
+        set_price = sum((self.prices[position] for position, _ in taken), self.zero)
+        if not set_price:
+            return []
+        discount = min(promotion.discount_value, set_price)
+        return [(position, discount * self.prices[position] / set_price) for position, _ in taken]
+
+    def _search(self, bundles, lines, depth, remaining, memo):
+        """
+        Best (discount over lines, application counts) for bundles[depth:] given the units remaining
+        """
+        if depth == len(bundles):
+            value = sum((self.line_best(position, remaining[position])[0] for position in lines), self.zero)
+            return value, ()
+        key = (depth, tuple(remaining[position] for position in lines))
+        if key in memo:
+            return memo[key]
+
+        promotion, needs, limit = self.bundles[bundles[depth]]
+        best_value, counts = self._search(bundles, lines, depth + 1, remaining, memo)
+        best_counts = (0,) + counts
+        state = list(remaining)
+        gained = self.zero
+        for count in range(1, limit + 1):
+            taken = self._take(needs, state)
+            if taken is None:
+                break
+            gained += sum((share for _, share in self._shares(promotion, taken)), self.zero)
+            value, counts = self._search(bundles, lines, depth + 1, state, memo)
+            if value + gained > best_value:
+                best_value, best_counts = value + gained, (count,) + counts
+        memo[key] = (best_value, best_counts)
+        return memo[key]
+
+    def _gain(self, bundle, remaining):
+        """
+        Claim one application of a bundle and return (marginal gain, taken), or None if it does not fit
+        """
+        promotion, needs, _ = self.bundles[bundle]
+        taken = self._take(needs, remaining)
+        if taken is None:
+            return None
+        gain = sum((share for _, share in self._shares(promotion, taken)), self.zero)
+        used = {}
+        for position, _ in taken:
+            used[position] = used.get(position, 0) + 1
+        for position, count in used.items():
+            gain -= self.line_best(position, remaining[position] + count)[0] - self.line_best(position, remaining[position])[0]
+        return gain, taken
+
+    def _greedy(self, bundles, remaining):
+        """
+        Apply bundles in order of their initial marginal gain while each application still pays;
+        claims the chosen units in remaining and returns the application counts
+        """
+        initial = {}
+        for bundle in bundles:
+            gain, taken = self._gain(bundle, remaining)
+            self._release(taken, remaining)
+            initial[bundle] = gain
+
+        counts = {bundle: 0 for bundle in bundles}
+        for bundle in sorted(bundles, key=initial.get, reverse=True):
+            while counts[bundle] < self.bundles[bundle][2]:
+                claimed = self._gain(bundle, remaining)
+                if claimed is None:
+                    break
+                if claimed[0] <= 0:
+                    self._release(claimed[1], remaining)
+                    break
+                counts[bundle] += 1
+        return [counts[bundle] for bundle in bundles]
+
+    def _allocate(self, counts):
+        remaining = list(self.quantities)
+        allocations = [{} for _ in self.quantities]
+        for (promotion, needs, _), count in zip(self.bundles, counts):
+            for _ in range(count):
+                for position, share in self._shares(promotion, self._take(needs, remaining)):
+                    allocations[position][promotion] = allocations[position].get(promotion, self.zero) + share
+        for position, quantity in enumerate(remaining):
+            discount, promotion = self.line_best(position, quantity)
+            if promotion is not None:
+                allocations[position][promotion] = allocations[position].get(promotion, self.zero) + discount
+        return allocations
+
+
+class PricingEngine:
+    """
+    Prices a whole basket against the promotion index in one pass.
+
+    Promotions do not stack on a unit; BasketPromotionSolver decides which promotion claims each
+    unit. min_order_value is checked against the undiscounted subtotal.
+    """
+
+    @staticmethod
+    def price_basket(lines, customer_user=None, group_ids=None, index=None):
+        """
+        Price lines given as dicts with 'product' (instance or id), 'quantity' and optional
+        'variant' and 'unit_price'. Returns per-line prices and the basket totals.
+        """
+        from decimal import Decimal, ROUND_HALF_UP
+        from .models import Product, ProductVariant
+
+        index = index or PromotionIndex.get()
+        if group_ids is None:
+            group_ids = set(customer_user.groups.values_list('id', flat=True)) if customer_user else set()
+        group_ids = set(group_ids)
+
+        product_ids = {getattr(line['product'], 'pk', line['product']) for line in lines}
+        variant_ids = {getattr(line.get('variant'), 'pk', line.get('variant')) for line in lines} - {None}
+        products = {
+            pk: (price, category_id)
+            for pk, price, category_id in Product.objects.filter(pk__in=product_ids).values_list('pk', 'price', 'category_id')
+        }
+        extras = dict(
+            ProductVariant.objects.filter(pk__in=variant_ids).values_list('pk', 'additional_price')
+        ) if variant_ids else {}
+
+        priced = []
+        subtotal = Decimal('0')
+        for line in lines:
+            product_id = getattr(line['product'], 'pk', line['product'])
+            if product_id not in products:
+                raise ValueError(f"Unknown product {product_id}")
+            variant_id = getattr(line.get('variant'), 'pk', line.get('variant'))
+            price, category_id = products[product_id]
+            unit_price = line.get('unit_price')
+            unit_price = Decimal(str(unit_price)) if unit_price is not None else price + extras.get(variant_id, 0)
+            quantity = int(line['quantity'])
+            line_total = unit_price * quantity
+            subtotal += line_total
+            priced.append({
+                'product_id': product_id, 'variant_id': variant_id, 'category_id': category_id,
+                'quantity': quantity, 'unit_price': unit_price, 'line_total': line_total,
+            })
+
+        solution = BasketPromotionSolver(priced, index, group_ids, subtotal).solve()
+        cent = Decimal('0.01')
+        discount_total = Decimal('0')
+        applied = {}
+        for line, allocation in zip(priced, solution['allocations']):
+            amounts = {
+                promotion: amount.quantize(cent, rounding=ROUND_HALF_UP) for promotion, amount in allocation.items()
+            }
+            line['discount'] = sum(amounts.values(), Decimal('0'))
+            line['promotion_ids'] = sorted(promotion.id for promotion in amounts)
+            line['promotion_id'] = max(amounts, key=amounts.get).id if amounts else None
+            line['net_total'] = line['line_total'] - line['discount']
+            discount_total += line['discount']
+            for promotion, amount in amounts.items():
+                applied.setdefault(promotion.id, {'id': promotion.id, 'name': promotion.name, 'discount': Decimal('0')})
+                applied[promotion.id]['discount'] += amount
+
+        return {
+            'lines': priced,
+            'subtotal': subtotal,
+            'discount_total': discount_total,
+            'total': subtotal - discount_total,
+            'applied_promotions': list(applied.values()),
+            'exact': solution['exact'],
+        }
+
+
+class CouponCache:
+    """
+    In-process cache of coupon lookups by code.
+
+    Only the fields that change rarely are cached; used_count is never read from here, since the
+    usage limit is enforced by the guarded UPDATE in CouponRedemptionService. Entries live for
+    TTL_SECONDS and are dropped by the Coupon save/delete signals. Codes the CouponCodeIndex has
+    never seen are rejected without a query, and unknown codes are cached too.
+    """
+
+    TTL_SECONDS = 30
+    MAX_ENTRIES = 10000
+    FIELDS = (
+        'id', 'code', 'coupon_type', 'discount_value', 'is_active', 'start_date', 'end_date',
+        'max_usage_count', 'is_limited_to_customer', 'promotion_id',
+    )
+
+    _lock = threading.Lock()
+    _entries = {}
+
+    @classmethod
+    def get(cls, code, now=None):
+        """
+        Return the cached coupon fields as a dict, or None if there is no coupon with this code
+        """
+        import time
+
+        now = time.monotonic() if now is None else now
+        entry = cls._entries.get(code)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        from .models import Coupon
+        coupon = None
+        if CouponCodeIndex.might_exist(code):
+            coupon = Coupon.objects.filter(code=code).values(*cls.FIELDS).first()
+        with cls._lock:
+            if len(cls._entries) >= cls.MAX_ENTRIES:
+                cls._entries = {key: value for key, value in cls._entries.items() if value[0] > now}
+                if len(cls._entries) >= cls.MAX_ENTRIES:
+                    cls._entries = {}
+            cls._entries[code] = (now + cls.TTL_SECONDS, coupon)
+        return coupon
+
+    @classmethod
+    def invalidate(cls, code=None):
+        """
+        Drop one code, or every entry when no code is given
+        """
+        if code is None:
+            cls._entries = {}
+        else:
+            cls._entries.pop(code, None)
+
+
+class CouponRedemptionService:
+    """
+    Reserves, commits and releases coupon uses without oversubscribing the usage limit.
+
+    Reserving claims a use with a single guarded UPDATE (used_count = used_count + 1 only while it
+    is below max_usage_count), so concurrent checkouts can never push a coupon past its limit.
+    Coupons limited to one use per customer are additionally guarded by a partial unique
+    constraint on live redemptions.
+    """
+
+    RESERVATION_MINUTES = 15
+
+    @staticmethod
+    def reserve(code, customer=None, sale=None, now=None, minutes=None):
+        from datetime import timedelta
+        from django.core.exceptions import ValidationError
+        from django.db import IntegrityError, transaction
+        from django.db.models import F, Q
+        from .models import Coupon, CouponRedemption
+
+        now = now or timezone.now()
+        coupon = CouponCache.get(code)
+        if coupon is None:
+            raise ValidationError("Invalid coupon code")
+        if not coupon['is_active']:
+            raise ValidationError("This coupon is not active")
+        if not (coupon['start_date'] <= now <= coupon['end_date']):
+            raise ValidationError("This coupon has expired")
+        if coupon['is_limited_to_customer'] and customer is None:
+            raise ValidationError("This coupon can only be redeemed by a known customer")
+
+        minutes = CouponRedemptionService.RESERVATION_MINUTES if minutes is None else minutes
+        with transaction.atomic():
+            claimed = Coupon.objects.filter(pk=coupon['id'], is_active=True).filter(
+                Q(max_usage_count__isnull=True) | Q(used_count__lt=F('max_usage_count'))
+            ).update(used_count=F('used_count') + 1, updated_at=now)
+            if not claimed:
+                raise ValidationError("This coupon has reached its usage limit")
+            try:
+                with transaction.atomic():
+                    return CouponRedemption.objects.create(
+                        coupon_id=coupon['id'],
+                        customer=customer,
+                        sale=sale,
+                        once_per_customer=coupon['is_limited_to_customer'],
+                        expires_at=now + timedelta(minutes=minutes),
+                    )
+            except IntegrityError:
+                # Raising here also rolls back the used_count increment above
+                raise ValidationError("This customer has already redeemed this coupon")
+
+    @staticmethod
+    def commit(redemption, sale=None):
+        """
+        Make a reserved redemption permanent; returns False if it was no longer reserved
+        """
+        from .models import CouponRedemption
+
+        values = {'status': 'committed', 'expires_at': None, 'updated_at': timezone.now()}
+        if sale is not None:
+            values['sale'] = sale
+        committed = CouponRedemption.objects.filter(pk=redemption.pk, status='reserved').update(**values)
+        if committed:
+            redemption.refresh_from_db(fields=['status', 'sale', 'expires_at', 'updated_at'])
+        return bool(committed)
+
+    @staticmethod
+    def redeem(code, customer=None, sale=None):
+        """
+        Reserve and commit in one step, for checkouts that apply the coupon at payment time
+        """
+        from django.db import transaction
+
+        with transaction.atomic():
+            redemption = CouponRedemptionService.reserve(code, customer=customer, sale=sale)
+            CouponRedemptionService.commit(redemption)
+        return redemption
+
+    @staticmethod
+    def release(redemption):
+        """
+        Give a reserved redemption's use back; returns False if it was no longer reserved
+        """
+        return CouponRedemptionService._release(
+            lambda queryset: queryset.filter(pk=redemption.pk)
+        ) > 0
+
+    @staticmethod
+    def release_expired(now=None):
+        """
+        Release reservations whose checkout never completed; returns how many were released
+        """
+        now = now or timezone.now()
+        return CouponRedemptionService._release(
+            lambda queryset: queryset.filter(expires_at__lte=now)
+        )
+
+    @staticmethod
+    def _release(narrow):
+        from django.db import transaction
+        from django.db.models import Count
+        from .models import Coupon, CouponRedemption
+
+        with transaction.atomic():
+            ids = list(
+                narrow(CouponRedemption.objects.select_for_update().filter(status='reserved')).values_list('pk', flat=True)
+            )
+            if not ids:
+                return 0
+            released = CouponRedemption.objects.filter(pk__in=ids, status='reserved')
+            per_coupon = dict(
+                released.values('coupon_id').annotate(count=Count('pk')).values_list('coupon_id', 'count')
+            )
+            released.update(status='released', expires_at=None, updated_at=timezone.now())
+            bulk_increment(Coupon, {coupon_id: (-count,) for coupon_id, count in per_coupon.items()}, ['used_count'])
+        return len(ids)
+
+
+class CouponCodeIndex:
+    """
+    In-process Bloom filter over every coupon code, so unknown codes are rejected without a query.
+
+    A miss is definitive; a hit may be a false positive (about FALSE_POSITIVE_RATE) and is confirmed
+    against the database. Codes saved in this process are added as they are saved, and codes
+    created elsewhere are picked up every SYNC_SECONDS by reading coupons above an id watermark.
+    The watermark only moves past coupons older than SETTLE_SECONDS, so a row inserted by a slower
+    transaction with a lower id is still picked up once it commits; writers must therefore keep
+    their transactions shorter than that. Older coupons renamed elsewhere are found the same way
+    through updated_at. The filter is rebuilt once it fills past its sizing.
+    """
+
+    FALSE_POSITIVE_RATE = 0.01
+    MIN_CAPACITY = 100000
+    SYNC_SECONDS = 5
+    SETTLE_SECONDS = 60
+    CHUNK_SIZE = 50000
+
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, capacity):
+        import math
+
+        self.capacity = max(int(capacity), self.MIN_CAPACITY)
+        self.size = int(-self.capacity * math.log(self.FALSE_POSITIVE_RATE) / (math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.settled_id = 0
+        self.updated_after = None
+        self.synced_at = 0.0
+
+    @staticmethod
+    def _digest(code):
+        import hashlib
+        return hashlib.blake2b(code.encode(), digest_size=16).digest()
+
+    def add_many(self, codes, counted=True):
+        """
+        Add codes in one vectorised pass over their digests
+        """
+        import hashlib
+        import numpy as np
+
+        blake2b = hashlib.blake2b
+        digests = b''.join([blake2b(code.encode(), digest_size=16).digest() for code in codes])
+        if not digests:
+            return
+        pairs = np.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            positions = np.sort(((pairs[:, :1] + steps * pairs[:, 1:]) % np.uint64(self.size)).ravel())
+        # OR together the bits that land in the same byte, then set each byte once
+        offsets = (positions >> np.uint64(3)).astype(np.intp)
+        masks = (1 << (positions & np.uint64(7))).astype(np.uint8)
+        starts = np.flatnonzero(np.concatenate(([True], offsets[1:] != offsets[:-1])))
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        bits[offsets[starts]] |= np.bitwise_or.reduceat(masks, starts)
+        if counted:
+            self.count += len(pairs)
+
+    def might_contain(self, code):
+        digest = self._digest(code)
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little')
+        for step in range(self.hashes):
+            position = ((first + step * second) & 0xFFFFFFFFFFFFFFFF) % self.size
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def sync(self):
+        """
+        Add codes of coupons created, or renamed, since the last sync
+        """
+        import time
+        from datetime import timedelta
+        from .models import Coupon
+
+        settle_before = timezone.now() - timedelta(seconds=self.SETTLE_SECONDS)
+        unsettled_from = Coupon.objects.filter(
+            pk__gt=self.settled_id, created_at__gt=settle_before
+        ).order_by('pk').values_list('pk', flat=True).first()
+        if self.updated_after is not None:
+            # Renames below the watermark; re-read until they settle, like new rows
+            self.add_many(list(Coupon.objects.filter(
+                pk__lte=self.settled_id, updated_at__gt=self.updated_after
+            ).values_list('code', flat=True)), counted=False)
+        self.updated_after = settle_before
+        after = self.settled_id
+        while True:
+            rows = list(Coupon.objects.filter(pk__gt=after).order_by('pk').values_list('pk', 'code')[:self.CHUNK_SIZE])
+            if not rows:
+                break
+            settled = [code for pk, code in rows if unsettled_from is None or pk < unsettled_from]
+            if settled:
+                self.settled_id = rows[len(settled) - 1][0]
+            # Recent rows are re-read on every sync until they settle, so only count them once
+            self.add_many(settled, counted=True)
+            self.add_many((code for _, code in rows[len(settled):]), counted=False)
+            after = rows[-1][0]
+        self.synced_at = time.monotonic()
+
+    @classmethod
+    def build(cls):
+        from .models import Coupon
+
+        total = Coupon.objects.count()
+        # Leave room for campaigns generated after the build before a resize is needed
+        index = cls(total * 2)
+        index.sync()
+        return index
+
+    @classmethod
+    def get(cls):
+        import time
+
+        with cls._lock:
+            index = cls._instance
+            if index is None or index.count > index.capacity:
+                index = cls._instance = cls.build()
+            elif time.monotonic() - index.synced_at >= cls.SYNC_SECONDS:
+                index.sync()
+            return index
+
+    @classmethod
+    def might_exist(cls, code):
+        return cls.get().might_contain(code)
+
+    @classmethod
+    def add(cls, codes):
+        """
+        Add freshly created codes to the filter if it is loaded
+        """
+        index = cls._instance
+        if index is not None:
+            index.add_many(codes)
+
+    @classmethod
+    def invalidate(cls):
+        cls._instance = None
+
+
+class CouponCampaignService:
+    """
+    Issues a campaign's coupons in bulk.
+
+    Codes are drawn from an alphabet without look-alike characters using os.urandom, de-duplicated
+    in memory, checked against existing codes in chunks, and inserted in batches. Any code that
+    turns out to be taken is simply replaced, so the campaign always gets exactly `quantity`
+    unique codes.
+    """
+
+    ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+    CHECK_CHUNK_SIZE = 5000
+    INSERT_BATCH_SIZE = 25000
+
+    @staticmethod
+    def random_codes(count, length, prefix=''):
+        import os
+
+        alphabet = CouponCampaignService.ALPHABET.encode()
+        # 256 is a multiple of the alphabet size, so every character is equally likely
+        table = bytes(alphabet[byte % len(alphabet)] for byte in range(256))
+        raw = os.urandom(count * length).translate(table).decode()
+        return [prefix + raw[start:start + length] for start in range(0, count * length, length)]
+
+    @staticmethod
+    def taken(codes):
+        """
+        The subset of codes that already exist, looked up in chunks
+        """
+        from django.db import connection
+        from .models import Coupon
+
+        chunk_size = CouponCampaignService.CHECK_CHUNK_SIZE
+        limit = connection.features.max_query_params
+        if limit:
+            chunk_size = min(chunk_size, limit - 1)
+        codes = list(codes)
+        found = set()
+        for start in range(0, len(codes), chunk_size):
+            found.update(Coupon.objects.filter(code__in=codes[start:start + chunk_size]).values_list('code', flat=True))
+        return found
+
+    @staticmethod
+    def generate(campaign):
+        """
+        Create campaign.quantity coupons for a saved CouponCampaign; returns the number created.
+        Batches are committed as they go, so a failure leaves the batches inserted so far.
+        """
+        from django.core.exceptions import ValidationError
+        from django.db import transaction
+        from .models import Coupon
+
+        length = campaign.code_length
+        if len(campaign.prefix) + length > Coupon._meta.get_field('code').max_length:
+            raise ValidationError("Prefix and code length exceed the maximum coupon code length.")
+        if len(CouponCampaignService.ALPHABET) ** length < campaign.quantity * 100:
+            raise ValidationError("Code length is too short for this many unique codes.")
+        template = Coupon(
+            campaign=campaign, promotion=campaign.promotion, coupon_type=campaign.coupon_type,
+            discount_value=campaign.discount_value, start_date=campaign.start_date, end_date=campaign.end_date,
+            max_usage_count=campaign.max_uses_per_code, is_limited_to_customer=campaign.is_limited_to_customer,
+        )
+        template.clean()
+
+        created = 0
+        seen = set()
+        while created < campaign.quantity:
+            wanted = min(campaign.quantity - created, CouponCampaignService.CHECK_CHUNK_SIZE * 10)
+            batch = []
+            for code in CouponCampaignService.random_codes(wanted, length, campaign.prefix):
+                if code not in seen:
+                    seen.add(code)
+                    batch.append(code)
+            taken = CouponCampaignService.taken(batch)
+            batch = [code for code in batch if code not in taken]
+            # Each batch commits on its own to keep transactions short for CouponCodeIndex.sync
+            for start in range(0, len(batch), CouponCampaignService.INSERT_BATCH_SIZE):
+                with transaction.atomic():
+                    template.created_at = template.updated_at = timezone.now()
+                    CouponCampaignService._insert(template, batch[start:start + CouponCampaignService.INSERT_BATCH_SIZE])
+            created += len(batch)
+            CouponCodeIndex.add(batch)
+        return created
+
+    @staticmethod
+    def _insert(template, codes):
+        """
+        Insert coupons that differ from template only in their code.
+
+        bulk_create prepares every field of every row, which dominates at millions of rows; here
+        the shared values are prepared once. PostgreSQL receives the codes as a single array
+        parameter per batch; other backends use executemany.
+        """
+        from django.db import connection
+        from .models import Coupon
+
+        fields = [field for field in Coupon._meta.concrete_fields if field.attname not in ('id', 'code')]
+        shared = [field.get_db_prep_save(getattr(template, field.attname), connection) for field in fields]
+        quote = connection.ops.quote_name
+        columns = ', '.join([quote('code')] + [quote(field.column) for field in fields])
+        placeholders = ', '.join(['%s'] * len(fields))
+        table = quote(Coupon._meta.db_table)
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    f"INSERT INTO {table} ({columns}) SELECT code, {placeholders} FROM unnest(%s::varchar[]) AS code",
+                    shared + [list(codes)],
+                )
+            else:
+                cursor.executemany(
+                    f"INSERT INTO {table} ({columns}) VALUES (%s, {placeholders})",
+                    [[code] + shared for code in codes],
+                )
+
+
+class LoyaltyService:
+    """
+    Loyalty points ledger. Every change to Customer.loyalty_points is a LoyaltyTransaction, and the
+    balance is only ever changed with F() expressions in the same transaction as the entry, so
+    concurrent sales for one customer cannot lose points and balances equal ledger sums.
+
+    Points expire EXPIRY_DAYS after they are earned (settings.LOYALTY_POINTS_EXPIRY_DAYS, None to
+    disable). Redemptions are taken from the points closest to expiring, so the amount due to
+    expire for a customer is simply their expired earnings minus everything already debited.
+    """
+
+    EXPIRY_BATCH_SIZE = 1000
+
+    @staticmethod
+    def expiry_days():
+        from django.conf import settings
+        return getattr(settings, 'LOYALTY_POINTS_EXPIRY_DAYS', 365)
+
+    @staticmethod
+    def _balance(customer_id):
+        from .models import Customer
+        return Customer.objects.filter(pk=customer_id).values_list('loyalty_points', flat=True).get()
+
+    @staticmethod
+    def earn(customer, points, sale=None, reason='', user=None):
+        """
+        Credit points and return the new balance
+        """
+        from datetime import timedelta
+        from django.core.exceptions import ValidationError
+        from django.db import transaction
+        from django.db.models import F
+        from .models import Customer, LoyaltyTransaction
+
+        points = int(points)
+        if points <= 0:
+            raise ValidationError("Points to earn must be greater than zero.")
+        now = timezone.now()
+        days = LoyaltyService.expiry_days()
+        with transaction.atomic():
+            Customer.objects.filter(pk=customer.pk).update(loyalty_points=F('loyalty_points') + points)
+            LoyaltyTransaction.objects.create(
+                customer_id=customer.pk, transaction_type='earn', points=points, sale=sale, reason=reason,
+                created_by=user, created_at=now, expires_at=now + timedelta(days=days) if days else None,
+            )
+            return LoyaltyService._balance(customer.pk)
+
+    @staticmethod
+    def earn_many(credits, user=None):
+        """
+        Credit many customers at once. `credits` is a list of (customer_id, points, sale_id, reason);
+        entries are inserted with one bulk_create and balances moved with set-based updates.
+        """
+        from datetime import timedelta
+        from django.db import transaction
+        from .models import Customer, LoyaltyTransaction
+
+        credits = [credit for credit in credits if credit[1] > 0]
+        if not credits:
+            return
+        now = timezone.now()
+        days = LoyaltyService.expiry_days()
+        totals = {}
+        for customer_id, points, _, _ in credits:
+            totals[customer_id] = totals.get(customer_id, 0) + points
+        with transaction.atomic():
+            LoyaltyTransaction.objects.bulk_create([
+                LoyaltyTransaction(
+                    customer_id=customer_id, transaction_type='earn', points=points, sale_id=sale_id, reason=reason,
+                    created_by=user, created_at=now, expires_at=now + timedelta(days=days) if days else None,
+                )
+                for customer_id, points, sale_id, reason in credits
+            ], batch_size=1000)
+            bulk_increment(Customer, {customer_id: (points,) for customer_id, points in totals.items()}, ['loyalty_points'])
+
+    @staticmethod
+    def redeem(customer, points, sale=None, reason='', user=None):
+        """
+        Debit points if the balance covers them and return the new balance
+        """
+        from django.core.exceptions import ValidationError
+        from django.db import transaction
+        from django.db.models import F
+        from .models import Customer, LoyaltyTransaction
+
+        points = int(points)
+        if points <= 0:
+            raise ValidationError("Points to redeem must be greater than zero.")
+        with transaction.atomic():
+            debited = Customer.objects.filter(pk=customer.pk, loyalty_points__gte=points).update(
+                loyalty_points=F('loyalty_points') - points
+            )
+            if not debited:
+                raise ValidationError(
+                    f"Insufficient loyalty points. Customer has {LoyaltyService._balance(customer.pk)} points, "
+                    f"but tried to redeem {points} points."
+                )
+            LoyaltyTransaction.objects.create(
+                customer_id=customer.pk, transaction_type='redeem', points=-points, sale=sale, reason=reason,
+                created_by=user,
+            )
+            return LoyaltyService._balance(customer.pk)
+
+    @staticmethod
+    def adjust(customer, points, reason='', user=None):
+        """
+        Apply a signed manual correction and return the new balance; a debit may not overdraw
+        """
+        from django.core.exceptions import ValidationError
+        from django.db import transaction
+        from django.db.models import F
+        from .models import Customer, LoyaltyTransaction
+
+        points = int(points)
+        if not points:
+            raise ValidationError("Points to adjust must not be zero.")
+        with transaction.atomic():
+            adjusted = Customer.objects.filter(pk=customer.pk, loyalty_points__gte=max(-points, 0)).update(
+                loyalty_points=F('loyalty_points') + points
+            )
+            if not adjusted:
+                raise ValidationError(
+                    f"Insufficient loyalty points. Customer has {LoyaltyService._balance(customer.pk)} points, "
+                    f"but the adjustment removes {-points} points."
+                )
+            LoyaltyTransaction.objects.create(
+                customer_id=customer.pk, transaction_type='adjust', points=points, reason=reason, created_by=user,
+            )
+            return LoyaltyService._balance(customer.pk)
+
+    @staticmethod
+    def expire(now=None, dry_run=False):
+        """
+        Expire lapsed points for every affected customer in set-based batches.
+        Returns {'customers': n, 'points': n}.
+        """
+        from django.db import transaction
+        from django.db.models import F, Q, Sum
+        from django.db.models.functions import Coalesce
+        from .models import Customer, LoyaltyTransaction
+
+        now = now or timezone.now()
+
+        def due_points(entries):
+            return entries.values('customer_id').annotate(
+                lapsed=Coalesce(Sum('points', filter=Q(transaction_type='earn', expires_at__lte=now)), 0),
+                debited=Coalesce(Sum('points', filter=Q(points__lt=0)), 0),
+            ).annotate(due=F('lapsed') + F('debited')).filter(due__gt=0)
+
+        # Every customer with lapsed earnings not yet covered by debits, however long ago they lapsed
+        customer_ids = list(
+            due_points(LoyaltyTransaction.objects.all()).order_by('customer_id').values_list('customer_id', flat=True)
+        )
+        summary = {'customers': 0, 'points': 0}
+        for start in range(0, len(customer_ids), LoyaltyService.EXPIRY_BATCH_SIZE):
+            chunk = customer_ids[start:start + LoyaltyService.EXPIRY_BATCH_SIZE]
+            with transaction.atomic():
+                # Hold the balances so redemptions cannot interleave with the due computation
+                list(Customer.objects.select_for_update().filter(pk__in=chunk).order_by('pk').values_list('pk', flat=True))
+                due = dict(
+                    due_points(LoyaltyTransaction.objects.filter(customer_id__in=chunk)).values_list('customer_id', 'due')
+                )
+                summary['customers'] += len(due)
+                summary['points'] += sum(due.values())
+                if dry_run or not due:
+                    continue
+                LoyaltyTransaction.objects.bulk_create([
+                    LoyaltyTransaction(
+                        customer_id=customer_id, transaction_type='expire', points=-points,
+                        reason='Points expired', created_at=now,
+                    )
+                    for customer_id, points in due.items()
+                ])
+                bulk_increment(Customer, {customer_id: (-points,) for customer_id, points in due.items()}, ['loyalty_points'])
+        return summary
+
+    @staticmethod
+    def period_summary(start, end, customer_ids=None):
+        """
+        Opening balance, movements by type and closing balance per customer for [start, end),
+        computed with one grouped query over the ledger
+        """
+        from django.db.models import Q, Sum
+        from django.db.models.functions import Coalesce
+        from .models import LoyaltyTransaction
+
+        def total(**filters):
+            return Coalesce(Sum('points', filter=Q(**filters)), 0)
+
+        entries = LoyaltyTransaction.objects.filter(created_at__lt=end)
+        if customer_ids is not None:
+            entries = entries.filter(customer_id__in=customer_ids)
+        rows = entries.values('customer_id').annotate(
+            opening=total(created_at__lt=start),
+            earned=total(created_at__gte=start, transaction_type='earn'),
+            redeemed=total(created_at__gte=start, transaction_type='redeem'),
+            expired=total(created_at__gte=start, transaction_type='expire'),
+            adjusted=total(created_at__gte=start, transaction_type='adjust'),
+        ).order_by('customer_id')
+        summaries = []
+        for row in rows:
+            row['closing'] = row['opening'] + row['earned'] + row['redeemed'] + row['expired'] + row['adjusted']
+            summaries.append(row)
+        return summaries
+
+    @staticmethod
+    def reconcile(fix=False):
+        """
+        Customers whose stored balance differs from their ledger sum, as
+        [(customer_id, balance, ledger_total)]. With fix=True balances are reset to the ledger.
+        """
+        from django.db import transaction
+        from django.db.models import F, IntegerField, OuterRef, Subquery, Sum
+        from django.db.models.functions import Coalesce
+        from .models import Customer, LoyaltyTransaction
+
+        ledger = LoyaltyTransaction.objects.filter(customer_id=OuterRef('pk')).values('customer_id').annotate(
+            total=Sum('points')
+        ).values('total')
+        with transaction.atomic():
+            drifted = list(
+                Customer.objects.annotate(
+                    ledger_total=Coalesce(Subquery(ledger, output_field=IntegerField()), 0)
+                ).exclude(loyalty_points=F('ledger_total')).values_list('pk', 'loyalty_points', 'ledger_total')
+            )
+            if fix and drifted:
+                bulk_increment(
+                    Customer, {pk: (ledger_total - balance,) for pk, balance, ledger_total in drifted}, ['loyalty_points']
+                )
+        return drifted
+
+
+class SalePaymentService:
+    """
+    Records payments and refunds against a sale's stored totals. Each write is a single guarded
+    UPDATE that moves amount_paid / amount_refunded / balance_due with F() expressions and
+    derives the new payment status in the same statement, so concurrent payments cannot
+    overpay a sale and no payment needs a full Sale.save() or a re-sum of its payments.
+    """
+
+    OPEN_STATUSES = ('pending', 'partially_paid')
+
+    @staticmethod
+    def _amount(value):
+        from django.core.exceptions import ValidationError
+        amount = Decimal(str(value)).quantize(Decimal('0.01'))
+        if amount <= 0:
+            raise ValidationError("Payment amount must be greater than zero.")
+        return amount
+
+    @staticmethod
+    def _cents(expression):
+        """
+        Round an F() expression to cents in SQL; SQLite evaluates decimal arithmetic in binary
+        floating point, and unrounded leftovers would make exact payoffs fail the guards
+        """
+        from django.db.models.functions import Round
+        return Round(expression, 2)
+
+    @staticmethod
+    def _reload(sale):
+        from .models import Sale
+        fields = ['amount_paid', 'amount_refunded', 'balance_due', 'payment_status', 'is_locked', 'locked_at', 'original_total']
+        for field, value in Sale.objects.filter(pk=sale.pk).values(*fields).get().items():
+            setattr(sale, field, value)
+
+    @staticmethod
+    def _completed(sale):
+        """
+        Side effects Sale.save() runs when an open sale reaches 'completed'
+        """
+        from django.db import transaction
+        sale.finalize_sale()
+        transaction.on_commit(lambda: trigger_sale_completed_webhooks(sale))
+
+    @staticmethod
+    def record(sale, amount, payment_method, reference='', notes=''):
+        """
+        Apply a payment to an open sale and create its Payment row. Raises ValidationError if
+        the sale is no longer open or the payment exceeds the balance due.
+        """
+        from django.core.exceptions import ValidationError
+        from django.db import transaction
+        from django.db.models import Case, F, Value, When
+        from django.db.models.functions import Coalesce
+        from .models import Payment, Sale
+
+        amount = SalePaymentService._amount(amount)
+        cents = SalePaymentService._cents
+        with transaction.atomic():
+            # Every right-hand side sees the row as it was before this UPDATE
+            updated = Sale.objects.filter(
+                pk=sale.pk, payment_status__in=SalePaymentService.OPEN_STATUSES, balance_due__gte=amount
+            ).update(
+                amount_paid=cents(F('amount_paid') + amount),
+                balance_due=cents(F('balance_due') - amount),
+                payment_status=Case(When(balance_due__lte=amount, then=Value('completed')), default=Value('partially_paid')),
+                is_locked=Case(When(balance_due__lte=amount, then=Value(True)), default=F('is_locked')),
+                locked_at=Case(When(balance_due__lte=amount, is_locked=False, then=Value(timezone.now())), default=F('locked_at')),
+                original_total=Coalesce(F('original_total'), F('total_amount')),
+            )
+            if not updated:
+                current = Sale.objects.filter(pk=sale.pk).values('payment_status', 'balance_due').get()
+                if current['payment_status'] not in SalePaymentService.OPEN_STATUSES:
+                    raise ValidationError(f"Sale is already {current['payment_status']}")
+                raise ValidationError(
+                    f"Payment would exceed total amount. Max additional payment: ${current['balance_due']:.2f}"
+                )
+
+            payment = Payment.objects.create(
+                sale_id=sale.pk, payment_method=payment_method, amount=amount, reference=reference, notes=notes
+            )
+            SalePaymentService._reload(sale)
+            if sale.payment_status == 'completed':
+                SalePaymentService._completed(sale)
+        return payment
+
+    @staticmethod
+    def refund(sale, amount, payment_method, reference='', notes=''):
+        """
+        Record a refund against a sale, capped at what was paid and not yet refunded, and create
+        its negative Payment row. A sale whose payments are fully refunded moves to 'refunded'.
+        """
+        from django.core.exceptions import ValidationError
+        from django.db import transaction
+        from django.db.models import Case, F, Value, When
+        from .models import Payment, Sale
+
+        amount = SalePaymentService._amount(amount)
+        refunded = SalePaymentService._cents(F('amount_refunded') + amount)
+        with transaction.atomic():
+            updated = Sale.objects.filter(pk=sale.pk, amount_paid__gte=refunded).update(
+                amount_refunded=refunded,
+                payment_status=Case(
+                    When(amount_paid__lte=refunded, then=Value('refunded')),
+                    default=F('payment_status'),
+                ),
+            )
+            if not updated:
+                current = Sale.objects.filter(pk=sale.pk).values('amount_paid', 'amount_refunded').get()
+                raise ValidationError(
+                    f"Refund of ${amount:.2f} exceeds the ${current['amount_paid'] - current['amount_refunded']:.2f} "
+                    f"paid and not yet refunded on sale {sale.receipt_number}."
+                )
+            # Payment.save() only accepts positive amounts; refunds are the negative rows sync() reads
+            Payment.objects.bulk_create([Payment(
+                sale_id=sale.pk, payment_method=payment_method, amount=-amount, reference=reference, notes=notes
+            )])
+            SalePaymentService._reload(sale)
+
+    @staticmethod
+    def sync(sale):
+        """
+        Recompute a sale's totals and status from its Payment rows (positive amounts are
+        payments, negative ones refunds), for sales whose payments were written directly
+        """
+        from django.db import transaction
+        from django.db.models import Q, Sum
+        from .models import Payment, Sale
+
+        with transaction.atomic():
+            totals = Payment.objects.filter(sale_id=sale.pk).aggregate(
+                paid=Sum('amount', filter=Q(amount__gt=0)), refunded=Sum('amount', filter=Q(amount__lt=0))
+            )
+            current = Sale.objects.select_for_update().filter(pk=sale.pk).values(
+                'total_amount', 'payment_status', 'is_locked', 'original_total'
+            ).get()
+            paid = totals['paid'] or Decimal('0')
+            if current['payment_status'] in ('cancelled', 'refunded'):
+                payment_status = current['payment_status']
+            elif paid <= 0:
+                payment_status = 'pending'
+            elif paid >= current['total_amount']:
+                payment_status = 'completed'
+            else:
+                payment_status = 'partially_paid'
+
+            changes = {
+                'amount_paid': paid,
+                'amount_refunded': -(totals['refunded'] or Decimal('0')),
+                'balance_due': current['total_amount'] - paid,
+                'payment_status': payment_status,
+            }
+            if payment_status == 'completed' and not current['is_locked']:
+                changes.update(is_locked=True, locked_at=timezone.now(), original_total=current['original_total'] or current['total_amount'])
+            Sale.objects.filter(pk=sale.pk).update(**changes)
+            SalePaymentService._reload(sale)
+            if payment_status == 'completed' and current['payment_status'] in SalePaymentService.OPEN_STATUSES:
+                SalePaymentService._completed(sale)
+
+
+class OfflineSaleIngestService:
+    """
+    Ingests batches of sales that terminals recorded while offline.
+
+    Every sale carries a client-generated uuid (and optionally the terminal's id and sequence
+    number), so replaying a queue is idempotent: sales already stored are reported as duplicates
+    with their existing ids. References, duplicates and stock are resolved with a fixed number of
+    queries per batch, the sales, lines and payments are inserted with bulk_create, and stock is
+    posted with one set-based update per batch.
+
+    Fully paid sales take their stock off hand; sales still owing are reserved and finalized when
+    SalePaymentService records the payoff. The sales already happened at the till, so a stock
+    shortfall does not reject a sale; what is there is posted and the rest reported as a warning.
+    Bulk inserts skip the per-sale save() hooks and signals (audit log, webhooks).
+    """
+
+    MAX_BATCH_SIZE = 500
+    INSERT_BATCH_SIZE = 500
+    INSERT_ATTEMPTS = 3
+
+    @staticmethod
+    def _decimal(value, field, errors, minimum=Decimal('0')):
+        from decimal import InvalidOperation
+        try:
+            number = Decimal(str(value)).quantize(Decimal('0.01'))
+        except (InvalidOperation, TypeError, ValueError):
+            errors.append(f"{field} must be a number")
+            return None
+        if number < minimum:
+            errors.append(f"{field} must be at least {minimum}")
+        return number
+
+    @staticmethod
+    def _parse(data, default_cashier_id):
+        """
+        Normalise one client sale. Returns (sale, errors); only shape is checked here,
+        references are checked for the whole batch at once.
+        """
+        import uuid
+        from django.utils.dateparse import parse_datetime
+        from .models import Payment
+
+        if not isinstance(data, dict):
+            return None, ['Each sale must be an object']
+        try:
+            client_uuid = uuid.UUID(str(data.get('client_uuid')))
+        except ValueError:
+            return None, ['client_uuid must be a UUID']
+
+        errors = []
+        to_decimal = OfflineSaleIngestService._decimal
+        sale = {
+            'client_uuid': client_uuid,
+            'terminal_id': str(data.get('terminal_id') or '')[:64],
+            'terminal_sequence': data.get('terminal_sequence'),
+            'warehouse_id': data.get('warehouse_id'),
+            'cashier_id': data.get('cashier_id') or default_cashier_id,
+            'customer_id': data.get('customer_id') or None,
+            'discount_amount': to_decimal(data.get('discount_amount', 0), 'discount_amount', errors),
+            'notes': data.get('notes') or '',
+            'receipt_number': data.get('receipt_number') or '',
+            'sold_at': timezone.now(),
+            'lines': [],
+            'payments': [],
+        }
+        for field in ('warehouse_id', 'cashier_id', 'customer_id', 'terminal_sequence'):
+            if sale[field] is not None and (not isinstance(sale[field], int) or sale[field] < 0):
+                errors.append(f"{field} must be a non-negative integer")
+        if sale['warehouse_id'] is None:
+            errors.append('warehouse_id is required')
+        if sale['terminal_sequence'] is not None and not sale['terminal_id']:
+            errors.append('terminal_sequence requires terminal_id')
+        if data.get('sold_at'):
+            sold_at = parse_datetime(str(data['sold_at']))
+            if sold_at is None:
+                errors.append('sold_at must be an ISO datetime')
+            else:
+                sale['sold_at'] = timezone.make_aware(sold_at) if timezone.is_naive(sold_at) else sold_at
+
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            errors.append('Sale must have at least one line item')
+            items = []
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get('product_id'), int):
+                errors.append('Each item needs an integer product_id')
+                continue
+            quantity = item.get('quantity')
+            if not isinstance(quantity, int) or quantity <= 0:
+                errors.append(f"Quantity for product {item['product_id']} must be a positive integer")
+                continue
+            unit_price = to_decimal(item.get('unit_price'), 'unit_price', errors, minimum=Decimal('0.01'))
+            discount_percent = to_decimal(item.get('discount_percent', 0), 'discount_percent', errors)
+            if unit_price is None or discount_percent is None:
+                continue
+            if discount_percent > 100:
+                errors.append('discount_percent must be between 0 and 100')
+                continue
+            sale['lines'].append({
+                'product_id': item['product_id'], 'variant_id': item.get('variant_id'), 'quantity': quantity,
+                'unit_price': unit_price, 'discount_percent': discount_percent,
+                'total_price': (quantity * unit_price * (100 - discount_percent) / 100).quantize(Decimal('0.01')),
+            })
+
+        methods = {choice for choice, _ in Payment.PAYMENT_METHOD_CHOICES}
+        for payment in data.get('payments') or []:
+            if not isinstance(payment, dict) or payment.get('method') not in methods:
+                errors.append(f"Payment method must be one of {sorted(methods)}")
+                continue
+            amount = to_decimal(payment.get('amount'), 'payment amount', errors, minimum=Decimal('0.01'))
+            if amount is not None:
+                sale['payments'].append({
+                    'method': payment['method'], 'amount': amount, 'reference': str(payment.get('reference') or '')[:200],
+                })
+        return sale, errors
+
+    @staticmethod
+    def ingest(sales_data, user=None):
+        """
+        Store a batch of client-stamped sales. Returns one outcome per input sale, in order:
+        {'client_uuid', 'status': 'created' | 'duplicate' | 'rejected', 'sale_id', 'receipt_number',
+        'errors', 'warnings'}.
+        """
+        from django.conf import settings
+        from django.contrib.auth.models import User
+        from django.core.exceptions import ValidationError
+        from django.db import IntegrityError, transaction
+        from .models import Customer, Inventory, Payment, Product, ProductVariant, Sale, SaleLine, Warehouse
+
+        if len(sales_data) > OfflineSaleIngestService.MAX_BATCH_SIZE:
+            raise ValidationError(f"At most {OfflineSaleIngestService.MAX_BATCH_SIZE} sales can be ingested per batch.")
+
+        results = [None] * len(sales_data)
+        pending = {}
+        repeats = []
+        for position, data in enumerate(sales_data):
+            sale, errors = OfflineSaleIngestService._parse(data, getattr(user, 'pk', None))
+            if errors:
+                results[position] = {
+                    'client_uuid': str(sale['client_uuid']) if sale else None, 'status': 'rejected', 'errors': errors,
+                }
+            elif sale['client_uuid'] in pending:
+                repeats.append((position, sale['client_uuid']))
+            else:
+                sale['position'] = position
+                pending[sale['client_uuid']] = sale
+
+        def reject(sale, error):
+            results[sale['position']] = {'client_uuid': str(sale['client_uuid']), 'status': 'rejected', 'errors': [error]}
+            pending.pop(sale['client_uuid'], None)
+
+        def drop_stored():
+            """Report sales whose uuid is already stored as duplicates; reject reused sequences and receipts"""
+            stored = Sale.objects.filter(client_uuid__in=list(pending)).values_list('client_uuid', 'id', 'receipt_number')
+            for client_uuid, sale_id, receipt_number in stored:
+                results[pending.pop(client_uuid)['position']] = {
+                    'client_uuid': str(client_uuid), 'status': 'duplicate', 'sale_id': sale_id, 'receipt_number': receipt_number,
+                }
+            sequences = {(sale['terminal_id'], sale['terminal_sequence']) for sale in pending.values() if sale['terminal_sequence'] is not None}
+            used = set(Sale.objects.filter(
+                terminal_id__in={terminal for terminal, _ in sequences},
+                terminal_sequence__in={sequence for _, sequence in sequences},
+            ).values_list('terminal_id', 'terminal_sequence')) if sequences else set()
+            receipts = set(Sale.objects.filter(
+                receipt_number__in=[sale['receipt_number'] for sale in pending.values()]
+            ).values_list('receipt_number', flat=True))
+            claimed = set()
+            for sale in list(pending.values()):
+                sequence = (sale['terminal_id'], sale['terminal_sequence'])
+                if sale['terminal_sequence'] is not None and (sequence in used or sequence in claimed):
+                    reject(sale, f"Sequence {sale['terminal_sequence']} of terminal {sale['terminal_id']} is already used by another sale")
+                elif sale['receipt_number'] in receipts:
+                    reject(sale, f"Receipt number {sale['receipt_number']} is already used")
+                else:
+                    claimed.add(sequence)
+                    receipts.add(sale['receipt_number'])
+
+        with transaction.atomic():
+            # References for the whole batch, one query per table
+            lines = [line for sale in pending.values() for line in sale['lines']]
+            products = {
+                pk: cost for pk, cost in Product.objects.filter(
+                    id__in={line['product_id'] for line in lines}
+                ).values_list('id', 'cost_price')
+            }
+            variants = dict(ProductVariant.objects.filter(
+                id__in={line['variant_id'] for line in lines if line['variant_id'] is not None}
+            ).values_list('id', 'product_id'))
+            warehouses = set(Warehouse.objects.filter(
+                id__in={sale['warehouse_id'] for sale in pending.values()}
+            ).values_list('id', flat=True))
+            customers = Customer.objects.only('id').in_bulk(
+                {sale['customer_id'] for sale in pending.values() if sale['customer_id']}
+            )
+            cashiers = set(User.objects.filter(
+                id__in={sale['cashier_id'] for sale in pending.values()}
+            ).values_list('id', flat=True))
+
+            tax_rate = Decimal(str(getattr(settings, 'DEFAULT_TAX_RATE', 0.10)))
+            for sale in list(pending.values()):
+                if sale['warehouse_id'] not in warehouses:
+                    reject(sale, f"Warehouse with id {sale['warehouse_id']} not found")
+                elif sale['cashier_id'] not in cashiers:
+                    reject(sale, f"Cashier with id {sale['cashier_id']} not found")
+                elif sale['customer_id'] and sale['customer_id'] not in customers:
+                    reject(sale, f"Customer with id {sale['customer_id']} not found")
+                elif any(line['product_id'] not in products for line in sale['lines']):
+                    reject(sale, 'Product not found: ' + ', '.join(
+                        str(line['product_id']) for line in sale['lines'] if line['product_id'] not in products
+                    ))
+                elif any(
+                    line['variant_id'] is not None and variants.get(line['variant_id']) != line['product_id']
+                    for line in sale['lines']
+                ):
+                    reject(sale, 'Variant not found for its product')
+                else:
+                    subtotal = sum((line['total_price'] for line in sale['lines']), Decimal('0'))
+                    sale['tax_amount'] = (subtotal * tax_rate).quantize(Decimal('0.01'))
+                    sale['total_amount'] = subtotal + sale['tax_amount'] - sale['discount_amount']
+                    sale['paid'] = sum((payment['amount'] for payment in sale['payments']), Decimal('0'))
+                    if sale['total_amount'] <= 0:
+                        reject(sale, 'Total amount must be greater than zero')
+                    elif not sale['receipt_number']:
+                        sale['receipt_number'] = (
+                            f"{sale['terminal_id']}-{sale['terminal_sequence']:06d}" if sale['terminal_sequence'] is not None
+                            else f"OFF-{sale['client_uuid'].hex[:16].upper()}"
+                        )
+
+            now = timezone.now()
+
+            def build(sale):
+                paid_off = sale['paid'] >= sale['total_amount']
+                return Sale(
+                    receipt_number=sale['receipt_number'], cashier_id=sale['cashier_id'], customer_id=sale['customer_id'],
+                    warehouse_id=sale['warehouse_id'], total_amount=sale['total_amount'], tax_amount=sale['tax_amount'],
+                    discount_amount=sale['discount_amount'], notes=sale['notes'],
+                    payment_status='pending' if sale['paid'] <= 0 else 'completed' if paid_off else 'partially_paid',
+                    completed_at=sale['sold_at'] if paid_off else None,
+                    is_locked=paid_off, locked_at=now if paid_off else None,
+                    original_total=sale['total_amount'], amount_paid=sale['paid'],
+                    balance_due=sale['total_amount'] - sale['paid'],
+                    client_uuid=sale['client_uuid'], terminal_id=sale['terminal_id'],
+                    terminal_sequence=sale['terminal_sequence'],
+                )
+
+            # A concurrent replay of the same queue can insert some of these first; drop them and retry
+            for attempt in range(OfflineSaleIngestService.INSERT_ATTEMPTS):
+                drop_stored()
+                batch = sorted(pending.values(), key=lambda sale: (sale['sold_at'], sale['position']))
+                objects = [build(sale) for sale in batch]
+                try:
+                    with transaction.atomic():
+                        Sale.objects.bulk_create(objects, batch_size=OfflineSaleIngestService.INSERT_BATCH_SIZE)
+                    break
+                except IntegrityError:
+                    if attempt < OfflineSaleIngestService.INSERT_ATTEMPTS - 1:
+                        continue
+                # Still clashing: insert one sale at a time and set aside the ones that conflict
+                objects = [build(sale) for sale in batch]
+                conflicts = []
+                for sale, stored in zip(batch, objects):
+                    try:
+                        with transaction.atomic():
+                            Sale.objects.bulk_create([stored])
+                    except IntegrityError:
+                        conflicts.append(sale)
+                stored_ids = dict(Sale.objects.filter(
+                    client_uuid__in=[sale['client_uuid'] for sale in conflicts]
+                ).values_list('client_uuid', 'id')) if conflicts else {}
+                for sale in conflicts:
+                    if sale['client_uuid'] in stored_ids:
+                        results[sale['position']] = {
+                            'client_uuid': str(sale['client_uuid']), 'status': 'duplicate',
+                            'sale_id': stored_ids[sale['client_uuid']], 'receipt_number': sale['receipt_number'],
+                        }
+                        pending.pop(sale['client_uuid'])
+                    else:
+                        reject(sale, 'Sale conflicts with one stored at the same time; send it again')
+                kept = [(sale, stored) for sale, stored in zip(batch, objects) if stored.pk is not None]
+                batch, objects = [sale for sale, _ in kept], [stored for _, stored in kept]
+            if objects:
+                # sale_date is auto_now_add, so the till's timestamps are written afterwards
+                for sale, stored in zip(batch, objects):
+                    stored.sale_date = sale['sold_at']
+                Sale.objects.bulk_update(objects, ['sale_date'], batch_size=OfflineSaleIngestService.INSERT_BATCH_SIZE)
+
+            SaleLine.objects.bulk_create([
+                SaleLine(
+                    sale_id=stored.pk, product_id=line['product_id'], variant_id=line['variant_id'],
+                    quantity=line['quantity'], unit_price=line['unit_price'], total_price=line['total_price'],
+                    discount_percent=line['discount_percent'], cost_price=products[line['product_id']],
+                )
+                for sale, stored in zip(batch, objects) for line in sale['lines']
+            ], batch_size=OfflineSaleIngestService.INSERT_BATCH_SIZE)
+            Payment.objects.bulk_create([
+                Payment(
+                    sale_id=stored.pk, payment_method=payment['method'], amount=payment['amount'],
+                    reference=payment['reference'], paid_at=sale['sold_at'],
+                )
+                for sale, stored in zip(batch, objects) for payment in sale['payments']
+            ], batch_size=OfflineSaleIngestService.INSERT_BATCH_SIZE)
+
+            # Stock: paid sales come off the shelves and open ones are reserved until they are paid off,
+            # as create_sale does. Rows of each (warehouse, product, variant) are used in id order, and a
+            # warehouse-level row is created where there is none.
+            keys = {
+                (sale['warehouse_id'], line['product_id'], line['variant_id'])
+                for sale in batch for line in sale['lines']
+            }
+            rows = {}
+            for row_id, *key in Inventory.objects.filter(
+                warehouse_id__in={key[0] for key in keys}, product_id__in={key[1] for key in keys}
+            ).order_by('id').values_list('id', 'warehouse_id', 'product_id', 'variant_id'):
+                if tuple(key) in keys:
+                    rows.setdefault(tuple(key), []).append(row_id)
+            missing = [(warehouse_id, None, None, product_id, variant_id) for warehouse_id, product_id, variant_id in keys - rows.keys()]
+            for (warehouse_id, _, _, product_id, variant_id), row_id in InventoryRowUpdater.ensure_rows(missing).items():
+                rows[(warehouse_id, product_id, variant_id)] = [row_id]
+            row_ids = [row_id for ids in rows.values() for row_id in ids]
+            InventoryRowUpdater.lock(row_ids)
+            stock = {
+                row_id: [on_hand, reserved] for row_id, on_hand, reserved in
+                Inventory.objects.filter(id__in=row_ids).values_list('id', 'qty_on_hand', 'qty_reserved')
+            }
+
+            moved = {}
+            warnings = {}
+            for sale in batch:
+                reserve = sale['paid'] < sale['total_amount']
+                for line in sale['lines']:
+                    left = line['quantity']
+                    for row_id in rows[(sale['warehouse_id'], line['product_id'], line['variant_id'])]:
+                        on_hand, reserved = stock[row_id]
+                        take = max(0, min(left, on_hand - reserved if reserve else on_hand))
+                        if take:
+                            stock[row_id] = [on_hand, reserved + take] if reserve else [on_hand - take, reserved]
+                            sold, held = moved.get(row_id, (0, 0))
+                            moved[row_id] = (sold, held + take) if reserve else (sold - take, held)
+                            left -= take
+                        if not left:
+                            break
+                    if left:
+                        warnings.setdefault(sale['client_uuid'], []).append(
+                            f"Stock for product {line['product_id']} in warehouse {sale['warehouse_id']} ran short by {left}"
+                        )
+            bulk_increment(Inventory, moved, ('qty_on_hand', 'qty_reserved'), last_updated=now)
+
+            LoyaltyService.earn_many([
+                (
+                    sale['customer_id'],
+                    customers[sale['customer_id']].calculate_loyalty_points_from_purchase(float(sale['total_amount'])),
+                    stored.pk, f"Sale {stored.receipt_number}",
+                )
+                for sale, stored in zip(batch, objects) if sale['customer_id']
+            ], user=user)
+
+            touched = sorted(moved)
+            if touched:
+                transaction.on_commit(lambda: broadcast_inventory_rows(touched, 'offline_sales'))
+
+        for sale, stored in zip(batch, objects):
+            results[sale['position']] = {
+                'client_uuid': str(sale['client_uuid']), 'status': 'created', 'sale_id': stored.pk,
+                'receipt_number': stored.receipt_number, 'warnings': warnings.get(sale['client_uuid'], []),
+            }
+        for position, client_uuid in repeats:
+            first = next(result for result in results if result and result.get('client_uuid') == str(client_uuid))
+            results[position] = dict(first, status='duplicate' if first['status'] != 'rejected' else 'rejected')
+        return results
+
+
+class IdempotencyStore:
+    """
+    Stored responses of requests sent with an Idempotency-Key header.
+
+    A request first claims its (user, key) row, runs, and then stores its status code and
+    rendered body in the same transaction as its work; retries with the same key get that
+    response back. Finished responses are
+    also kept in a per-process LRU in front of the IdempotencyKey table, so most retries are
+    answered without a query. Keys live for settings.IDEMPOTENCY_KEY_TTL_SECONDS (a day by
+    default); a claim whose request died without finishing can be taken over after
+    IN_PROGRESS_SECONDS.
+    """
+
+    LRU_SIZE = 4096
+    IN_PROGRESS_SECONDS = 120
+
+    _lock = threading.Lock()
+    _entries = None
+
+    @staticmethod
+    def ttl_seconds():
+        from django.conf import settings
+        return getattr(settings, 'IDEMPOTENCY_KEY_TTL_SECONDS', 24 * 60 * 60)
+
+    @staticmethod
+    def fingerprint(method, path, data):
+        """
+        sha256 of the request; the body is canonicalised so key order does not matter
+        """
+        body = json.dumps(data, sort_keys=True, default=str, separators=(',', ':'))
+        return hashlib.sha256(f"{method} {path}\n{body}".encode()).hexdigest()
+
+    @classmethod
+    def _remember(cls, user_id, key, entry):
+        from collections import OrderedDict
+
+        with cls._lock:
+            if cls._entries is None:
+                cls._entries = OrderedDict()
+            cls._entries[(user_id, key)] = entry
+            cls._entries.move_to_end((user_id, key))
+            while len(cls._entries) > cls.LRU_SIZE:
+                cls._entries.popitem(last=False)
+
+    @classmethod
+    def lookup(cls, user_id, key):
+        """
+        (fingerprint, status_code, body, expires_at) for a live key, or None.
+        status_code is None while the first request is still running.
+        """
+        from .models import IdempotencyKey
+
+        now = timezone.now()
+        entry = (cls._entries or {}).get((user_id, key))
+        if entry is not None and entry[3] > now:
+            return entry
+        entry = IdempotencyKey.objects.filter(user_id=user_id, key=key, expires_at__gt=now).values_list(
+            'fingerprint', 'status_code', 'response_body', 'expires_at'
+        ).first()
+        if entry is not None and entry[1] is not None:
+            entry = (entry[0], entry[1], bytes(entry[2] or b''), entry[3])
+            cls._remember(user_id, key, entry)
+        return entry
+
+    @classmethod
+    def claim(cls, user_id, key, fingerprint):
+        """
+        Reserve the key for a request about to run. False if another request holds it.
+        """
+        from datetime import timedelta
+        from django.db import IntegrityError, transaction
+        from django.db.models import Q
+        from .models import IdempotencyKey
+
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=cls.ttl_seconds())
+        try:
+            with transaction.atomic():
+                IdempotencyKey.objects.create(user_id=user_id, key=key, fingerprint=fingerprint, expires_at=expires_at)
+            return True
+        except IntegrityError:
+            # Take over an expired key, or a claim whose request never finished
+            stale = Q(expires_at__lte=now) | Q(
+                status_code__isnull=True, created_at__lte=now - timedelta(seconds=cls.IN_PROGRESS_SECONDS)
+            )
+            return bool(IdempotencyKey.objects.filter(stale, user_id=user_id, key=key).update(
+                fingerprint=fingerprint, status_code=None, response_body=None, created_at=now, expires_at=expires_at,
+            ))
+
+    @classmethod
+    def finish(cls, user_id, key, fingerprint, status_code, body):
+        """
+        Store the response of a claimed key. Call it inside the request's transaction; the response
+        is cached in memory once that commits.
+        """
+        from datetime import timedelta
+        from django.db import transaction
+        from .models import IdempotencyKey
+
+        expires_at = timezone.now() + timedelta(seconds=cls.ttl_seconds())
+        IdempotencyKey.objects.filter(user_id=user_id, key=key).update(
+            status_code=status_code, response_body=body, expires_at=expires_at
+        )
+        transaction.on_commit(lambda: cls._remember(user_id, key, (fingerprint, status_code, body, expires_at)))
+
+    @classmethod
+    def abandon(cls, user_id, key):
+        """
+        Release a claim whose request failed, so a retry runs it again
+        """
+        from .models import IdempotencyKey
+        IdempotencyKey.objects.filter(user_id=user_id, key=key, status_code__isnull=True).delete()
+
+    @classmethod
+    def purge_expired(cls, now=None):
+        """
+        Delete expired keys; returns how many were removed
+        """
+        from .models import IdempotencyKey
+
+        now = now or timezone.now()
+        if cls._entries:
+            with cls._lock:
+                for cache_key in [cache_key for cache_key, entry in cls._entries.items() if entry[3] <= now]:
+                    del cls._entries[cache_key]
+        deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=now).delete()
+        return deleted
+
+    @classmethod
+    def invalidate(cls):
+        cls._entries = None
+
+
+class DocumentNumberService:
+    """
+    Per-warehouse document numbers such as RCT-003-000124, handed out from blocks held in memory.
+
+    A worker reserves BLOCK_SIZE numbers at a time (settings.DOCUMENT_NUMBER_BLOCK_SIZE) with one
+    UPDATE ... RETURNING on the DocumentSequence row, and then numbers documents from that block
+    without touching the database. Numbers never repeat and rise within each worker; numbers
+    left in a block when a worker stops are skipped. A block reserved inside a transaction is
+    pending: later calls in the same transaction number from it, and whatever is left is shared
+    with other transactions once it commits, since a rollback also gives the block back.
+    """
+
+    PREFIXES = {
+        'sale': 'RCT',
+        'exchange': 'EXC',
+        'return': 'RET',
+        'transfer': 'TR',
+        'purchase_order': 'PO',
+        'grn': 'GRN',
+        'reservation': 'RES',
+    }
+
+    _lock = threading.Lock()
+    _blocks = {}
+    _local = threading.local()
+
+    @staticmethod
+    def block_size():
+        from django.conf import settings
+        return max(1, getattr(settings, 'DOCUMENT_NUMBER_BLOCK_SIZE', 100))
+
+    @classmethod
+    def format(cls, document_type, warehouse_id, number):
+        return f"{cls.PREFIXES[document_type]}-{warehouse_id:03d}-{number:06d}"
+
+    @classmethod
+    def next(cls, document_type, warehouse_id):
+        """
+        The next number for a document of this type in this warehouse
+        """
+        return cls.take(document_type, warehouse_id, 1)[0]
+
+    @classmethod
+    def take(cls, document_type, warehouse_id, count):
+        """
+        `count` consecutive numbers, e.g. for documents created with bulk_create
+        """
+        from django.db import connection, transaction
+
+        if document_type not in cls.PREFIXES:
+            raise ValueError(f"Unknown document type: {document_type}")
+        key = (document_type, warehouse_id)
+        start = None
+        pending = getattr(cls._local, 'pending', None)
+        if connection.in_atomic_block and pending and key in pending:
+            block, publish = pending[key]
+            # The block is only ours while its on_commit hook survives; a rolled back savepoint drops both
+            if block[1] - block[0] >= count and any(entry[1] is publish for entry in connection.run_on_commit):
+                start = block[0]
+                block[0] += count
+        if start is None:
+            with cls._lock:
+                for block in cls._blocks.get(key, ()):
+                    if block[1] - block[0] >= count:
+                        start = block[0]
+                        block[0] += count
+                        break
+        if start is not None:
+            return [cls.format(document_type, warehouse_id, number) for number in range(start, start + count)]
+
+        size = max(cls.block_size(), count)
+        start = cls._reserve(document_type, warehouse_id, size)
+        spare = [start + count, start + size]
+        if connection.in_atomic_block:
+            def publish():
+                if cls._local.pending.get(key, (None, None))[1] is publish:
+                    del cls._local.pending[key]
+                cls._keep(key, spare)
+
+            if pending is None:
+                pending = cls._local.pending = {}
+            pending[key] = (spare, publish)
+            transaction.on_commit(publish)
+        else:
+            cls._keep(key, spare)
+        return [cls.format(document_type, warehouse_id, number) for number in range(start, start + count)]
+
+    @classmethod
+    def _keep(cls, key, spare):
+        """
+        Share the unused part of a block. Blocks kept by other threads meanwhile stay; the lowest is used first.
+        """
+        with cls._lock:
+            blocks = [block for block in cls._blocks.get(key, ()) if block[0] < block[1]]
+            if spare[0] < spare[1]:
+                blocks.append(spare)
+            cls._blocks[key] = sorted(blocks)
+
+    @staticmethod
+    def _reserve(document_type, warehouse_id, size):
+        """
+        Move the sequence on by `size` and return the first number of the reserved block
+        """
+        from django.db import IntegrityError, connection, transaction
+        from .models import DocumentSequence
+
+        table = connection.ops.quote_name(DocumentSequence._meta.db_table)
+        sql = (
+            f"UPDATE {table} SET next_number = next_number + %s "
+            f"WHERE warehouse_id = %s AND document_type = %s RETURNING next_number"
+        )
+        for _ in range(2):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [size, warehouse_id, document_type])
+                row = cursor.fetchone()
+            if row is not None:
+                return row[0] - size
+            try:
+                with transaction.atomic():
+                    DocumentSequence.objects.create(warehouse_id=warehouse_id, document_type=document_type)
+            except IntegrityError:
+                pass
+        raise RuntimeError(f"Could not reserve {document_type} numbers for warehouse {warehouse_id}")
+
+    @classmethod
+    def invalidate(cls):
+        cls._blocks = {}
+        cls._local.pending = {}
+
+
+class StockSummaryService:
+    """
+    Warehouse-level stock totals kept in StockSummary, and stock movements that use them.
+
+    The summary rows are maintained by row-level triggers on the inventory table (PostgreSQL and
+    SQLite), so every change to bin-level stock -- save(), F() updates, bulk_increment, bulk
+    inserts and deletes -- moves the totals in the same transaction. install_triggers() runs
+    after every migrate and rebuilds the table whenever it had to (re)create a trigger.
+
+    Movements lock the affected inventory rows first and let the triggers update the summary,
+    so they take locks in the same order as every other inventory writer.
+    """
+
+    TRIGGER_NAMES = (
+        'pos_app_stock_summary_insert', 'pos_app_stock_summary_update', 'pos_app_stock_summary_delete',
+    )
+
+    @staticmethod
+    def _tables(connection):
+        from .models import Inventory, StockSummary
+        return connection.ops.quote_name(Inventory._meta.db_table), connection.ops.quote_name(StockSummary._meta.db_table)
+
+    @classmethod
+    def _trigger_sql(cls, connection):
+        inventory, summary = cls._tables(connection)
+        match = (
+            "product_id = {row}.product_id AND COALESCE(variant_id, 0) = COALESCE({row}.variant_id, 0) "
+            "AND warehouse_id = {row}.warehouse_id"
+        )
+        subtract = (
+            f"UPDATE {summary} SET on_hand = on_hand - OLD.qty_on_hand, reserved = reserved - OLD.qty_reserved, "
+            f"available = available - (OLD.qty_on_hand - OLD.qty_reserved), version = version + 1 "
+            f"WHERE {match.format(row='OLD')};"
+        )
+        changed = (
+            "OLD.qty_on_hand <> NEW.qty_on_hand OR OLD.qty_reserved <> NEW.qty_reserved "
+            "OR OLD.product_id <> NEW.product_id OR OLD.warehouse_id <> NEW.warehouse_id "
+            "OR COALESCE(OLD.variant_id, 0) <> COALESCE(NEW.variant_id, 0)"
+        )
+
+        if connection.vendor == 'postgresql':
+            add = (
+                f"INSERT INTO {summary} (product_id, variant_id, warehouse_id, on_hand, reserved, available, version) "
+                "VALUES (NEW.product_id, NEW.variant_id, NEW.warehouse_id, NEW.qty_on_hand, NEW.qty_reserved, "
+                "NEW.qty_on_hand - NEW.qty_reserved, 1) "
+                "ON CONFLICT (product_id, (COALESCE(variant_id, 0)), warehouse_id) DO UPDATE SET "
+                f"on_hand = {summary}.on_hand + EXCLUDED.on_hand, reserved = {summary}.reserved + EXCLUDED.reserved, "
+                f"available = {summary}.available + EXCLUDED.available, version = {summary}.version + 1;"
+            )
+            function = (
+                "CREATE OR REPLACE FUNCTION pos_app_stock_summary_sync() RETURNS trigger AS $$ BEGIN "
+                f"IF TG_OP <> 'INSERT' THEN {subtract} END IF; "
+                f"IF TG_OP <> 'DELETE' THEN {add} END IF; "
+                "RETURN NULL; END; $$ LANGUAGE plpgsql"
+            )
+            events = {
+                'pos_app_stock_summary_insert': 'AFTER INSERT',
+                'pos_app_stock_summary_update': 'AFTER UPDATE',
+                'pos_app_stock_summary_delete': 'AFTER DELETE',
+            }
+            statements = [function]
+            for name, event in events.items():
+                condition = f" WHEN ({changed})" if event == 'AFTER UPDATE' else ''
+                statements.append(f"DROP TRIGGER IF EXISTS {name} ON {inventory}")
+                statements.append(
+                    f"CREATE TRIGGER {name} {event} ON {inventory} FOR EACH ROW{condition} "
+                    "EXECUTE FUNCTION pos_app_stock_summary_sync()"
+                )
+            return statements
+
+        if connection.vendor == 'sqlite':
+            # SQLite has a single writer, so creating the summary row and then adding to it is safe
+            add = (
+                f"INSERT INTO {summary} (product_id, variant_id, warehouse_id, on_hand, reserved, available, version) "
+                "SELECT NEW.product_id, NEW.variant_id, NEW.warehouse_id, 0, 0, 0, 0 "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {summary} WHERE {match.format(row='NEW')}); "
+                f"UPDATE {summary} SET on_hand = on_hand + NEW.qty_on_hand, reserved = reserved + NEW.qty_reserved, "
+                f"available = available + (NEW.qty_on_hand - NEW.qty_reserved), version = version + 1 "
+                f"WHERE {match.format(row='NEW')};"
+            )
+            return [
+                f"CREATE TRIGGER IF NOT EXISTS pos_app_stock_summary_insert AFTER INSERT ON {inventory} "
+                f"BEGIN {add} END",
+                f"CREATE TRIGGER IF NOT EXISTS pos_app_stock_summary_update AFTER UPDATE ON {inventory} "
+                f"WHEN {changed} BEGIN {subtract} {add} END",
+                f"CREATE TRIGGER IF NOT EXISTS pos_app_stock_summary_delete AFTER DELETE ON {inventory} "
+                f"BEGIN {subtract} END",
+            ]
+        return None
+
+    @classmethod
+    def installed_triggers(cls, connection):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    "SELECT tgname FROM pg_trigger WHERE NOT tgisinternal AND tgname = ANY(%s)", [list(cls.TRIGGER_NAMES)]
+                )
+            elif connection.vendor == 'sqlite':
+                cursor.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN (%s, %s, %s)", list(cls.TRIGGER_NAMES)
+                )
+            else:
+                return set()
+            return {row[0] for row in cursor.fetchall()}
+
+    @classmethod
+    def install_triggers(cls, using='default'):
+        """
+        Create the inventory triggers that are missing and rebuild the summary if any were.
+        Returns True if the triggers had to be (re)created.
+        """
+        import logging
+        from django.db import connections, transaction
+
+        from django.db.migrations.executor import MigrationExecutor
+
+        connection = connections[using]
+        executor = MigrationExecutor(connection)
+        if executor.migration_plan(executor.loader.graph.leaf_nodes()):
+            # Migrated to an older state; the triggers are written for the current schema
+            return False
+        statements = cls._trigger_sql(connection)
+        if statements is None:
+            logging.getLogger(__name__).warning(
+                f"Stock summary triggers are not available on {connection.vendor}; run reconcile_stock_summary --fix"
+            )
+            return False
+        if cls.installed_triggers(connection) == set(cls.TRIGGER_NAMES):
+            return False
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+            cls.rebuild(using=using)
+        return True
+
+    @classmethod
+    def rebuild(cls, using='default'):
+        """
+        Recompute every summary row from the inventory table
+        """
+        from django.db import connections
+
+        connection = connections[using]
+        inventory, summary = cls._tables(connection)
+        with connection.cursor() as cursor:
+            # Rebuilt rows start above every version handed out before, so no old ETag matches again
+            cursor.execute(f"SELECT COALESCE(MAX(version), 0) + 1 FROM {summary}")
+            version = cursor.fetchone()[0]
+            cursor.execute(f"DELETE FROM {summary}")
+            cursor.execute(
+                f"INSERT INTO {summary} (product_id, variant_id, warehouse_id, on_hand, reserved, available, version) "
+                "SELECT product_id, variant_id, warehouse_id, SUM(qty_on_hand), SUM(qty_reserved), "
+                f"SUM(qty_on_hand) - SUM(qty_reserved), %s FROM {inventory} GROUP BY product_id, variant_id, warehouse_id",
+                [version],
+            )
+
+    @staticmethod
+    def availability(keys):
+        """
+        Map (warehouse, product, variant) keys to their available stock with one query.
+        Keys without any inventory rows are left out.
+        """
+        from .models import StockSummary
+
+        keys = set(keys)
+        if not keys:
+            return {}
+        available = {}
+        for row in StockSummary.objects.filter(
+            product_id__in={key[1] for key in keys}, warehouse_id__in={key[0] for key in keys}
+        ).values_list('warehouse_id', 'product_id', 'variant_id', 'available'):
+            if row[:3] in keys:
+                available[row[:3]] = max(0, row[3])
+        return available
+
+    @staticmethod
+    def available(warehouse_id, product_id, variant_id=None):
+        """
+        Stock that can still be sold or reserved in a warehouse, across all of its bins
+        """
+        return StockSummaryService.availability([(warehouse_id, product_id, variant_id)]).get(
+            (warehouse_id, product_id, variant_id), 0
+        )
+
+    @staticmethod
+    def _quantities(warehouse_id, items):
+        quantities = {}
+        for product_id, variant_id, quantity in items:
+            key = (warehouse_id, product_id, variant_id)
+            quantities[key] = quantities.get(key, 0) + quantity
+        return quantities
+
+    @staticmethod
+    def _locked_rows(quantities):
+        """
+        Lock the inventory rows of the keyed products in id order and return them per key
+        """
+        from .models import Inventory
+
+        rows = {}
+        if not quantities:
+            return rows
+        for row in Inventory.objects.select_for_update().filter(
+            warehouse_id__in={key[0] for key in quantities}, product_id__in={key[1] for key in quantities}
+        ).order_by('id').values_list('id', 'warehouse_id', 'product_id', 'variant_id', 'qty_on_hand', 'qty_reserved'):
+            key = row[1:4]
+            if key in quantities:
+                rows.setdefault(key, []).append(row)
+        return rows
+
+    @staticmethod
+    def _apply(increments):
+        from .models import Inventory
+        bulk_increment(
+            Inventory, increments, ('qty_on_hand', 'qty_reserved'),
+            chunk_size=InventoryRowUpdater.UPDATE_CHUNK_SIZE, last_updated=timezone.now(),
+        )
+
+    @classmethod
+    def reserve(cls, warehouse_id, items, names=None):
+        """
+        Reserve (product_id, variant_id, quantity) items in a warehouse, spread over its bins.
+
+        Shortfalls are rejected from the summary before any inventory row is locked. Products
+        with no inventory row at all in the warehouse get one with the reservation on it, so
+        orders can still be taken for stock that is not tracked there yet.
+        """
+        from django.core.exceptions import ValidationError
+        from django.db import transaction
+        from .models import Inventory
+
+        names = names or {}
+        quantities = cls._quantities(warehouse_id, items)
+        with transaction.atomic():
+            available = cls.availability(quantities)
+            for key, quantity in quantities.items():
+                if key in available and available[key] < quantity:
+                    raise ValidationError(
+                        f"Insufficient stock for product {names.get(key[1], key[1])}. "
+                        f"Available: {available[key]}, Requested: {quantity}"
+                    )
+
+            rows = cls._locked_rows(quantities)
+            increments = {}
+            for key, quantity in quantities.items():
+                if key not in rows:
+                    Inventory.objects.create(
+                        warehouse_id=key[0], product_id=key[1], variant_id=key[2],
+                        qty_on_hand=0, qty_reserved=quantity, min_stock_level=0,
+                    )
+                    continue
+                remaining = quantity
+                for row_id, _, _, _, on_hand, reserved in rows[key]:
+                    take = min(remaining, max(0, on_hand - reserved))
+                    if take:
+                        increments[row_id] = (0, take)
+                        remaining -= take
+                if remaining:
+                    # Another transaction took the stock between the summary check and the lock
+                    raise ValidationError(
+                        f"Insufficient stock for product {names.get(key[1], key[1])}. "
+                        f"Available: {quantity - remaining}, Requested: {quantity}"
+                    )
+            cls._apply(increments)
+
+    @classmethod
+    def release(cls, warehouse_id, items):
+        """
+        Give reserved (product_id, variant_id, quantity) items back, clamping at zero
+        """
+        cls._move(warehouse_id, items, on_hand=False, reserved=True)
+
+    @classmethod
+    def deduct(cls, warehouse_id, items, reserved=False):
+        """
+        Take sold items off the shelves of a warehouse, and off their reservations with reserved=True.
+        Bins are emptied in id order; stock never goes below zero.
+        """
+        cls._move(warehouse_id, items, on_hand=True, reserved=reserved)
+
+    @classmethod
+    def _move(cls, warehouse_id, items, on_hand, reserved):
+        from django.db import transaction
+
+        quantities = cls._quantities(warehouse_id, items)
+        with transaction.atomic():
+            rows = cls._locked_rows(quantities)
+            increments = {}
+            for key, quantity in quantities.items():
+                left_on_hand = quantity if on_hand else 0
+                left_reserved = quantity if reserved else 0
+                for row_id, _, _, _, row_on_hand, row_reserved in rows.get(key, ()):
+                    take_on_hand = min(left_on_hand, row_on_hand)
+                    take_reserved = min(left_reserved, row_reserved)
+                    if take_on_hand or take_reserved:
+                        increments[row_id] = (-take_on_hand, -take_reserved)
+                        left_on_hand -= take_on_hand
+                        left_reserved -= take_reserved
+            cls._apply(increments)
+
+    @staticmethod
+    def reconcile(fix=False):
+        """
+        Compare the summary with bin-level totals. Returns the rows that disagree as
+        (warehouse_id, product_id, variant_id, on_hand, reserved, summary_on_hand, summary_reserved)
+        and, with fix=True, corrects them.
+        """
+        from django.db import transaction
+        from django.db.models import F, Sum
+        from .models import Inventory, StockSummary
+
+        totals = {
+            (row['warehouse_id'], row['product_id'], row['variant_id']): (row['on_hand'], row['reserved'])
+            for row in Inventory.objects.values('warehouse_id', 'product_id', 'variant_id')
+            .annotate(on_hand=Sum('qty_on_hand'), reserved=Sum('qty_reserved'))
+        }
+        summary = {
+            row[:3]: row[3:]
+            for row in StockSummary.objects.values_list('warehouse_id', 'product_id', 'variant_id', 'on_hand', 'reserved', 'available')
+        }
+        drift = []
+        for key in totals.keys() | summary.keys():
+            on_hand, reserved = totals.get(key, (0, 0))
+            stored = summary.get(key, (0, 0, 0))
+            if (on_hand, reserved, on_hand - reserved) != stored[:3]:
+                drift.append((*key, on_hand, reserved, stored[0], stored[1]))
+        drift.sort(key=lambda row: (row[0], row[1], row[2] or 0))
+        if fix and drift:
+            with transaction.atomic():
+                for warehouse_id, product_id, variant_id, *_ in drift:
+                    stored = StockSummary.objects.filter(
+                        warehouse_id=warehouse_id, product_id=product_id, variant_id=variant_id
+                    )
+                    list(stored.select_for_update().values_list('id'))
+                    # Re-read under the lock; changes committed since the first read are included
+                    current = Inventory.objects.filter(
+                        warehouse_id=warehouse_id, product_id=product_id, variant_id=variant_id
+                    ).aggregate(on_hand=Sum('qty_on_hand'), reserved=Sum('qty_reserved'))
+                    if current['on_hand'] is None:
+                        stored.delete()
+                    elif not stored.update(
+                        on_hand=current['on_hand'], reserved=current['reserved'],
+                        available=current['on_hand'] - current['reserved'], version=F('version') + 1,
+                    ):
+                        StockSummary.objects.create(
+                            warehouse_id=warehouse_id, product_id=product_id, variant_id=variant_id,
+                            on_hand=current['on_hand'], reserved=current['reserved'],
+                            available=current['on_hand'] - current['reserved'],
+                        )
+        return drift
+
+
+class StockAvailabilityService:
+    """
+    Batch availability lookups against StockSummary for storefronts and terminals.
+
+    Each item names a product by "sku" (product or variant SKU) or by "product_id" and optional
+    "variant_id", and a place by "warehouse_id" or by a "region" circle
+    ({"latitude", "longitude", "radius_km"}) that is resolved to warehouses in memory through
+    WarehouseSpatialIndex. All items are answered by one query over the summary table, reading
+    plain values. The ETag covers the request and the version of every summary row read, so it
+    changes whenever any stock in the answer moves.
+    """
+
+    MAX_ITEMS = 5000
+    MAX_REGION_WAREHOUSES = 500
+
+    @staticmethod
+    def _parse(items, defaults):
+        from django.core.exceptions import ValidationError
+
+        parsed = []
+        errors = []
+        for position, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors.append(f"items[{position}]: must be an object")
+                continue
+            if item.get('warehouse_id') is None and item.get('region') is None:
+                item = {**item, **defaults}
+            if item.get('sku') is None and item.get('product_id') is None:
+                errors.append(f"items[{position}]: sku or product_id is required")
+                continue
+            if item.get('warehouse_id') is None and not isinstance(item.get('region'), dict):
+                errors.append(f"items[{position}]: warehouse_id or region is required")
+                continue
+            try:
+                sku = str(item['sku']) if item.get('sku') is not None else None
+                product_id = int(item['product_id']) if item.get('product_id') is not None else None
+                variant_id = int(item['variant_id']) if item.get('variant_id') is not None else None
+                quantity = int(item.get('quantity', 1))
+                if item.get('warehouse_id') is not None:
+                    target = ('warehouse', int(item['warehouse_id']))
+                else:
+                    region = item['region']
+                    target = ('region', float(region['latitude']), float(region['longitude']), float(region['radius_km']))
+            except (KeyError, TypeError, ValueError):
+                errors.append(f"items[{position}]: invalid value")
+                continue
+            parsed.append((sku, product_id, variant_id, quantity, target))
+        if errors:
+            raise ValidationError(errors)
+        return parsed
+
+    @classmethod
+    def check(cls, items, defaults=None):
+        """
+        Answer a batch of availability questions.
+
+        Returns (columns, etag). columns holds one list per field, aligned with `items`:
+        product_id, variant_id (resolved, None for unknown SKUs), available (summed over the
+        target warehouses) and in_stock (available >= the item's quantity, default 1), plus
+        "all_in_stock" for whole-cart checks. Unknown products simply have nothing available.
+        """
+        import hashlib
+        import json
+        from django.core.exceptions import ValidationError
+        from django.db.models import Q
+        from .models import StockSummary
+
+        if not isinstance(items, list) or not items:
+            raise ValidationError('items must be a non-empty list')
+        if len(items) > cls.MAX_ITEMS:
+            raise ValidationError(f"At most {cls.MAX_ITEMS} items can be checked at once")
+        parsed = cls._parse(items, defaults or {})
+
+        regions = {}
+        for *_, target in parsed:
+            if target[0] == 'region' and target not in regions:
+                _, latitude, longitude, radius_km = target
+                regions[target] = [
+                    warehouse['id'] for warehouse, _ in WarehouseSpatialIndex.get().nearest(
+                        latitude, longitude, limit=cls.MAX_REGION_WAREHOUSES, max_distance_km=radius_km,
+                    )
+                ]
+        warehouse_ids = {target[1] for *_, target in parsed if target[0] == 'warehouse'}
+        for ids in regions.values():
+            warehouse_ids.update(ids)
+
+        skus = {sku for sku, *_ in parsed if sku is not None}
+        product_ids = {product_id for _, product_id, *_ in parsed if product_id is not None}
+        condition = Q(product_id__in=product_ids) if product_ids else Q(pk__in=[])
+        if skus:
+            condition |= Q(product__sku__in=skus, variant__isnull=True) | Q(variant__sku__in=skus)
+        rows = StockSummary.objects.filter(condition, warehouse_id__in=warehouse_ids).values_list(
+            'product_id', 'variant_id', 'warehouse_id', 'available', 'version', 'product__sku', 'variant__sku',
+        ) if warehouse_ids else []
+
+        stock = {}
+        by_sku = {}
+        versions = []
+        for product_id, variant_id, warehouse_id, available, version, product_sku, variant_sku in rows:
+            stock[(product_id, variant_id, warehouse_id)] = max(0, available)
+            versions.append((product_id, variant_id or 0, warehouse_id, version))
+            if variant_sku in skus:
+                by_sku[variant_sku] = (product_id, variant_id)
+            elif variant_id is None and product_sku in skus:
+                by_sku.setdefault(product_sku, (product_id, None))
+
+        columns = {'product_id': [], 'variant_id': [], 'available': [], 'in_stock': []}
+        for sku, product_id, variant_id, quantity, target in parsed:
+            if sku is not None and product_id is None:
+                product_id, variant_id = by_sku.get(sku, (None, None))
+            targets = regions[target] if target[0] == 'region' else [target[1]]
+            available = sum(stock.get((product_id, variant_id, warehouse_id), 0) for warehouse_id in targets)
+            columns['product_id'].append(product_id)
+            columns['variant_id'].append(variant_id)
+            columns['available'].append(available)
+            columns['in_stock'].append(available >= quantity)
+        columns['all_in_stock'] = all(columns['in_stock'])
+
+        digest = hashlib.sha256(json.dumps([items, defaults, sorted(versions)], sort_keys=True, default=str).encode())
+        return columns, f'"{digest.hexdigest()[:32]}"'
+
+
+class ReservedStockReconciler:
+    """
+    Recomputes what `qty_reserved` should be from the documents that hold stock and diffs it
+    against the inventory rows.
+
+    Open sales, active reservations and transfers that have not left yet are each summed with one
+    grouped query per batch of warehouses, so the work per batch does not depend on the number of
+    documents or lines. Drift is reported per (warehouse, product, variant) as
+    (warehouse_id, product_id, variant_id, expected, reserved, on_hand); when a discrepancy is
+    fixed, the reservations are laid out again over the bins with one chunked UPDATE. A bin never
+    reserves more than it holds, so stock that documents hold but the warehouse does not have
+    (expected above on_hand) stays in the report until it is received.
+    """
+
+    WAREHOUSE_BATCH_SIZE = 50
+    TRANSFER_STATUSES = ('requested', 'approved', 'in_transit')
+
+    @classmethod
+    def reconcile(cls, fix=False, warehouse_ids=None):
+        """
+        Return the drifted (warehouse, product, variant) totals, ordered by key, and with
+        fix=True reset them to what the open documents hold.
+        """
+        from .models import Warehouse
+
+        if warehouse_ids is None:
+            warehouse_ids = Warehouse.objects.order_by('id').values_list('id', flat=True)
+        warehouse_ids = sorted(set(warehouse_ids))
+
+        drift = []
+        for start in range(0, len(warehouse_ids), cls.WAREHOUSE_BATCH_SIZE):
+            batch = warehouse_ids[start:start + cls.WAREHOUSE_BATCH_SIZE]
+            found = cls._diff(cls.expected(batch)[0], cls._stored(batch))
+            if fix and found:
+                found = cls._fix(batch, found)
+            drift.extend(found)
+        return drift
+
+    @classmethod
+    def expected(cls, warehouse_ids, product_ids=None):
+        """
+        Sum the stock held by open documents in the given warehouses. Returns the totals per
+        (warehouse, product, variant) and, separately, the part of them that transfers hold on
+        a specific (warehouse, location, bin, product, variant) row.
+        """
+        from django.conf import settings
+        from django.db.models import Sum
+        from .models import ReservationLine, SaleLine, TransferLine
+
+        def grouped(queryset, quantity, *fields):
+            if product_ids is not None:
+                queryset = queryset.filter(product_id__in=product_ids)
+            return queryset.order_by().values_list(*fields, 'product_id', 'variant_id').annotate(total=Sum(quantity))
+
+        totals = {}
+        pinned = {}
+        sources = [grouped(
+            ReservationLine.objects.filter(reservation__status='active', reservation__warehouse_id__in=warehouse_ids),
+            'quantity', 'reservation__warehouse_id',
+        )]
+        if getattr(settings, 'AUTO_RESERVE_SALE_STOCK', True):
+            sources.append(grouped(
+                SaleLine.objects.filter(
+                    sale__payment_status__in=SalePaymentService.OPEN_STATUSES, sale__warehouse_id__in=warehouse_ids,
+                ).exclude(sale__sale_type='return'),
+                'quantity', 'sale__warehouse_id',
+            ))
+        for source in sources:
+            for warehouse_id, product_id, variant_id, quantity in source:
+                key = (warehouse_id, product_id, variant_id)
+                totals[key] = totals.get(key, 0) + quantity
+
+        if getattr(settings, 'AUTO_RESERVE_TRANSFER_STOCK', True):
+            for row in grouped(
+                TransferLine.objects.filter(
+                    transfer__status__in=cls.TRANSFER_STATUSES, transfer__from_warehouse_id__in=warehouse_ids,
+                ),
+                'requested_qty', 'transfer__from_warehouse_id', 'transfer__from_location_id', 'transfer__from_bin_id',
+            ):
+                slot, quantity = row[:5], row[5]
+                key = (slot[0], slot[3], slot[4])
+                totals[key] = totals.get(key, 0) + quantity
+                pinned[slot] = pinned.get(slot, 0) + quantity
+        return totals, pinned
+
+    @staticmethod
+    def _stored(warehouse_ids, product_ids=None):
+        from django.db.models import Sum
+        from .models import Inventory
+
+        rows = Inventory.objects.filter(warehouse_id__in=warehouse_ids)
+        if product_ids is not None:
+            rows = rows.filter(product_id__in=product_ids)
+        return {
+            row[:3]: row[3:]
+            for row in rows.order_by().values_list('warehouse_id', 'product_id', 'variant_id')
+            .annotate(reserved=Sum('qty_reserved'), on_hand=Sum('qty_on_hand'))
+        }
+
+    @staticmethod
+    def _diff(totals, stored, keys=None):
+        drift = []
+        for key in (totals.keys() | stored.keys()) if keys is None else keys:
+            reserved, on_hand = stored.get(key, (0, 0))
+            if totals.get(key, 0) != reserved:
+                drift.append((*key, totals.get(key, 0), reserved, on_hand))
+        drift.sort(key=lambda row: (row[0], row[1], row[2] or 0))
+        return drift
+
+    @classmethod
+    def _fix(cls, warehouse_ids, drift):
+        """
+        Lay the expected reservations of the drifted keys out over their bins: transfers on the
+        row they were taken from, the rest in id order up to what each bin holds.
+        """
+        from django.db import transaction
+        from .models import Inventory
+
+        keys = {row[:3] for row in drift}
+        product_ids = {key[1] for key in keys}
+        with transaction.atomic():
+            rows = {}
+            for row in Inventory.objects.select_for_update().filter(
+                warehouse_id__in=warehouse_ids, product_id__in=product_ids,
+            ).order_by('id').values_list('id', 'warehouse_id', 'location_id', 'bin_id', 'product_id', 'variant_id',
+                                         'qty_on_hand', 'qty_reserved'):
+                key = (row[1], row[4], row[5])
+                if key in keys:
+                    rows.setdefault(key, []).append(row)
+
+            # Re-read under the lock: a document whose stock movement is waiting on these rows
+            # is either committed and counted here, or applies its movement after this fix
+            totals, pinned = cls.expected(warehouse_ids, product_ids)
+            drift = cls._diff(totals, cls._stored(warehouse_ids, product_ids), keys)
+            increments = {}
+            for warehouse_id, product_id, variant_id, expected, _, _ in drift:
+                key = (warehouse_id, product_id, variant_id)
+                targets = {}
+                remaining = expected
+                for row_id, _, location_id, bin_id, _, _, on_hand, _ in rows.get(key, ()):
+                    held = pinned.pop((warehouse_id, location_id, bin_id, product_id, variant_id), 0)
+                    targets[row_id] = min(held, on_hand)
+                    remaining -= targets[row_id]
+                for row_id, *_, on_hand, _ in rows.get(key, ()):
+                    take = min(remaining, on_hand - targets[row_id])
+                    targets[row_id] += take
+                    remaining -= take
+                for row_id, *_, reserved in rows.get(key, ()):
+                    if targets[row_id] != reserved:
+                        increments[row_id] = (targets[row_id] - reserved,)
+
+            bulk_increment(
+                Inventory, increments, ('qty_reserved',),
+                chunk_size=InventoryRowUpdater.UPDATE_CHUNK_SIZE, last_updated=timezone.now(),
+            )
+        return drift
+
+
+class InventoryBootstrapService:
+    """
+    Creates the warehouse-level inventory rows (no location or bin) that products and their
+    variants are still missing in each warehouse.
+
+    The missing (product, variant, warehouse) combinations come from one anti-join over the
+    catalog and the warehouses and are inserted with bulk_create in batches, so the statement
+    count depends on the number of rows created, not on the number of products times warehouses.
+    """
+
+    BATCH_SIZE = 1000
+
+    @staticmethod
+    def _missing_sql(connection, warehouse_ids=None, category_ids=None):
+        from .models import Inventory, Product, ProductVariant, Warehouse
+
+        product, variant, warehouse, inventory = (
+            connection.ops.quote_name(model._meta.db_table) for model in (Product, ProductVariant, Warehouse, Inventory)
+        )
+        params = []
+        product_filter = ''
+        if category_ids is not None:
+            product_filter = f" WHERE p.category_id IN ({', '.join(['%s'] * len(category_ids))})"
+            params.extend(category_ids)
+        catalog = (
+            f"SELECT p.id AS product_id, NULL AS variant_id FROM {product} p{product_filter} "
+            f"UNION ALL SELECT v.product_id, v.id FROM {variant} v JOIN {product} p ON p.id = v.product_id{product_filter}"
+        )
+        params = params * 2
+        warehouse_filter = ''
+        if warehouse_ids is not None:
+            warehouse_filter = f" WHERE w.id IN ({', '.join(['%s'] * len(warehouse_ids))})"
+            params.extend(warehouse_ids)
+        sql = (
+            f"SELECT c.product_id, c.variant_id, w.id FROM ({catalog}) c "
+            f"CROSS JOIN (SELECT w.id FROM {warehouse} w{warehouse_filter}) w "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {inventory} i WHERE i.product_id = c.product_id "
+            "AND COALESCE(i.variant_id, 0) = COALESCE(c.variant_id, 0) AND i.warehouse_id = w.id "
+            "AND i.location_id IS NULL AND i.bin_id IS NULL)"
+        )
+        return sql, params
+
+    @classmethod
+    def count_missing(cls, warehouse_ids=None, category_ids=None):
+        """
+        Map warehouse ids to the number of rows ensure() would create there, with one query
+        """
+        from django.db import connection
+
+        if warehouse_ids == [] or category_ids == []:
+            return {}
+        sql, params = cls._missing_sql(connection, warehouse_ids, category_ids)
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT m.id, COUNT(*) FROM ({sql}) m GROUP BY m.id ORDER BY m.id", params)
+            return dict(cursor.fetchall())
+
+    @classmethod
+    def ensure(cls, qty_on_hand=0, min_stock_level=0, warehouse_ids=None, category_ids=None, batch_size=None):
+        """
+        Create the missing rows with the given stock levels. Returns the number of rows created.
+        """
+        from django.db import connection, transaction
+        from .models import Inventory
+
+        if warehouse_ids == [] or category_ids == []:
+            return 0
+        batch_size = batch_size or cls.BATCH_SIZE
+        sql, params = cls._missing_sql(connection, warehouse_ids, category_ids)
+        created = 0
+        with transaction.atomic():
+            # The anti-join is read in full before the first insert changes the table it reads
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                missing = cursor.fetchall()
+            for start in range(0, len(missing), batch_size):
+                created += len(Inventory.objects.bulk_create([
+                    Inventory(
+                        product_id=product_id, variant_id=variant_id, warehouse_id=warehouse_id,
+                        qty_on_hand=qty_on_hand, qty_reserved=0, min_stock_level=min_stock_level,
+                    )
+                    for product_id, variant_id, warehouse_id in missing[start:start + batch_size]
+                ], ignore_conflicts=True))
+        return created
@@ -1,11 +1,11 @@
 # pos_app/signals.py
-from django.db.models.signals import post_save, post_delete, pre_save
+from django.db.models.signals import post_save, post_delete, pre_save, m2m_changed
 from django.dispatch import receiver
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from .models import (
     Product, Sale, Inventory, Warehouse, Customer, UserProfile,
-    Transfer, Return, AuditLog
+    Transfer, Return, AuditLog, Promotion, Coupon
 )
 import logging
 from django.utils import timezone
@@ -367,6 +367,43 @@ def warehouse_deleted(sender, instance, **kwargs):
     except Exception as e:
         logger.error(f"Error sending warehouse delete via WebSocket: {e}")
 
+@receiver(post_save, sender=Warehouse)
+@receiver(post_delete, sender=Warehouse)
+def invalidate_warehouse_spatial_index(sender, instance, **kwargs):
+    """
+    Drop the in-memory warehouse spatial index so it is rebuilt with the new coordinates.
+    """
+    from .services import WarehouseSpatialIndex
+    WarehouseSpatialIndex.invalidate()
+
+@receiver(post_save, sender=Promotion)
+@receiver(post_delete, sender=Promotion)
+@receiver(m2m_changed, sender=Promotion.products.through)
+@receiver(m2m_changed, sender=Promotion.categories.through)
+@receiver(m2m_changed, sender=Promotion.customer_groups.through)
+@receiver(m2m_changed, sender=Promotion.required_products.through)
+@receiver(m2m_changed, sender=Promotion.bonus_products.through)
+def invalidate_promotion_index(sender, instance, **kwargs):
+    """
+    Drop the in-memory promotion index when a promotion or its product/category/group sets change.
+    """
+    if kwargs.get('action', 'post_').startswith('pre_'):
+        return
+    from .services import PromotionIndex
+    PromotionIndex.invalidate()
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def invalidate_coupon_cache(sender, instance, **kwargs):
+    """
+    Drop cached coupon lookups; the code itself may have changed, so clear every entry.
+    """
+    from .services import CouponCache, CouponCodeIndex
+    CouponCache.invalidate()
+    if 'created' in kwargs:
+        # Saved, possibly under a new code
+        CouponCodeIndex.add([instance.code])
+
 @receiver(post_save, sender=Customer)
 def customer_saved(sender, instance, created, **kwargs):
     """
@@ -0,0 +1,136 @@
+import json
+import os
+import tempfile
+from decimal import Decimal
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from pos_app.models import Category, Product
+from pos_app.views import bulk_product_operations
+from pos_app.services import ProductExportService, ProductImportService
+
+
+class ProductImportDryRunTest(TestCase):
+    """Test the dry-run validation of bulk product imports"""
+
+    def setUp(self):
+        category = Category.objects.create(name='Drinks')
+        Product.objects.create(name='Cola', sku='SKU-1', barcode='111', price=Decimal('1.50'), category=category)
+        Product.objects.create(name='Water', sku='SKU-2', barcode='222', price=Decimal('0.99'), category=category)
+
+    def _run(self, csv_text):
+        rows = ProductImportService.iter_rows(StringIO(csv_text), 'csv')
+        return ProductImportService.dry_run(rows)
+
+    def test_dry_run_reports_diff_without_writing(self):
+        report = self._run(
+            "sku,name,barcode,category,price\n"
+            "SKU-1,Cola,111,Drinks,1.75\n"
+            "SKU-2,Water,222,Drinks,0.99\n"
+            "SKU-3,Juice,333,Drinks,2.10\n"
+        )
+
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['updated'], 1)
+        self.assertEqual(report['unchanged'], 1)
+        self.assertEqual(report['field_change_counts'], {'price': 1})
+        self.assertEqual(report['changes'][0]['changes']['price'], {'old': '1.50', 'new': '1.75'})
+        self.assertEqual(Product.objects.get(sku='SKU-1').price, Decimal('1.50'))
+        self.assertFalse(Product.objects.filter(sku='SKU-3').exists())
+
+    def test_dry_run_flags_invalid_rows(self):
+        report = self._run(
+            "sku,name,barcode,price\n"
+            "SKU-4,Tea,444,0\n"
+            "SKU-5,,555,1.00\n"
+            "SKU-6,Milk,777,1.00\n"
+            "SKU-6,Milk,666,1.00\n"
+            "SKU-7,Soda,111,1.00\n"
+            "SKU-8,Lemonade,888,NaN\n"
+        )
+
+        self.assertEqual(report['total_rows'], 6)
+        self.assertEqual(report['invalid_rows'], 5)
+        self.assertEqual(report['created'], 1)
+        errors = {error['row']: ' '.join(error['errors']) for error in report['errors']}
+        self.assertIn('Price must be greater than zero', errors[2])
+        self.assertIn('Missing required field: name', errors[3])
+        self.assertIn('Duplicate SKU in file', errors[5])
+        self.assertIn('already belongs to product SKU-1', errors[6])
+        self.assertIn('Invalid price: NaN', errors[7])
+
+    def test_preview_and_import_read_is_active_alike(self):
+        flags = {'': True, 'no': False, 'yes': True, '1': True, 'FALSE': False}
+        report = ProductImportService.dry_run(
+            (row_num, {'sku': sku, 'name': name, 'barcode': barcode, 'category': 'Drinks', 'price': price, 'is_active': flag})
+            for row_num, (sku, name, barcode, price, flag) in enumerate(
+                [('SKU-1', 'Cola', '111', '1.50', ''), ('SKU-2', 'Water', '222', '0.99', 'no')], start=1
+            )
+        )
+        self.assertEqual(report['unchanged'], 1)
+        self.assertEqual(report['changes'][0]['changes'], {'is_active': {'old': True, 'new': False}})
+
+        admin = User.objects.create_user(username='admin', password='pass12345')
+        admin.userprofile.role = 'super_admin'
+        admin.userprofile.save()
+        items = [{'sku': f'NEW-{i}', 'name': 'Juice', 'price': 2.1, 'is_active': flag} for i, flag in enumerate(flags)]
+        upload = SimpleUploadedFile('products.json', json.dumps(items).encode(), content_type='application/json')
+        request = APIRequestFactory().post('/api/v1/products/bulk/', {'action': 'import', 'format': 'json', 'file': upload})
+        force_authenticate(request, admin)
+
+        self.assertEqual(bulk_product_operations(request).status_code, 200)
+        self.assertEqual(
+            list(Product.objects.filter(sku__startswith='NEW-').order_by('sku').values_list('is_active', flat=True)),
+            list(flags.values()),
+        )
+
+        # The management command writes what its --dry-run previews too
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as file:
+            json.dump([dict(item, sku=f'CLI-{i}') for i, item in enumerate(items)], file)
+        self.addCleanup(os.remove, file.name)
+        call_command('bulk_product_operations', 'import', '--file', file.name, '--format', 'json', stdout=StringIO())
+        self.assertEqual(
+            list(Product.objects.filter(sku__startswith='CLI-').order_by('sku').values_list('is_active', flat=True)),
+            list(flags.values()),
+        )
+
+
+class ProductExportStreamTest(TestCase):
+    """Test the streaming product exporter"""
+
+    def setUp(self):
+        drinks = Category.objects.create(name='Drinks')
+        snacks = Category.objects.create(name='Snacks')
+        Product.objects.create(name='Cola', sku='SKU-1', price=Decimal('1.50'), category=drinks)
+        Product.objects.create(name='Chips', sku='SKU-2', price=Decimal('2.25'), category=snacks)
+        Product.objects.create(name='Old Cola', sku='SKU-3', price=Decimal('1.00'), category=drinks, is_active=False)
+
+    def test_csv_export_joins_category_in_one_query(self):
+        with self.assertNumQueries(1):
+            output = b''.join(ProductExportService.stream('csv', 'sku,category,price'))
+
+        lines = output.decode('utf-8').splitlines()
+        self.assertEqual(lines, ['sku,category,price', 'SKU-1,Drinks,1.50', 'SKU-2,Snacks,2.25', 'SKU-3,Drinks,1.00'])
+
+    def test_jsonl_export_with_filters_and_gzip(self):
+        import gzip
+
+        output = b''.join(ProductExportService.stream(
+            'jsonl', ['sku', 'price'], {'category': 'Drinks', 'is_active': True}, compress=True
+        ))
+
+        lines = gzip.decompress(output).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{'sku': 'SKU-1', 'price': 1.5}])
+
+    def test_json_export_is_a_valid_array(self):
+        output = b''.join(ProductExportService.stream('json', ['sku']))
+        self.assertEqual(json.loads(output), [{'sku': 'SKU-1'}, {'sku': 'SKU-2'}, {'sku': 'SKU-3'}])
+
+    def test_unknown_column_is_rejected(self):
+        with self.assertRaises(ValueError):
+            ProductExportService.stream('csv', 'sku,password')
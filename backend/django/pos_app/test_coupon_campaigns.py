@@ -0,0 +1,100 @@
+from datetime import timedelta
+from io import StringIO
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from pos_app.models import Coupon, CouponCampaign
+from pos_app.services import CouponCache, CouponCampaignService, CouponCodeIndex
+
+
+class CouponCampaignTest(TestCase):
+    """Test bulk coupon generation and the code prefilter"""
+
+    def setUp(self):
+        CouponCodeIndex.invalidate()
+        CouponCache.invalidate()
+        now = timezone.now()
+        self.terms = {
+            'coupon_type': 'fixed_amount', 'discount_value': Decimal('5.00'),
+            'start_date': now - timedelta(days=1), 'end_date': now + timedelta(days=30),
+        }
+
+    def tearDown(self):
+        CouponCodeIndex.invalidate()
+
+    def test_generated_codes_are_unique_and_share_terms(self):
+        Coupon.objects.create(code='EXISTING', **self.terms)
+        campaign = CouponCampaign.objects.create(name='Spring', prefix='SPR', code_length=8, quantity=3000, **self.terms)
+
+        self.assertEqual(CouponCampaignService.generate(campaign), 3000)
+
+        codes = list(campaign.coupons.values_list('code', flat=True))
+        self.assertEqual(len(set(codes)), 3000)
+        self.assertTrue(all(code.startswith('SPR') and len(code) == 11 for code in codes))
+        self.assertEqual(set(campaign.coupons.values_list('max_usage_count', 'discount_value').distinct()), {(1, Decimal('5.00'))})
+
+    def test_taken_codes_are_replaced(self):
+        existing = CouponCampaignService.random_codes(50, 6)
+        Coupon.objects.bulk_create([Coupon(code=code, **self.terms) for code in existing])
+
+        self.assertEqual(CouponCampaignService.taken(existing + ['NOPE']), set(existing))
+
+    def test_index_rejects_unknown_codes_without_queries(self):
+        Coupon.objects.create(code='KNOWN1', **self.terms)
+        campaign = CouponCampaign.objects.create(name='Batch', quantity=200, **self.terms)
+        CouponCodeIndex.get()
+        CouponCampaignService.generate(campaign)
+        late = Coupon.objects.create(code='LATE1', **self.terms)
+
+        index = CouponCodeIndex.get()
+        for code in ['KNOWN1', late.code] + list(campaign.coupons.values_list('code', flat=True)):
+            self.assertTrue(index.might_contain(code))
+        misses = sum(not index.might_contain(f'GUESS{i}') for i in range(2000))
+        self.assertGreater(misses, 1900)
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(CouponCache.get('DEFINITELY-NOT-A-CODE'))
+
+    def test_index_sync_picks_up_codes_from_other_processes(self):
+        index = CouponCodeIndex.build()
+        # Inserted without signals, as another process would
+        Coupon.objects.bulk_create([Coupon(code='REMOTE1', **self.terms)])
+        self.assertFalse(index.might_contain('REMOTE1'))
+
+        index.sync()
+        self.assertTrue(index.might_contain('REMOTE1'))
+
+    def test_renamed_codes_are_added(self):
+        coupon = Coupon.objects.create(code='OLD77', **self.terms)
+        Coupon.objects.filter(pk=coupon.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        index = CouponCodeIndex.get()
+        self.assertEqual(index.settled_id, coupon.pk)
+
+        coupon.code = 'RENAMED77'
+        coupon.save()
+        self.assertTrue(CouponCodeIndex.might_exist('RENAMED77'))
+
+        # Renamed by another process, without signals
+        Coupon.objects.filter(pk=coupon.pk).update(code='REMOTE77', updated_at=timezone.now())
+        self.assertFalse(index.might_contain('REMOTE77'))
+        index.sync()
+        self.assertTrue(index.might_contain('REMOTE77'))
+
+    def test_campaign_endpoint_and_command(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='marketing', password='pass12345'))
+        payload = dict(self.terms, name='Email blast', quantity=25, prefix='EM')
+
+        response = client.post('/api/v1/coupons/campaigns/', payload, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Coupon.objects.filter(campaign_id=response.data['id']).count(), 25)
+        self.assertEqual(client.post('/api/v1/coupons/campaigns/', dict(payload, quantity=10 ** 7), format='json').status_code, 400)
+
+        call_command('generate_coupons', 'Flyers', '40', value='2.50', prefix='fly', stdout=StringIO())
+        self.assertEqual(Coupon.objects.filter(campaign__name='Flyers', code__startswith='FLY').count(), 40)
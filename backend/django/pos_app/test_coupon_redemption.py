@@ -0,0 +1,150 @@
+import threading
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from pos_app.models import Coupon, CouponRedemption, Customer
+from pos_app.services import CouponCache, CouponRedemptionService
+
+
+def make_coupon(code, **fields):
+    now = timezone.now()
+    return Coupon.objects.create(
+        code=code, coupon_type='fixed_amount', discount_value=Decimal('5.00'),
+        start_date=now - timedelta(days=1), end_date=now + timedelta(days=1), **fields
+    )
+
+
+class CouponRedemptionTest(TestCase):
+    """Test reserving, committing and releasing coupon uses"""
+
+    def setUp(self):
+        CouponCache.invalidate()
+        self.alice = Customer.objects.create(first_name='Alice', last_name='Doe', email='alice@example.com')
+        self.bob = Customer.objects.create(first_name='Bob', last_name='Doe', email='bob@example.com')
+
+    def test_usage_limit_is_never_exceeded(self):
+        coupon = make_coupon('LIMIT3', max_usage_count=3)
+        outcomes = []
+        for _ in range(5):
+            try:
+                CouponRedemptionService.redeem('LIMIT3')
+                outcomes.append(True)
+            except ValidationError:
+                outcomes.append(False)
+
+        coupon.refresh_from_db()
+        self.assertEqual(outcomes, [True, True, True, False, False])
+        self.assertEqual(coupon.used_count, 3)
+        self.assertEqual(coupon.redemptions.filter(status='committed').count(), 3)
+
+    def test_once_per_customer(self):
+        coupon = make_coupon('WELCOME', is_limited_to_customer=True)
+        CouponRedemptionService.redeem('WELCOME', customer=self.alice)
+
+        with self.assertRaises(ValidationError):
+            CouponRedemptionService.redeem('WELCOME', customer=self.alice)
+        with self.assertRaises(ValidationError):
+            CouponRedemptionService.redeem('WELCOME')
+        CouponRedemptionService.redeem('WELCOME', customer=self.bob)
+
+        coupon.refresh_from_db()
+        # The rejected attempt's increment was rolled back with it
+        self.assertEqual(coupon.used_count, 2)
+
+    def test_release_gives_the_use_back(self):
+        coupon = make_coupon('ONCE', max_usage_count=1, is_limited_to_customer=True)
+        held = CouponRedemptionService.reserve('ONCE', customer=self.alice)
+        with self.assertRaises(ValidationError):
+            CouponRedemptionService.reserve('ONCE', customer=self.bob)
+
+        self.assertTrue(CouponRedemptionService.release(held))
+        self.assertFalse(CouponRedemptionService.commit(held))
+        retry = CouponRedemptionService.reserve('ONCE', customer=self.alice)
+        self.assertTrue(CouponRedemptionService.commit(retry))
+
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used_count, 1)
+
+    def test_expired_reservations_are_released(self):
+        coupon = make_coupon('STALE', max_usage_count=2)
+        stale = CouponRedemptionService.reserve('STALE', now=timezone.now() - timedelta(hours=1))
+        fresh = CouponRedemptionService.reserve('STALE')
+
+        self.assertEqual(CouponRedemptionService.release_expired(), 1)
+
+        coupon.refresh_from_db()
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, fresh.status), ('released', 'reserved'))
+        self.assertEqual(coupon.used_count, 1)
+
+    def test_cached_lookup_follows_coupon_changes(self):
+        coupon = make_coupon('HOT')
+        CouponRedemptionService.redeem('HOT')
+        with self.assertNumQueries(0):
+            CouponCache.get('HOT')
+
+        coupon.is_active = False
+        coupon.save()
+        with self.assertRaises(ValidationError):
+            CouponRedemptionService.redeem('HOT')
+
+    def test_redeem_endpoint(self):
+        make_coupon('API', max_usage_count=1)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='cashier', password='pass12345'))
+
+        reserved = client.post('/api/v1/coupons/redeem/', {'code': 'API', 'customer_id': self.alice.pk}, format='json')
+        self.assertEqual(reserved.status_code, 201)
+        self.assertEqual(reserved.data['status'], 'reserved')
+        self.assertEqual(client.post('/api/v1/coupons/redeem/', {'code': 'API'}, format='json').status_code, 409)
+
+        committed = client.post(f"/api/v1/coupons/redemptions/{reserved.data['id']}/commit/", format='json')
+        self.assertEqual(committed.data['status'], 'committed')
+        self.assertEqual(client.post(f"/api/v1/coupons/redemptions/{reserved.data['id']}/release/").status_code, 409)
+
+        make_coupon('FORM', max_usage_count=2)
+        held = client.post('/api/v1/coupons/redeem/', {'code': 'FORM', 'commit': 'false'})
+        self.assertEqual(held.data['status'], 'reserved')
+        redeemed = client.post('/api/v1/coupons/redeem/', {'code': 'FORM', 'commit': 'true'})
+        self.assertEqual(redeemed.data['status'], 'committed')
+
+
+class ConcurrentCouponRedemptionTest(TransactionTestCase):
+    """Test that concurrent redemptions cannot oversubscribe a coupon"""
+
+    def test_concurrent_redemptions(self):
+        CouponCache.invalidate()
+        coupon = make_coupon('RUSH', max_usage_count=5)
+        barrier = threading.Barrier(20)
+        outcomes = []
+
+        def redeem():
+            barrier.wait()
+            try:
+                CouponRedemptionService.redeem('RUSH')
+                outcomes.append('redeemed')
+            except (ValidationError, OperationalError):
+                outcomes.append('rejected')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=redeem) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        coupon.refresh_from_db()
+        redeemed = outcomes.count('redeemed')
+        # SQLite may turn some attempts away on its write lock; none may ever be over the limit
+        self.assertTrue(0 < redeemed <= 5)
+        self.assertEqual(coupon.used_count, redeemed)
+        self.assertEqual(CouponRedemption.objects.filter(coupon=coupon).count(), redeemed)
@@ -0,0 +1,84 @@
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from pos_app.models import DemandForecast, Inventory, Product, Sale, SaleLine, Warehouse
+from pos_app.services import DemandForecastService
+
+
+class DemandForecastTest(TestCase):
+    """Test the demand forecast refresh"""
+
+    AS_OF = date(2024, 3, 31)  # a Sunday
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='analyst', password='pass12345')
+        self.warehouse = Warehouse.objects.create(name='Store', location='Centre')
+        self.bread = Product.objects.create(name='Bread', sku='BRD-1', price=Decimal('1.00'))
+        self.jam = Product.objects.create(name='Jam', sku='JAM-1', price=Decimal('3.00'))
+        Inventory.objects.create(product=self.bread, warehouse=self.warehouse, qty_on_hand=70)
+
+    def sell(self, product, day, quantity):
+        sale = Sale.objects.create(
+            receipt_number=f'R-{Sale.objects.count() + 1}', cashier=self.user, warehouse=self.warehouse,
+            total_amount=Decimal(quantity), payment_status='completed',
+        )
+        sold_at = timezone.make_aware(datetime.combine(day, time(12)))
+        Sale.objects.filter(pk=sale.pk).update(sale_date=sold_at)
+        SaleLine.objects.bulk_create([SaleLine(
+            sale=sale, product=product, quantity=quantity, unit_price=Decimal('1.00'), total_price=Decimal(quantity),
+        )])
+
+    def sell_daily(self, product, days, weekday_qty=10, weekend_qty=10):
+        for offset in range(days):
+            day = self.AS_OF - timedelta(days=offset)
+            self.sell(product, day, weekend_qty if day.weekday() >= 5 else weekday_qty)
+
+    def test_steady_demand(self):
+        self.sell_daily(self.bread, 56)
+
+        summary = DemandForecastService.refresh(as_of=self.AS_OF)
+
+        self.assertEqual((summary['created'], summary['updated']), (1, 0))
+        forecast = DemandForecast.objects.get(product=self.bread)
+        self.assertAlmostEqual(forecast.smoothed_daily, 10.0, places=4)
+        self.assertEqual((forecast.avg_daily_7, forecast.avg_daily_28), (10.0, 10.0))
+        self.assertEqual(forecast.days_of_cover, 7.0)
+        self.assertEqual(forecast.suggested_min_level, 70)
+        self.assertEqual(forecast.weekday_factors, [1.0] * 7)
+
+    def test_weekend_seasonality(self):
+        self.sell_daily(self.bread, 56, weekday_qty=5, weekend_qty=20)
+
+        DemandForecastService.refresh(as_of=self.AS_OF)
+
+        factors = DemandForecast.objects.get(product=self.bread).weekday_factors
+        self.assertGreater(factors[5], 1.5)
+        self.assertLess(factors[0], 1.0)
+
+    def test_incremental_refresh_continues_smoothed_level(self):
+        self.sell_daily(self.bread, 56)
+        DemandForecastService.refresh(as_of=self.AS_OF)
+        next_day = self.AS_OF + timedelta(days=1)
+        self.sell(self.bread, next_day, 20)
+
+        summary = DemandForecastService.refresh(as_of=next_day)
+
+        self.assertEqual(summary['updated'], 1)
+        forecast = DemandForecast.objects.get(product=self.bread)
+        # One new day of 20 units on top of a level of 10
+        self.assertAlmostEqual(forecast.smoothed_daily, 0.3 * 20 + 0.7 * 10, places=4)
+        self.assertEqual(forecast.computed_through, next_day)
+
+    def test_pairs_without_recent_sales_are_pruned(self):
+        self.sell(self.jam, self.AS_OF, 4)
+        DemandForecastService.refresh(as_of=self.AS_OF)
+        self.assertTrue(DemandForecast.objects.filter(product=self.jam).exists())
+
+        summary = DemandForecastService.refresh(as_of=self.AS_OF + timedelta(days=60))
+
+        self.assertEqual(summary['pruned'], 1)
+        self.assertFalse(DemandForecast.objects.exists())
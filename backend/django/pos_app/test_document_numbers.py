@@ -0,0 +1,97 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from pos_app.models import DocumentSequence, Inventory, Product, PurchaseOrder, Sale, Warehouse
+from pos_app.services import DocumentNumberService
+
+
+class DocumentNumberTest(TestCase):
+    """Test block-allocated per-warehouse document numbers"""
+
+    def setUp(self):
+        DocumentNumberService.invalidate()
+        self.store = Warehouse.objects.create(name='Store', location='Centre')
+        self.depot = Warehouse.objects.create(name='Depot', location='Edge')
+
+    def test_numbers_are_sequential_per_warehouse_and_type(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = DocumentNumberService.next('sale', self.store.pk)
+        self.assertEqual(first, f"RCT-{self.store.pk:03d}-000001")
+        self.assertEqual(DocumentNumberService.take('sale', self.store.pk, 2), [
+            f"RCT-{self.store.pk:03d}-000002", f"RCT-{self.store.pk:03d}-000003",
+        ])
+        self.assertEqual(DocumentNumberService.next('sale', self.depot.pk), f"RCT-{self.depot.pk:03d}-000001")
+        self.assertEqual(DocumentNumberService.next('return', self.store.pk), f"RET-{self.store.pk:03d}-000001")
+
+    def test_numbers_come_from_memory_once_a_block_is_reserved(self):
+        with self.settings(DOCUMENT_NUMBER_BLOCK_SIZE=3):
+            with self.captureOnCommitCallbacks(execute=True):
+                DocumentNumberService.next('sale', self.store.pk)
+            with self.assertNumQueries(0):
+                DocumentNumberService.take('sale', self.store.pk, 2)
+            refill = DocumentNumberService.next('sale', self.store.pk)
+
+        self.assertEqual(refill, f"RCT-{self.store.pk:03d}-000004")
+        self.assertEqual(DocumentSequence.objects.get(warehouse=self.store, document_type='sale').next_number, 7)
+
+    def test_numbers_in_one_transaction_come_from_its_pending_block(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                numbers = [DocumentNumberService.next('transfer', self.store.pk) for _ in range(5)]
+        after_commit = DocumentNumberService.next('transfer', self.store.pk)
+
+        self.assertEqual(numbers, [f"TR-{self.store.pk:03d}-{number:06d}" for number in range(1, 6)])
+        self.assertEqual(after_commit, f"TR-{self.store.pk:03d}-000006")
+        self.assertEqual(DocumentSequence.objects.get(warehouse=self.store, document_type='transfer').next_number, 101)
+
+    def test_blocks_kept_by_other_transactions_are_not_dropped(self):
+        key = ('sale', self.store.pk)
+        DocumentNumberService._keep(key, [210, 300])
+        DocumentNumberService._keep(key, [110, 200])
+
+        self.assertEqual(DocumentNumberService.take('sale', self.store.pk, 2), [
+            f"RCT-{self.store.pk:03d}-000110", f"RCT-{self.store.pk:03d}-000111",
+        ])
+        self.assertEqual(DocumentNumberService.take('sale', self.store.pk, 89)[0], f"RCT-{self.store.pk:03d}-000210")
+
+    def test_block_from_a_rolled_back_savepoint_is_not_reused(self):
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    DocumentNumberService.next('sale', self.store.pk)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            # The savepoint gave the block back, so the sequence hands out 000001 again
+            self.assertEqual(DocumentNumberService.next('sale', self.store.pk), f"RCT-{self.store.pk:03d}-000001")
+
+    def test_block_from_a_rolled_back_transaction_is_not_reused(self):
+        try:
+            with transaction.atomic():
+                DocumentNumberService.next('sale', self.store.pk)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        # The reservation was undone with the transaction, so its spare numbers were never kept
+        self.assertEqual(DocumentNumberService._blocks, {})
+        self.assertEqual(DocumentNumberService.next('sale', self.store.pk), f"RCT-{self.store.pk:03d}-000001")
+
+    def test_documents_are_numbered_on_save(self):
+        order = PurchaseOrder.objects.create(warehouse=self.depot)
+        self.assertEqual(order.po_number, f"PO-{self.depot.pk:03d}-000001")
+
+        cashier = User.objects.create_user(username='cashier', password='pass12345')
+        tea = Product.objects.create(name='Tea', sku='TEA-1', price=Decimal('4.00'))
+        Inventory.objects.create(product=tea, warehouse=self.store, qty_on_hand=5)
+        client = APIClient()
+        client.force_authenticate(cashier)
+        response = client.post('/api/v1/sales/create/', {
+            'cashier_id': cashier.pk, 'warehouse_id': self.store.pk,
+            'items': [{'product_id': tea.pk, 'quantity': 1, 'unit_price': 4}], 'payments': [],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Sale.objects.get().receipt_number, f"RCT-{self.store.pk:03d}-000001")
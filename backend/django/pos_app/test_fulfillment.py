@@ -0,0 +1,100 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+
+from pos_app.models import Customer, Inventory, Product, Sale, Warehouse
+from pos_app.services import FulfillmentPlanner
+
+
+class FulfillmentPlannerTest(TestCase):
+    """Test warehouse selection for online orders"""
+
+    def test_prefers_nearest_warehouse_that_ships_everything(self):
+        demand = {(1, None): 2, (2, None): 1}
+        availability = {
+            10: {(1, None): 5, (2, None): 5},
+            20: {(1, None): 5, (2, None): 5},
+            30: {(1, None): 5},
+        }
+        coordinates = {10: (9.0, 38.7), 20: (8.5, 39.3), 30: (9.01, 38.76)}
+
+        plan = FulfillmentPlanner.plan_from_availability(demand, availability, coordinates, origin=(8.55, 39.27))
+
+        self.assertFalse(plan['is_split'])
+        self.assertEqual(plan['shipments'][0]['warehouse_id'], 20)
+
+    def test_minimises_number_of_shipments(self):
+        demand = {(1, None): 1, (2, None): 1, (3, None): 1}
+        availability = {
+            10: {(1, None): 1},
+            20: {(2, None): 1, (3, None): 1},
+            30: {(1, None): 1, (2, None): 1},
+        }
+
+        plan = FulfillmentPlanner.plan_from_availability(demand, availability)
+
+        self.assertTrue(plan['fully_fulfilled'])
+        self.assertEqual(plan['warehouse_count'], 2)
+
+    def test_splits_a_line_no_warehouse_can_cover(self):
+        demand = {(1, None): 8}
+        availability = {10: {(1, None): 5}, 20: {(1, None): 5}}
+
+        plan = FulfillmentPlanner.plan_from_availability(demand, availability)
+
+        self.assertTrue(plan['is_split'])
+        self.assertEqual(sum(s['lines'][0]['quantity'] for s in plan['shipments']), 8)
+
+    def test_reports_unfulfilled_quantities(self):
+        plan = FulfillmentPlanner.plan_from_availability({(1, None): 3}, {10: {(1, None): 1}})
+
+        self.assertFalse(plan['fully_fulfilled'])
+        self.assertEqual(plan['unfulfilled'], [{'product_id': 1, 'variant_id': None, 'quantity': 2}])
+
+
+class OnlineOrderFulfillmentTest(TestCase):
+    """Test create_online_order and create_split_online_order against the database"""
+
+    def setUp(self):
+        self.cashier = User.objects.create_user(username='web', password='pass12345')
+        self.customer = Customer.objects.create(first_name='Abebe', last_name='Kebede')
+        self.near = Warehouse.objects.create(name='Near', location='A', latitude=Decimal('9.0'), longitude=Decimal('38.7'))
+        self.far = Warehouse.objects.create(name='Far', location='B', latitude=Decimal('11.6'), longitude=Decimal('37.4'))
+        self.tea = Product.objects.create(name='Tea', sku='TEA', price=Decimal('4.00'))
+        self.cups = Product.objects.create(name='Cups', sku='CUPS', price=Decimal('6.00'))
+        Inventory.objects.create(product=self.tea, warehouse=self.near, qty_on_hand=5)
+        Inventory.objects.create(product=self.cups, warehouse=self.far, qty_on_hand=5)
+        Inventory.objects.create(product=self.tea, warehouse=self.far, qty_on_hand=5)
+
+    def _lines(self):
+        return [
+            {'product': self.tea, 'quantity': 2, 'unit_price': Decimal('4.00'), 'total_price': Decimal('8.00')},
+            {'product': self.cups, 'quantity': 1, 'unit_price': Decimal('6.00'), 'total_price': Decimal('6.00')},
+        ]
+
+    def test_single_warehouse_order_uses_warehouse_with_everything(self):
+        sale = Sale.create_online_order(
+            'WEB-1', self.customer, Decimal('14.00'), lines_data=self._lines(),
+            customer_location=(9.0, 38.7), cashier=self.cashier
+        )
+
+        self.assertEqual(sale.warehouse, self.far)
+        self.assertEqual(Inventory.objects.get(product=self.cups, warehouse=self.far).qty_reserved, 1)
+
+    def test_split_order_creates_one_sale_per_shipment(self):
+        Inventory.objects.filter(product=self.tea, warehouse=self.far).delete()
+
+        with self.assertRaises(ValidationError):
+            Sale.create_online_order('WEB-2', self.customer, Decimal('14.00'), lines_data=self._lines(), cashier=self.cashier)
+
+        sales = Sale.create_split_online_order(
+            'WEB-2', self.customer, Decimal('14.00'), tax_amount=Decimal('1.40'),
+            lines_data=self._lines(), cashier=self.cashier
+        )
+
+        self.assertEqual({sale.warehouse for sale in sales}, {self.near, self.far})
+        self.assertEqual(sum(sale.total_amount for sale in sales), Decimal('14.00'))
+        self.assertEqual(sum(sale.tax_amount for sale in sales), Decimal('1.40'))
+        self.assertEqual(sorted(sale.receipt_number for sale in sales), ['WEB-2-1', 'WEB-2-2'])
@@ -0,0 +1,53 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import Count, Sum
+from django.test import TestCase
+
+from pos_app.models import AuditLog, Inventory, Payment, Return, ReturnLine, Sale, SaleLine, Transfer
+from pos_app.services import ReservedStockReconciler, StockSummaryService
+
+
+class GenerateDatasetTest(TestCase):
+    """Test the seeded synthetic dataset generator"""
+
+    def generate(self, prefix, seed=7):
+        call_command(
+            'generate_dataset', '--warehouses', '3', '--locations', '2', '--bins', '2', '--products', '40',
+            '--customers', '20', '--sales', '600', '--start', '2025-11-01', '--end', '2026-01-31',
+            '--seed', str(seed), '--prefix', prefix, stdout=StringIO(),
+        )
+        return Sale.objects.filter(receipt_number__startswith=f'{prefix}-').order_by('id')
+
+    def test_dataset_is_consistent(self):
+        sales = self.generate('SYN')
+        self.assertEqual(sales.count(), 600)
+        # Every sale adds up: lines plus tax, and what was paid
+        for sale in sales.annotate(lines_total=Sum('lines__total_price')):
+            self.assertEqual(sale.lines_total + sale.tax_amount, sale.total_amount)
+        paid = dict(Payment.objects.values_list('sale_id').annotate(total=Sum('amount')))
+        self.assertTrue(all(paid[sale.pk] == sale.total_amount for sale in sales))
+
+        returns = Return.objects.count()
+        self.assertEqual(ReturnLine.objects.count(), returns)
+        self.assertEqual(AuditLog.objects.count(), 600 + returns)
+        self.assertEqual(Inventory.objects.values('warehouse').distinct().count(), 3)
+        self.assertTrue(Transfer.objects.filter(status='received').exists())
+        self.assertEqual(StockSummaryService.reconcile(), [])
+        self.assertEqual(ReservedStockReconciler.reconcile(), [])
+
+        # December carries the yearly peak
+        by_month = dict(sales.order_by().values_list('sale_date__month').annotate(count=Count('id')))
+        self.assertGreater(by_month[12], by_month[11])
+
+    def test_same_seed_same_sales(self):
+        first = list(self.generate('SYA').values_list('sale_date', 'total_amount'))
+        second = list(self.generate('SYB').values_list('sale_date', 'total_amount'))
+        self.assertEqual(first, second)
+        self.assertEqual(SaleLine.objects.filter(sale__receipt_number__startswith='SYA-').count(),
+                         SaleLine.objects.filter(sale__receipt_number__startswith='SYB-').count())
+        self.assertNotEqual(first, list(self.generate('SYC', seed=8).values_list('sale_date', 'total_amount')))
+
+        with self.assertRaises(CommandError):
+            self.generate('SYA')
@@ -0,0 +1,94 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from pos_app.models import (
+    Bin, GoodsReceivedNote, Inventory, Location, Product, PurchaseOrder, PurchaseOrderLine, Warehouse
+)
+from pos_app.services import GoodsReceivingService
+
+
+class GoodsReceivingTest(TestCase):
+    """Test posting goods received notes to inventory"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='receiver', password='pass12345')
+        self.warehouse = Warehouse.objects.create(name='DC', location='Depot')
+        self.flour = Product.objects.create(name='Flour', sku='FLR-1', price=Decimal('2.00'))
+        self.salt = Product.objects.create(name='Salt', sku='SLT-1', price=Decimal('1.00'))
+        self.order = PurchaseOrder.objects.create(warehouse=self.warehouse, status='ordered')
+        self.flour_line = PurchaseOrderLine.objects.create(
+            purchase_order=self.order, product=self.flour, ordered_qty=10, unit_cost=Decimal('1.50'), total_price=Decimal('15.00')
+        )
+        self.salt_line = PurchaseOrderLine.objects.create(
+            purchase_order=self.order, product=self.salt, ordered_qty=4, unit_cost=Decimal('0.50'), total_price=Decimal('2.00')
+        )
+        Inventory.objects.create(product=self.flour, warehouse=self.warehouse, qty_on_hand=3)
+
+    def stock(self, product, **slot):
+        return Inventory.objects.get(product=product, warehouse=self.warehouse, location=slot.get('location'), bin=slot.get('bin')).qty_on_hand
+
+    def test_partial_then_full_receipt(self):
+        GoodsReceivingService.post(self.order, [
+            {'purchase_order_line': self.flour_line, 'received_qty': 6},
+            {'purchase_order_line': self.salt_line.pk, 'received_qty': 4},
+        ], self.user)
+
+        self.order.refresh_from_db()
+        self.flour_line.refresh_from_db()
+        self.assertEqual(self.order.status, 'partially_received')
+        self.assertEqual((self.flour_line.received_qty, self.flour_line.processed_qty), (6, 6))
+        self.assertEqual((self.stock(self.flour), self.stock(self.salt)), (9, 4))
+
+        GoodsReceivingService.post(self.order, [{'purchase_order_line': self.flour_line, 'received_qty': 4}], self.user)
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'received')
+        self.assertIsNotNone(self.order.received_date)
+        self.assertEqual(self.stock(self.flour), 13)
+
+    def test_damaged_goods_are_received_but_not_stocked(self):
+        GoodsReceivingService.post(self.order, [
+            {'purchase_order_line': self.salt_line, 'received_qty': 3, 'condition': 'Damaged'},
+        ], self.user)
+
+        self.salt_line.refresh_from_db()
+        self.assertEqual((self.salt_line.received_qty, self.salt_line.processed_qty), (3, 0))
+        self.assertFalse(Inventory.objects.filter(product=self.salt).exists())
+
+    def test_line_destination_overrides_order_destination(self):
+        location = Location.objects.create(name='Aisle 1', warehouse=self.warehouse, code='A1')
+        shelf = Bin.objects.create(name='Shelf 1', location=location, code='A1-1')
+
+        GoodsReceivingService.post(self.order, [
+            {'purchase_order_line': self.salt_line, 'received_qty': 2, 'destination_location': location, 'destination_bin': shelf},
+        ], self.user)
+
+        self.assertEqual(self.stock(self.salt, location=location, bin=shelf), 2)
+
+    def test_over_receipt_is_rejected_atomically(self):
+        with self.assertRaises(ValidationError):
+            GoodsReceivingService.post(self.order, [
+                {'purchase_order_line': self.salt_line, 'received_qty': 2},
+                {'purchase_order_line': self.flour_line, 'received_qty': 11},
+            ], self.user)
+
+        self.assertFalse(GoodsReceivedNote.objects.exists())
+        self.salt_line.refresh_from_db()
+        self.assertEqual(self.salt_line.received_qty, 0)
+
+    def test_grn_endpoint_posts_stock(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post('/api/v1/grns/', {
+            'purchase_order': self.order.pk, 'received_by': self.user.pk,
+            'lines': [{'purchase_order_line': self.flour_line.pk, 'received_qty': 10}],
+        }, format='json')
+
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(self.stock(self.flour), 13)
+        self.assertEqual(len(response.data['lines']), 1)
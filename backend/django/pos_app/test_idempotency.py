@@ -0,0 +1,104 @@
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import OperationalError
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from pos_app.models import IdempotencyKey, Inventory, Payment, Product, Sale, Warehouse
+from pos_app.services import IdempotencyStore
+
+
+class IdempotencyKeyTest(TestCase):
+    """Test that retried mutating requests replay the stored response"""
+
+    def setUp(self):
+        IdempotencyStore.invalidate()
+        self.cashier = User.objects.create_user(username='cashier', password='pass12345')
+        self.store = Warehouse.objects.create(name='Store', location='Centre')
+        self.tea = Product.objects.create(name='Tea', sku='TEA-1', price=Decimal('4.00'))
+        self.stock = Inventory.objects.create(product=self.tea, warehouse=self.store, qty_on_hand=10)
+        self.client = APIClient()
+        self.client.force_authenticate(self.cashier)
+
+    def sale_request(self, quantity=1):
+        return {
+            'cashier_id': self.cashier.pk, 'warehouse_id': self.store.pk,
+            'items': [{'product_id': self.tea.pk, 'quantity': quantity, 'unit_price': 4}],
+            'payments': [],
+        }
+
+    def post_sale(self, key, quantity=1):
+        return self.client.post('/api/v1/sales/create/', self.sale_request(quantity), format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_first_response(self):
+        first = self.post_sale('checkout-1')
+        retry = self.post_sale('checkout-1')
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual((retry.status_code, retry['Idempotent-Replayed']), (201, 'true'))
+        self.assertEqual(retry.json()['id'], first.data['id'])
+        self.assertEqual(Sale.objects.count(), 1)
+        self.assertEqual(self.post_sale('checkout-2').status_code, 201)
+        self.assertEqual(Sale.objects.count(), 2)
+
+    def test_replay_from_memory_does_not_query(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post_sale('checkout-1')
+        with self.assertNumQueries(0):
+            stored = IdempotencyStore.lookup(self.cashier.pk, 'checkout-1')
+        self.assertEqual(stored[1], 201)
+
+        IdempotencyStore.invalidate()
+        retry = self.post_sale('checkout-1')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Sale.objects.count(), 1)
+
+    def test_transient_database_errors_are_not_replayed(self):
+        self.client.raise_request_exception = False
+        with mock.patch('pos_app.services.DocumentNumberService.next', side_effect=OperationalError('database is locked')):
+            failed = self.post_sale('checkout-1')
+
+        self.assertEqual(failed.status_code, 500)
+        self.assertFalse(IdempotencyKey.objects.filter(key='checkout-1').exists())
+        retry = self.post_sale('checkout-1')
+        self.assertEqual(retry.status_code, 201)
+        self.assertFalse(retry.has_header('Idempotent-Replayed'))
+        self.assertEqual(Sale.objects.count(), 1)
+
+    def test_key_reused_for_another_request(self):
+        self.post_sale('checkout-1')
+        self.assertEqual(self.post_sale('checkout-1', quantity=2).status_code, 422)
+        self.assertEqual(Sale.objects.count(), 1)
+
+    def test_key_in_progress_and_stale_claims(self):
+        fingerprint = IdempotencyStore.fingerprint('POST', '/api/v1/sales/create/', self.sale_request())
+        self.assertTrue(IdempotencyStore.claim(self.cashier.pk, 'checkout-1', fingerprint))
+        self.assertEqual(self.post_sale('checkout-1').status_code, 409)
+
+        # A claim whose request died is taken over once its lease has passed
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(seconds=IdempotencyStore.IN_PROGRESS_SECONDS + 1))
+        self.assertEqual(self.post_sale('checkout-1').status_code, 201)
+        self.assertEqual(Sale.objects.count(), 1)
+
+    def test_keys_are_per_user(self):
+        self.post_sale('checkout-1')
+        other = User.objects.create_user(username='other', password='pass12345')
+        self.client.force_authenticate(other)
+
+        self.assertEqual(self.post_sale('checkout-1').status_code, 201)
+        self.assertEqual(Sale.objects.count(), 2)
+
+    def test_expired_keys_are_purged(self):
+        sale = self.post_sale('checkout-1').data
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(IdempotencyStore.purge_expired(), 1)
+
+        payment = {'method': 'cash', 'amount': 2}
+        url = f"/api/v1/sales/{sale['id']}/add-payment/"
+        self.assertEqual(self.client.post(url, payment, format='json', HTTP_IDEMPOTENCY_KEY='pay-1').status_code, 200)
+        self.assertEqual(self.client.post(url, payment, format='json', HTTP_IDEMPOTENCY_KEY='pay-1').status_code, 200)
+        self.assertEqual(Payment.objects.filter(sale_id=sale['id']).count(), 1)
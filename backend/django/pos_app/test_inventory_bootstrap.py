@@ -0,0 +1,59 @@
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from pos_app.models import Bin, Category, Inventory, Location, Product, ProductVariant, Warehouse
+from pos_app.services import InventoryBootstrapService
+
+
+class InventoryBootstrapTest(TestCase):
+    """Test creating the missing warehouse-level inventory rows in bulk"""
+
+    def setUp(self):
+        self.drinks = Category.objects.create(name='Drinks')
+        self.kitchen = Category.objects.create(name='Kitchen')
+        self.store = Warehouse.objects.create(name='Store', location='Centre')
+        self.depot = Warehouse.objects.create(name='Depot', location='Edge')
+        self.tea = Product.objects.create(name='Tea', sku='TEA-1', price=Decimal('4.00'), category=self.drinks)
+        self.mug = Product.objects.create(name='Mug', sku='MUG-1', price=Decimal('8.00'), category=self.kitchen)
+        self.red_mug = ProductVariant.objects.create(product=self.mug, name='Red', sku='MUG-1-RED')
+        self.blue_mug = ProductVariant.objects.create(product=self.mug, name='Blue', sku='MUG-1-BLUE')
+        Inventory.objects.create(product=self.tea, warehouse=self.store, qty_on_hand=7)
+        # A binned row does not stand in for the warehouse-level one
+        aisle = Location.objects.create(name='Aisle A', warehouse=self.depot, code='A')
+        shelf = Bin.objects.create(name='Shelf', location=aisle, code='A-1')
+        Inventory.objects.create(product=self.mug, variant=self.red_mug, warehouse=self.depot, location=aisle, bin=shelf)
+
+    def rows(self):
+        return set(
+            Inventory.objects.filter(location=None).values_list('warehouse_id', 'product_id', 'variant_id', 'qty_on_hand')
+        )
+
+    def test_missing_rows_are_created_in_batches(self):
+        # The anti-join and four inserts of up to two rows, inside one savepoint
+        with self.assertNumQueries(1 + 4 + 2):
+            created = InventoryBootstrapService.ensure(qty_on_hand=5, batch_size=2)
+        self.assertEqual(created, 7)
+        self.assertEqual(self.rows(), {(self.store.pk, self.tea.pk, None, 7)} | {
+            (warehouse.pk, self.mug.pk, variant, 5)
+            for warehouse in (self.store, self.depot) for variant in (None, self.red_mug.pk, self.blue_mug.pk)
+        } | {(self.depot.pk, self.tea.pk, None, 5)})
+        self.assertEqual(InventoryBootstrapService.ensure(), 0)
+
+    def test_filters_and_dry_run(self):
+        self.assertEqual(InventoryBootstrapService.count_missing(), {self.store.pk: 3, self.depot.pk: 4})
+        self.assertEqual(InventoryBootstrapService.count_missing(category_ids=[self.drinks.pk]), {self.depot.pk: 1})
+
+        out = StringIO()
+        call_command('ensure_inventory_for_sales', '--dry-run', '--warehouse', str(self.depot.pk), stdout=out)
+        self.assertIn('would create 4 new inventory records', out.getvalue())
+        self.assertEqual(Inventory.objects.count(), 2)
+
+        call_command(
+            'ensure_inventory_for_sales', '--category', str(self.kitchen.pk), '--warehouse', str(self.store.pk),
+            '--qty', '3', stdout=out,
+        )
+        self.assertIn('Created 3 new inventory records', out.getvalue())
+        self.assertEqual(InventoryBootstrapService.count_missing(), {self.depot.pk: 4})
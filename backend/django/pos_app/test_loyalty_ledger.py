@@ -0,0 +1,126 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from pos_app.models import Customer
+from pos_app.services import LoyaltyService
+
+
+class LoyaltyLedgerTest(TestCase):
+    """Test the loyalty points ledger and the balances derived from it"""
+
+    def setUp(self):
+        self.alice = Customer.objects.create(first_name='Alice', last_name='Doe', email='alice@example.com')
+        self.bob = Customer.objects.create(first_name='Bob', last_name='Doe', email='bob@example.com')
+
+    def earn_at(self, customer, points, when):
+        LoyaltyService.earn(customer, points)
+        customer.loyalty_transactions.filter(pk=customer.loyalty_transactions.latest('id').pk).update(
+            created_at=when, expires_at=when + timedelta(days=LoyaltyService.expiry_days())
+        )
+
+    def test_earn_and_redeem_write_the_ledger(self):
+        self.assertEqual(self.alice.earn_loyalty_points(100), 100)
+        self.assertEqual(self.alice.redeem_loyalty_points(30), 70)
+
+        with self.assertRaises(ValidationError):
+            self.alice.redeem_loyalty_points(71)
+
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.loyalty_points, 70)
+        self.assertEqual(
+            list(self.alice.loyalty_transactions.order_by('id').values_list('transaction_type', 'points')),
+            [('earn', 100), ('redeem', -30)],
+        )
+        self.assertEqual(LoyaltyService.reconcile(), [])
+
+    def test_stale_instance_cannot_overdraw(self):
+        LoyaltyService.earn(self.alice, 50)
+        stale = Customer.objects.get(pk=self.alice.pk)
+        LoyaltyService.redeem(self.alice, 40)
+
+        # The in-memory balance still says 50; the guarded UPDATE reads the stored one
+        with self.assertRaises(ValidationError):
+            stale.redeem_loyalty_points(20)
+        self.assertEqual(Customer.objects.get(pk=self.alice.pk).loyalty_points, 10)
+
+    def test_expiry_skips_points_already_redeemed(self):
+        now = timezone.now()
+        lapsed = now - timedelta(days=LoyaltyService.expiry_days() + 1)
+        self.earn_at(self.alice, 100, lapsed)
+        self.earn_at(self.alice, 50, now)
+        LoyaltyService.redeem(self.alice, 60)
+        self.earn_at(self.bob, 20, lapsed)
+
+        self.assertEqual(LoyaltyService.expire(now=now), {'customers': 2, 'points': 60})
+        # Running again expires nothing more
+        self.assertEqual(LoyaltyService.expire(now=now), {'customers': 0, 'points': 0})
+
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertEqual((self.alice.loyalty_points, self.bob.loyalty_points), (50, 0))
+        self.assertEqual(LoyaltyService.reconcile(), [])
+
+    def test_expiry_catches_up_after_missed_runs(self):
+        now = timezone.now()
+        self.earn_at(self.alice, 30, now - timedelta(days=LoyaltyService.expiry_days() + 90))
+        self.earn_at(self.alice, 10, now)
+
+        self.assertEqual(LoyaltyService.expire(now=now), {'customers': 1, 'points': 30})
+        self.assertEqual(Customer.objects.get(pk=self.alice.pk).loyalty_points, 10)
+
+    def test_period_summary(self):
+        now = timezone.now()
+        self.earn_at(self.alice, 100, now - timedelta(days=40))
+        LoyaltyService.earn(self.alice, 25)
+        LoyaltyService.redeem(self.alice, 10)
+
+        summary, = LoyaltyService.period_summary(now - timedelta(days=30), now + timedelta(minutes=1))
+        self.assertEqual(
+            {key: summary[key] for key in ('opening', 'earned', 'redeemed', 'closing')},
+            {'opening': 100, 'earned': 25, 'redeemed': -10, 'closing': 115},
+        )
+
+    def test_reconcile_repairs_drift(self):
+        LoyaltyService.earn(self.alice, 80)
+        Customer.objects.filter(pk=self.alice.pk).update(loyalty_points=95)
+
+        self.assertEqual(LoyaltyService.reconcile(), [(self.alice.pk, 95, 80)])
+        call_command('reconcile_loyalty_points', '--fix', stdout=StringIO())
+        self.assertEqual(Customer.objects.get(pk=self.alice.pk).loyalty_points, 80)
+
+    def test_statement_endpoint(self):
+        LoyaltyService.earn(self.alice, 40)
+        LoyaltyService.redeem(self.alice, 15)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='cashier', password='pass12345'))
+
+        response = client.get(f'/api/v1/customers/{self.alice.pk}/loyalty-statement/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['opening'], response.data['closing']), (0, 25))
+        self.assertEqual([entry['points'] for entry in response.data['transactions']], [40, -15])
+
+        redeem = client.post(f'/api/v1/customers/{self.alice.pk}/redeem-points/', {'points': 30}, format='json')
+        self.assertEqual(redeem.status_code, 400)
+
+    def test_balance_is_only_changed_through_the_ledger(self):
+        LoyaltyService.earn(self.alice, 40)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='manager', password='pass12345'))
+
+        response = client.patch(f'/api/v1/customers/{self.alice.pk}/', {'loyalty_points': 500}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Customer.objects.get(pk=self.alice.pk).loyalty_points, 40)
+
+        adjust = client.post(f'/api/v1/customers/{self.alice.pk}/adjust-points/', {'points': -15}, format='json')
+        self.assertEqual(adjust.data['customer']['loyalty_points'], 25)
+        overdraw = client.post(f'/api/v1/customers/{self.alice.pk}/adjust-points/', {'points': -26}, format='json')
+        self.assertEqual(overdraw.status_code, 400)
+        self.assertEqual(self.alice.loyalty_transactions.latest('id').transaction_type, 'adjust')
+        self.assertEqual(LoyaltyService.reconcile(), [])
@@ -0,0 +1,65 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from pos_app.models import Inventory, Product, Warehouse
+from pos_app.services import WarehouseSpatialIndex
+
+
+class WarehouseSpatialIndexTest(TestCase):
+    """Test the in-memory warehouse spatial index"""
+
+    def test_nearest_matches_brute_force(self):
+        import random
+        from pos_app.services import FulfillmentPlanner
+
+        rng = random.Random(7)
+        warehouses = [
+            {'id': i, 'name': f'W{i}', 'warehouse_type': 'store', 'location': '',
+             'latitude': rng.uniform(-60, 60), 'longitude': rng.uniform(-180, 180)}
+            for i in range(1, 301)
+        ]
+        index = WarehouseSpatialIndex(warehouses)
+        origin = (9.03, 38.74)
+        candidates = {w['id'] for w in warehouses if w['id'] % 3 == 0}
+
+        result = [w['id'] for w, _ in index.nearest(*origin, limit=5, candidates=candidates)]
+
+        expected = sorted(
+            (w for w in warehouses if w['id'] in candidates),
+            key=lambda w: FulfillmentPlanner.distance_km(origin, (w['latitude'], w['longitude']))
+        )[:5]
+        self.assertEqual(result, [w['id'] for w in expected])
+
+
+class NearestStockEndpointTest(TestCase):
+    """Test the nearest stock lookup endpoint"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='staff', password='pass12345'))
+        self.product = Product.objects.create(name='Coffee', sku='COF-1', price=Decimal('9.00'))
+        self.bole = Warehouse.objects.create(name='Bole', location='Bole', latitude=Decimal('8.99'), longitude=Decimal('38.79'))
+        self.piassa = Warehouse.objects.create(name='Piassa', location='Piassa', latitude=Decimal('9.03'), longitude=Decimal('38.75'))
+        self.adama = Warehouse.objects.create(name='Adama', location='Adama', latitude=Decimal('8.54'), longitude=Decimal('39.27'))
+        Inventory.objects.create(product=self.product, warehouse=self.bole, qty_on_hand=3, qty_reserved=3)
+        Inventory.objects.create(product=self.product, warehouse=self.piassa, qty_on_hand=4)
+        Inventory.objects.create(product=self.product, warehouse=self.adama, qty_on_hand=10)
+
+    def test_returns_nearest_locations_with_available_stock(self):
+        response = self.client.get('/api/v1/inventory/nearest_stock/', {'sku': 'COF-1', 'lat': 9.0, 'lng': 38.78})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['warehouse_name'] for item in response.data['locations']], ['Piassa', 'Adama'])
+        self.assertEqual(response.data['locations'][0]['available_stock'], 4)
+
+    def test_index_is_rebuilt_when_a_warehouse_moves(self):
+        self.client.get('/api/v1/inventory/nearest_stock/', {'sku': 'COF-1', 'lat': 8.5, 'lng': 39.3})
+        self.adama.latitude, self.adama.longitude = Decimal('12.0'), Decimal('37.0')
+        self.adama.save()
+
+        response = self.client.get('/api/v1/inventory/nearest_stock/', {'sku': 'COF-1', 'lat': 8.5, 'lng': 39.3, 'limit': 1})
+
+        self.assertEqual(response.data['locations'][0]['warehouse_name'], 'Piassa')
@@ -0,0 +1,140 @@
+import uuid
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from pos_app.models import Customer, Inventory, Product, Sale, Warehouse
+from pos_app.services import OfflineSaleIngestService, ReservedStockReconciler, SalePaymentService
+
+
+class OfflineSaleIngestTest(TestCase):
+    """Test idempotent batch ingestion of sales queued by offline terminals"""
+
+    def setUp(self):
+        self.cashier = User.objects.create_user(username='cashier', password='pass12345')
+        self.store = Warehouse.objects.create(name='Store', location='Centre')
+        self.tea = Product.objects.create(name='Tea', sku='TEA-1', price=Decimal('4.00'), cost_price=Decimal('2.50'))
+        self.cups = Product.objects.create(name='Cups', sku='CUP-1', price=Decimal('6.00'))
+        self.tea_stock = Inventory.objects.create(product=self.tea, warehouse=self.store, qty_on_hand=10)
+        self.customer = Customer.objects.create(first_name='Alice', last_name='Doe', email='alice@example.com')
+
+    def offline_sale(self, sequence, quantity=1, **fields):
+        return {
+            'client_uuid': str(uuid.uuid4()), 'terminal_id': 'T1', 'terminal_sequence': sequence,
+            'warehouse_id': self.store.pk, 'sold_at': '2026-03-01T10:00:00Z',
+            'items': [{'product_id': self.tea.pk, 'quantity': quantity, 'unit_price': '4.00'}],
+            'payments': [{'method': 'cash', 'amount': '4.40'}] if quantity == 1 else [],
+            **fields,
+        }
+
+    def test_replay_is_idempotent(self):
+        batch = [self.offline_sale(sequence) for sequence in range(1, 4)]
+        first = OfflineSaleIngestService.ingest(batch, user=self.cashier)
+        replay = OfflineSaleIngestService.ingest(batch, user=self.cashier)
+
+        self.assertEqual([result['status'] for result in first], ['created'] * 3)
+        self.assertEqual([result['status'] for result in replay], ['duplicate'] * 3)
+        self.assertEqual([result['sale_id'] for result in replay], [result['sale_id'] for result in first])
+        self.assertEqual(Sale.objects.count(), 3)
+        self.tea_stock.refresh_from_db()
+        self.assertEqual(self.tea_stock.qty_on_hand, 7)
+
+    def test_sales_are_stored_as_rung_up(self):
+        result, = OfflineSaleIngestService.ingest([self.offline_sale(7, customer_id=self.customer.pk)], user=self.cashier)
+
+        sale = Sale.objects.get(pk=result['sale_id'])
+        self.assertEqual(sale.receipt_number, 'T1-000007')
+        self.assertEqual((sale.total_amount, sale.amount_paid, sale.payment_status), (Decimal('4.40'), Decimal('4.40'), 'completed'))
+        self.assertEqual(sale.sale_date.isoformat(), '2026-03-01T10:00:00+00:00')
+        self.assertEqual(sale.lines.get().cost_price, Decimal('2.50'))
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.loyalty_points, 4)
+
+    def test_invalid_sales_are_rejected_individually(self):
+        reused = self.offline_sale(1)
+        OfflineSaleIngestService.ingest([reused], user=self.cashier)
+        repeated = self.offline_sale(5)
+
+        results = OfflineSaleIngestService.ingest([
+            self.offline_sale(1),
+            self.offline_sale(2, items=[{'product_id': 999, 'quantity': 1, 'unit_price': '1.00'}]),
+            {'client_uuid': 'not-a-uuid'},
+            repeated,
+            repeated,
+            self.offline_sale(6, quantity=14, payments=[{'method': 'cash', 'amount': '61.60'}]),
+        ], user=self.cashier)
+
+        self.assertEqual(
+            [result['status'] for result in results],
+            ['rejected', 'rejected', 'rejected', 'created', 'duplicate', 'created'],
+        )
+        self.assertIn('already used', results[0]['errors'][0])
+        # A sale that already happened is posted even when stock runs short
+        self.assertEqual(len(results[5]['warnings']), 1)
+        self.tea_stock.refresh_from_db()
+        self.assertEqual(self.tea_stock.qty_on_hand, 0)
+
+    def test_sales_that_keep_conflicting_are_rejected(self):
+        bulk_create = Sale.objects.bulk_create
+
+        def clashing(objects, *args, **kwargs):
+            # Stands in for another request that keeps storing receipt CLASH first
+            if any(sale.receipt_number == 'CLASH' for sale in objects):
+                raise IntegrityError('UNIQUE constraint failed: pos_app_sale.receipt_number')
+            return bulk_create(objects, *args, **kwargs)
+
+        with mock.patch.object(Sale.objects, 'bulk_create', side_effect=clashing):
+            results = OfflineSaleIngestService.ingest([
+                self.offline_sale(1, customer_id=self.customer.pk),
+                self.offline_sale(2, receipt_number='CLASH'),
+            ], user=self.cashier)
+
+        self.assertEqual([result['status'] for result in results], ['created', 'rejected'])
+        self.assertIn('send it again', results[1]['errors'][0])
+        self.assertEqual(Sale.objects.get().pk, results[0]['sale_id'])
+        self.tea_stock.refresh_from_db()
+        self.assertEqual(self.tea_stock.qty_on_hand, 9)
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.loyalty_points, self.customer.calculate_loyalty_points_from_purchase(4.40))
+
+    def test_unpaid_sales_reserve_stock_until_paid_off(self):
+        result, = OfflineSaleIngestService.ingest([self.offline_sale(1, quantity=2)], user=self.cashier)
+        sale = Sale.objects.get(pk=result['sale_id'])
+        self.assertEqual(sale.payment_status, 'pending')
+        self.tea_stock.refresh_from_db()
+        self.assertEqual((self.tea_stock.qty_on_hand, self.tea_stock.qty_reserved), (10, 2))
+        self.assertEqual(ReservedStockReconciler.reconcile(), [])
+
+        SalePaymentService.record(sale, '8.80', 'cash')
+        self.tea_stock.refresh_from_db()
+        self.assertEqual((self.tea_stock.qty_on_hand, self.tea_stock.qty_reserved), (8, 0))
+        self.assertEqual(ReservedStockReconciler.reconcile(), [])
+
+    def test_missing_inventory_rows_are_created(self):
+        sale = self.offline_sale(1, items=[{'product_id': self.cups.pk, 'quantity': 2, 'unit_price': '6.00'}])
+        OfflineSaleIngestService.ingest([sale], user=self.cashier)
+        self.assertEqual(Inventory.objects.get(product=self.cups, warehouse=self.store).qty_on_hand, 0)
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        def queries_for(size, start):
+            batch = [self.offline_sale(start + i, customer_id=self.customer.pk) for i in range(size)]
+            with CaptureQueriesContext(connection) as queries:
+                OfflineSaleIngestService.ingest(batch, user=self.cashier)
+            return len(queries)
+
+        # Kept under SQLite's bound-parameter limit, which would split the bulk inserts
+        self.assertEqual(queries_for(5, 100), queries_for(30, 200))
+
+    def test_ingest_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.cashier)
+
+        response = client.post('/api/v1/offline/sales/', {'sales': [self.offline_sale(1)]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['created'], response.data['rejected']), (1, 0))
+        self.assertEqual(client.post('/api/v1/offline/sales/', {'sales': []}, format='json').status_code, 400)
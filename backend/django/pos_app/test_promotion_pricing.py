@@ -0,0 +1,210 @@
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import Group, User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from pos_app.models import Category, Product, Promotion
+from pos_app.services import BasketPromotionSolver, IndexedPromotion, PricingEngine, PromotionIndex
+
+
+class PromotionPricingTest(TestCase):
+    """Test basket pricing against the in-memory promotion index"""
+
+    def setUp(self):
+        PromotionIndex.invalidate()
+        self.drinks = Category.objects.create(name='Drinks')
+        self.cola = Product.objects.create(name='Cola', sku='COLA-1', price=Decimal('2.00'), category=self.drinks)
+        self.bread = Product.objects.create(name='Bread', sku='BRD-1', price=Decimal('3.00'))
+        now = timezone.now()
+        self.window = {'start_date': now - timedelta(days=1), 'end_date': now + timedelta(days=1)}
+
+    def tearDown(self):
+        PromotionIndex.invalidate()
+
+    def promotion(self, name, promotion_type, discount_value, **fields):
+        return Promotion.objects.create(
+            name=name, promotion_type=promotion_type, discount_value=Decimal(discount_value), **self.window, **fields
+        )
+
+    def test_best_promotion_per_line(self):
+        drinks_off = self.promotion('Drinks 10%', 'percentage', '10')
+        drinks_off.categories.add(self.drinks)
+        three_for_two = self.promotion('Cola 3 for 2', 'buy_x_get_y', '0', buy_quantity=2, get_quantity=1)
+        three_for_two.products.add(self.cola)
+
+        result = PricingEngine.price_basket([
+            {'product': self.cola, 'quantity': 3},
+            {'product': self.bread.pk, 'quantity': 1},
+        ])
+
+        cola, bread = result['lines']
+        self.assertEqual(cola['promotion_id'], three_for_two.pk)
+        self.assertEqual(cola['discount'], Decimal('2.00'))
+        # As in Promotion.calculate_discount, a category restriction does not exclude uncategorized products
+        self.assertEqual(bread['promotion_id'], drinks_off.pk)
+        self.assertEqual(bread['discount'], Decimal('0.30'))
+        self.assertEqual(result['subtotal'], Decimal('9.00'))
+        self.assertEqual(result['total'], Decimal('6.70'))
+
+    def test_uncategorized_product_matches_model_rules(self):
+        snacks = Category.objects.create(name='Snacks')
+        snacks_off = self.promotion('Snacks 25%', 'percentage', '25')
+        snacks_off.categories.add(snacks)
+        cola_deal = self.promotion('Cola 1 off', 'fixed_amount', '1.00')
+        cola_deal.products.add(self.cola)
+
+        result = PricingEngine.price_basket([
+            {'product': self.cola, 'quantity': 1},
+            {'product': self.bread, 'quantity': 2},
+        ])
+
+        cola, bread = result['lines']
+        for line, product, promotion in ((cola, self.cola, cola_deal), (bread, self.bread, snacks_off)):
+            self.assertEqual(line['discount'], promotion.calculate_discount(product, quantity=line['quantity']))
+        # Snacks 25% neither reaches Cola, which is in another category, nor stops Bread
+        self.assertEqual(cola['promotion_id'], cola_deal.pk)
+        self.assertEqual(bread['promotion_id'], snacks_off.pk)
+        self.assertEqual(bread['discount'], Decimal('1.50'))
+
+    def test_customer_group_and_minimum_order(self):
+        members = Group.objects.create(name='Members')
+        member_deal = self.promotion('Members 20%', 'percentage', '20')
+        member_deal.customer_groups.add(members)
+        self.promotion('Big basket', 'fixed_amount', '1.50', min_order_value=Decimal('10.00'))
+
+        anonymous = PricingEngine.price_basket([{'product': self.bread, 'quantity': 2}])
+        self.assertEqual(anonymous['discount_total'], Decimal('0'))
+
+        member = User.objects.create_user(username='member', password='pass12345')
+        member.groups.add(members)
+        priced = PricingEngine.price_basket([{'product': self.bread, 'quantity': 4}], customer_user=member)
+        # 20% of 12.00 beats the flat 1.50 once both are eligible
+        self.assertEqual(priced['discount_total'], Decimal('2.40'))
+
+    def test_index_rebuilt_on_m2m_change(self):
+        promotion = self.promotion('Bread 50%', 'percentage', '50')
+        promotion.products.add(self.cola)
+        self.assertEqual(PricingEngine.price_basket([{'product': self.bread, 'quantity': 1}])['discount_total'], Decimal('0'))
+
+        promotion.products.add(self.bread)
+        self.assertEqual(PricingEngine.price_basket([{'product': self.bread, 'quantity': 1}])['discount_total'], Decimal('1.50'))
+
+        promotion.is_active = False
+        promotion.save()
+        self.assertEqual(PricingEngine.price_basket([{'product': self.bread, 'quantity': 1}])['discount_total'], Decimal('0'))
+
+    def test_pricing_queries_do_not_grow_with_promotions(self):
+        for i in range(30):
+            self.promotion(f'Promo {i}', 'percentage', str(i % 10 + 1)).products.add(self.cola)
+        index = PromotionIndex.get()
+
+        with CaptureQueriesContext(connection) as queries:
+            result = PricingEngine.price_basket(
+                [{'product': self.cola, 'quantity': 1}, {'product': self.bread, 'quantity': 2}], index=index
+            )
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(result['lines'][0]['discount'], Decimal('0.20'))
+
+    def test_bundle_priced_against_line_promotions(self):
+        pack = self.promotion('Cola and bread', 'bundle', '1.50')
+        pack.required_products.add(self.cola, self.bread)
+        cola_off = self.promotion('Cola 10%', 'percentage', '10')
+        cola_off.products.add(self.cola)
+
+        result = PricingEngine.price_basket([
+            {'product': self.cola, 'quantity': 2},
+            {'product': self.bread, 'quantity': 1},
+        ])
+
+        cola, bread = result['lines']
+        # One cola goes into the bundle, the other keeps its 10%
+        self.assertEqual(cola['promotion_ids'], sorted([pack.pk, cola_off.pk]))
+        self.assertEqual(cola['discount'], Decimal('0.80'))
+        self.assertEqual(result['discount_total'], Decimal('1.70'))
+        self.assertTrue(result['exact'])
+
+    def test_evaluate_endpoint(self):
+        self.promotion('Everything 10%', 'percentage', '10')
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='cashier', password='pass12345'))
+
+        response = client.post('/api/v1/promotions/evaluate/', {
+            'lines': [{'product_id': self.cola.pk, 'quantity': 5}],
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Decimal(str(response.data['discount_total'])), Decimal('1.00'))
+
+        response = client.post('/api/v1/promotions/evaluate/', {
+            'lines': [{'product_id': self.cola.pk, 'quantity': 5, 'unit_price': 'free'}],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+def indexed(promotion_id, promotion_type, discount_value, **relations):
+    row = {
+        'id': promotion_id, 'name': f'P{promotion_id}', 'promotion_type': promotion_type,
+        'discount_value': Decimal(discount_value), 'buy_quantity': relations.pop('buy', None),
+        'get_quantity': relations.pop('get', None), 'min_order_value': relations.pop('min_order_value', 0),
+    }
+    return IndexedPromotion(row, **relations)
+
+
+def basket_line(product_id, quantity, unit_price):
+    return {'product_id': product_id, 'category_id': None, 'quantity': quantity, 'unit_price': Decimal(unit_price)}
+
+
+class BasketPromotionSolverTest(SimpleTestCase):
+    """Test allocating bundle and line promotions across a basket"""
+
+    def index(self, *promotions):
+        return PromotionIndex(list(promotions), timezone.now() + timedelta(hours=1))
+
+    def discounts(self, solution):
+        return [sum(allocation.values(), Decimal('0')) for allocation in solution['allocations']]
+
+    def test_bundle_only_when_it_beats_line_promotions(self):
+        half_off = indexed(1, 'percentage', '50', products=[1])
+        lines = [basket_line(1, 1, '10.00'), basket_line(2, 1, '10.00')]
+
+        weak = BasketPromotionSolver(lines, self.index(half_off, indexed(2, 'bundle', '4', required_products=[1, 2]))).solve()
+        self.assertEqual(self.discounts(weak), [Decimal('5'), Decimal('0')])
+
+        strong = BasketPromotionSolver(lines, self.index(half_off, indexed(2, 'bundle', '8', required_products=[1, 2]))).solve()
+        self.assertEqual(sum(self.discounts(strong)), Decimal('8'))
+
+    def test_bonus_products_are_free(self):
+        buy_two_get_sauce = indexed(1, 'bundle', '0', required_products=[1, 2], bonus_products=[3])
+        lines = [basket_line(1, 2, '4.00'), basket_line(2, 1, '6.00'), basket_line(3, 3, '1.50')]
+
+        solution = BasketPromotionSolver(lines, self.index(buy_two_get_sauce)).solve()
+
+        # Only one complete set of required products, so one sauce is free
+        self.assertEqual(self.discounts(solution), [Decimal('0'), Decimal('0'), Decimal('1.50')])
+
+    def test_greedy_fallback_is_feasible_and_bounded_by_exact(self):
+        rng = random.Random(7)
+        promotions = [indexed(i, 'percentage', str(rng.randint(5, 40)), products=[i]) for i in range(1, 9)]
+        promotions += [
+            indexed(100 + i, 'bundle', str(rng.randint(2, 12)), required_products=rng.sample(range(1, 9), 2))
+            for i in range(6)
+        ]
+        index = self.index(*promotions)
+        for _ in range(20):
+            lines = [basket_line(product_id, rng.randint(1, 4), str(rng.randint(2, 20))) for product_id in range(1, 9)]
+            exact = BasketPromotionSolver(lines, index).solve()
+            greedy_solver = BasketPromotionSolver(lines, index)
+            greedy_solver.DP_STATE_LIMIT = 1
+            greedy = greedy_solver.solve()
+
+            self.assertTrue(exact['exact'])
+            self.assertFalse(greedy['exact'])
+            self.assertLessEqual(sum(self.discounts(greedy)), sum(self.discounts(exact)))
+            for line, discount in zip(lines, self.discounts(exact)):
+                self.assertLessEqual(discount, line['unit_price'] * line['quantity'])
@@ -0,0 +1,91 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from pos_app.models import (
+    Inventory, Product, PurchaseOrder, PurchaseOrderLine, Sale, SaleLine, Transfer, TransferLine, Warehouse
+)
+from pos_app.services import ReplenishmentPlanner
+
+
+class ReplenishmentPlannerTest(TestCase):
+    """Test the replenishment planner"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='planner', password='pass12345')
+        self.dc = Warehouse.objects.create(name='DC', location='Depot', latitude=Decimal('9.00'), longitude=Decimal('38.70'))
+        self.far_dc = Warehouse.objects.create(name='Far DC', location='Far', latitude=Decimal('11.00'), longitude=Decimal('40.00'))
+        self.store = Warehouse.objects.create(name='Store', location='Centre', warehouse_type='store',
+                                              latitude=Decimal('9.02'), longitude=Decimal('38.75'))
+        self.product = Product.objects.create(name='Oil', sku='OIL-1', price=Decimal('5.00'), cost_price=Decimal('3.00'))
+        Inventory.objects.create(product=self.product, warehouse=self.dc, qty_on_hand=30, min_stock_level=20)
+        Inventory.objects.create(product=self.product, warehouse=self.far_dc, qty_on_hand=100, min_stock_level=20)
+        Inventory.objects.create(product=self.product, warehouse=self.store, qty_on_hand=2, min_stock_level=10)
+
+    def record_sales(self, warehouse, quantity):
+        sale = Sale.objects.create(
+            receipt_number=f'R-{Sale.objects.count() + 1}', cashier=self.user, warehouse=warehouse,
+            total_amount=Decimal('5.00') * quantity, payment_status='completed',
+        )
+        SaleLine.objects.bulk_create([SaleLine(
+            sale=sale, product=self.product, quantity=quantity,
+            unit_price=Decimal('5.00'), total_price=Decimal('5.00') * quantity,
+        )])
+
+    def test_deficit_is_covered_by_nearest_surplus_first(self):
+        plan = ReplenishmentPlanner.plan(warehouse_ids=[self.store.pk])
+
+        # Store needs 8; the nearby DC can spare 10
+        self.assertEqual(plan['transfers'], [{
+            'from_warehouse_id': self.dc.pk, 'to_warehouse_id': self.store.pk,
+            'lines': [{'product_id': self.product.pk, 'variant_id': None, 'quantity': 8}],
+        }])
+        self.assertEqual(plan['purchase_orders'], [])
+
+    def test_velocity_raises_target_and_rest_is_purchased(self):
+        # 28 units over 28 days with 14 days of cover -> target 14; the DC can only spare 5
+        self.record_sales(self.store, 28)
+        Inventory.objects.filter(warehouse=self.far_dc).update(qty_on_hand=20)
+        Inventory.objects.filter(warehouse=self.dc).update(qty_on_hand=25)
+
+        plan = ReplenishmentPlanner.plan(warehouse_ids=[self.store.pk])
+
+        self.assertEqual(plan['transfer_units'], 5)
+        self.assertEqual(plan['purchase_units'], 7)
+
+    def test_open_inbound_counts_towards_position(self):
+        transfer = Transfer.objects.create(
+            transfer_number='TR-OPEN', from_warehouse=self.far_dc, to_warehouse=self.store,
+            requested_by=self.user, status='approved',
+        )
+        TransferLine.objects.create(transfer=transfer, product=self.product, requested_qty=8)
+
+        plan = ReplenishmentPlanner.plan(warehouse_ids=[self.store.pk])
+
+        self.assertEqual((plan['transfer_units'], plan['purchase_units']), (0, 0))
+
+    def test_endpoint_creates_drafts(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post('/api/v1/inventory/replenishment/', {'allow_transfers': False}, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        order = PurchaseOrder.objects.get(pk__in=response.data['created_purchase_order_ids'])
+        self.assertEqual((order.warehouse_id, order.status, order.subtotal), (self.store.pk, 'draft', Decimal('24.00')))
+        self.assertEqual(PurchaseOrderLine.objects.get(purchase_order=order).ordered_qty, 8)
+
+    def test_replanning_after_drafts_adds_nothing(self):
+        second_store = Warehouse.objects.create(name='Store 2', location='North', warehouse_type='store')
+        Inventory.objects.create(product=self.product, warehouse=second_store, qty_on_hand=0, min_stock_level=10)
+
+        plan = ReplenishmentPlanner.plan()
+        transfers, orders = ReplenishmentPlanner.create_drafts(plan, self.user)
+        self.assertEqual(plan['transfer_units'], 18)
+        self.assertEqual(len({transfer.transfer_number for transfer in transfers}), len(transfers))
+
+        # Drafts count as inbound at their destination and as gone from their source
+        replan = ReplenishmentPlanner.plan()
+        self.assertEqual((replan['transfers'], replan['purchase_orders']), ([], []))
@@ -0,0 +1,73 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from pos_app.models import Inventory, Product, Reservation, ReservationLine, Warehouse
+from pos_app.services import ReservationExpiryService
+
+
+class ReservationExpirySweepTest(TestCase):
+    """Test the reservation expiry sweeper"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='clerk', password='pass12345')
+        self.warehouse = Warehouse.objects.create(name='Main', location='Main St')
+        self.tea = Product.objects.create(name='Tea', sku='TEA-1', price=Decimal('3.00'))
+        self.sugar = Product.objects.create(name='Sugar', sku='SUG-1', price=Decimal('2.00'))
+        self.tea_stock = Inventory.objects.create(product=self.tea, warehouse=self.warehouse, qty_on_hand=50, qty_reserved=9)
+        self.sugar_stock = Inventory.objects.create(product=self.sugar, warehouse=self.warehouse, qty_on_hand=50, qty_reserved=4)
+
+    def reserve(self, lines, expired=True):
+        reservation = Reservation.objects.create(
+            user=self.user, warehouse=self.warehouse, expires_at=timezone.now() + timedelta(hours=1)
+        )
+        for product, quantity in lines:
+            ReservationLine.objects.create(reservation=reservation, product=product, quantity=quantity)
+        if expired:
+            # save() refuses past expiry dates, so age the reservation directly
+            Reservation.objects.filter(pk=reservation.pk).update(expires_at=timezone.now() - timedelta(minutes=5))
+        return reservation
+
+    def test_sweep_releases_stock_and_cancels_expired_reservations(self):
+        first = self.reserve([(self.tea, 3), (self.sugar, 4)])
+        second = self.reserve([(self.tea, 2)])
+        live = self.reserve([(self.tea, 4)], expired=False)
+
+        summary = ReservationExpiryService.sweep(batch_size=1)
+
+        self.assertEqual(summary['expired_reservations'], 2)
+        self.assertEqual(summary['released_units'], 9)
+        self.assertEqual(summary['inventory_rows'], 2)
+        self.tea_stock.refresh_from_db()
+        self.sugar_stock.refresh_from_db()
+        self.assertEqual(self.tea_stock.qty_reserved, 4)
+        self.assertEqual(self.sugar_stock.qty_reserved, 0)
+        self.assertEqual(
+            dict(Reservation.objects.values_list('id', 'status')),
+            {first.id: 'canceled', second.id: 'canceled', live.id: 'active'}
+        )
+        # A second sweep has nothing left to do
+        self.assertEqual(ReservationExpiryService.sweep()['expired_reservations'], 0)
+
+    def test_release_never_drives_reserved_below_zero(self):
+        Inventory.objects.filter(pk=self.sugar_stock.pk).update(qty_reserved=1)
+        self.reserve([(self.sugar, 4)])
+
+        ReservationExpiryService.sweep()
+
+        self.sugar_stock.refresh_from_db()
+        self.assertEqual(self.sugar_stock.qty_reserved, 0)
+
+    def test_dry_run_changes_nothing(self):
+        reservation = self.reserve([(self.tea, 3)])
+
+        summary = ReservationExpiryService.sweep(dry_run=True)
+
+        self.assertEqual((summary['expired_reservations'], summary['released_units']), (1, 3))
+        reservation.refresh_from_db()
+        self.tea_stock.refresh_from_db()
+        self.assertEqual(reservation.status, 'active')
+        self.assertEqual(self.tea_stock.qty_reserved, 9)
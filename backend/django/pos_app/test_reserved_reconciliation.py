@@ -0,0 +1,120 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from pos_app.models import (
+    Bin, Inventory, Location, Product, Reservation, ReservationLine, Sale, SaleLine, StockSummary, Transfer,
+    TransferLine, Warehouse,
+)
+from pos_app.services import ReservedStockReconciler
+
+
+class ReservedStockReconcilerTest(TestCase):
+    """Test recomputing reserved stock from open sales, reservations and transfers"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='cashier', password='pass12345')
+        self.store = Warehouse.objects.create(name='Store', location='Centre')
+        self.depot = Warehouse.objects.create(name='Depot', location='Edge')
+        self.aisle = Location.objects.create(name='Aisle A', warehouse=self.store, code='A')
+        self.back = Bin.objects.create(name='Back', location=self.aisle, code='A-2')
+        self.tea = Product.objects.create(name='Tea', sku='TEA-1', price=Decimal('4.00'))
+        self.mug = Product.objects.create(name='Mug', sku='MUG-1', price=Decimal('8.00'))
+        self.jam = Product.objects.create(name='Jam', sku='JAM-1', price=Decimal('3.00'))
+        self.front_tea = Inventory.objects.create(product=self.tea, warehouse=self.store, qty_on_hand=5)
+        self.back_tea = Inventory.objects.create(
+            product=self.tea, warehouse=self.store, location=self.aisle, bin=self.back, qty_on_hand=5,
+        )
+        self.stray_mug = Inventory.objects.create(product=self.mug, warehouse=self.store, qty_on_hand=4)
+        Inventory.objects.filter(pk=self.stray_mug.pk).update(qty_reserved=3)
+
+    def sale(self, status, quantity, product=None):
+        sale = Sale.objects.create(
+            receipt_number=f'R-{Sale.objects.count() + 1}', cashier=self.user, warehouse=self.store,
+            total_amount=Decimal('4.00') * quantity, payment_status=status,
+        )
+        SaleLine.objects.create(
+            sale=sale, product=product or self.tea, quantity=quantity, unit_price=Decimal('4.00'),
+            total_price=Decimal('4.00') * quantity,
+        )
+
+    def open_documents(self):
+        # Documents are written without their stock movements, so every reservation has drifted
+        self.sale('partially_paid', 3)
+        self.sale('completed', 10)
+        reservation = Reservation.objects.create(
+            user=self.user, warehouse=self.store, expires_at=timezone.now() + timedelta(hours=1),
+        )
+        ReservationLine.objects.create(reservation=reservation, product=self.tea, quantity=2)
+        ReservationLine.objects.create(reservation=reservation, product=self.jam, quantity=1)
+        transfer = Transfer.objects.create(
+            from_warehouse=self.store, from_location=self.aisle, from_bin=self.back, to_warehouse=self.depot,
+            requested_by=self.user, status='approved',
+        )
+        TransferLine.objects.create(transfer=transfer, product=self.tea, requested_qty=4)
+
+    def test_drift_is_found_with_grouped_queries(self):
+        self.open_documents()
+        # Warehouses, reservations, sales, transfers and the inventory totals
+        with self.assertNumQueries(5):
+            drift = ReservedStockReconciler.reconcile()
+        self.assertEqual(drift, [
+            (self.store.pk, self.tea.pk, None, 9, 0, 10),
+            (self.store.pk, self.mug.pk, None, 0, 3, 4),
+            (self.store.pk, self.jam.pk, None, 1, 0, 0),
+        ])
+        self.assertEqual(ReservedStockReconciler.reconcile(warehouse_ids=[self.depot.pk]), [])
+
+    def test_fix_lays_reservations_out_over_bins(self):
+        self.open_documents()
+        ReservedStockReconciler.reconcile(fix=True)
+
+        for row in (self.front_tea, self.back_tea, self.stray_mug):
+            row.refresh_from_db()
+        # The transfer keeps its bin; the rest fills the other bin up to what it holds
+        self.assertEqual((self.back_tea.qty_reserved, self.front_tea.qty_reserved, self.stray_mug.qty_reserved), (4, 5, 0))
+        self.assertEqual(StockSummary.objects.get(product=self.tea, warehouse=self.store).reserved, 9)
+        # Jam is held by a reservation but was never stocked, so it stays reported
+        self.assertEqual(ReservedStockReconciler.reconcile(), [(self.store.pk, self.jam.pk, None, 1, 0, 0)])
+
+    def test_command_reports_and_fixes(self):
+        self.open_documents()
+        out = StringIO()
+        call_command('reconcile_reserved_stock', '--limit', '1', stdout=out)
+        report = out.getvalue()
+        self.assertIn('... and 2 more', report)
+        self.assertIn('3 units reserved without an open document, 10 units missing from reservations', report)
+        self.assertIn('3 reserved quantities differ', report)
+
+        call_command('reconcile_reserved_stock', '--fix', '--warehouse', str(self.store.pk), stdout=out)
+        out = StringIO()
+        call_command('reconcile_reserved_stock', stdout=out)
+        self.assertIn('1 units held by documents but not on hand', out.getvalue())
+        ReservationLine.objects.filter(product=self.jam).delete()
+        out = StringIO()
+        call_command('reconcile_reserved_stock', stdout=out)
+        self.assertIn('All reserved quantities match', out.getvalue())
+
+    def test_checkout_paths_keep_reservations_in_step(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        Inventory.objects.filter(pk=self.stray_mug.pk).update(qty_reserved=0)
+
+        sale = client.post('/api/v1/sales/create/', {
+            'cashier_id': self.user.pk, 'warehouse_id': self.store.pk,
+            'items': [{'product_id': self.tea.pk, 'quantity': 2, 'unit_price': 4}],
+            'payments': [{'method': 'cash', 'amount': 5}],
+        }, format='json').data
+        self.assertEqual(sale['payment_status'], 'partially_paid')
+        self.assertEqual(ReservedStockReconciler.reconcile(), [])
+
+        paid = client.post(f"/api/v1/sales/{sale['id']}/add-payment/", {'method': 'cash', 'amount': sale['balance_due']}, format='json')
+        self.assertEqual(paid.status_code, 200)
+        self.assertEqual(ReservedStockReconciler.reconcile(), [])
+        self.assertEqual(StockSummary.objects.get(product=self.tea, warehouse=self.store).on_hand, 8)
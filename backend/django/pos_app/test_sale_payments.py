@@ -0,0 +1,161 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+
+from pos_app.models import Inventory, Location, Payment, Product, Sale, SaleLine, Warehouse
+from pos_app.services import SalePaymentService
+from pos_app.views import LocationListView, SaleListView
+
+
+class SalePaymentTotalsTest(TestCase):
+    """Test stored payment totals and the status transitions applied with them"""
+
+    def setUp(self):
+        self.cashier = User.objects.create_user(username='cashier', password='pass12345')
+        self.warehouse = Warehouse.objects.create(name='Store', location='Centre')
+        self.tea = Product.objects.create(name='Tea', sku='TEA-1', price=Decimal('5.00'))
+        self.inventory = Inventory.objects.create(product=self.tea, warehouse=self.warehouse, qty_on_hand=10, qty_reserved=2)
+
+    def sale(self, total='20.00', **fields):
+        sale = Sale.objects.create(
+            receipt_number=f'R-{Sale.objects.count() + 1}', cashier=self.cashier, warehouse=self.warehouse,
+            total_amount=Decimal(total), **fields
+        )
+        SaleLine.objects.create(sale=sale, product=self.tea, quantity=2, unit_price=Decimal('5.00'), total_price=Decimal('10.00'))
+        return sale
+
+    def test_partial_then_full_payment(self):
+        sale = self.sale()
+        self.assertEqual(sale.balance_due, Decimal('20.00'))
+
+        SalePaymentService.record(sale, '7.50', 'cash')
+        self.assertEqual((sale.payment_status, sale.amount_paid, sale.balance_due), ('partially_paid', Decimal('7.50'), Decimal('12.50')))
+
+        with self.assertRaises(ValidationError):
+            SalePaymentService.record(sale, '12.51', 'card')
+        SalePaymentService.record(sale, '12.50', 'card')
+
+        sale.refresh_from_db()
+        self.assertEqual((sale.payment_status, sale.balance_due, sale.is_locked), ('completed', Decimal('0.00'), True))
+        with self.assertRaises(ValidationError):
+            SalePaymentService.record(sale, '1.00', 'cash')
+        self.assertEqual(sale.payments.count(), 2)
+
+    def test_payment_is_one_update_without_sale_save(self):
+        sale = self.sale()
+        with CaptureQueriesContext(connection) as queries:
+            SalePaymentService.record(sale, '5.00', 'cash')
+        # Guarded UPDATE, payment INSERT and one read of the new totals (plus savepoint statements)
+        statements = [query['sql'] for query in queries if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        self.assertEqual(len(statements), 3)
+
+    def test_settling_a_pending_sale_finalizes_stock(self):
+        sale = self.sale(total='10.00')
+        SalePaymentService.record(sale, '10.00', 'cash')
+
+        self.inventory.refresh_from_db()
+        self.assertEqual((self.inventory.qty_on_hand, self.inventory.qty_reserved), (8, 0))
+
+    def test_refunds_are_capped_by_payments(self):
+        sale = self.sale(total='10.00')
+        SalePaymentService.record(sale, '10.00', 'cash')
+        SalePaymentService.refund(sale, '4.00', 'cash')
+        with self.assertRaises(ValidationError):
+            SalePaymentService.refund(sale, '6.01', 'cash')
+        SalePaymentService.refund(sale, '6.00', 'cash')
+
+        sale.refresh_from_db()
+        self.assertEqual((sale.amount_refunded, sale.payment_status), (Decimal('10.00'), 'refunded'))
+
+    def test_refunds_survive_a_resync(self):
+        sale = self.sale(total='10.00')
+        SalePaymentService.record(sale, '10.00', 'card')
+        SalePaymentService.refund(sale, '4.00', 'card', reference='Refund for return RET-1')
+        sale.update_payment_status()
+
+        sale.refresh_from_db()
+        self.assertEqual((sale.amount_paid, sale.amount_refunded), (Decimal('10.00'), Decimal('4.00')))
+        self.assertEqual(
+            list(sale.payments.order_by('id').values_list('payment_method', 'amount')),
+            [('card', Decimal('10.00')), ('card', Decimal('-4.00'))],
+        )
+
+    def test_exact_payoffs_with_non_round_amounts(self):
+        odd = self.sale(total='19.99')
+        SalePaymentService.record(odd, '4.33', 'cash')
+        SalePaymentService.record(odd, '15.66', 'card')
+        dimes = self.sale(total='0.30')
+        for _ in range(3):
+            SalePaymentService.record(dimes, '0.10', 'cash')
+        for _ in range(3):
+            SalePaymentService.refund(dimes, '0.10', 'cash')
+
+        odd.refresh_from_db()
+        dimes.refresh_from_db()
+        self.assertEqual((odd.balance_due, odd.payment_status), (Decimal('0.00'), 'completed'))
+        self.assertEqual((dimes.amount_refunded, dimes.payment_status), (Decimal('0.30'), 'refunded'))
+
+    def test_checkout_with_fractional_tax_pays_off_exactly(self):
+        client = APIClient()
+        client.force_authenticate(self.cashier)
+        sale = client.post('/api/v1/sales/create/', {
+            'cashier_id': self.cashier.pk, 'warehouse_id': self.warehouse.pk,
+            'items': [{'product_id': self.tea.pk, 'quantity': 3, 'unit_price': 18.35}],
+            'payments': [{'method': 'cash', 'amount': 27.53}],
+        }, format='json').data
+        # 55.05 + 5.50 tax (5.505 rounded to even) - 27.53
+        self.assertEqual(Decimal(str(sale['balance_due'])), Decimal('33.02'))
+
+        payment = client.post(f"/api/v1/sales/{sale['id']}/add-payment/", {'method': 'card', 'amount': sale['balance_due']}, format='json')
+        self.assertEqual(payment.status_code, 200)
+        self.assertEqual(Sale.objects.get(pk=sale['id']).payment_status, 'completed')
+
+    def test_sync_and_stale_save_keep_stored_totals(self):
+        sale = self.sale()
+        stale = Sale.objects.get(pk=sale.pk)
+        Payment.objects.create(sale=sale, payment_method='cash', amount=Decimal('8.00'))
+        sale.update_payment_status()
+        self.assertEqual((sale.amount_paid, sale.payment_status), (Decimal('8.00'), 'partially_paid'))
+
+        stale.notes = 'edited'
+        stale.save()
+        stale.refresh_from_db()
+        self.assertEqual((stale.amount_paid, stale.balance_due), (Decimal('8.00'), Decimal('12.00')))
+
+    def test_filter_by_balance_due(self):
+        owing = self.sale(total='30.00')
+        SalePaymentService.record(owing, '5.00', 'cash')
+        paid = self.sale(total='10.00')
+        SalePaymentService.record(paid, '10.00', 'cash')
+        self.cashier.userprofile.role = 'store_manager'
+        self.cashier.userprofile.save()
+        client = APIClient()
+        client.force_authenticate(self.cashier)
+
+        payment = client.post(f'/api/v1/sales/{owing.pk}/add-payment/', {'method': 'card', 'amount': 5}, format='json')
+        self.assertEqual(payment.status_code, 200)
+        self.assertEqual(Decimal(str(payment.data['balance_due'])), Decimal('20.00'))
+
+        outstanding = client.get('/api/v1/reports/sales/', {'outstanding': 'true'})
+        self.assertEqual([row['id'] for row in outstanding.data['sales']], [owing.pk])
+        self.assertEqual(outstanding.data['summary']['total_outstanding'], 20.0)
+        self.assertEqual(client.get('/api/v1/sales/', {'min_balance_due': '25'}).status_code, 200)
+        self.assertEqual(client.get('/api/v1/sales/', {'min_balance_due': 'lots'}).status_code, 400)
+
+        def listed(view, **params):
+            request = APIRequestFactory().get('/', params)
+            force_authenticate(request, self.cashier)
+            return [row['id'] for row in view.as_view()(request).data]
+
+        self.assertEqual(listed(SaleListView, outstanding='true'), [owing.pk])
+        depot = Warehouse.objects.create(name='Depot', location='Edge')
+        Location.objects.create(name='Aisle A', warehouse=depot, code='A')
+        self.assertEqual(
+            sorted(listed(LocationListView, warehouse=self.warehouse.pk)),
+            sorted(self.warehouse.locations.values_list('pk', flat=True)),
+        )
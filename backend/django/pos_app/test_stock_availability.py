@@ -0,0 +1,65 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from pos_app.models import Inventory, Product, ProductVariant, Warehouse
+from pos_app.services import StockAvailabilityService, WarehouseSpatialIndex
+
+
+class StockAvailabilityTest(TestCase):
+    """Test batch availability checks over the warehouse stock summary"""
+
+    def setUp(self):
+        WarehouseSpatialIndex.invalidate()
+        self.north = Warehouse.objects.create(name='North', location='A', latitude=Decimal('9.03'), longitude=Decimal('38.74'))
+        self.south = Warehouse.objects.create(name='South', location='B', latitude=Decimal('9.00'), longitude=Decimal('38.76'))
+        self.far = Warehouse.objects.create(name='Far', location='C', latitude=Decimal('13.50'), longitude=Decimal('39.47'))
+        self.tea = Product.objects.create(name='Tea', sku='TEA-1', price=Decimal('4.00'))
+        self.mug = Product.objects.create(name='Mug', sku='MUG-1', price=Decimal('8.00'))
+        self.red_mug = ProductVariant.objects.create(product=self.mug, name='Red', sku='MUG-1-RED')
+        Inventory.objects.create(product=self.tea, warehouse=self.north, qty_on_hand=5, qty_reserved=1)
+        Inventory.objects.create(product=self.tea, warehouse=self.south, qty_on_hand=3)
+        Inventory.objects.create(product=self.tea, warehouse=self.far, qty_on_hand=50)
+        Inventory.objects.create(product=self.mug, variant=self.red_mug, warehouse=self.north, qty_on_hand=2)
+
+    def test_cart_is_answered_by_one_query(self):
+        items = [
+            {'sku': 'TEA-1', 'quantity': 4},
+            {'sku': 'MUG-1-RED', 'quantity': 3},
+            {'product_id': self.tea.pk, 'region': {'latitude': 9.02, 'longitude': 38.75, 'radius_km': 20}, 'quantity': 7},
+            {'sku': 'NOPE-1'},
+        ]
+        WarehouseSpatialIndex.get()
+        with self.assertNumQueries(1):
+            columns, _ = StockAvailabilityService.check(items, {'warehouse_id': self.north.pk})
+
+        self.assertEqual(columns['product_id'], [self.tea.pk, self.mug.pk, self.tea.pk, None])
+        self.assertEqual(columns['variant_id'], [None, self.red_mug.pk, None, None])
+        self.assertEqual(columns['available'], [4, 2, 7, 0])
+        self.assertEqual(columns['in_stock'], [True, False, True, False])
+        self.assertFalse(columns['all_in_stock'])
+
+    def test_invalid_items_are_reported_together(self):
+        with self.assertRaises(ValidationError) as raised:
+            StockAvailabilityService.check([{'sku': 'TEA-1'}, {'warehouse_id': self.north.pk}, {'sku': 'TEA-1', 'warehouse_id': 'x'}])
+        self.assertEqual(len(raised.exception.messages), 3)
+
+    def test_etag_changes_only_when_stock_moves(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='shop', password='pass12345'))
+        cart = {'warehouse_id': self.north.pk, 'items': [{'sku': 'TEA-1', 'quantity': 2}]}
+
+        first = client.post('/api/v1/availability/', cart, format='json')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.data['available'], [4])
+        unchanged = client.post('/api/v1/availability/', cart, format='json', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(unchanged.status_code, 304)
+
+        Inventory.objects.filter(product=self.tea, warehouse=self.north).update(qty_reserved=2)
+        moved = client.post('/api/v1/availability/', cart, format='json', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual((moved.status_code, moved.data['available']), (200, [3]))
+        self.assertNotEqual(moved['ETag'], first['ETag'])
+        self.assertEqual(client.post('/api/v1/availability/', {'items': []}, format='json').status_code, 400)
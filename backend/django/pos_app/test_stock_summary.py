@@ -0,0 +1,109 @@
+from decimal import Decimal
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db.models import F
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from pos_app.models import Bin, Inventory, Location, Product, Sale, SaleLine, StockSummary, Warehouse
+from pos_app.services import StockSummaryService, bulk_increment
+
+
+class StockSummaryTest(TestCase):
+    """Test the trigger-maintained warehouse stock totals and the movements that use them"""
+
+    def setUp(self):
+        self.store = Warehouse.objects.create(name='Store', location='Centre')
+        self.depot = Warehouse.objects.create(name='Depot', location='Edge')
+        aisle = Location.objects.create(name='Aisle A', warehouse=self.store, code='A')
+        self.front = Bin.objects.create(name='Front', location=aisle, code='A-1')
+        self.back = Bin.objects.create(name='Back', location=aisle, code='A-2')
+        self.tea = Product.objects.create(name='Tea', sku='TEA-1', price=Decimal('4.00'))
+
+    def stock(self, **fields):
+        return Inventory.objects.create(product=self.tea, warehouse=self.store, **fields)
+
+    def summary(self, warehouse=None):
+        row = StockSummary.objects.get(product=self.tea, variant=None, warehouse=warehouse or self.store)
+        return row.on_hand, row.reserved, row.available
+
+    def test_summary_follows_every_kind_of_inventory_write(self):
+        front = self.stock(location=self.front.location, bin=self.front, qty_on_hand=6, qty_reserved=1)
+        self.assertEqual(self.summary(), (6, 1, 5))
+
+        Inventory.objects.bulk_create([
+            Inventory(product=self.tea, warehouse=self.store, location=self.back.location, bin=self.back, qty_on_hand=4),
+        ])
+        Inventory.objects.filter(pk=front.pk).update(qty_on_hand=F('qty_on_hand') - 2)
+        bulk_increment(Inventory, {front.pk: (0, 2)}, ('qty_on_hand', 'qty_reserved'))
+        self.assertEqual(self.summary(), (8, 3, 5))
+
+        front.refresh_from_db()
+        front.warehouse = self.depot
+        front.location = front.bin = None
+        front.save()
+        self.assertEqual((self.summary(), self.summary(self.depot)), ((4, 0, 4), (4, 3, 1)))
+
+        front.delete()
+        self.assertEqual(self.summary(self.depot), (0, 0, 0))
+        self.assertEqual(StockSummaryService.reconcile(), [])
+
+    def test_availability_is_one_query(self):
+        self.stock(location=self.front.location, bin=self.front, qty_on_hand=3)
+        self.stock(location=self.back.location, bin=self.back, qty_on_hand=5, qty_reserved=2)
+        with self.assertNumQueries(1):
+            available = StockSummaryService.availability([(self.store.pk, self.tea.pk, None), (self.depot.pk, self.tea.pk, None)])
+        self.assertEqual(available, {(self.store.pk, self.tea.pk, None): 6})
+
+    def test_sale_stock_is_spread_over_bins(self):
+        front = self.stock(location=self.front.location, bin=self.front, qty_on_hand=2)
+        back = self.stock(location=self.back.location, bin=self.back, qty_on_hand=5)
+        cashier = User.objects.create_user(username='cashier', password='pass12345')
+        sale = Sale.objects.create(receipt_number='R-1', cashier=cashier, warehouse=self.store, total_amount=Decimal('16.00'))
+        SaleLine.objects.create(sale=sale, product=self.tea, quantity=4, unit_price=Decimal('4.00'), total_price=Decimal('16.00'))
+
+        sale.reserve_stock_for_sale()
+        self.assertEqual(self.summary(), (7, 4, 3))
+        with self.assertRaises(ValidationError):
+            StockSummaryService.reserve(self.store.pk, [(self.tea.pk, None, 4)])
+
+        sale.finalize_sale()
+        front.refresh_from_db()
+        back.refresh_from_db()
+        self.assertEqual(((front.qty_on_hand, front.qty_reserved), (back.qty_on_hand, back.qty_reserved)), ((0, 0), (3, 0)))
+        self.assertEqual(self.summary(), (3, 0, 3))
+
+    def test_checkout_with_stock_in_two_bins(self):
+        self.stock(location=self.front.location, bin=self.front, qty_on_hand=1)
+        self.stock(location=self.back.location, bin=self.back, qty_on_hand=2)
+        cashier = User.objects.create_user(username='cashier', password='pass12345')
+        client = APIClient()
+        client.force_authenticate(cashier)
+
+        def checkout(quantity):
+            return client.post('/api/v1/sales/create/', {
+                'cashier_id': cashier.pk, 'warehouse_id': self.store.pk,
+                'items': [{'product_id': self.tea.pk, 'quantity': quantity, 'unit_price': 4}],
+                'payments': [{'method': 'cash', 'amount': 20}],
+            }, format='json')
+
+        self.assertEqual(checkout(4).status_code, 400)
+        self.assertEqual(checkout(3).status_code, 201)
+        self.assertEqual(self.summary(), (0, 0, 0))
+
+    def test_reconcile_repairs_drift(self):
+        self.stock(qty_on_hand=5)
+        StockSummary.objects.update(on_hand=9, available=9)
+        StockSummary.objects.create(product=self.tea, warehouse=self.depot, on_hand=1, available=1)
+
+        out = StringIO()
+        call_command('reconcile_stock_summary', stdout=out)
+        self.assertIn('2 summaries differ', out.getvalue())
+        call_command('reconcile_stock_summary', '--fix', stdout=out)
+
+        self.assertEqual(self.summary(), (5, 0, 5))
+        self.assertFalse(StockSummary.objects.filter(warehouse=self.depot).exists())
+        self.assertEqual(StockSummaryService.reconcile(), [])
@@ -0,0 +1,141 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from pos_app.models import Inventory, Product, Transfer, TransferLine, Warehouse
+
+
+class TransferReceiptTest(TestCase):
+    """Test the batched transfer receipt"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='keeper', password='pass12345')
+        self.dc = Warehouse.objects.create(name='DC', location='Depot Rd')
+        self.store = Warehouse.objects.create(name='Store', location='High St', warehouse_type='store')
+
+    def make_transfer(self, product_count, qty=5):
+        transfer = Transfer.objects.create(
+            transfer_number=f'TR-{Transfer.objects.count() + 1}', from_warehouse=self.dc,
+            to_warehouse=self.store, requested_by=self.user, status='approved',
+        )
+        for i in range(product_count):
+            product = Product.objects.create(name=f'P{transfer.pk}-{i}', sku=f'SKU-{transfer.pk}-{i}', price=Decimal('1.00'))
+            Inventory.objects.create(product=product, warehouse=self.dc, qty_on_hand=20, qty_reserved=qty)
+            if i % 2:
+                Inventory.objects.create(product=product, warehouse=self.store, qty_on_hand=1)
+            TransferLine.objects.create(transfer=transfer, product=product, requested_qty=qty)
+        return transfer
+
+    def test_receipt_moves_stock_and_marks_lines(self):
+        transfer = self.make_transfer(4)
+        before = dict(Inventory.objects.filter(warehouse=self.store).values_list('product_id', 'qty_on_hand'))
+
+        transfer.status = 'received'
+        transfer.save()
+
+        for line in transfer.lines.all():
+            source = Inventory.objects.get(product=line.product, warehouse=self.dc)
+            destination = Inventory.objects.get(product=line.product, warehouse=self.store)
+            self.assertEqual((source.qty_on_hand, source.qty_reserved), (15, 0))
+            self.assertEqual(destination.qty_on_hand, before.get(line.product_id, 0) + 5)
+            self.assertEqual((line.transferred_qty, line.received_qty), (5, 5))
+            self.assertEqual((line.from_inventory_id, line.to_inventory_id), (source.pk, destination.pk))
+        transfer.refresh_from_db()
+        self.assertIsNotNone(transfer.received_at)
+
+    def test_partial_receipt(self):
+        transfer = self.make_transfer(2)
+        short, full = transfer.lines.order_by('id')
+
+        transfer.receive_transfer({short.id: 3})
+
+        short.refresh_from_db()
+        full.refresh_from_db()
+        self.assertEqual((short.transferred_qty, short.received_qty), (5, 3))
+        self.assertEqual(full.received_qty, 5)
+        self.assertEqual(Inventory.objects.get(product=short.product, warehouse=self.store).qty_on_hand, 3)
+        self.assertEqual(Inventory.objects.get(product=short.product, warehouse=self.dc).qty_on_hand, 15)
+        self.assertEqual(Transfer.objects.get(pk=transfer.pk).status, 'received')
+
+        with self.assertRaises(ValidationError):
+            self.make_transfer(1).receive_transfer({TransferLine.objects.latest('id').id: 6})
+
+    def test_query_count_does_not_grow_with_lines(self):
+        small, large = self.make_transfer(2), self.make_transfer(40)
+
+        with CaptureQueriesContext(connection) as small_queries:
+            small.receive_transfer()
+        with CaptureQueriesContext(connection) as large_queries:
+            large.receive_transfer()
+
+        self.assertEqual(len(small_queries), len(large_queries))
+
+
+class BulkTransferTransitionTest(TestCase):
+    """Test the bulk transfer transition endpoint"""
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+
+        self.manager = User.objects.create_user(username='manager', password='pass12345')
+        self.manager.userprofile.role = 'warehouse_manager'
+        self.manager.userprofile.save()
+        self.cashier = User.objects.create_user(username='cashier', password='pass12345')
+        self.client = APIClient()
+        self.client.force_authenticate(self.manager)
+        self.dc = Warehouse.objects.create(name='DC', location='Depot Rd')
+        self.store = Warehouse.objects.create(name='Store', location='High St', warehouse_type='store')
+        self.product = Product.objects.create(name='Rice', sku='RICE-1', price=Decimal('4.00'))
+        self.stock = Inventory.objects.create(product=self.product, warehouse=self.dc, qty_on_hand=100)
+
+    def make_transfer(self, qty=5, requested_by=None):
+        transfer = Transfer.objects.create(
+            transfer_number=f'TR-{Transfer.objects.count() + 1}', from_warehouse=self.dc,
+            to_warehouse=self.store, requested_by=requested_by or self.cashier, status='draft',
+        )
+        TransferLine.objects.create(transfer=transfer, product=self.product, requested_qty=qty)
+        Transfer.objects.filter(pk=transfer.pk).update(status='requested')
+        Inventory.objects.filter(pk=self.stock.pk).update(qty_reserved=F('qty_reserved') + qty)
+        return transfer
+
+    def post(self, action, ids):
+        return self.client.post('/api/v1/transfers/bulk_transition/', {'action': action, 'ids': ids}, format='json')
+
+    def test_approve_then_receive_many(self):
+        transfers = [self.make_transfer() for _ in range(6)]
+        ids = [transfer.pk for transfer in transfers]
+
+        response = self.post('approve', ids + [999999])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['succeeded'], response.data['failed']), (6, 1))
+        self.assertEqual(set(Transfer.objects.values_list('status', flat=True)), {'approved'})
+
+        response = self.post('receive', ids)
+
+        self.assertEqual(response.data['succeeded'], 6)
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.qty_on_hand, self.stock.qty_reserved), (70, 0))
+        self.assertEqual(Inventory.objects.get(warehouse=self.store, product=self.product).qty_on_hand, 30)
+        # Receiving again is refused per transfer, not for the whole request
+        response = self.post('receive', ids[:1])
+        self.assertFalse(response.data['results'][0]['success'])
+
+    def test_cancel_releases_reservations_and_checks_permissions(self):
+        own = self.make_transfer(qty=4, requested_by=self.manager)
+        other = self.make_transfer(qty=6)
+
+        response = self.post('cancel', [own.pk, other.pk])
+
+        outcomes = {result['id']: result['success'] for result in response.data['results']}
+        self.assertEqual(outcomes, {own.pk: True, other.pk: False})
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.qty_reserved, 6)
+
+    def test_rejects_unknown_action(self):
+        self.assertEqual(self.post('ship', [1]).status_code, 400)
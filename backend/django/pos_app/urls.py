@@ -22,6 +22,8 @@ router.register(r'ecommerce-sync-logs', views.EcommerceSyncLogViewSet)
 router.register(r'reservations', views.ReservationViewSet, basename='reservation')
 
 urlpatterns = [
+    # POS checkout; listed before the router, whose sales/<pk>/ route would otherwise match it
+    path('sales/create/', views.create_sale, name='create-sale'),
     # Include the router URLs for ViewSets
     path('', include(router.urls)),
     # Authentication
@@ -64,6 +66,8 @@ urlpatterns = [
     # Customer loyalty points
     path('customers/<int:customer_id>/earn-points/', views.earn_loyalty_points, name='earn-loyalty-points'),
     path('customers/<int:customer_id>/redeem-points/', views.redeem_loyalty_points, name='redeem-loyalty-points'),
+    path('customers/<int:customer_id>/adjust-points/', views.adjust_loyalty_points, name='adjust-loyalty-points'),
+    path('customers/<int:customer_id>/loyalty-statement/', views.loyalty_statement, name='loyalty-statement'),
     path('customers/apply-loyalty-discount/', views.apply_loyalty_discount, name='apply-loyalty-discount'),
     
     # Sales
@@ -78,7 +82,8 @@ urlpatterns = [
     path('audit-logs/', views.AuditLogListView.as_view(), name='audit-log-list'),
     
     # POS Sales
-    path('sales/create/', views.create_sale, name='create-sale'),
+    path('offline/sales/', views.ingest_offline_sales, name='ingest-offline-sales'),
+    path('availability/', views.check_availability, name='check-availability'),
     
     # Receipt
     path('sales/<int:pk>/receipt/', views.get_receipt, name='get-receipt'),
@@ -86,7 +91,7 @@ urlpatterns = [
     path('sales/<int:pk>/print-receipt/', views.print_receipt, name='print-receipt'),
     
     # Additional payment to sale (for partial payments)
-    path('sales/<int:pk>/add-payment/', views.add_payment_to_sale, name='add-payment-to-sale'),
+    path('sales/<int:sale_id>/add-payment/', views.add_payment_to_sale, name='add-payment-to-sale'),
     
     # Customer purchase history
     path('customers/<int:pk>/purchase-history/', views.customer_purchase_history, name='customer-purchase-history'),
@@ -101,10 +106,14 @@ urlpatterns = [
     
     # Promotions/Discounts
     path('promotions/', views.PromotionListView.as_view(), name='promotion-list'),
+    path('promotions/evaluate/', views.evaluate_promotions, name='promotion-evaluate'),
     path('promotions/<int:pk>/', views.PromotionDetailView.as_view(), name='promotion-detail'),
     path('coupons/', views.CouponListView.as_view(), name='coupon-list'),
     path('coupons/<int:pk>/', views.CouponDetailView.as_view(), name='coupon-detail'),
     path('coupons/verify/<str:code>/', views.verify_coupon, name='verify-coupon'),
+    path('coupons/redeem/', views.redeem_coupon, name='coupon-redeem'),
+    path('coupons/campaigns/', views.coupon_campaigns, name='coupon-campaigns'),
+    path('coupons/redemptions/<int:pk>/<str:action>/', views.coupon_redemption_action, name='coupon-redemption-action'),
     
     # Returns/Exchanges
     path('returns/', views.ReturnListView.as_view(), name='return-list'),
@@ -6,7 +6,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.contrib.auth import authenticate
 from django.contrib.auth.hashers import make_password
-from django.db import transaction
+from django.db import DatabaseError, transaction
 from django.db.models import F
 from django.http import HttpResponse
 from django.utils import timezone
@@ -19,6 +19,7 @@ from django.contrib.auth import get_user_model
 from django.core.mail import send_mail
 from django.template import loader
 from django.urls import reverse
+from django.core.exceptions import ValidationError
 import tempfile
 import os
 import csv
@@ -48,10 +49,10 @@ except ImportError:
 from .models import (
     User, Category, Product, ProductVariant, Warehouse,Location,Bin,
     Inventory, Customer, Sale, SaleLine, Payment, 
-    Transfer, TransferLine, AuditLog, Return, ReturnLine, Promotion, Coupon,
+    Transfer, TransferLine, AuditLog, Return, ReturnLine, Promotion, Coupon, CouponCampaign, CouponRedemption, LoyaltyTransaction,
     PurchaseOrder, PurchaseOrderLine, GoodsReceivedNote, GoodsReceivedNoteLine, UserProfile,
     Webhook, WebhookLog, PaymentToken, PaymentGatewayConfig,
-    EcommercePlatform, EcommerceSyncLog, Reservation
+    EcommercePlatform, EcommerceSyncLog, Reservation, DemandForecast
 )
 from .serializers import (
     UserSerializer, UserRegistrationSerializer, CategorySerializer, ProductSerializer, ProductVariantSerializer,
@@ -59,7 +60,8 @@ from .serializers import (
     SaleSerializer, SaleLineSerializer, PaymentSerializer, WebhookSerializer,WebhookLogSerializer,PaymentTokenSerializer, PaymentGatewayConfigSerializer,
     TransferSerializer, TransferLineSerializer, AuditLogSerializer, ReturnSerializer, ReturnLineSerializer, EcommercePlatformSerializer, EcommerceSyncLogSerializer,
     PromotionSerializer, CouponSerializer, PurchaseOrderSerializer, PurchaseOrderLineSerializer,
-    GoodsReceivedNoteSerializer, GoodsReceivedNoteLineSerializer, ReservationSerializer
+    GoodsReceivedNoteSerializer, GoodsReceivedNoteLineSerializer, ReservationSerializer, CouponRedemptionSerializer,
+    CouponCampaignSerializer, LoyaltyTransactionSerializer
 )
 from .mfa_views import (
     enable_mfa,
@@ -489,6 +491,87 @@ class LocationListView(generics.ListCreateAPIView):
         return [permission() for permission in permission_classes]
     
 
+def filter_by_balance_due(queryset, params):
+    """
+    Apply the outstanding / min_balance_due query parameters to a Sale queryset.
+    Both resolve against the partial index on Sale.balance_due.
+    """
+    if str(params.get('outstanding', '')).lower() in ('1', 'true', 'yes'):
+        queryset = queryset.filter(balance_due__gt=0)
+    if params.get('min_balance_due'):
+        from decimal import InvalidOperation
+        from rest_framework.exceptions import ValidationError as InvalidParameter
+        try:
+            minimum = Decimal(params['min_balance_due'])
+        except InvalidOperation:
+            raise InvalidParameter({'min_balance_due': 'Must be a number'})
+        queryset = queryset.filter(balance_due__gte=max(minimum, Decimal('0.01')))
+    return queryset
+
+
+def idempotent(view):
+    """
+    Replay the stored response when a mutating request is retried with the same Idempotency-Key.
+
+    Requests without the header run as before. A key reused with a different request body is
+    rejected with 422, and one whose first request is still running with 409. The view runs in a
+    transaction together with storing its response, so a stored response always belongs to work
+    that committed. Responses below 500 are stored; a request that fails with a server error or
+    raises (database errors included) releases its key so it can be retried.
+    """
+    from functools import wraps
+    from rest_framework.renderers import JSONRenderer
+    from .services import IdempotencyStore
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(request, *args, **kwargs)
+        if len(key) > 128:
+            return Response({'error': 'Idempotency-Key must be at most 128 characters'}, status=status.HTTP_400_BAD_REQUEST)
+
+        user_id = request.user.pk
+        fingerprint = IdempotencyStore.fingerprint(request.method, request.path, request.data)
+        stored = IdempotencyStore.lookup(user_id, key)
+        if stored is None or stored[1] is None:
+            # Unused, expired or abandoned mid-request keys can be claimed for this request
+            if IdempotencyStore.claim(user_id, key, fingerprint):
+                stored = None
+            else:
+                stored = IdempotencyStore.lookup(user_id, key) or (fingerprint, None)
+        if stored is not None:
+            if stored[0] != fingerprint:
+                return Response(
+                    {'error': 'Idempotency-Key was already used for a different request'},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            if stored[1] is None:
+                return Response(
+                    {'error': 'A request with this Idempotency-Key is still being processed'},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            replay = HttpResponse(stored[2], status=stored[1], content_type='application/json')
+            replay['Idempotent-Replayed'] = 'true'
+            return replay
+
+        try:
+            with transaction.atomic():
+                response = view(request, *args, **kwargs)
+                if response.status_code < 500:
+                    IdempotencyStore.finish(
+                        user_id, key, fingerprint, response.status_code, JSONRenderer().render(response.data)
+                    )
+        except Exception:
+            IdempotencyStore.abandon(user_id, key)
+            raise
+        if response.status_code >= 500:
+            IdempotencyStore.abandon(user_id, key)
+        return response
+
+    return wrapper
+
+
 
 
 class LocationDetailView(generics.RetrieveUpdateDestroyAPIView):
@@ -599,6 +682,15 @@ class SaleListView(generics.ListCreateAPIView):
         #     permission_classes.append(HasSpecificPermission)
         return [permission() for permission in permission_classes]
     
+    def get_queryset(self):
+        """
+        Optional filters on the stored balance:
+        - outstanding=true: only sales with a balance still due
+        - min_balance_due: only sales owing at least this much
+        """
+        queryset = super().get_queryset()
+        return filter_by_balance_due(queryset, self.request.query_params)
+    
 
 
 class SaleDetailView(generics.RetrieveUpdateDestroyAPIView):
@@ -613,6 +705,7 @@ logger = logging.getLogger(__name__)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def create_sale(request):
     logger.error(f"create_sale request data: {request.data}")
 
@@ -669,7 +762,14 @@ def create_sale(request):
             logger.error("Validated cashier, customer, and warehouse")
 
             # -------------------- Validate Inventory --------------------
+            from .services import StockSummaryService
             inventory_errors = []
+            requested = {}
+            for item_data in items_data:
+                key = (warehouse.pk, item_data['product_id'], item_data.get('variant_id'))
+                requested[key] = requested.get(key, 0) + item_data['quantity']
+            # Warehouse totals across all bins, one indexed lookup for the whole basket
+            available = StockSummaryService.availability(requested)
             for item_data in items_data:
                 try:
                     product = Product.objects.get(id=item_data['product_id'])
@@ -685,12 +785,11 @@ def create_sale(request):
                         inventory_errors.append(f"ProductVariant with id {item_data['variant_id']} not found")
                         continue
 
-                try:
-                    inventory = Inventory.objects.get(product=product, variant=variant, warehouse=warehouse)
-                    if inventory.available_stock() < item_data['quantity']:
-                        inventory_errors.append(f"Insufficient stock for {product.name}. Available: {inventory.available_stock()}, Requested: {item_data['quantity']}")
-                except Inventory.DoesNotExist:
+                key = (warehouse.pk, product.pk, item_data.get('variant_id'))
+                if key not in available:
                     inventory_errors.append(f"Inventory for {product.name} not found in warehouse {warehouse.name}")
+                elif available[key] < requested[key]:
+                    inventory_errors.append(f"Insufficient stock for {product.name}. Available: {available[key]}, Requested: {requested[key]}")
 
             if inventory_errors:
                 return Response({'errors': inventory_errors}, status=status.HTTP_400_BAD_REQUEST)
@@ -698,17 +797,22 @@ def create_sale(request):
             logger.error("Validated inventory")
 
             # -------------------- Generate Receipt Early (FIXED) --------------------
-            receipt_number = f"RCT-{uuid.uuid4().hex[:8].upper()}"
+            from .services import DocumentNumberService
+            receipt_number = DocumentNumberService.next('sale', warehouse.pk)
             logger.error(f"Generated receipt number: {receipt_number}")
 
             # -------------------- Calculate Totals --------------------
-            total_amount = sum(item['quantity'] * item['unit_price'] for item in items_data)
+            # In Decimal cents, so the stored balance_due matches the response and an exact payoff
+            def cents(value):
+                return Decimal(str(value)).quantize(Decimal('0.01'))
+
+            total_amount = cents(sum(item['quantity'] * item['unit_price'] for item in items_data))
             tax_rate = getattr(settings, 'DEFAULT_TAX_RATE', 0.10)
-            tax_amount = total_amount * tax_rate
-            total_amount_with_tax = total_amount + tax_amount - discount_amount
+            tax_amount = cents(total_amount * Decimal(str(tax_rate)))
+            total_amount_with_tax = total_amount + tax_amount - cents(discount_amount)
 
             # -------------------- Determine Payment Status --------------------
-            total_payment = sum(p['amount'] for p in payments_data)
+            total_payment = cents(sum(p['amount'] for p in payments_data))
             if total_payment == 0:
                 payment_status = 'pending'
             elif total_payment >= total_amount_with_tax:
@@ -726,8 +830,9 @@ def create_sale(request):
                 warehouse=warehouse,
                 total_amount=total_amount_with_tax,
                 tax_amount=tax_amount,
-                discount_amount=discount_amount,
+                discount_amount=cents(discount_amount),
                 payment_status=payment_status,
+                amount_paid=total_payment,
                 notes=notes
             )
             logger.error("Created sale object")
@@ -747,9 +852,12 @@ def create_sale(request):
                     discount_percent=item_data.get('discount_percent', 0)
                 )
 
-                inventory = Inventory.objects.get(product=product, variant=variant, warehouse=warehouse)
-                inventory.qty_on_hand -= item_data['quantity']
-                inventory.save()
+            stock_items = [(item['product_id'], item.get('variant_id'), item['quantity']) for item in items_data]
+            if payment_status in ('pending', 'partially_paid'):
+                # Held until the balance is paid, when SalePaymentService finalizes the sale
+                StockSummaryService.reserve(warehouse.pk, stock_items)
+            else:
+                StockSummaryService.deduct(warehouse.pk, stock_items)
 
             logger.error("Created sale lines and updated inventory")
 
@@ -766,26 +874,20 @@ def create_sale(request):
             # -------------------- Customer Loyalty (Optional) --------------------
             if customer:
                 points_earned = customer.calculate_loyalty_points_from_purchase(float(sale.total_amount))
-                original_points = customer.loyalty_points
-                new_points = customer.earn_loyalty_points(points_earned)
-
-                AuditLog.objects.create(
-                    user=request.user,
-                    action='update',
-                    object_type='customer',
-                    object_id=customer.id,
-                    object_repr=f"Loyalty points earned from sale {sale.receipt_number}",
-                    old_values={'loyalty_points': original_points},
-                    new_values={'loyalty_points': new_points},
-                    notes=f"Loyalty points earned: {points_earned} from sale totaling ${sale.total_amount}",
-                    ip_address=request.META.get('REMOTE_ADDR')
-                )
+                if points_earned > 0:
+                    # The ledger entry references the sale, so no separate audit log is needed
+                    customer.earn_loyalty_points(
+                        points_earned, sale=sale, reason=f"Sale {sale.receipt_number}", user=request.user
+                    )
 
             # -------------------- Return Response --------------------
             serializer = SaleSerializer(sale)
             logger.error("Sale creation successful ✅")
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    except DatabaseError:
+        # Locks, deadlocks and lost connections are transient: fail with a 500 so the retry runs again
+        raise
     except Exception as e:
         logger.error(f"Error in create_sale: {e}", exc_info=True)
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -794,6 +896,7 @@ def create_sale(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def process_payment_gateway(request):
     """
     Process a payment through a payment gateway (Stripe/PayPal)
@@ -814,7 +917,7 @@ def process_payment_gateway(request):
     }
     """
     try:
-        from .services import PaymentGatewayService
+        from .services import PaymentGatewayService, SalePaymentService
         
         sale_id = request.data.get('sale_id')
         amount = request.data.get('amount')
@@ -835,6 +938,13 @@ def process_payment_gateway(request):
                 status=status.HTTP_404_NOT_FOUND
             )
         
+        # Don't charge the card for more than the sale still owes
+        if sale.payment_status not in SalePaymentService.OPEN_STATUSES or Decimal(str(amount)) > sale.balance_due:
+            return Response(
+                {'error': f'Payment would exceed total amount. Max additional payment: ${sale.balance_due:.2f}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
         # Process the payment
         customer = sale.customer if sale.customer else None
         result = PaymentGatewayService.process_payment(
@@ -842,18 +952,15 @@ def process_payment_gateway(request):
         )
         
         if result['success']:
-            # Create payment record
-            Payment.objects.create(
-                sale=sale,
-                payment_method=f"{result['gateway']}_card",
-                amount=amount,
+            # Record the payment and update the sale's totals and status in one step
+            SalePaymentService.record(
+                sale,
+                amount,
+                f"{result['gateway']}_card",
                 reference=result['transaction_id'],
                 notes=f"Payment processed via {result['gateway']}"
             )
             
-            # Update sale payment status
-            sale.update_payment_status()
-            
             return Response({
                 'success': True,
                 'transaction_id': result['transaction_id'],
@@ -1066,6 +1173,7 @@ def get_ecommerce_sync_status(request, platform_id):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def add_payment_to_sale(request, sale_id):
     """
     Add an additional payment to an existing sale (for handling partial payments).
@@ -1104,31 +1212,12 @@ def add_payment_to_sale(request, sale_id):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Check if sale is already completed
-        if sale.payment_status == 'completed':
-            return Response(
-                {'error': 'Sale is already completed'}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Calculate if the payment would overpay
-        total_paid = sale.amount_paid() + float(amount)
-        if total_paid > sale.total_amount:
-            return Response(
-                {'error': f'Payment would exceed total amount. Max additional payment: ${sale.total_amount - sale.amount_paid():.2f}'}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Create the payment
-        Payment.objects.create(
-            sale=sale,
-            payment_method=payment_method,
-            amount=amount,
-            reference=request.data.get('reference', ''),
-        )
-        
-        # Update the sale's payment status
-        sale.update_payment_status()
+        # The completed-sale and overpayment checks happen in the same UPDATE that applies the payment
+        from .services import SalePaymentService
+        try:
+            SalePaymentService.record(sale, amount, payment_method, reference=request.data.get('reference', ''))
+        except ValidationError as e:
+            return Response({'error': e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
         
         # Serialize and return the updated sale
         serializer = SaleSerializer(sale)
@@ -1504,9 +1593,25 @@ class TransferDetailView(generics.RetrieveUpdateDestroyAPIView):
                         status=status.HTTP_403_FORBIDDEN
                     )
                 
-                # Process the transfer receipt
+                if instance.status not in ['approved', 'in_transit']:
+                    return Response(
+                        {'error': f'Cannot receive a transfer with status: {instance.status}.'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
+                # Process the transfer receipt; optional per-line quantities allow partial receipts
                 try:
-                    instance.receive_transfer()
+                    received_quantities = {
+                        int(line['id']): int(line['received_qty'])
+                        for line in request.data.get('lines', [])
+                        if 'received_qty' in line
+                    }
+                    instance.receive_transfer(received_quantities)
+                except (KeyError, TypeError, ValueError):
+                    return Response(
+                        {'error': 'lines must be a list of {"id", "received_qty"} objects.'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
                 except ValidationError as e:
                     return Response(
                         {'error': str(e)},
@@ -1611,39 +1716,40 @@ class ReservationViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         logger.info(f"Received reservation data: {self.request.data}")
         # When a reservation is created, update the reserved quantity in the inventory
-        reservation = serializer.save(user=self.request.user)
-        for line in reservation.lines.all():
-            inventory = Inventory.objects.get(product=line.product, variant=line.variant, warehouse=reservation.warehouse)
-            inventory.qty_reserved += line.quantity
-            inventory.save()
+        from rest_framework.exceptions import ValidationError as InvalidReservation
+        from .services import StockSummaryService
+        with transaction.atomic():
+            reservation = serializer.save(user=self.request.user)
+            try:
+                StockSummaryService.reserve(reservation.warehouse_id, self._stock_items(reservation))
+            except ValidationError as e:
+                raise InvalidReservation({'error': e.messages})
+
+    @staticmethod
+    def _stock_items(reservation):
+        return [(line.product_id, line.variant_id, line.quantity) for line in reservation.lines.all()]
 
     def perform_update(self, serializer):
         # When a reservation is updated, adjust the reserved quantity in the inventory
         old_reservation = self.get_object()
         new_reservation = serializer.save()
 
+        from .services import StockSummaryService
+
         # If the status is changed to 'canceled', release the reserved stock
         if old_reservation.status != 'canceled' and new_reservation.status == 'canceled':
-            for line in new_reservation.lines.all():
-                inventory = Inventory.objects.get(product=line.product, variant=line.variant, warehouse=new_reservation.warehouse)
-                inventory.qty_reserved -= line.quantity
-                inventory.save()
+            StockSummaryService.release(new_reservation.warehouse_id, self._stock_items(new_reservation))
 
         # If the status is changed to 'completed', the stock will be handled by the sale creation process
         # so we just need to release the reservation
         if old_reservation.status != 'completed' and new_reservation.status == 'completed':
-            for line in new_reservation.lines.all():
-                inventory = Inventory.objects.get(product=line.product, variant=line.variant, warehouse=new_reservation.warehouse)
-                inventory.qty_reserved -= line.quantity
-                inventory.save()
+            StockSummaryService.release(new_reservation.warehouse_id, self._stock_items(new_reservation))
 
     def perform_destroy(self, instance):
         # When a reservation is deleted, release the reserved stock
         if instance.status == 'active':
-            for line in instance.lines.all():
-                inventory = Inventory.objects.get(product=line.product, variant=line.variant, warehouse=instance.warehouse)
-                inventory.qty_reserved -= line.quantity
-                inventory.save()
+            from .services import StockSummaryService
+            StockSummaryService.release(instance.warehouse_id, self._stock_items(instance))
         instance.delete()
 
 # Return/Exchange Views
@@ -1699,6 +1805,7 @@ def lookup_returns_by_customer(request, customer_id):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def process_return(request, return_id):
     """
     Process a return by restocking items and issuing refund/store credit
@@ -1758,19 +1865,14 @@ def process_return(request, return_id):
         # Process based on action
         if action == 'refund':
             refund_method = request.data.get('refund_method')
-            if not refund_method:
+            if refund_method not in dict(Payment.PAYMENT_METHOD_CHOICES):
                 return Response(
                     {'error': 'Refund method is required (cash, card, etc.)'}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            # Create a payment record for the refund
-            Payment.objects.create(
-                sale=return_obj.original_sale,
-                payment_method=refund_method,
-                amount=-return_obj.refund_amount,  # Negative because it's a refund
-                reference=f"Refund for return {return_obj.return_number}"
-            )
+            # Record the refund against the original sale's payment totals
+            return_obj.issue_refund(refund_method)
             
             # Mark as processed
             return_obj.status = 'processed'
@@ -1927,7 +2029,7 @@ def earn_loyalty_points(request, customer_id):
         
         # Record the points adjustment in audit log
         original_points = customer.loyalty_points
-        new_points = customer.earn_loyalty_points(points)
+        new_points = customer.earn_loyalty_points(points, reason=reason, user=request.user)
         
         # Create audit log for the loyalty point change
         AuditLog.objects.create(
@@ -1978,15 +2080,9 @@ def redeem_loyalty_points(request, customer_id):
         if not points or points <= 0:
             return Response({'error': 'Points must be a positive number'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Check if customer has enough points
-        if points > customer.loyalty_points:
-            return Response({
-                'error': f'Insufficient loyalty points. Customer has {customer.loyalty_points} points, but tried to redeem {points} points.'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Record the points adjustment in audit log
+        # The balance check happens in the same UPDATE that deducts the points
         original_points = customer.loyalty_points
-        new_points = customer.redeem_loyalty_points(points)
+        new_points = customer.redeem_loyalty_points(points, reason=reason, user=request.user)
         
         # Create audit log for the loyalty point change
         AuditLog.objects.create(
@@ -2018,6 +2114,58 @@ def redeem_loyalty_points(request, customer_id):
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def adjust_loyalty_points(request, customer_id):
+    """
+    Correct a customer's loyalty balance by a signed amount, recorded as an adjust entry
+    Expected JSON format:
+    {
+        "points": -20,
+        "reason": "Points credited twice"
+    }
+    """
+    try:
+        customer = Customer.objects.get(id=customer_id)
+        points = request.data.get('points')
+        reason = request.data.get('reason', 'Manual adjustment')
+        
+        if not points:
+            return Response({'error': 'Points must be a non-zero number'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        original_points = customer.loyalty_points
+        new_points = customer.adjust_loyalty_points(points, reason=reason, user=request.user)
+        
+        # Create audit log for the loyalty point change
+        AuditLog.objects.create(
+            user=request.user,
+            action='update',
+            object_type='customer',
+            object_id=customer.id,
+            object_repr=f"Loyalty points adjusted for {customer.first_name} {customer.last_name}",
+            old_values={'loyalty_points': original_points},
+            new_values={'loyalty_points': new_points},
+            notes=f"Manual adjustment: {points} points - {reason}",
+            ip_address=request.META.get('REMOTE_ADDR')
+        )
+        
+        return Response({
+            'message': f'Loyalty points adjusted by {points}',
+            'customer': {
+                'id': customer.id,
+                'name': f"{customer.first_name} {customer.last_name}",
+                'loyalty_points': new_points
+            }
+        })
+        
+    except Customer.DoesNotExist:
+        return Response({'error': 'Customer not found'}, status=status.HTTP_404_NOT_FOUND)
+    except ValidationError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def apply_loyalty_discount(request):
@@ -2065,6 +2213,55 @@ def apply_loyalty_discount(request):
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def loyalty_statement(request, customer_id):
+    """
+    Loyalty points statement for a period, built from the ledger
+    Query params: start, end (ISO dates or datetimes, end exclusive; default the last 30 days)
+    """
+    from datetime import timedelta
+    from django.utils.dateparse import parse_datetime, parse_date
+    from .services import LoyaltyService
+
+    def parse(value):
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(f"Invalid date: {value}")
+            moment = datetime(day.year, day.month, day.day)
+        return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+    try:
+        customer = Customer.objects.get(id=customer_id)
+        end = parse(request.query_params['end']) if request.query_params.get('end') else timezone.now()
+        start = parse(request.query_params['start']) if request.query_params.get('start') else end - timedelta(days=30)
+        if start >= end:
+            return Response({'error': 'start must be before end'}, status=status.HTTP_400_BAD_REQUEST)
+
+        summary = LoyaltyService.period_summary(start, end, customer_ids=[customer.id])
+        totals = summary[0] if summary else {
+            'opening': 0, 'earned': 0, 'redeemed': 0, 'expired': 0, 'adjusted': 0, 'closing': 0
+        }
+        totals.pop('customer_id', None)
+        entries = LoyaltyTransaction.objects.filter(
+            customer=customer, created_at__gte=start, created_at__lt=end
+        ).select_related('sale', 'created_by').order_by('created_at', 'id')
+        return Response({
+            'customer': {'id': customer.id, 'name': f"{customer.first_name} {customer.last_name}"},
+            'start': start,
+            'end': end,
+            **totals,
+            'transactions': LoyaltyTransactionSerializer(entries, many=True).data,
+        })
+
+    except Customer.DoesNotExist:
+        return Response({'error': 'Customer not found'}, status=status.HTTP_404_NOT_FOUND)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
 
 # Report Views
 @api_view(['GET'])
@@ -2114,6 +2311,7 @@ def sales_report(request):
         if product_id:
             # Filter by product ID through sale lines
             sales_query = sales_query.filter(lines__product_id=product_id)
+        sales_query = filter_by_balance_due(sales_query, request.query_params)
         
         # Get sales with related data
         sales = sales_query.prefetch_related('lines__product', 'payments', 'warehouse').order_by('-sale_date')
@@ -2122,10 +2320,12 @@ def sales_report(request):
         report_data = []
         total_sales = 0
         total_revenue = 0
+        total_outstanding = 0
         
         for sale in sales:
             sale_total = float(sale.total_amount)
             total_revenue += sale_total
+            total_outstanding += max(float(sale.balance_due), 0)
             
             sale_data = {
                 'id': sale.id,
@@ -2135,6 +2335,8 @@ def sales_report(request):
                 'warehouse_name': sale.warehouse.name,
                 'warehouse_type': sale.warehouse.warehouse_type,
                 'total_amount': sale_total,
+                'amount_paid': float(sale.amount_paid),
+                'balance_due': float(sale.balance_due),
                 'payment_status': sale.payment_status,
                 'items': []
             }
@@ -2156,6 +2358,7 @@ def sales_report(request):
             'summary': {
                 'total_sales': len(report_data),
                 'total_revenue': total_revenue,
+                'total_outstanding': total_outstanding,
                 'date_range': f"{start_date or 'Start'} to {end_date or 'Now'}"
             }
         })
@@ -2204,6 +2407,17 @@ def inventory_report(request):
         report_data = []
         total_value = 0
         
+        # Forecast days of cover, used to flag slow movers when a forecast exists
+        forecast_cover = {}
+        if include_aging:
+            forecasts = DemandForecast.objects.all()
+            if warehouse_id:
+                forecasts = forecasts.filter(warehouse_id=warehouse_id)
+            forecast_cover = {
+                (w, p, v): cover
+                for w, p, v, cover in forecasts.values_list('warehouse_id', 'product_id', 'variant_id', 'days_of_cover')
+            }
+        
         for item in inventory_query:
             item_value = float(item.qty_on_hand) * float(item.product.price) if item.product.price else 0
             total_value += item_value
@@ -2240,8 +2454,15 @@ def inventory_report(request):
                 else:
                     item_data['age_category'] = 'Old (>90 days)'
                 
-                # Calculate slow-moving items (items with no movement for extended period)
-                item_data['is_slow_moving'] = age_in_days > 90 and item.qty_on_hand > item.min_stock_level
+                # Slow-moving: more than 90 days of forecast cover; without a forecast,
+                # fall back to no movement for an extended period
+                forecast_key = (item.warehouse_id, item.product_id, item.variant_id)
+                if forecast_key in forecast_cover:
+                    cover = forecast_cover[forecast_key]
+                    item_data['days_of_cover'] = cover
+                    item_data['is_slow_moving'] = cover is None or cover > 90
+                else:
+                    item_data['is_slow_moving'] = age_in_days > 90 and item.qty_on_hand > item.min_stock_level
             
             report_data.append(item_data)
         
@@ -2684,6 +2905,10 @@ class SaleViewSet(viewsets.ModelViewSet):
     serializer_class = SaleSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        # Supports ?outstanding=true and ?min_balance_due=N, see filter_by_balance_due
+        return filter_by_balance_due(super().get_queryset(), self.request.query_params)
+
 
 class InventoryViewSet(viewsets.ModelViewSet):
     queryset = Inventory.objects.all()
@@ -2717,6 +2942,132 @@ class InventoryViewSet(viewsets.ModelViewSet):
             'total_low_items': len(low_stock_data)
         })
     
+    @action(detail=False, methods=['get'])
+    def forecast(self, request):
+        """
+        Get demand forecasts with days of cover and suggested min levels
+        Query parameters:
+        - warehouse_id: Filter by warehouse
+        - product_id: Filter by product
+        - max_days_of_cover: Only pairs that run out within this many days
+        - limit: Number of rows to return (default 100, max 1000)
+        Rows are ordered by days of cover, most urgent first
+        """
+        queryset = DemandForecast.objects.all()
+        try:
+            if request.query_params.get('warehouse_id'):
+                queryset = queryset.filter(warehouse_id=int(request.query_params['warehouse_id']))
+            if request.query_params.get('product_id'):
+                queryset = queryset.filter(product_id=int(request.query_params['product_id']))
+            if request.query_params.get('max_days_of_cover'):
+                queryset = queryset.filter(days_of_cover__lte=float(request.query_params['max_days_of_cover']))
+            limit = min(int(request.query_params.get('limit', 100)), 1000)
+        except ValueError:
+            return Response(
+                {'error': 'warehouse_id, product_id, max_days_of_cover and limit must be numbers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        forecasts = list(
+            queryset.order_by(F('days_of_cover').asc(nulls_last=True), 'id').values(
+                'warehouse_id', 'warehouse__name', 'product_id', 'product__sku', 'product__name', 'variant_id',
+                'avg_daily_7', 'avg_daily_28', 'smoothed_daily', 'weekday_factors', 'available_stock',
+                'days_of_cover', 'suggested_min_level', 'computed_through'
+            )[:limit]
+        )
+        return Response({'forecasts': forecasts, 'count': len(forecasts)})
+    
+    @action(detail=False, methods=['get', 'post'])
+    def replenishment(self, request):
+        """
+        Plan replenishment from min stock levels, available stock and recent sales velocity
+        Parameters (query string for GET, body for POST):
+        - warehouse_ids: Comma-separated warehouses to replenish (default: all active)
+        - lookback_days: Sales history window for velocity (default 28)
+        - cover_days: Days of sales the target level should cover (default 14)
+        - allow_transfers: Set to false to purchase every deficit (default true)
+        GET previews the plan; POST also saves it as draft transfers and purchase orders
+        """
+        from .services import ReplenishmentPlanner
+        
+        params = request.query_params if request.method == 'GET' else request.data
+        try:
+            warehouse_ids = params.get('warehouse_ids')
+            if isinstance(warehouse_ids, str):
+                warehouse_ids = [int(value) for value in warehouse_ids.split(',') if value.strip()]
+            elif warehouse_ids:
+                warehouse_ids = [int(value) for value in warehouse_ids]
+            lookback_days = int(params.get('lookback_days', ReplenishmentPlanner.LOOKBACK_DAYS))
+            cover_days = int(params.get('cover_days', ReplenishmentPlanner.COVER_DAYS))
+        except (TypeError, ValueError):
+            return Response(
+                {'error': 'warehouse_ids, lookback_days and cover_days must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if lookback_days <= 0 or cover_days <= 0:
+            return Response({'error': 'lookback_days and cover_days must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+        allow_transfers = str(params.get('allow_transfers', 'true')).lower() not in ['false', '0', 'no']
+        
+        plan = ReplenishmentPlanner.plan(warehouse_ids, lookback_days, cover_days, allow_transfers)
+        if request.method == 'POST':
+            transfers, orders = ReplenishmentPlanner.create_drafts(plan, request.user)
+            plan['created_transfer_ids'] = [transfer.pk for transfer in transfers]
+            plan['created_purchase_order_ids'] = [order.pk for order in orders]
+            return Response(plan, status=status.HTTP_201_CREATED)
+        return Response(plan)
+    
+    @action(detail=False, methods=['get'])
+    def nearest_stock(self, request):
+        """
+        Find the nearest warehouses/stores with available stock of a SKU
+        Query parameters:
+        - sku: Product or variant SKU (required)
+        - lat, lng: Customer coordinates, or
+        - warehouse_id: Use this warehouse/store's coordinates as the origin
+        - limit: Number of locations to return (default 5, max 50)
+        - min_qty: Minimum available quantity (default 1)
+        - max_distance_km: Optional search radius
+        """
+        from .services import FulfillmentPlanner, find_nearest_stock
+        
+        sku = request.query_params.get('sku')
+        if not sku:
+            return Response({'error': 'sku is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        warehouse_id = request.query_params.get('warehouse_id')
+        if warehouse_id:
+            origin_warehouse = Warehouse.objects.filter(pk=warehouse_id).first()
+            origin = FulfillmentPlanner.coerce_location(origin_warehouse) if origin_warehouse else None
+        else:
+            origin = FulfillmentPlanner.coerce_location({
+                'latitude': request.query_params.get('lat'),
+                'longitude': request.query_params.get('lng'),
+            })
+        if origin is None:
+            return Response(
+                {'error': 'Provide lat and lng, or a warehouse_id with coordinates'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            limit = min(int(request.query_params.get('limit', 5)), 50)
+            min_qty = max(int(request.query_params.get('min_qty', 1)), 1)
+            max_distance = request.query_params.get('max_distance_km')
+            max_distance = float(max_distance) if max_distance else None
+        except ValueError:
+            return Response({'error': 'limit, min_qty and max_distance_km must be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        locations = find_nearest_stock(sku, origin[0], origin[1], limit, min_qty, max_distance)
+        if locations is None:
+            return Response({'error': f'No product or variant with SKU {sku}'}, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response({
+            'sku': sku,
+            'origin': {'latitude': origin[0], 'longitude': origin[1]},
+            'locations': locations,
+            'total_locations': len(locations)
+        })
+    
     def get_queryset(self):
         queryset = Inventory.objects.select_related(
             'product', 'product__category', 'warehouse', 'location', 'bin'
@@ -2760,6 +3111,36 @@ class TransferViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(status=status_filter)
         
         return queryset
+    
+    @action(detail=False, methods=['post'])
+    def bulk_transition(self, request):
+        """
+        Apply one status transition to many transfers at once
+        Body:
+        - action: approve, reject, in_transit, receive or cancel
+        - ids: List of transfer ids (at most 500)
+        Returns one outcome per transfer; transfers that cannot be transitioned are skipped
+        """
+        from .services import TransferBulkService
+        
+        ids = request.data.get('ids')
+        if not isinstance(ids, list) or not ids:
+            return Response({'error': 'ids must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = [int(transfer_id) for transfer_id in ids]
+            results = TransferBulkService.transition(request.user, request.data.get('action'), ids)
+        except (TypeError, ValueError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ValidationError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        succeeded = sum(1 for result in results if result['success'])
+        return Response({
+            'action': request.data.get('action'),
+            'results': results,
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded
+        })
 
 
 class ProductVariantViewSet(viewsets.ModelViewSet):
@@ -3296,8 +3677,10 @@ def verify_coupon(request, code):
         from django.utils import timezone
         from django.db.models import Q
         
-        # Find the coupon by code
-        coupon = Coupon.objects.filter(code=code).first()
+        from .services import CouponCodeIndex
+
+        # Find the coupon by code; the in-memory filter turns away unknown codes without a query
+        coupon = Coupon.objects.filter(code=code).first() if CouponCodeIndex.might_exist(code) else None
         
         if not coupon:
             return Response(
@@ -3344,6 +3727,201 @@ def verify_coupon(request, code):
         )
 
 
+MAX_API_CAMPAIGN_SIZE = 100000
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def coupon_campaigns(request):
+    """
+    List coupon campaigns, or create one and generate its codes.
+    Campaigns above MAX_API_CAMPAIGN_SIZE codes go through the generate_coupons command instead.
+    """
+    from .services import CouponCampaignService
+
+    if request.method == 'GET':
+        campaigns = CouponCampaign.objects.order_by('-created_at')
+        return Response(CouponCampaignSerializer(campaigns, many=True).data)
+
+    serializer = CouponCampaignSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    if serializer.validated_data['quantity'] > MAX_API_CAMPAIGN_SIZE:
+        return Response(
+            {'error': f'At most {MAX_API_CAMPAIGN_SIZE} codes per request; use the generate_coupons command for larger campaigns'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    campaign = serializer.save(created_by=request.user)
+    try:
+        CouponCampaignService.generate(campaign)
+    except ValidationError as e:
+        campaign.delete()
+        return Response({'error': e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(CouponCampaignSerializer(campaign).data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def ingest_offline_sales(request):
+    """
+    Store a batch of sales queued by a terminal while it was offline.
+
+    Expects {"sales": [...]}, each sale shaped like a create_sale payload plus "client_uuid" and
+    optionally "terminal_id", "terminal_sequence", "sold_at" and "receipt_number". Replaying the
+    same sales is safe: already stored ones come back as "duplicate" with their sale_id.
+    Responds with one outcome per sale, in request order.
+    """
+    from .services import OfflineSaleIngestService
+
+    sales_data = request.data.get('sales')
+    if not isinstance(sales_data, list) or not sales_data:
+        return Response({'error': 'sales must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        results = OfflineSaleIngestService.ingest(sales_data, user=request.user)
+    except ValidationError as e:
+        return Response({'error': e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+    counts = {outcome: 0 for outcome in ('created', 'duplicate', 'rejected')}
+    for result in results:
+        counts[result['status']] += 1
+    return Response({'results': results, **counts})
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def check_availability(request):
+    """
+    Check stock for many products at once, e.g. a whole cart.
+
+    Expects {"items": [{"sku" | "product_id" [, "variant_id"], "warehouse_id" | "region", "quantity"?}, ...]}
+    where "region" is {"latitude", "longitude", "radius_km"}; a top-level "warehouse_id" or "region"
+    applies to items without their own. Responds with columns aligned to the items (product_id,
+    variant_id, available, in_stock) and "all_in_stock". The response carries an ETag; sending it
+    back in If-None-Match returns 304 while none of the stock involved has changed.
+    """
+    from .services import StockAvailabilityService
+
+    if not isinstance(request.data, dict):
+        return Response({'error': 'Expected a JSON object'}, status=status.HTTP_400_BAD_REQUEST)
+    defaults = {field: request.data[field] for field in ('warehouse_id', 'region') if field in request.data}
+    try:
+        columns, etag = StockAvailabilityService.check(request.data.get('items'), defaults)
+    except ValidationError as e:
+        return Response({'errors': e.messages}, status=status.HTTP_400_BAD_REQUEST)
+
+    if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(columns)
+    response['ETag'] = etag
+    return response
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def redeem_coupon(request):
+    """
+    Claim one use of a coupon.
+
+    Expects {"code", "customer_id"?, "sale_id"?, "commit"?}. Without "commit" the use is only
+    reserved and must be committed or released through coupons/redemptions/<id>/<action>/;
+    abandoned reservations are released by the expire_reservations sweep.
+    """
+    from .services import CouponRedemptionService
+
+    code = request.data.get('code')
+    if not code:
+        return Response({'error': 'code is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    customer = None
+    if request.data.get('customer_id'):
+        customer = Customer.objects.filter(pk=request.data['customer_id']).first()
+        if customer is None:
+            return Response({'error': 'Customer not found'}, status=status.HTTP_404_NOT_FOUND)
+    sale = None
+    if request.data.get('sale_id'):
+        sale = Sale.objects.filter(pk=request.data['sale_id']).first()
+        if sale is None:
+            return Response({'error': 'Sale not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    try:
+        if str(request.data.get('commit', '')).lower() in ('1', 'true', 'yes'):
+            redemption = CouponRedemptionService.redeem(code, customer=customer, sale=sale)
+        else:
+            redemption = CouponRedemptionService.reserve(code, customer=customer, sale=sale)
+    except ValidationError as e:
+        return Response({'error': e.messages[0]}, status=status.HTTP_409_CONFLICT)
+
+    return Response(CouponRedemptionSerializer(redemption).data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def coupon_redemption_action(request, pk, action):
+    """
+    Commit or release a reserved coupon redemption
+    """
+    from .services import CouponRedemptionService
+
+    redemption = CouponRedemption.objects.filter(pk=pk).first()
+    if redemption is None:
+        return Response({'error': 'Redemption not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    if action == 'commit':
+        sale = Sale.objects.filter(pk=request.data['sale_id']).first() if request.data.get('sale_id') else None
+        done = CouponRedemptionService.commit(redemption, sale=sale)
+    elif action == 'release':
+        done = CouponRedemptionService.release(redemption)
+    else:
+        return Response({'error': f'Unknown action {action}'}, status=status.HTTP_400_BAD_REQUEST)
+
+    if not done:
+        return Response(
+            {'error': f'Redemption is {redemption.status}, not reserved'}, status=status.HTTP_409_CONFLICT
+        )
+    redemption.refresh_from_db()
+    return Response(CouponRedemptionSerializer(redemption).data, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def evaluate_promotions(request):
+    """
+    Price a basket against all currently valid promotions.
+
+    Expects {"lines": [{"product_id", "variant_id"?, "quantity", "unit_price"?}, ...]} and
+    optionally "customer_user_id" or "customer_group_ids" for group-restricted promotions.
+    """
+    from decimal import InvalidOperation
+    from .services import PricingEngine
+
+    lines = request.data.get('lines') or []
+    if not isinstance(lines, list) or not lines:
+        return Response({'error': 'lines must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        basket = [
+            {
+                'product': int(line['product_id']),
+                'variant': int(line['variant_id']) if line.get('variant_id') else None,
+                'quantity': int(line.get('quantity', 1)),
+                'unit_price': line.get('unit_price'),
+            }
+            for line in lines
+        ]
+        customer_user = None
+        if request.data.get('customer_user_id'):
+            customer_user = User.objects.filter(pk=request.data['customer_user_id']).first()
+        group_ids = request.data.get('customer_group_ids')
+        result = PricingEngine.price_basket(basket, customer_user=customer_user, group_ids=group_ids)
+    except (KeyError, TypeError, ValueError) as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except InvalidOperation:
+        return Response({'error': 'unit_price must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(result, status=status.HTTP_200_OK)
+
+
 # Token Management Views
 from django.utils import timezone
 from rest_framework_simplejwt.tokens import AccessToken
@@ -3507,9 +4085,11 @@ def bulk_product_operations(request):
     from io import StringIO
     from django.core.files.uploadedfile import SimpleUploadedFile
     from pos_app.models import Category
+    from .services import ProductImportService
     
     action = request.data.get('action', '').lower()  # 'import' or 'export'
     file_format = request.data.get('format', 'csv').lower()  # 'csv' or 'json'
+    dry_run = str(request.data.get('dry_run', '')).lower() in ('true', '1', 'yes')
     
     if action == 'import':
         uploaded_file = request.FILES.get('file')
@@ -3519,6 +4099,20 @@ def bulk_product_operations(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        if dry_run:
+            # Stream the upload through the validator; nothing is written
+            import codecs
+            try:
+                report = ProductImportService.dry_run(
+                    ProductImportService.iter_rows(codecs.iterdecode(uploaded_file, 'utf-8'), file_format)
+                )
+            except (ValueError, KeyError) as e:
+                return Response(
+                    {'error': str(e)},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            return Response(report, status=status.HTTP_200_OK)
+        
         try:
             # Import products based on file format
             if file_format == 'csv':
@@ -3551,7 +4145,7 @@ def bulk_product_operations(request):
                             'cost_price': row.get('cost_price') or None,
                             'min_wholesale_qty': row.get('min_wholesale_qty') or 1,
                             'tags': tags,
-                            'is_active': row.get('is_active', 'true').lower() == 'true'
+                            'is_active': ProductImportService.parse_is_active(row.get('is_active'))
                         }
                     )
                     
@@ -3566,7 +4160,7 @@ def bulk_product_operations(request):
                         product.cost_price = row.get('cost_price') or None
                         product.min_wholesale_qty = row.get('min_wholesale_qty') or 1
                         product.tags = tags
-                        product.is_active = row.get('is_active', 'true').lower() == 'true'
+                        product.is_active = ProductImportService.parse_is_active(row.get('is_active'))
                         product.save()
                 
                 return Response(
@@ -3600,7 +4194,7 @@ def bulk_product_operations(request):
                             'cost_price': item.get('cost_price') or None,
                             'min_wholesale_qty': item.get('min_wholesale_qty') or 1,
                             'tags': item.get('tags', ''),
-                            'is_active': item.get('is_active', True)
+                            'is_active': ProductImportService.parse_is_active(item.get('is_active'))
                         }
                     )
                     
@@ -3615,7 +4209,7 @@ def bulk_product_operations(request):
                         product.cost_price = item.get('cost_price') or None
                         product.min_wholesale_qty = item.get('min_wholesale_qty') or 1
                         product.tags = item.get('tags', '')
-                        product.is_active = item.get('is_active', True)
+                        product.is_active = ProductImportService.parse_is_active(item.get('is_active'))
                         product.save()
                 
                 return Response(
@@ -3635,77 +4229,48 @@ def bulk_product_operations(request):
             )
     
     elif action == 'export':
+        # Stream the catalog straight from a server-side cursor so memory stays flat
+        from django.http import StreamingHttpResponse, FileResponse
+        from .services import ProductExportService
+        
+        if file_format not in ProductExportService.FORMATS:
+            return Response(
+                {'error': f'Unsupported format: {file_format}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        columns = request.data.get('columns')
+        filters = {
+            'category': request.data.get('category'),
+            'sku_prefix': request.data.get('sku_prefix'),
+            'updated_since': request.data.get('updated_since'),
+        }
+        if 'is_active' in request.data:
+            filters['is_active'] = str(request.data.get('is_active')).lower() in ('true', '1', 'yes')
+        compress = str(request.data.get('gzip', '')).lower() in ('true', '1', 'yes')
+        content_type, extension = ProductExportService.FORMATS[file_format]
+        filename = f'products_export.{extension}'
+        
         try:
-            # Get all products
-            products = Product.objects.all()
+            if file_format == 'xlsx':
+                # Write-only workbooks are assembled in a spooled temp file, not in memory
+                spool = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+                ProductExportService.write_xlsx(spool, columns, filters)
+                spool.seek(0)
+                return FileResponse(spool, as_attachment=True, filename=filename, content_type=content_type)
             
-            if file_format == 'csv':
-                # Create CSV response
-                response = HttpResponse(content_type='text/csv')
-                response['Content-Disposition'] = 'attachment; filename="products_export.csv"'
-                
-                fieldnames = [
-                    'name', 'sku', 'barcode', 'description', 'category', 
-                    'price', 'wholesale_price', 'cost_price', 'min_wholesale_qty',
-                    'effective_date', 'tags', 'is_active'
-                ]
-                writer = csv.DictWriter(response, fieldnames=fieldnames)
-                writer.writeheader()
-                
-                for product in products:
-                    writer.writerow({
-                        'name': product.name,
-                        'sku': product.sku,
-                        'barcode': product.barcode or '',
-                        'description': product.description,
-                        'category': product.category.name if product.category else '',
-                        'price': product.price,
-                        'wholesale_price': product.wholesale_price or '',
-                        'cost_price': product.cost_price or '',
-                        'min_wholesale_qty': product.min_wholesale_qty,
-                        'effective_date': product.effective_date,
-                        'tags': product.tags,
-                        'is_active': product.is_active
-                    })
-                
-                return response
-                
-            elif file_format == 'json':
-                # Create JSON response
-                products_data = []
-                for product in products:
-                    products_data.append({
-                        'name': product.name,
-                        'sku': product.sku,
-                        'barcode': product.barcode,
-                        'description': product.description,
-                        'category': product.category.name if product.category else None,
-                        'price': float(product.price),
-                        'wholesale_price': float(product.wholesale_price) if product.wholesale_price else None,
-                        'cost_price': float(product.cost_price) if product.cost_price else None,
-                        'min_wholesale_qty': product.min_wholesale_qty,
-                        'effective_date': product.effective_date.isoformat(),
-                        'image': str(product.image) if product.image else None,
-                        'tags': product.tags,
-                        'is_active': product.is_active,
-                        'created_at': product.created_at.isoformat(),
-                        'updated_at': product.updated_at.isoformat()
-                    })
-                
-                response = HttpResponse(
-                    json.dumps(products_data, indent=2), 
-                    content_type='application/json'
-                )
-                response['Content-Disposition'] = 'attachment; filename="products_export.json"'
-                
-                return response
-            else:
-                return Response(
-                    {'error': f'Unsupported format: {file_format}'}, 
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-                
-        except Exception as e:
+            # Resolve columns up front so bad input is reported before streaming starts
+            ProductExportService.resolve_columns(columns, file_format)
+            response = StreamingHttpResponse(
+                ProductExportService.stream(file_format, columns, filters, compress),
+                content_type='application/gzip' if compress else content_type
+            )
+            if compress:
+                filename += '.gz'
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+            return response
+        
+        except ValueError as e:
             return Response(
                 {'error': str(e)}, 
                 status=status.HTTP_400_BAD_REQUEST
@@ -152,9 +152,9 @@ def test_pos_sales_flow():
     print(f"   Sale payment status after completing payment: {sale.payment_status}")
     
     # Verify total paid matches total amount
-    total_paid = sale.amount_paid()
+    total_paid = sale.amount_paid
     print(f"   Total paid: ${total_paid}, Sale total: ${sale.total_amount}")
-    print(f"   Balance due: ${sale.balance_due()}")
+    print(f"   Balance due: ${sale.balance_due}")
     
     # Test FR-26: Apply discounts (model already supports this)
     print("\n4. Testing Discount Application...")
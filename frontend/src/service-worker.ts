@@ -79,6 +79,7 @@ registerRoute(
 // This allows the web app to trigger skipWaiting via
 // registration.waiting.postMessage({type: 'SKIP_WAITING'})
 let authToken: string | null = null;
+const SYNC_BATCH_SIZE = 500;
 
 self.addEventListener('message', (event) => {
   if (event.data && event.data.type === 'SKIP_WAITING') {
@@ -110,35 +111,44 @@ async function syncTransactions() {
 
   request.onsuccess = async () => {
     const offlineSales = request.result.filter(sale => !sale.synced);
-    for (const sale of offlineSales) {
+    // Send the queue in batches; the server dedupes on client_uuid, so a replay is safe
+    for (let start = 0; start < offlineSales.length; start += SYNC_BATCH_SIZE) {
+      const batch = offlineSales.slice(start, start + SYNC_BATCH_SIZE);
       try {
-        const saleToSend = {
-          cashier_id: sale.cashier_id,
-          customer_id: sale.customer_id,
-          warehouse_id: sale.warehouse_id,
-          items: sale.items,
-          payments: sale.payments,
-        };
-
-        const response = await fetch('/api/v1/sales/create/', {
+        const response = await fetch('/api/v1/offline/sales/', {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json',
             'Authorization': `Bearer ${authToken}`,
           },
-          body: JSON.stringify(saleToSend),
+          body: JSON.stringify({
+            sales: batch.map(sale => ({
+              client_uuid: sale.client_uuid,
+              terminal_id: sale.terminal_id,
+              terminal_sequence: sale.terminal_sequence,
+              sold_at: sale.timestamp,
+              cashier_id: sale.cashier_id,
+              customer_id: sale.customer_id,
+              warehouse_id: sale.warehouse_id,
+              items: sale.items,
+              payments: sale.payments,
+            })),
+          }),
         });
 
         if (response.ok) {
-          const getRequest = store.get(sale.id);
-          getRequest.onsuccess = () => {
-            const saleToUpdate = getRequest.result;
-            saleToUpdate.synced = true;
-            store.put(saleToUpdate);
-          };
+          const { results } = await response.json();
+          const updateStore = db.transaction(['offlineSales'], 'readwrite').objectStore('offlineSales');
+          results.forEach((result: { status: string }, index: number) => {
+            // Rejected sales stay queued for review
+            if (result.status === 'created' || result.status === 'duplicate') {
+              updateStore.put({ ...batch[index], synced: true });
+            }
+          });
         }
       } catch (error) {
-        console.error('Error syncing sale:', error);
+        console.error('Error syncing sales:', error);
+        return;
       }
     }
   };
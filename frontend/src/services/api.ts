@@ -138,6 +138,12 @@ export const inventoryAPI = {
   updateInventory: (id: number, inventoryData: any) => apiClient.put(`/inventory/${id}/`, inventoryData),
   deleteInventory: (id: number) => apiClient.delete(`/inventory/${id}/`),
   getLowStockAlerts: () => apiClient.get('/inventory/low_stock/'),
+  // Whole-cart stock check in one request; pass the previous ETag to get a 304 while nothing moved
+  checkAvailability: (request: any, etag?: string) =>
+    apiClient.post('/availability/', request, {
+      headers: etag ? { 'If-None-Match': etag } : {},
+      validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+    }),
 };
 
 // Category API calls
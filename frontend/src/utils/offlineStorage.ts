@@ -39,6 +39,23 @@ class OfflineStorage {
     };
   }
 
+  // Stable id for this terminal, created on first use
+  private terminalId(): string {
+    let terminalId = localStorage.getItem('posTerminalId');
+    if (!terminalId) {
+      terminalId = `T-${crypto.randomUUID().slice(0, 8).toUpperCase()}`;
+      localStorage.setItem('posTerminalId', terminalId);
+    }
+    return terminalId;
+  }
+
+  // Per-terminal sequence number for queued sales
+  private nextSequence(): number {
+    const sequence = Number(localStorage.getItem('posTerminalSequence') || '0') + 1;
+    localStorage.setItem('posTerminalSequence', String(sequence));
+    return sequence;
+  }
+
   async saveOfflineSale(sale: any): Promise<number> {
     return new Promise((resolve, reject) => {
       if (!this.db) {
@@ -49,9 +66,12 @@ class OfflineStorage {
       const transaction = this.db.transaction(['offlineSales'], 'readwrite');
       const store = transaction.objectStore('offlineSales');
       
-      // Mark as not synced yet
+      // Mark as not synced yet and stamp it so the server can dedupe replays of the queue
       const saleToStore = {
         ...sale,
+        client_uuid: sale.client_uuid ?? crypto.randomUUID(),
+        terminal_id: this.terminalId(),
+        terminal_sequence: this.nextSequence(),
         synced: false,
         timestamp: new Date().toISOString(),
       };